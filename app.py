@@ -1,15 +1,38 @@
+import atexit
 import json
 import os
 import logging
-import requests
+import math
 import openai
-import copy
-import time
 from base64 import b64encode
 from flask import Flask, Response, request, jsonify, send_from_directory
 from dotenv import load_dotenv
+from azure.identity import DefaultAzureCredential
 
 from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.bulk_delete import BulkDeleteSettings, DeletionJobs
+from backend.history.store import create_local_store
+from backend.history.stream_tee import StreamTee, StreamTeeSettings, already_stored
+from backend.history.titles import TitleSettings, TitleWorker, provisional_title
+from backend.history.write_behind import WriteBehindSettings, WriteBehindStore
+from backend.clients.admission import AdmissionController, AdmissionRejected, AdmissionSettings
+from backend.clients.deployments import DeploymentPool, DeploymentPoolSettings
+from backend.clients.hedging import HedgeSettings, Hedger
+from backend.clients.pool import ConnectionPool, PoolSettings
+from backend.clients.retry import (CircuitOpenError, Deadline, RetryPolicy, RetrySettings, UpstreamStatusError, retry_after_seconds,
+                                   status_code_of, status_error)
+from backend.context.budget import ContextBudget, ContextBudgetSettings
+from backend.context.tokens import TokenCounter
+from backend.settings import AppSettings
+from backend.streaming.relay import WithDataStreamRelay, iter_raw_chunks
+from backend.streaming.coalesce import DeltaCoalescer, coalescing_requested
+from backend import metrics
+from backend.serialization import JSONProvider, dumps, ndjson
+from backend.tools.executor import ToolExecutor
+from backend.tools.loop import ToolLoop
+from backend.cache.group_cache import GroupMembershipCache
+from backend.cache.history_cache import CachingConversationStore, HistoryCache, HistoryCacheSettings
+from backend.cache.response_cache import AnswerRecorder, ResponseCache, ResponseCacheSettings, replay_response, replay_stream
 
 from auth import jwt_required
 
@@ -23,6 +46,7 @@ logger.setLevel(logging.ERROR)
 load_dotenv()
 
 app = Flask(__name__, static_folder="static")
+app.json = JSONProvider(app)
 
 # Static Files
 @app.route("/")
@@ -55,6 +79,10 @@ AZURE_SEARCH_CONTENT_COLUMNS = os.environ.get("AZURE_SEARCH_CONTENT_COLUMNS")
 AZURE_SEARCH_FILENAME_COLUMN = os.environ.get("AZURE_SEARCH_FILENAME_COLUMN")
 AZURE_SEARCH_TITLE_COLUMN = os.environ.get("AZURE_SEARCH_TITLE_COLUMN")
 AZURE_SEARCH_URL_COLUMN = os.environ.get("AZURE_SEARCH_URL_COLUMN")
+AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_COLUMN")
+
+# Data source used by Azure OpenAI on your data: AzureCognitiveSearch or AzureCosmosDB (Mongo vCore)
+DATASOURCE_TYPE = os.environ.get("DATASOURCE_TYPE", "AzureCognitiveSearch")
 
 # AOAI Integration Settings
 AZURE_OPENAI_RESOURCE = os.environ.get("AZURE_OPENAI_RESOURCE")
@@ -78,16 +106,79 @@ AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME", "gpt-35-turb
 AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ.get("AZURE_OPENAI_EMBEDDING_ENDPOINT")
 AZURE_OPENAI_EMBEDDING_KEY = os.environ.get("AZURE_OPENAI_EMBEDDING_KEY")
 AZURE_OPENAI_EMBEDDING_NAME = os.environ.get("AZURE_OPENAI_EMBEDDING_NAME", "")
+AZURE_OPENAI_CHAT_API_VERSION = os.environ.get("AZURE_OPENAI_CHAT_API_VERSION", "2023-08-01-preview")
+AZURE_OPENAI_DALLE_API_VERSION = os.environ.get("AZURE_OPENAI_DALLE_API_VERSION", "2023-12-01-preview")
 
 # Bing Integration
 BING_SEARCH_API_KEY = os.environ.get("BING_SEARCH_API_KEY")
+BING_SEARCH_ENDPOINT = os.environ.get("BING_SEARCH_ENDPOINT", "https://api.bing.microsoft.com/v7.0/search")
+
+# Function/tool calling. With AZURE_OPENAI_PARALLEL_TOOL_CALLS the model is offered "tools" and may
+# request several calls at once (needs api-version 2023-12-01-preview), otherwise "functions".
+AZURE_OPENAI_PARALLEL_TOOL_CALLS = os.environ.get("AZURE_OPENAI_PARALLEL_TOOL_CALLS", "false").lower() == "true"
+TOOLS_API_VERSION = "2023-12-01-preview"
+TOOL_TIMEOUT_SECONDS = float(os.environ.get("TOOL_TIMEOUT_SECONDS", 10))
+# Empty answer lines sent while tools run so the response keeps streaming
+TOOL_HEARTBEAT_SECONDS = float(os.environ.get("TOOL_HEARTBEAT_SECONDS", 2))
+# Rounds of tool calls per answer, and the size tool results are trimmed to before resubmission
+MAX_TOOL_ROUNDS = int(os.environ.get("MAX_TOOL_ROUNDS", 3))
+TOOL_OUTPUT_MAX_CHARS = int(os.environ.get("TOOL_OUTPUT_MAX_CHARS", 8000))
+
+# Microsoft Graph group lookups for the per-user security filter, $top keeps the number of pages low
+GRAPH_MEMBER_OF_ENDPOINT = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id&$top=999"
+
+# Streamed output coalescing: combine small deltas into one NDJSON line per STREAM_COALESCE_MAX_BYTES
+# or STREAM_COALESCE_WINDOW_MS. Clients can opt out per request with "X-Stream-Coalesce: off".
+STREAM_COALESCE = os.environ.get("STREAM_COALESCE", "false").lower() == "true"
+STREAM_COALESCE_MAX_BYTES = int(os.environ.get("STREAM_COALESCE_MAX_BYTES", 512))
+STREAM_COALESCE_WINDOW_MS = int(os.environ.get("STREAM_COALESCE_WINDOW_MS", 30))
+
+# Metrics
+ENABLE_METRICS_ENDPOINT = os.environ.get("ENABLE_METRICS_ENDPOINT", "false").lower() == "true"
+
+# Pooled upstream connections shared by every request of the process
+connection_pool = ConnectionPool(PoolSettings.from_env())
+metrics.register("http_pool", connection_pool.snapshot)
+# Retries with backoff and a circuit breaker per upstream, see backend/clients/retry.py
+upstream_retry = RetryPolicy.from_settings(RetrySettings.from_env())
+metrics.register("upstream_retry", upstream_retry.snapshot)
+
+# Opt-in cache of /conversation answers, see backend/cache/response_cache.py
+response_cache_settings = ResponseCacheSettings.from_env()
+response_cache = ResponseCache.from_settings(response_cache_settings)
+if response_cache:
+    metrics.register("response_cache", response_cache.snapshot)
+
+# Chat and image requests are routed over one or more deployments, see backend/clients/deployments.py
+AZURE_OPENAI_BASE_URL = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
+chat_deployments = DeploymentPool.from_settings(DeploymentPoolSettings.from_env(
+    "AZURE_OPENAI_DEPLOYMENTS", AZURE_OPENAI_BASE_URL, AZURE_OPENAI_KEY, AZURE_OPENAI_MODEL or "gpt-4-32k"))
+image_deployments = DeploymentPool.from_settings(DeploymentPoolSettings.from_env(
+    "AZURE_OPENAI_IMAGE_DEPLOYMENTS", AZURE_OPENAI_BASE_URL, AZURE_OPENAI_KEY, "dall-e-3"))
+metrics.register("chat_deployments", chat_deployments.snapshot)
+metrics.register("image_deployments", image_deployments.snapshot)
+
+# Streams slow to their first token are duplicated to a second chat deployment, see backend/clients/hedging.py
+hedge_settings = HedgeSettings.from_env()
+hedger = None
+if hedge_settings.enabled and len(chat_deployments.deployments) > 1:
+    hedger = Hedger.from_settings(hedge_settings)
+    metrics.register("hedging", hedger.snapshot)
+
+def get_openai_client(api_version, deployment=None):
+    if deployment is None:
+        return connection_pool.openai_client(
+            azure_endpoint=f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com",
+            api_key=AZURE_OPENAI_KEY,
+            api_version=api_version)
+    return connection_pool.openai_client(azure_endpoint=deployment.endpoint, api_key=deployment.api_key, api_version=api_version)
 
 # Available Functions
 def search(query):
-    bing_search_url = "https://api.bing.microsoft.com/v7.0/search"
     headers = {"Ocp-Apim-Subscription-Key": BING_SEARCH_API_KEY}
     params = {"q": query, "textDecorations": False }
-    response = requests.get(bing_search_url, headers=headers, params=params)
+    response = upstream_retry.call("bing", lambda: connection_pool.get(BING_SEARCH_ENDPOINT, headers=headers, params=params, timeout=TOOL_TIMEOUT_SECONDS),
+                                   failed=status_error, deadline=Deadline(TOOL_TIMEOUT_SECONDS))
     response.raise_for_status()
     search_results = response.json()
 
@@ -123,8 +214,47 @@ AVAILABLE_FUNCTIONS = {
     "search_bing": search
 }
 
+# Runs the calls requested by the model concurrently, with per-tool timeouts and a result cache
+tool_executor = ToolExecutor.from_env(AVAILABLE_FUNCTIONS)
+metrics.register("tools", tool_executor.snapshot)
+# Prompt token counts, with the tiktoken encoding of the model when tiktoken is installed
+token_counter = TokenCounter(AZURE_OPENAI_MODEL_NAME)
+tool_loop = ToolLoop(tool_executor, max_rounds=MAX_TOOL_ROUNDS, max_output_chars=TOOL_OUTPUT_MAX_CHARS,
+                     heartbeat_seconds=TOOL_HEARTBEAT_SECONDS, count_tokens=token_counter.prompt_tokens)
+metrics.register("tool_loop", tool_loop.stats.snapshot)
+
+def tool_parameters():
+    if AZURE_OPENAI_PARALLEL_TOOL_CALLS:
+        return {"tools": [{"type": "function", "function": function} for function in FUNCTIONS], "tool_choice": "auto"}
+    return {"functions": FUNCTIONS, "function_call": "auto"}
+
 SHOULD_STREAM = True if AZURE_OPENAI_STREAM.lower() == "true" else False
-MAX_RETRIES = 3
+HIGH_DEMAND_MESSAGE = """
+            Thank you for using the enhanced features of IDSGPT 4.0. We are currently experiencing high demand
+            and cannot respond to your request. We appreciate your patience as you use this experimental
+            service. Please resubmit your request at a later time.
+        """
+
+# Parsed settings and the pre-serialized "on your data" request body, built once at startup
+app_settings = AppSettings.from_env(system_message=AZURE_OPENAI_SYSTEM_MESSAGE)
+if DEBUG_LOGGING and app_settings.redacted_body_template:
+    logging.debug(f"REQUEST BODY TEMPLATE: {app_settings.redacted_body_template.render([], '').decode('utf-8')}")
+
+# Older turns of long conversations are dropped, or summarized, to fit the model's context window
+context_budget_settings = ContextBudgetSettings.from_env()
+context_budget = None
+if context_budget_settings.active(token_counter):
+    context_budget = ContextBudget.from_settings(token_counter, context_budget_settings, app_settings.chat.max_tokens)
+    metrics.register("context_budget", context_budget.snapshot)
+# Tokens of the documents retrieved with data, left out of the transcript's budget and counted for admission
+DATA_SOURCE_RESERVED_TOKENS = context_budget.data_source_reserved_tokens if context_budget else context_budget_settings.data_source_reserved_tokens or 0
+
+# Token and request rates per user and per deployment pool, see backend/clients/admission.py
+admission_settings = AdmissionSettings.from_env()
+admission = None
+if admission_settings.enabled:
+    admission = AdmissionController.from_settings(admission_settings, {"chat": chat_deployments.quota(), "image": image_deployments.quota()})
+    metrics.register("admission", admission.snapshot)
 
 # Chat History CosmosDB Integration Settings
 AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
@@ -132,9 +262,20 @@ AZURE_COSMOSDB_ACCOUNT = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
 AZURE_COSMOSDB_CONVERSATIONS_CONTAINER = os.environ.get("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER")
 AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
 
+# Chat History storage backend: cosmos, or sqlite/memory for single-node deployments, tests and benchmarks
+CHAT_HISTORY_BACKEND = os.environ.get("CHAT_HISTORY_BACKEND", "cosmos").lower()
+CHAT_HISTORY_SQLITE_PATH = os.environ.get("CHAT_HISTORY_SQLITE_PATH", "chat_history.db")
+CHAT_HISTORY_CONFIGURED = CHAT_HISTORY_BACKEND != "cosmos" or bool(AZURE_COSMOSDB_ACCOUNT)
+
 # Initialize a CosmosDB client with AAD auth and containers for Chat History
-cosmos_conversation_client = None
-if AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER:
+conversation_store = None
+if CHAT_HISTORY_BACKEND != "cosmos":
+    try:
+        conversation_store = create_local_store(CHAT_HISTORY_BACKEND, CHAT_HISTORY_SQLITE_PATH)
+    except Exception:
+        logging.exception("Exception in chat history initialization")
+        conversation_store = None
+elif AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER:
     try :
         cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
 
@@ -143,7 +284,7 @@ if AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERS
         else:
             credential = AZURE_COSMOSDB_ACCOUNT_KEY
 
-        cosmos_conversation_client = CosmosConversationClient(
+        conversation_store = CosmosConversationClient(
             cosmosdb_endpoint=cosmos_endpoint, 
             credential=credential, 
             database_name=AZURE_COSMOSDB_DATABASE,
@@ -151,7 +292,37 @@ if AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERS
         )
     except Exception as e:
         logging.exception("Exception in CosmosDB initialization", e)
-        cosmos_conversation_client = None
+        conversation_store = None
+
+# Optionally serve repeated history list and read calls from a cache, invalidated by the writes
+history_cache_settings = HistoryCacheSettings.from_env()
+if conversation_store and history_cache_settings.enabled:
+    conversation_store = CachingConversationStore(conversation_store, HistoryCache.from_settings(history_cache_settings))
+    metrics.register("history_cache", conversation_store.cache.snapshot)
+
+# Optionally persist chat messages off the request path, drained when the process exits. Stacked on top
+# of the cache, so the flushes (not the queueing) invalidate what they change
+history_write_behind_settings = WriteBehindSettings.from_env()
+if conversation_store and history_write_behind_settings.enabled:
+    conversation_store = WriteBehindStore.from_settings(conversation_store, history_write_behind_settings)
+    metrics.register("history_write_behind", conversation_store.snapshot)
+    atexit.register(conversation_store.close)
+
+# Bulk history deletion, large deletions run as background jobs of this process
+bulk_delete_settings = BulkDeleteSettings.from_env()
+deletion_jobs = DeletionJobs()
+metrics.register("history_deletions", deletion_jobs.snapshot)
+
+# Titles of new conversations are generated by background workers
+title_worker = TitleWorker.from_settings(TitleSettings.from_env())
+metrics.register("history_titles", title_worker.snapshot)
+
+# Optionally write streamed answers to the history from the server, /history/update then skips them
+stream_tee_settings = StreamTeeSettings.from_env()
+stream_tee = None
+if conversation_store and stream_tee_settings.enabled:
+    stream_tee = StreamTee.from_settings(stream_tee_settings)
+    metrics.register("history_stream_tee", stream_tee.snapshot)
 
 
 def is_chat_model():
@@ -160,46 +331,54 @@ def is_chat_model():
     return False
 
 def should_use_data():
-    if AZURE_SEARCH_SERVICE and AZURE_SEARCH_INDEX and AZURE_SEARCH_KEY:
-        return True
-    return False
+    return app_settings.datasource is not None
 
-def format_as_ndjson(obj: dict) -> str:
-    return json.dumps(obj, ensure_ascii=False) + "\n"
+def new_stream_coalescer(headers):
+    if not coalescing_requested(headers.get("X-Stream-Coalesce"), STREAM_COALESCE):
+        return None
+    return DeltaCoalescer(max_bytes=STREAM_COALESCE_MAX_BYTES, window_seconds=STREAM_COALESCE_WINDOW_MS / 1000)
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
-    
+def format_as_ndjson(obj: dict) -> bytes:
+    return ndjson(obj)
+
+def _parse_openai_error(e):
+    # openai>=1.0 errors carry the service message in `message`, everything else falls back to str()
+    return getattr(e, "message", None) or str(e)
+
+def fetchUserGroupPages(userToken):
+    # Follow @odata.nextLink page by page, raises when Graph does not answer with 200
+    endpoint = GRAPH_MEMBER_OF_ENDPOINT
     headers = {
         'Authorization': "bearer " + userToken
     }
-    try :
-        r = requests.get(endpoint, headers=headers)
+    groups = []
+    while endpoint:
+        r = upstream_retry.call("graph", lambda: connection_pool.get(endpoint, headers=headers), failed=status_error)
         if r.status_code != 200:
             if DEBUG_LOGGING:
                 logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
-        
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r['value'].extend(nextLinkData)
-        
-        return r['value']
+            raise Exception(f"Graph returned {r.status_code} for the group membership lookup")
+        page = r.json()
+        groups.extend(page['value'])
+        endpoint = page.get("@odata.nextLink")
+    return groups
+
+# Group memberships and the security filter built from them are cached per user,
+# see backend/cache/group_cache.py
+group_cache = GroupMembershipCache.from_env(fetchUserGroupPages)
+metrics.register("graph_groups_cache", group_cache.snapshot)
+
+def fetchUserGroups(userToken):
+    if not userToken:
+        return []
+    try:
+        return group_cache.groups(userToken)
     except Exception as e:
         logging.error(f"Exception in fetchUserGroups: {e}")
         return []
 
 
-def generateFilterString(userToken):
-    # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
-
-    # Construct filter string
+def buildGroupFilter(userGroups):
     if not userGroups:
         logging.debug("No user groups found")
 
@@ -207,134 +386,63 @@ def generateFilterString(userToken):
     return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
 
 
+def generateFilterString(userToken):
+    if not userToken:
+        return buildGroupFilter([])
+    try:
+        return group_cache.filter_string(userToken, buildGroupFilter)
+    except Exception as e:
+        # Same as a user without groups: the filter matches no document, nothing is cached
+        logging.error(f"Exception in fetchUserGroups: {e}")
+        return buildGroupFilter([])
 
-def prepare_body_headers_with_data(request):
-    request_messages = request.json["messages"]
 
-    body = {
-        "messages": request_messages,
-        "temperature": float(AZURE_OPENAI_TEMPERATURE),
-        "max_tokens": int(AZURE_OPENAI_MAX_TOKENS),
-        "top_p": float(AZURE_OPENAI_TOP_P),
-        "stop": AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
-        "stream": SHOULD_STREAM,
-        "dataSources": []
-    }
+def search_filter(user_token):
+    # Per-user security filter, only when the index has a permitted groups column
+    if app_settings.datasource and app_settings.datasource.permitted_groups_column:
+        return generateFilterString(user_token)
+    return None
 
-    if DATASOURCE_TYPE == "AzureCosmosDB":
-        # Set query type
-        query_type = "vector"
-
-        body["dataSources"].append(
-            {
-                "type": "AzureCosmosDB",
-                "parameters": {
-                    "connectionString": AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING,
-                    "indexName": AZURE_COSMOSDB_MONGO_VCORE_INDEX,
-                    "databaseName": AZURE_COSMOSDB_MONGO_VCORE_DATABASE,
-                    "containerName": AZURE_COSMOSDB_MONGO_VCORE_CONTAINER,                    
-                    "fieldsMapping": {
-                        "contentFields": AZURE_COSMOSDB_MONGO_VCORE_CONTENT_COLUMNS.split("|") if AZURE_COSMOSDB_MONGO_VCORE_CONTENT_COLUMNS else [],
-                        "titleField": AZURE_COSMOSDB_MONGO_VCORE_TITLE_COLUMN if AZURE_COSMOSDB_MONGO_VCORE_TITLE_COLUMN else None,
-                        "urlField": AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN if AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN else None,
-                        "filepathField": AZURE_COSMOSDB_MONGO_VCORE_FILENAME_COLUMN if AZURE_COSMOSDB_MONGO_VCORE_FILENAME_COLUMN else None,
-                        "vectorFields": AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS.split("|") if AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS else []
-                    },
-                    "inScope": True if AZURE_COSMOSDB_MONGO_VCORE_ENABLE_IN_DOMAIN.lower() == "true" else False,
-                    "topNDocuments": AZURE_COSMOSDB_MONGO_VCORE_TOP_K,
-                    "strictness": int(AZURE_COSMOSDB_MONGO_VCORE_STRICTNESS),
-                    "queryType": query_type,
-                    "roleInformation": AZURE_OPENAI_SYSTEM_MESSAGE
-                }
-            }
-        )
-    else:
+
+def prepare_body_headers_with_data(request_body, filter=None):
+    # Everything but the messages (and the per-user security filter) was serialized at startup,
+    # see backend/settings.py
+    if not app_settings.body_template:
         raise Exception(f"DATASOURCE_TYPE is not configured or unknown: {DATASOURCE_TYPE}")
 
-    if "vector" in query_type.lower():
-        if AZURE_OPENAI_EMBEDDING_NAME:
-            body["dataSources"][0]["parameters"]["embeddingDeploymentName"] = AZURE_OPENAI_EMBEDDING_NAME
-        else:
-            body["dataSources"][0]["parameters"]["embeddingEndpoint"] = AZURE_OPENAI_EMBEDDING_ENDPOINT
-            body["dataSources"][0]["parameters"]["embeddingKey"] = AZURE_OPENAI_EMBEDDING_KEY
+    request_messages = request_body["messages"]
+    body = app_settings.body_template.render(request_messages, filter)
 
     if DEBUG_LOGGING:
-        body_clean = copy.deepcopy(body)
-        if body_clean["dataSources"][0]["parameters"].get("key"):
-            body_clean["dataSources"][0]["parameters"]["key"] = "*****"
-        if body_clean["dataSources"][0]["parameters"].get("connectionString"):
-            body_clean["dataSources"][0]["parameters"]["connectionString"] = "*****"
-        if body_clean["dataSources"][0]["parameters"].get("embeddingKey"):
-            body_clean["dataSources"][0]["parameters"]["embeddingKey"] = "*****"
-            
-        logging.debug(f"REQUEST BODY: {json.dumps(body_clean, indent=4)}")
+        logging.debug(f"REQUEST BODY: {app_settings.redacted_body_template.render(request_messages, filter).decode('utf-8')}")
 
-    headers = {
-        'Content-Type': 'application/json',
-        'api-key': AZURE_OPENAI_KEY,
-        "x-ms-useragent": "GitHubSampleWebApp/PublicAPI/3.0.0"
-    }
+    return body, app_settings.headers
 
-    return body, headers
 
-
-def stream_with_data(body, headers, endpoint, history_metadata={}):
-    s = requests.Session()
+def stream_with_data(r, lease, history_metadata={}, coalescer=None, transcript=None, chunks=None):
     try:
-        with s.post(endpoint, json=body, headers=headers, stream=True) as r:
-            for line in r.iter_lines(chunk_size=10):
-                response = {
-                    "id": "",
-                    "model": "",
-                    "created": 0,
-                    "object": "",
-                    "choices": [{
-                        "messages": []
-                    }],
-                    "apim-request-id": "",
-                    'history_metadata': history_metadata
-                }
-                if line:
-                    if AZURE_OPENAI_PREVIEW_API_VERSION == '2023-06-01-preview':
-                        lineJson = json.loads(line.lstrip(b'data:').decode('utf-8'))
-                    else:
-                        try:
-                            rawResponse = json.loads(line.lstrip(b'data:').decode('utf-8'))
-                            lineJson = formatApiResponseStreaming(rawResponse)
-                        except json.decoder.JSONDecodeError:
-                            continue
-
-                    if 'error' in lineJson:
-                        yield format_as_ndjson(lineJson)
-                    response["id"] = lineJson["id"]
-                    response["model"] = lineJson["model"]
-                    response["created"] = lineJson["created"]
-                    response["object"] = lineJson["object"]
-                    response["apim-request-id"] = r.headers.get('apim-request-id')
-
-                    role = lineJson["choices"][0]["messages"][0]["delta"].get("role")
-
-                    if role == "tool":
-                        response["choices"][0]["messages"].append(lineJson["choices"][0]["messages"][0]["delta"])
-                        yield format_as_ndjson(response)
-                    elif role == "assistant": 
-                        if response['apim-request-id'] and DEBUG_LOGGING: 
-                            logging.debug(f"RESPONSE apim-request-id: {response['apim-request-id']}")
-                        response["choices"][0]["messages"].append({
-                            "role": "assistant",
-                            "content": ""
-                        })
-                        yield format_as_ndjson(response)
-                    else:
-                        deltaText = lineJson["choices"][0]["messages"][0]["delta"]["content"]
-                        if deltaText != "[DONE]":
-                            response["choices"][0]["messages"].append({
-                                "role": "assistant",
-                                "content": deltaText
-                            })
-                            yield format_as_ndjson(response)
+        with r:
+            relay = WithDataStreamRelay(
+                history_metadata=history_metadata,
+                apim_request_id=r.headers.get('apim-request-id'),
+                legacy_format=AZURE_OPENAI_PREVIEW_API_VERSION == '2023-06-01-preview',
+                debug_logging=DEBUG_LOGGING,
+                coalescer=coalescer,
+                transcript=transcript)
+            for chunk in chunks or iter_raw_chunks(r):
+                events = relay.feed(chunk)
+                if events:
+                    yield b"".join(events)
+            events = relay.close()
+            if events:
+                yield b"".join(events)
     except Exception as e:
-        yield format_as_ndjson({"error" + str(e)})
+        lease.release(e)
+        if transcript:
+            transcript.fail()
+        yield format_as_ndjson({"error": str(e)})
+    finally:
+        lease.release()
 
 def formatApiResponseNoStreaming(rawResponse):
     if 'error' in rawResponse:
@@ -361,173 +469,252 @@ def formatApiResponseNoStreaming(rawResponse):
 
     return response
 
-def formatApiResponseStreaming(rawResponse):
-    if 'error' in rawResponse:
-        return {"error": rawResponse["error"]}
-    response = {
-        "id": rawResponse["id"],
-        "model": rawResponse["model"],
-        "created": rawResponse["created"],
-        "object": rawResponse["object"],
-        "choices": [{
-            "messages": []
-        }],
-    }
+def with_data_endpoint(deployment):
+    return f"{deployment.endpoint}/openai/deployments/{deployment.deployment}/extensions/chat/completions?api-version={AZURE_OPENAI_PREVIEW_API_VERSION}"
 
-    if rawResponse["choices"][0]["delta"].get("context"):
-        messageObj = {
-            "delta": {
-                "role": "tool",
-                "content": rawResponse["choices"][0]["delta"]["context"]["messages"][0]["content"]
-            }
-        }
-        response["choices"][0]["messages"].append(messageObj)
-    elif rawResponse["choices"][0]["delta"].get("role"):
-        messageObj = {
-            "delta": {
-                "role": "assistant",
-            }
-        }
-        response["choices"][0]["messages"].append(messageObj)
-    else:
-        if rawResponse["choices"][0]["end_turn"]:
-            messageObj = {
-                "delta": {
-                    "content": "[DONE]",
-                }
-            }
-            response["choices"][0]["messages"].append(messageObj)
-        else:
-            messageObj = {
-                "delta": {
-                    "content": rawResponse["choices"][0]["delta"]["content"],
-                }
-            }
-            response["choices"][0]["messages"].append(messageObj)
+def with_data_headers(headers, deployment):
+    return {**headers, "api-key": deployment.api_key}
 
-    return response
+def request_tokens(messages):
+    """Estimated prompt and completion tokens of a chat request, to admit and route it by."""
+    prompt_tokens = token_counter.prompt_tokens(messages)
+    if context_budget:
+        # longer transcripts are cut to the budget before they are sent
+        prompt_tokens = min(prompt_tokens, context_budget.max_prompt_tokens)
+    return prompt_tokens + app_settings.chat.max_tokens
 
 def conversation_with_data(request_body, model, api_version):
-    body, headers = prepare_body_headers_with_data(request)
-    base_url = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-    endpoint = f"{base_url}openai/deployments/{AZURE_OPENAI_MODEL}/extensions/chat/completions?api-version={AZURE_OPENAI_PREVIEW_API_VERSION}"
+    filter = search_filter(request.headers.get('X-MS-TOKEN-AAD-ACCESS-TOKEN'))
     history_metadata = request_body.get("history_metadata", {})
 
+    cache_key = response_cache_key(request_body, with_data_cache_scope(model, api_version, filter), request.headers)
+    if cache_key:
+        cached, embedding = lookup_response_cache(cache_key, api_version)
+        if cached:
+            return cached_response(cached, history_metadata)
+
+    # The data source adds the retrieved documents and its own system message, and gets no summary
+    request_body = dict(request_body, messages=fit_context_window(
+        request_body["messages"], history_metadata, DATA_SOURCE_RESERVED_TOKENS, summarize=False))
+    body, headers = prepare_body_headers_with_data(request_body, filter)
+    tokens = request_tokens(request_body["messages"]) + DATA_SOURCE_RESERVED_TOKENS
+
+    def post(deployment):
+        return connection_pool.post(with_data_endpoint(deployment), headers=with_data_headers(headers, deployment), data=body, stream=SHOULD_STREAM)
+
+    def start(exclude=(), picked=None):
+        r, lease = chat_deployments.start(post, tokens, failed=status_error, exclude=exclude, picked=picked)
+        error = status_error(r)
+        if error:
+            # every deployment failed, the retry policy decides what next
+            r.close()
+            raise error
+        return r, lease
+
     if not SHOULD_STREAM:
-        r = requests.post(endpoint, headers=headers, json=body)
+        r = upstream_retry.call("openai:chat", lambda: chat_deployments.call(post, tokens, failed=status_error), failed=status_error)
         status_code = r.status_code
         r = r.json()
         if AZURE_OPENAI_PREVIEW_API_VERSION == "2023-06-01-preview":
             r['history_metadata'] = history_metadata
-            return Response(format_as_ndjson(r), status=status_code)
+            response_body = format_as_ndjson(r)
         else:
             result = formatApiResponseNoStreaming(r)
             result['history_metadata'] = history_metadata
-            return Response(format_as_ndjson(result), status=status_code)
+            response_body = format_as_ndjson(result)
+        if cache_key and status_code == 200:
+            store_response_cache(cache_key, embedding, [response_body])
+        return Response(response_body, status=status_code)
 
     else:
-        return Response(stream_with_data(body, headers, endpoint, history_metadata), mimetype='text/event-stream')
-
-def run_function(messages, func_call, api_version, model):
-    function_name = func_call["name"]
-    arguments = func_call["arguments"]
-
-    # Verify that the function exists and call it.
-    if function_name not in AVAILABLE_FUNCTIONS:
-        logging.error("Function " + function_name + " does not exist")
-        return
-    
-    function_to_call = AVAILABLE_FUNCTIONS[function_name]  
-    function_response = function_to_call(arguments)
-    
-    # Add the function response to messages for consideration.
-    messages.append(
-        {
-            "role": "function",
-            "name": function_name,
-            "content": function_response,
-        }
-    ) 
+        chunks = None
+        if hedger:
+            # the hedge is a single try on another deployment, the primary is retried as usual
+            r, lease, chunks = hedger.start(lambda picked: upstream_retry.call("openai:chat", lambda: start(picked=picked)),
+                                            lambda exclude: start(exclude=exclude), iter_raw_chunks)
+        else:
+            r, lease = upstream_retry.call("openai:chat", start)
+        coalescer = new_stream_coalescer(request.headers)
+        transcript = new_stream_transcript(history_metadata)
+        stream = stream_with_data(r, lease, history_metadata, coalescer, transcript, chunks)
+        if cache_key:
+            stream = record_response_cache(stream, cache_key, embedding)
+        if transcript:
+            stream = persist_stream(stream, transcript, request.headers.get('x-auth-request-email'), history_metadata['conversation_id'])
+        return Response(stream, mimetype='text/event-stream')
+
+def with_data_cache_scope(model, api_version, filter):
+    # Everything in the request body but the messages, including the per-user filter
+    return dumps([model, api_version]) + app_settings.redacted_body_template.render([], filter)
+
+def without_data_cache_scope(model, api_version):
+    chat = app_settings.chat
+    return [model, api_version, chat.temperature, chat.max_tokens, chat.top_p, chat.stop, chat.system_message, FUNCTIONS]
+
+def response_cache_key(request_body, scope, headers):
+    # "Cache-Control: no-cache" skips the lookup and the store for one request
+    if response_cache is None or "no-cache" in headers.get("Cache-Control", ""):
+        return None
+    return response_cache.key(scope, request_body["messages"])
+
+def embed_for_response_cache(text, api_version):
+    response = upstream_retry.call("openai:embeddings", lambda: get_openai_client(api_version).embeddings.create(
+        model=response_cache_settings.embedding_deployment, input=text))
+    return response.data[0].embedding
+
+def lookup_response_cache(cache_key, api_version):
+    """The cached answer for cache_key, None on a miss, and the embedding computed for the lookup."""
+    cached = response_cache.get(cache_key)
+    embedding = None
+    if cached is None and response_cache.similarity_enabled:
+        try:
+            embedding = embed_for_response_cache(cache_key.text, api_version)
+        except Exception:
+            logging.exception("Embedding for the response cache failed")
+        else:
+            cached = response_cache.get_similar(cache_key, embedding)
+    return cached, embedding
+
+def cached_response(cached, history_metadata):
+    if SHOULD_STREAM:
+        stream = [replay_stream(cached, history_metadata)]
+        transcript = new_stream_transcript(history_metadata)
+        if transcript:
+            transcript.add_messages(cached["messages"])
+            stream = persist_stream(stream, transcript, request.headers.get('x-auth-request-email'), history_metadata['conversation_id'])
+        return Response(stream, mimetype='text/event-stream')
+    return jsonify(replay_response(cached, history_metadata)), 200
+
+def store_response_cache(cache_key, embedding, chunks):
+    recorder = AnswerRecorder()
+    for chunk in chunks:
+        recorder.feed(chunk)
+    answer = recorder.answer()
+    if answer:
+        response_cache.put(cache_key, answer, embedding)
+
+def record_response_cache(stream, cache_key, embedding):
+    # Only a stream that ran to completion is cached, a client disconnect closes the generator first
+    chunks = []
+    for chunk in stream:
+        chunks.append(chunk)
+        yield chunk
+    store_response_cache(cache_key, embedding, chunks)
+
+def new_stream_transcript(history_metadata):
+    # Only /history/generate has a conversation to write the answer to
+    if stream_tee and history_metadata.get('conversation_id'):
+        return stream_tee.transcript()
+    return None
+
+def persist_stream(stream, transcript, user_id, conversation_id):
+    # Writes before the generator returns, so before the response ends and the frontend posts /history/update
+    def write(messages):
+        conversation_store.create_messages(conversation_id=conversation_id, user_id=user_id, input_messages=messages)
 
-    # Make a new call to the API with the data from the function.
-    client = openai.AzureOpenAI(
-        api_key=AZURE_OPENAI_KEY,
-        azure_endpoint=f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com",
-        api_version=api_version)
-    
-    response = client.chat.completions.create(
-        model=model,
+    try:
+        for chunk in stream:
+            yield chunk
+    except GeneratorExit:
+        # The client went away: read the rest of the answer without sending it, and write it anyway
+        try:
+            for chunk in stream:
+                pass
+        except Exception:
+            transcript.fail()
+        stream_tee.persist(transcript, write, conversation_id)
+        raise
+    stream_tee.persist(transcript, write, conversation_id)
+
+def fit_context_window(messages, history_metadata, reserved_tokens=0, summarize=None):
+    """The messages with older turns dropped, or summarized, to fit the prompt budget."""
+    if not context_budget or context_budget.fits(messages, reserved_tokens):
+        return messages
+    # Summaries are kept on the conversation, without one (/conversation) the turns are just dropped
+    user_id = request.headers.get('x-auth-request-email')
+    conversation_id = history_metadata.get('conversation_id')
+    summarize = (context_budget.summarize if summarize is None else summarize) and bool(conversation_store and conversation_id)
+    stored_summary = None
+    if summarize:
+        conversation = conversation_store.get_conversation(user_id, conversation_id)
+        stored_summary = conversation.get('summary') if conversation else None
+
+    plan = context_budget.plan(messages, reserved_tokens, stored_summary, summarize)
+    if not plan.summary_needed:
+        return plan.messages()
+    try:
+        summary = plan.summary_record(summarize_turns(plan.summary_prompt()))
+    except Exception:
+        logging.exception("Summarizing older turns failed, they are left out")
+        return plan.messages()
+    try:
+        conversation_store.set_summary(user_id, conversation_id, summary)
+    except Exception:
+        logging.exception("Storing the conversation summary failed")
+    return plan.messages(summary)
+
+def summarize_turns(messages):
+    completion = upstream_retry.call("openai:chat", lambda: chat_deployments.call(
+        lambda deployment: get_openai_client(AZURE_OPENAI_PREVIEW_API_VERSION, deployment).chat.completions.create(
+            model=deployment.deployment,
+            messages=messages,
+            temperature=0,
+            max_tokens=context_budget.summary_max_tokens
+        ), token_counter.prompt_tokens(messages) + context_budget.summary_max_tokens))
+    return completion.choices[0].message.content
+
+def complete_with_tool_results(messages, api_version, deployment, with_tools=False):
+    # Make a new call to the API with the results of the tools, on the same pooled client and deployment.
+    response = upstream_retry.call(f"openai:{deployment.name}", lambda: get_openai_client(api_version, deployment).chat.completions.create(
+        model=deployment.deployment,
         messages = messages,
         timeout = 60,
         temperature = 0,
-        stream=True
-    )
+        stream=True,
+        **(tool_parameters() if with_tools else {})
+    ))
 
     return response
 
-def stream_without_data(response, messages, api_version, model, history_metadata={}):
-    response_text = ""
-    function_call_detected = False
-    func_call = {"name": "", "arguments": ""}
+def format_stream_without_data_chunk(response_chunk, response_text, history_metadata={}):
+    response_obj = {
+        "id": response_chunk.id,
+        "model": response_chunk.model,
+        "created": response_chunk.created,
+        "object": response_chunk.object,
+        "choices": [{
+            "messages": [{
+                "role": "assistant",
+                "content": response_text
+            }]
+        }],
+        "history_metadata": history_metadata
+    }
+    return ndjson(response_obj)
 
-    for response_chunk in response:
-        # Retrieve the "choices" attribute from response_chunk and skip iteration if empty or not present.
-        if not (choices := getattr(response_chunk, "choices")): continue
+def stream_without_data(response, messages, api_version, deployment, history_metadata={}, coalescer=None, transcript=None):
+    response_chunk = None
 
-        deltas = response_chunk.choices[0].delta or None
+    def next_round(messages, with_tools):
+        return complete_with_tool_results(messages, api_version, deployment, with_tools)
 
-        # If the a function call has been requested, set the func_call values to be called later.
-        if getattr(deltas, "function_call", None) is not None:
-            function_call_detected = True
-            func_call["name"] = deltas.function_call.name or func_call["name"]
-            func_call["arguments"] += deltas.function_call.arguments or ""
-        
-        # Call the requested function if the call has finished.
-        if function_call_detected and choices[0].finish_reason == "function_call":
-            # Run the requested function and parse the new response.
-            function_response_generator = run_function(messages, func_call, api_version, model)
-            for function_response_chunk in function_response_generator:
-                function_deltas = getattr(function_response_chunk.choices[0], "delta", None) if function_response_chunk.choices else None
-                response_text = getattr(function_deltas, "content", "") or ""
-                response_obj = {
-                    "id": response_chunk.id,
-                    "model": response_chunk.model,
-                    "created": response_chunk.created,
-                    "object": response_chunk.object,
-                    "choices": [{
-                        "messages": [{
-                            "role": "assistant",
-                            "content": response_text
-                        }]
-                    }],
-                    "history_metadata": history_metadata
-                }
-                yield json.dumps(response_obj).replace("\n", "\\n") + "\n"
-        # Otherwise just append the content from the current response.
-        elif hasattr(deltas, "content") and not function_call_detected:
-            response_text = deltas.content or ""
-            response_obj = {
-                "id": response_chunk.id,
-                "model": response_chunk.model,
-                "created": response_chunk.created,
-                "object": response_chunk.object,
-                "choices": [{
-                    "messages": [{
-                        "role": "assistant",
-                        "content": response_text
-                    }]
-                }],
-                "history_metadata": history_metadata
-            }
-            yield json.dumps(response_obj).replace("\n", "\\n") + "\n"
+    # Answer text of every round, tool calls are run by the loop in between.
+    for response_chunk, response_text in tool_loop.run(response, messages, next_round):
+        # Heartbeat while tools run
+        if response_text is None:
+            yield format_stream_without_data_chunk(response_chunk, "", history_metadata)
+            continue
+        if transcript:
+            transcript.add_content(response_text)
+        if coalescer and (response_text := coalescer.add(response_text)) is None:
+            continue
+        yield format_stream_without_data_chunk(response_chunk, response_text, history_metadata)
 
-def conversation_without_data(request_body, model, api_version):
-    openai.api_type = "azure"
-    openai.api_base = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-    openai.api_version = "2023-08-01-preview"
-    openai.api_key = AZURE_OPENAI_KEY
+    # Release whatever the coalescer still holds
+    if coalescer and (response_text := coalescer.flush()):
+        yield format_stream_without_data_chunk(response_chunk, response_text, history_metadata)
 
-    request_messages = request_body["messages"]
+def prepare_messages_without_data(request_body):
     messages = [
         {
             "role": "system",
@@ -535,34 +722,52 @@ def conversation_without_data(request_body, model, api_version):
         }
     ]
 
-    for message in request_messages:
+    for message in request_body["messages"]:
         if message:
             messages.append({
                 "role": message["role"] ,
                 "content": message["content"]
             })
 
-    client = openai.AzureOpenAI(
-        api_key=AZURE_OPENAI_KEY,
-        azure_endpoint=f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com",
-        api_version=api_version)
-
-    response = client.chat.completions.create(
-        model=model,
-        messages = messages,
-        temperature=float(AZURE_OPENAI_TEMPERATURE),
-        max_tokens=int(AZURE_OPENAI_MAX_TOKENS),
-        top_p=float(AZURE_OPENAI_TOP_P),
-        stop=AZURE_OPENAI_STOP_SEQUENCE.split("|") if AZURE_OPENAI_STOP_SEQUENCE else None,
-        stream=SHOULD_STREAM,
-        timeout=60,
-        function_call="auto",
-        functions=FUNCTIONS
-    )
+    return messages
 
+def conversation_without_data(request_body, model, api_version):
+    if AZURE_OPENAI_PARALLEL_TOOL_CALLS:
+        api_version = TOOLS_API_VERSION
     history_metadata = request_body.get("history_metadata", {})
 
+    cache_key = response_cache_key(request_body, without_data_cache_scope(model, api_version), request.headers)
+    if cache_key:
+        cached, embedding = lookup_response_cache(cache_key, api_version)
+        if cached:
+            return cached_response(cached, history_metadata)
+
+    messages = fit_context_window(prepare_messages_without_data(request_body), history_metadata)
+
+    def create(deployment):
+        return get_openai_client(api_version, deployment).chat.completions.create(
+            model=deployment.deployment,
+            messages = messages,
+            temperature=app_settings.chat.temperature,
+            max_tokens=app_settings.chat.max_tokens,
+            top_p=app_settings.chat.top_p,
+            stop=list(app_settings.chat.stop) if app_settings.chat.stop else None,
+            stream=SHOULD_STREAM,
+            timeout=60,
+            **tool_parameters()
+        )
+
+    tokens = request_tokens(messages)
+    if SHOULD_STREAM and hedger:
+        # the response is then the stream of chunks, its first one read while racing the hedge
+        _, lease, response = hedger.start(
+            lambda picked: upstream_retry.call("openai:chat", lambda: chat_deployments.start(create, tokens, picked=picked)),
+            lambda exclude: chat_deployments.start(create, tokens, exclude=exclude), iter)
+    else:
+        response, lease = upstream_retry.call("openai:chat", lambda: chat_deployments.start(create, tokens))
+
     if not SHOULD_STREAM:
+        lease.release()
         response_obj = {
             "id": response.id,
             "model": response.model,
@@ -577,14 +782,34 @@ def conversation_without_data(request_body, model, api_version):
             "history_metadata": history_metadata
         }
 
+        if cache_key:
+            store_response_cache(cache_key, embedding, [dumps(response_obj)])
         return jsonify(response_obj), 200
     else:
-        return Response(stream_without_data(response, messages, api_version, model, history_metadata), mimetype='text/event-stream')
-
+        coalescer = new_stream_coalescer(request.headers)
+        transcript = new_stream_transcript(history_metadata)
+        stream = lease.wrap(stream_without_data(response, messages, api_version, lease.deployment, history_metadata, coalescer, transcript))
+        if cache_key:
+            stream = record_response_cache(stream, cache_key, embedding)
+        if transcript:
+            stream = persist_stream(stream, transcript, request.headers.get('x-auth-request-email'), history_metadata['conversation_id'])
+        return Response(stream, mimetype='text/event-stream')
+
+
+def upstream_error(e):
+    """The error body, status and Retry-After of a throttled or unavailable upstream, returned as is by Flask and Quart."""
+    if isinstance(e, AdmissionRejected):
+        status_code, retry_after = 429, e.retry_after
+    elif isinstance(e, CircuitOpenError):
+        status_code, retry_after = 503, e.retry_after
+    else:
+        status_code, retry_after = status_code_of(e) or 500, retry_after_seconds(e)
+    headers = {"Retry-After": str(math.ceil(retry_after))} if retry_after is not None else {}
+    return {"error": _parse_openai_error(e)}, status_code, headers
 
 @app.route("/conversation", methods=["GET", "POST"])
 @jwt_required
-def conversation():
+def conversation(jwt_claims):
     request_body = request.json
     return conversation_internal(request_body)
 
@@ -599,18 +824,25 @@ def conversation_internal(request_body):
     # Retrieve the content from the last message from the request body
     message = request.json["messages"][-1]["content"]
 
-    model = "gpt-4-32k"
-    api_version = "2023-08-01-preview"
+    model = chat_deployments.model
+    api_version = AZURE_OPENAI_CHAT_API_VERSION
 
     # Log the user identity, device information, and message
     logging.info(f'model: {model}, api version: {api_version}, user identity: {user_identity}, IP address: {ip_address}, message: {message}')
 
     try:
+        if admission:
+            admission.admit(request.headers.get('x-auth-request-email') or ip_address, "chat", request_tokens(request_body["messages"]))
         use_data = should_use_data()
-        if use_data:
-            return conversation_with_data(request_body, model, api_version)
-        else:
-            return conversation_without_data(request_body, model, api_version)
+        # Retries of the upstream calls made for the request share one deadline
+        with upstream_retry.deadline_scope():
+            if use_data:
+                return conversation_with_data(request_body, model, api_version)
+            else:
+                return conversation_without_data(request_body, model, api_version)
+    except (AdmissionRejected, CircuitOpenError, openai.RateLimitError, UpstreamStatusError) as e:
+        logging.warning(f"Upstream unavailable: {e}")
+        return upstream_error(e)
     except (TimeoutError, openai.APITimeoutError) as e:
         logging.error("OpenAI timed out!")
         return jsonify({"error": _parse_openai_error(e)}), 408
@@ -623,7 +855,7 @@ def conversation_internal(request_body):
 
 @app.route("/dalle", methods=["GET", "POST"])
 @jwt_required
-def dalle():
+def dalle(jwt_claims):
     # Retrieve the user identity from the request headers
     user_identity = request.headers.get('x-auth-request-email')
 
@@ -633,73 +865,69 @@ def dalle():
     # Retrieve the content from the last message from the request body
     message = request.json["messages"][-1]["content"]
 
-    model = "dall-e-3"
-    api_version = "2023-12-01-preview"
+    model = image_deployments.model
+    api_version = AZURE_OPENAI_DALLE_API_VERSION
 
     # Log the user identity, device information, and message
     logging.info(f'model: {model}, api version: {api_version}, user identity: {user_identity}, IP address: {ip_address}, message: {message}')
 
-    client = openai.AzureOpenAI(
-        api_key=AZURE_OPENAI_KEY,
-        azure_endpoint=f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com",
-        api_version=api_version)
-
-    for attempt in range(1, MAX_RETRIES):
-        try:
-            generation_response = client.images.generate(
-                model=model, # the name of your DALL-E 3 deployment
-                prompt=message,
-                timeout=60
-            )
-
-            logging.info(f"prompt: {message}, revised_prompt: {generation_response.data[0].revised_prompt}")
+    def generate(deployment):
+        return get_openai_client(api_version, deployment).images.generate(
+            model=deployment.deployment, # the name of your DALL-E 3 deployment
+            prompt=message,
+            timeout=60
+        )
 
-            image_url = generation_response.data[0].url
-            response_data = {"image_url": image_url}
-            return Response(json.dumps(response_data).replace("\n", "\\n"), status=200)
-        except openai.RateLimitError as e:
-            logging.warning(f"Attempt {attempt + 1}/{MAX_RETRIES} - OpenAI request rate limited. Retrying...")
-            time.sleep(3)
-            continue
-        except (TimeoutError, openai.APITimeoutError) as e:
-            logging.error("OpenAI timed out!")
-            return jsonify({"error": _parse_openai_error(e)}), 408
-        except openai.BadRequestError as e:
-            logging.error(e)
-            return jsonify({"error": _parse_openai_error(e)}), 400
-        except Exception as e:
-            logging.exception(f"Exception in /dalle: {_parse_openai_error(e)}")
-            return jsonify({"error": _parse_openai_error(e)}), 500
-        
-    # If all attempts fail
-    logging.error(f"All {MAX_RETRIES} attempts failed. OpenAI timed out or rate limit exceeded!")
-    return jsonify({"error": 
-        """
-            Thank you for using the enhanced features of IDSGPT 4.0. We are currently experiencing high demand 
-            and cannot respond to your request. We appreciate your patience as you use this experimental
-            service. Please resubmit your request at a later time.
-        """}), 429
+    try:
+        if admission:
+            admission.admit(user_identity or ip_address, "image")
+        # Rate limited generations are retried (after the Retry-After of the service) within the request's deadline
+        with upstream_retry.deadline_scope():
+            generation_response = upstream_retry.call("openai:image", lambda: image_deployments.call(generate))
+
+        logging.info(f"prompt: {message}, revised_prompt: {generation_response.data[0].revised_prompt}")
+
+        image_url = generation_response.data[0].url
+        response_data = {"image_url": image_url}
+        return Response(dumps(response_data), status=200)
+    except AdmissionRejected as e:
+        logging.warning(str(e))
+        return upstream_error(e)
+    except (openai.RateLimitError, CircuitOpenError) as e:
+        logging.error(f"OpenAI rate limit exceeded: {_parse_openai_error(e)}")
+        return jsonify({"error": HIGH_DEMAND_MESSAGE}), 429
+    except (TimeoutError, openai.APITimeoutError) as e:
+        logging.error("OpenAI timed out!")
+        return jsonify({"error": _parse_openai_error(e)}), 408
+    except openai.BadRequestError as e:
+        logging.error(e)
+        return jsonify({"error": _parse_openai_error(e)}), 400
+    except Exception as e:
+        logging.exception(f"Exception in /dalle: {_parse_openai_error(e)}")
+        return jsonify({"error": _parse_openai_error(e)}), 500
 
 ## Conversation History API ## 
 @app.route("/history/generate", methods=["POST"])
 @jwt_required
-def add_conversation():
-    user_id = request_body.headers.get('x-auth-request-email')
+def add_conversation(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
 
     ## check request for conversation_id
     conversation_id = request.json.get("conversation_id", None)
 
     try:
         # make sure cosmos is configured
-        if not cosmos_conversation_client:
+        if not conversation_store:
             raise Exception("CosmosDB is not configured")
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
         if not conversation_id:
-            title = generate_title(request.json["messages"])
-            conversation_dict = cosmos_conversation_client.create_conversation(user_id=user_id, title=title)
+            ## start with the user's message as the title, the generated one is set in the background
+            title = provisional_title(request.json["messages"])
+            conversation_dict = conversation_store.create_conversation(user_id=user_id, title=title)
             conversation_id = conversation_dict['id']
+            title_worker.schedule(generate_title, conversation_store, user_id, conversation_id, request.json["messages"], title)
             history_metadata['title'] = title
             history_metadata['date'] = conversation_dict['createdAt']
             
@@ -707,7 +935,7 @@ def add_conversation():
         ## then write it to the conversation history in cosmos
         messages = request.json["messages"]
         if len(messages) > 0 and messages[-1]['role'] == "user":
-            cosmos_conversation_client.create_message(
+            conversation_store.create_message(
                 conversation_id=conversation_id,
                 user_id=user_id,
                 input_message=messages[-1]
@@ -728,15 +956,15 @@ def add_conversation():
 
 @app.route("/history/update", methods=["POST"])
 @jwt_required
-def update_conversation():
-    user_id = request_body.headers.get('x-auth-request-email')
+def update_conversation(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
 
     ## check request for conversation_id
     conversation_id = request.json.get("conversation_id", None)
 
     try:
         # make sure cosmos is configured
-        if not cosmos_conversation_client:
+        if not conversation_store:
             raise Exception("CosmosDB is not configured")
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
@@ -747,19 +975,17 @@ def update_conversation():
         ## then write it to the conversation history in cosmos
         messages = request.json["messages"]
         if len(messages) > 0 and messages[-1]['role'] == "assistant":
-            if len(messages) > 1 and messages[-2].get('role', None) == "tool":
-                # write the tool message first
-                cosmos_conversation_client.create_message(
+            # write the tool message first (if any), then the assistant message, in one write
+            new_messages = messages[-2:] if len(messages) > 1 and messages[-2].get('role', None) == "tool" else messages[-1:]
+            if stream_tee and already_stored(conversation_store.get_messages(user_id, conversation_id), new_messages):
+                # the answer was written when its stream ended
+                stream_tee.count("duplicates_skipped")
+            else:
+                conversation_store.create_messages(
                     conversation_id=conversation_id,
                     user_id=user_id,
-                    input_message=messages[-2]
+                    input_messages=new_messages
                 )
-            # write the assistant message
-            cosmos_conversation_client.create_message(
-                conversation_id=conversation_id,
-                user_id=user_id,
-                input_message=messages[-1]
-            )
         else:
             raise Exception("No bot messages found")
         
@@ -773,9 +999,9 @@ def update_conversation():
 
 @app.route("/history/delete", methods=["DELETE"])
 @jwt_required
-def delete_conversation():
+def delete_conversation(jwt_claims):
     ## get the user id from the request headers
-    user_id = request_body.headers.get('x-auth-request-email')
+    user_id = request.headers.get('x-auth-request-email')
     
     ## check request for conversation_id
     conversation_id = request.json.get("conversation_id", None)
@@ -784,10 +1010,10 @@ def delete_conversation():
             return jsonify({"error": "conversation_id is required"}), 400
         
         ## delete the conversation messages from cosmos first
-        deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id)
+        deleted_messages = conversation_store.delete_messages(conversation_id, user_id)
 
         ## Now delete the conversation 
-        deleted_conversation = cosmos_conversation_client.delete_conversation(user_id, conversation_id)
+        deleted_conversation = conversation_store.delete_conversation(user_id, conversation_id)
 
         return jsonify({"message": "Successfully deleted conversation and messages", "conversation_id": conversation_id}), 200
     except Exception as e:
@@ -796,12 +1022,29 @@ def delete_conversation():
 
 @app.route("/history/list", methods=["GET"])
 @jwt_required
-def list_conversations():
-    offset = request.args.get("offset", 0)
-    user_id = request_body.headers.get('x-auth-request-email')
+def list_conversations(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
+
+    ## with a cursor (empty for the first page) page by keyset, the next page's cursor is sent in the
+    ## X-Next-Cursor header and left out on the last page. Without one, page by offset as before
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        try:
+            conversations, next_cursor = conversation_store.get_conversations_page(user_id, limit=25, cursor=cursor)
+        except ValueError:
+            return jsonify({"error": "cursor is invalid"}), 400
+        response = jsonify(conversations)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return response, 200
+
+    try:
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        return jsonify({"error": "offset must be an integer"}), 400
 
     ## get the conversations from cosmos
-    conversations = cosmos_conversation_client.get_conversations(user_id, offset=offset, limit=25)
+    conversations = conversation_store.get_conversations(user_id, offset=offset, limit=25)
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
@@ -811,8 +1054,8 @@ def list_conversations():
 
 @app.route("/history/read", methods=["POST"])
 @jwt_required
-def get_conversation():
-    user_id = request_body.headers.get('x-auth-request-email')
+def get_conversation(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
 
     ## check request for conversation_id
     conversation_id = request.json.get("conversation_id", None)
@@ -821,13 +1064,13 @@ def get_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     ## get the conversation object and the related messages from cosmos
-    conversation = cosmos_conversation_client.get_conversation(user_id, conversation_id)
+    conversation = conversation_store.get_conversation(user_id, conversation_id)
     ## return the conversation id and the messages in the bot frontend format
     if not conversation:
         return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
     
     # get the messages for the conversation from cosmos
-    conversation_messages = cosmos_conversation_client.get_messages(user_id, conversation_id)
+    conversation_messages = conversation_store.get_messages(user_id, conversation_id)
 
     ## format the messages in the bot frontend format
     messages = [{'id': msg['id'], 'role': msg['role'], 'content': msg['content'], 'createdAt': msg['createdAt']} for msg in conversation_messages]
@@ -836,8 +1079,8 @@ def get_conversation():
 
 @app.route("/history/rename", methods=["POST"])
 @jwt_required
-def rename_conversation():
-    user_id = request_body.headers.get('x-auth-request-email')
+def rename_conversation(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
 
     ## check request for conversation_id
     conversation_id = request.json.get("conversation_id", None)
@@ -846,7 +1089,7 @@ def rename_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
     
     ## get the conversation from cosmos
-    conversation = cosmos_conversation_client.get_conversation(user_id, conversation_id)
+    conversation = conversation_store.get_conversation(user_id, conversation_id)
     if not conversation:
         return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
 
@@ -855,42 +1098,60 @@ def rename_conversation():
     if not title:
         return jsonify({"error": "title is required"}), 400
     conversation['title'] = title
-    updated_conversation = cosmos_conversation_client.upsert_conversation(conversation)
+    updated_conversation = conversation_store.upsert_conversation(conversation)
 
     return jsonify(updated_conversation), 200
 
 @app.route("/history/delete_all", methods=["DELETE"])
 @jwt_required
-def delete_all_conversations():
+def delete_all_conversations(jwt_claims):
     ## get the user id from the request headers
-    user_id = request_body.headers.get('x-auth-request-email')
+    user_id = request.headers.get('x-auth-request-email')
 
-    # get conversations for user
+    # get the ids of the user's conversations and messages
     try:
-        conversations = cosmos_conversation_client.get_conversations(user_id, offset=0, limit=None)
-        if not conversations:
+        message_ids, conversation_ids = conversation_store.get_history_item_ids(user_id)
+        if not conversation_ids:
             return jsonify({"error": f"No conversations for {user_id} were found"}), 404
-        
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = cosmos_conversation_client.delete_messages(conversation['id'], user_id)
-
-            ## Now delete the conversation 
-            deleted_conversation = cosmos_conversation_client.delete_conversation(user_id, conversation['id'])
 
+        def delete_history(progress=None):
+            return conversation_store.delete_history(user_id, message_ids, conversation_ids,
+                                                             batch_size=bulk_delete_settings.batch_size,
+                                                             concurrency=bulk_delete_settings.concurrency,
+                                                             progress=progress)
+
+        # too much to delete within the request: continue in the background and report progress
+        total = len(message_ids) + len(conversation_ids)
+        if total > bulk_delete_settings.background_threshold:
+            job = deletion_jobs.start(user_id, total, lambda job: delete_history(job.advance))
+            return jsonify({
+                "message": f"Deleting {total} conversations and messages for user {user_id}",
+                "job_id": job.id,
+                "status_url": f"/history/delete_all/status?job_id={job.id}",
+            }), 202
+
+        delete_history()
         return jsonify({"message": f"Successfully deleted conversation and messages for user {user_id}"}), 200
     
     except Exception as e:
         logging.exception("Exception in /history/delete_all")
         return jsonify({"error": str(e)}), 500
+
+@app.route("/history/delete_all/status", methods=["GET"])
+@jwt_required
+def delete_all_status(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
+    job = deletion_jobs.get(user_id, request.args.get("job_id", ""))
+    if not job:
+        return jsonify({"error": "Deletion job was not found"}), 404
+    return jsonify(job.progress()), 200
     
 
-@app.route("/history/clear", methods=["POST"])'
+@app.route("/history/clear", methods=["POST"])
 @jwt_required
-def clear_messages():
+def clear_messages(jwt_claims):
     ## get the user id from the request headers
-    user_id = request_body.headers.get('x-auth-request-email')
+    user_id = request.headers.get('x-auth-request-email')
 
     ## check request for conversation_id
     conversation_id = request.json.get("conversation_id", None)
@@ -899,7 +1160,7 @@ def clear_messages():
             return jsonify({"error": "conversation_id is required"}), 400
         
         ## delete the conversation messages from cosmos
-        deleted_messages = cosmos_conversation_client.delete_messages(conversation_id, user_id)
+        deleted_messages = conversation_store.delete_messages(conversation_id, user_id)
 
         return jsonify({"message": "Successfully deleted messages in conversation", "conversation_id": conversation_id}), 200
     except Exception as e:
@@ -908,39 +1169,47 @@ def clear_messages():
 
 @app.route("/history/ensure", methods=["GET"])
 def ensure_cosmos():
-    if not AZURE_COSMOSDB_ACCOUNT:
+    if not CHAT_HISTORY_CONFIGURED:
         return jsonify({"error": "CosmosDB is not configured"}), 404
     
-    if not cosmos_conversation_client or not cosmos_conversation_client.ensure():
+    if not conversation_store or not conversation_store.ensure():
         return jsonify({"error": "CosmosDB is not working"}), 500
 
     return jsonify({"message": "CosmosDB is configured and working"}), 200
 
 
-def generate_title(conversation_messages):
-    ## make sure the messages are sorted by _ts descending
-    title_prompt = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    if not ENABLE_METRICS_ENDPOINT:
+        return jsonify({"error": "Metrics are not enabled"}), 404
+    return jsonify(metrics.collect()), 200
+
 
+TITLE_PROMPT = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
+
+def prepare_title_messages(conversation_messages):
+    ## make sure the messages are sorted by _ts descending
     messages = [{'role': msg['role'], 'content': msg['content']} for msg in conversation_messages]
-    messages.append({'role': 'user', 'content': title_prompt})
+    messages.append({'role': 'user', 'content': TITLE_PROMPT})
+    return messages
+
+def generate_title(conversation_messages):
+    """The generated title, None when the completion fails (the conversation keeps its provisional title)."""
+    messages = prepare_title_messages(conversation_messages)
 
     try:
         ## Submit prompt to Chat Completions for response
-        base_url = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-        openai.api_type = "azure"
-        openai.api_base = base_url
-        openai.api_version = "2023-03-15-preview"
-        openai.api_key = AZURE_OPENAI_KEY
-        completion = openai.ChatCompletion.create(    
-            engine=AZURE_OPENAI_MODEL,
-            messages=messages,
-            temperature=1,
-            max_tokens=64 
-        )
-        title = json.loads(completion['choices'][0]['message']['content'])['title']
-        return title
+        completion = upstream_retry.call("openai:chat", lambda: chat_deployments.call(
+            lambda deployment: get_openai_client(AZURE_OPENAI_PREVIEW_API_VERSION, deployment).chat.completions.create(
+                model=deployment.deployment,
+                messages=messages,
+                temperature=1,
+                max_tokens=64
+            ), token_counter.prompt_tokens(messages) + 64))
+        return json.loads(completion.choices[0].message.content)['title']
     except Exception as e:
-        return messages[-2]['content']
+        logging.warning(f"Title generation failed: {e}")
+        return None
 
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
@@ -0,0 +1,865 @@
+"""
+ASGI serving mode.
+
+Serves the same API as app.py, but /conversation, /dalle and /history/* are coroutines backed by
+asyncio upstream clients (openai.AsyncAzureOpenAI, pooled httpx.AsyncClient for the extensions endpoint and
+the async Cosmos SDK). A single process can therefore keep thousands of chat streams open while
+waiting on Azure OpenAI instead of pinning one uwsgi worker per stream.
+
+Run with:
+    hypercorn asgi:app --bind 0.0.0.0:80
+
+app.py remains the WSGI entry point for uwsgi/gunicorn deployments; settings and response
+formatting are shared with it.
+"""
+import asyncio
+import json
+import logging
+
+import openai
+from quart import Quart, Response, request, jsonify, send_from_directory
+
+from backend.history.async_cosmosdbservice import AsyncCosmosConversationClient
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.store import AsyncConversationStore
+from backend.clients.admission import AdmissionRejected
+from backend.clients.pool import AsyncConnectionPool, PoolSettings
+from backend.clients.retry import CircuitOpenError, UpstreamStatusError, status_error
+from backend.streaming.relay import WithDataStreamRelay
+from backend.streaming.coalesce import FLUSH, iterate_with_deadlines
+from backend import metrics
+from backend.serialization import JSONProvider, dumps
+from backend.cache.response_cache import replay_response, replay_stream
+
+from auth import jwt_required
+from app import (
+    AZURE_COSMOSDB_ACCOUNT,
+    AZURE_COSMOSDB_ACCOUNT_KEY,
+    AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
+    AZURE_COSMOSDB_DATABASE,
+    AZURE_OPENAI_CHAT_API_VERSION,
+    AZURE_OPENAI_DALLE_API_VERSION,
+    AZURE_OPENAI_KEY,
+    AZURE_OPENAI_PARALLEL_TOOL_CALLS,
+    AZURE_OPENAI_PREVIEW_API_VERSION,
+    AZURE_OPENAI_RESOURCE,
+    CHAT_HISTORY_BACKEND,
+    CHAT_HISTORY_CONFIGURED,
+    DATA_SOURCE_RESERVED_TOKENS,
+    DEBUG_LOGGING,
+    ENABLE_METRICS_ENDPOINT,
+    HIGH_DEMAND_MESSAGE,
+    SHOULD_STREAM,
+    TOOLS_API_VERSION,
+    _parse_openai_error,
+    admission,
+    already_stored,
+    app_settings,
+    bulk_delete_settings,
+    chat_deployments,
+    context_budget,
+    hedger,
+    conversation_store as shared_conversation_store,
+    deletion_jobs,
+    formatApiResponseNoStreaming,
+    image_deployments,
+    format_as_ndjson,
+    format_stream_without_data_chunk,
+    new_stream_coalescer,
+    new_stream_transcript,
+    prepare_body_headers_with_data,
+    prepare_messages_without_data,
+    prepare_title_messages,
+    provisional_title,
+    request_tokens,
+    response_cache,
+    response_cache_key,
+    response_cache_settings,
+    search_filter,
+    should_use_data,
+    store_response_cache,
+    stream_tee,
+    title_worker,
+    token_counter,
+    tool_loop,
+    tool_parameters,
+    upstream_error,
+    upstream_retry,
+    with_data_cache_scope,
+    with_data_endpoint,
+    with_data_headers,
+    without_data_cache_scope,
+)
+
+app = Quart(__name__, static_folder="static")
+app.json = JSONProvider(app)
+
+# Upstream clients are pooled per host and shared by every request
+connection_pool = AsyncConnectionPool(PoolSettings.from_env())
+metrics.register("async_http_pool", connection_pool.snapshot)
+conversation_store = None
+
+# Tasks that outlive their request, the event loop only holds tasks weakly
+background_tasks = set()
+
+
+def get_openai_client(api_version, deployment=None):
+    if deployment is None:
+        return connection_pool.openai_client(
+            azure_endpoint=f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com",
+            api_key=AZURE_OPENAI_KEY,
+            api_version=api_version)
+    return connection_pool.openai_client(azure_endpoint=deployment.endpoint, api_key=deployment.api_key, api_version=api_version)
+
+
+@app.before_serving
+async def init_clients():
+    global conversation_store
+    if shared_conversation_store and not isinstance(shared_conversation_store, CosmosConversationClient):
+        # the sqlite/memory store, write-behind queue or history cache app.py created, shared with it
+        conversation_store = AsyncConversationStore(shared_conversation_store)
+    elif CHAT_HISTORY_BACKEND == "cosmos" and AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER:
+        try:
+            cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
+
+            if not AZURE_COSMOSDB_ACCOUNT_KEY:
+                from azure.identity.aio import DefaultAzureCredential
+                credential = DefaultAzureCredential()
+            else:
+                credential = AZURE_COSMOSDB_ACCOUNT_KEY
+
+            conversation_store = AsyncCosmosConversationClient(
+                cosmosdb_endpoint=cosmos_endpoint,
+                credential=credential,
+                database_name=AZURE_COSMOSDB_DATABASE,
+                container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
+            )
+        except Exception:
+            logging.exception("Exception in CosmosDB initialization")
+            conversation_store = None
+
+
+@app.after_serving
+async def close_clients():
+    await connection_pool.aclose()
+    if conversation_store:
+        await conversation_store.close()
+
+
+# Static Files
+@app.route("/")
+async def index():
+    return await app.send_static_file("index.html")
+
+@app.route("/favicon.ico")
+async def favicon():
+    return await app.send_static_file('favicon.ico')
+
+@app.route("/assets/<path:path>")
+async def assets(path):
+    return await send_from_directory("static/assets", path)
+
+
+async def stream_with_data(r, lease, history_metadata={}, coalescer=None, transcript=None, chunks=None):
+    try:
+        relay = WithDataStreamRelay(
+            history_metadata=history_metadata,
+            apim_request_id=r.headers.get('apim-request-id'),
+            legacy_format=AZURE_OPENAI_PREVIEW_API_VERSION == '2023-06-01-preview',
+            debug_logging=DEBUG_LOGGING,
+            coalescer=coalescer,
+            transcript=transcript)
+        chunks = chunks or r.aiter_bytes()
+        if coalescer:
+            chunks = iterate_with_deadlines(chunks, relay.flush_timeout)
+        async for chunk in chunks:
+            events = relay.flush_pending() if chunk is FLUSH else relay.feed(chunk)
+            if events:
+                yield b"".join(events)
+        events = relay.close()
+        if events:
+            yield b"".join(events)
+    except Exception as e:
+        lease.release(e)
+        if transcript:
+            transcript.fail()
+        yield format_as_ndjson({"error": str(e)})
+    finally:
+        await r.aclose()
+        lease.release()
+
+async def conversation_with_data(request_body, model, api_version):
+    filter = None
+    if app_settings.datasource.permitted_groups_column:
+        # Graph group lookups for the security filter are blocking
+        filter = await asyncio.to_thread(search_filter, request.headers.get('X-MS-TOKEN-AAD-ACCESS-TOKEN'))
+    history_metadata = request_body.get("history_metadata", {})
+
+    cache_key = response_cache_key(request_body, with_data_cache_scope(model, api_version, filter), request.headers)
+    if cache_key:
+        cached, embedding = await lookup_response_cache(cache_key, api_version)
+        if cached:
+            return cached_response(cached, history_metadata)
+
+    # The data source adds the retrieved documents and its own system message, and gets no summary
+    request_body = dict(request_body, messages=await fit_context_window(
+        request_body["messages"], history_metadata, DATA_SOURCE_RESERVED_TOKENS, summarize=False))
+    body, headers = prepare_body_headers_with_data(request_body, filter)
+    tokens = request_tokens(request_body["messages"]) + DATA_SOURCE_RESERVED_TOKENS
+
+    async def post(deployment):
+        # the response is opened here, so a throttled deployment can be failed over before streaming
+        endpoint = with_data_endpoint(deployment)
+        client = connection_pool.httpx_client(endpoint)
+        request = client.build_request("POST", endpoint, content=body, headers=with_data_headers(headers, deployment))
+        return await client.send(request, stream=SHOULD_STREAM)
+
+    async def start(exclude=(), picked=None):
+        r, lease = await chat_deployments.astart(post, tokens, failed=status_error, exclude=exclude, picked=picked)
+        error = status_error(r)
+        if error:
+            # every deployment failed, the retry policy decides what next
+            await r.aclose()
+            raise error
+        return r, lease
+
+    if not SHOULD_STREAM:
+        r = await upstream_retry.acall("openai:chat", lambda: chat_deployments.acall(post, tokens, failed=status_error), failed=status_error)
+        status_code = r.status_code
+        r = r.json()
+        if AZURE_OPENAI_PREVIEW_API_VERSION == "2023-06-01-preview":
+            r['history_metadata'] = history_metadata
+            response_body = format_as_ndjson(r)
+        else:
+            result = formatApiResponseNoStreaming(r)
+            result['history_metadata'] = history_metadata
+            response_body = format_as_ndjson(result)
+        if cache_key and status_code == 200:
+            await asyncio.to_thread(store_response_cache, cache_key, embedding, [response_body])
+        return Response(response_body, status=status_code)
+
+    else:
+        chunks = None
+        if hedger:
+            # the hedge is a single try on another deployment, the primary is retried as usual
+            r, lease, chunks = await hedger.astart(lambda picked: upstream_retry.acall("openai:chat", lambda: start(picked=picked)),
+                                                   lambda exclude: start(exclude=exclude), lambda r: r.aiter_bytes())
+        else:
+            r, lease = await upstream_retry.acall("openai:chat", start)
+        coalescer = new_stream_coalescer(request.headers)
+        transcript = new_stream_transcript(history_metadata)
+        stream = stream_with_data(r, lease, history_metadata, coalescer, transcript, chunks)
+        if cache_key:
+            stream = record_response_cache(stream, cache_key, embedding)
+        if transcript:
+            stream = persist_stream(stream, transcript, request.headers.get('x-auth-request-email'), history_metadata['conversation_id'])
+        return Response(stream, mimetype='text/event-stream')
+
+async def lookup_response_cache(cache_key, api_version):
+    """The cached answer for cache_key, None on a miss, and the embedding computed for the lookup."""
+    # The cache backend may be remote (Redis), keep its calls off the event loop
+    cached = await asyncio.to_thread(response_cache.get, cache_key)
+    embedding = None
+    if cached is None and response_cache.similarity_enabled:
+        try:
+            response = await upstream_retry.acall("openai:embeddings", lambda: get_openai_client(api_version).embeddings.create(
+                model=response_cache_settings.embedding_deployment, input=cache_key.text))
+            embedding = response.data[0].embedding
+        except Exception:
+            logging.exception("Embedding for the response cache failed")
+        else:
+            cached = await asyncio.to_thread(response_cache.get_similar, cache_key, embedding)
+    return cached, embedding
+
+def cached_response(cached, history_metadata):
+    if SHOULD_STREAM:
+        transcript = new_stream_transcript(history_metadata)
+        if transcript:
+            transcript.add_messages(cached["messages"])
+            stream = persist_stream(replay_chunks(replay_stream(cached, history_metadata)), transcript,
+                                    request.headers.get('x-auth-request-email'), history_metadata['conversation_id'])
+            return Response(stream, mimetype='text/event-stream')
+        return Response(replay_stream(cached, history_metadata), mimetype='text/event-stream')
+    return jsonify(replay_response(cached, history_metadata)), 200
+
+async def record_response_cache(stream, cache_key, embedding):
+    # Only a stream that ran to completion is cached, a client disconnect closes the generator first
+    chunks = []
+    async for chunk in stream:
+        chunks.append(chunk)
+        yield chunk
+    await asyncio.to_thread(store_response_cache, cache_key, embedding, chunks)
+
+async def replay_chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+async def persist_stream(stream, transcript, user_id, conversation_id):
+    # Writes before the generator returns, so before the response ends and the frontend posts /history/update
+    async def write(messages):
+        await conversation_store.create_messages(conversation_id=conversation_id, user_id=user_id, input_messages=messages)
+
+    async def drain():
+        # The client went away: read the rest of the answer without sending it, and write it anyway
+        try:
+            async for chunk in stream:
+                pass
+        except Exception:
+            transcript.fail()
+        await stream_tee.apersist(transcript, write, conversation_id)
+
+    try:
+        async for chunk in stream:
+            yield chunk
+    except GeneratorExit:
+        # in a task of its own, the request's task may be cancelled at any moment now
+        task = asyncio.get_running_loop().create_task(drain())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        raise
+    await stream_tee.apersist(transcript, write, conversation_id)
+
+async def fit_context_window(messages, history_metadata, reserved_tokens=0, summarize=None):
+    """The messages with older turns dropped, or summarized, to fit the prompt budget."""
+    if not context_budget or context_budget.fits(messages, reserved_tokens):
+        return messages
+    # Summaries are kept on the conversation, without one (/conversation) the turns are just dropped
+    user_id = request.headers.get('x-auth-request-email')
+    conversation_id = history_metadata.get('conversation_id')
+    summarize = (context_budget.summarize if summarize is None else summarize) and bool(conversation_store and conversation_id)
+    stored_summary = None
+    if summarize:
+        conversation = await conversation_store.get_conversation(user_id, conversation_id)
+        stored_summary = conversation.get('summary') if conversation else None
+
+    plan = context_budget.plan(messages, reserved_tokens, stored_summary, summarize)
+    if not plan.summary_needed:
+        return plan.messages()
+    try:
+        summary = plan.summary_record(await summarize_turns(plan.summary_prompt()))
+    except Exception:
+        logging.exception("Summarizing older turns failed, they are left out")
+        return plan.messages()
+    try:
+        await conversation_store.set_summary(user_id, conversation_id, summary)
+    except Exception:
+        logging.exception("Storing the conversation summary failed")
+    return plan.messages(summary)
+
+async def summarize_turns(messages):
+    completion = await upstream_retry.acall("openai:chat", lambda: chat_deployments.acall(
+        lambda deployment: get_openai_client(AZURE_OPENAI_PREVIEW_API_VERSION, deployment).chat.completions.create(
+            model=deployment.deployment,
+            messages=messages,
+            temperature=0,
+            max_tokens=context_budget.summary_max_tokens
+        ), token_counter.prompt_tokens(messages) + context_budget.summary_max_tokens))
+    return completion.choices[0].message.content
+
+async def complete_with_tool_results(messages, api_version, deployment, with_tools=False):
+    # Make a new call to the API with the results of the tools, on the same pooled client and deployment.
+    return await upstream_retry.acall(f"openai:{deployment.name}", lambda: get_openai_client(api_version, deployment).chat.completions.create(
+        model=deployment.deployment,
+        messages = messages,
+        timeout = 60,
+        temperature = 0,
+        stream=True,
+        **(tool_parameters() if with_tools else {})
+    ))
+
+async def stream_without_data(response, messages, api_version, deployment, history_metadata={}, coalescer=None, transcript=None):
+    response_chunk = None
+
+    def next_round(messages, with_tools):
+        return complete_with_tool_results(messages, api_version, deployment, with_tools)
+
+    # Answer text of every round, tool calls are run by the loop in between.
+    items = tool_loop.arun(response, messages, next_round)
+    if coalescer:
+        items = iterate_with_deadlines(items, coalescer.flush_timeout)
+    async for item in items:
+        # The coalescing window expired while waiting for the next chunk
+        if item is FLUSH:
+            if response_text := coalescer.flush():
+                yield format_stream_without_data_chunk(response_chunk, response_text, history_metadata)
+            continue
+        response_chunk, response_text = item
+        # Heartbeat while tools run
+        if response_text is None:
+            yield format_stream_without_data_chunk(response_chunk, "", history_metadata)
+            continue
+        if transcript:
+            transcript.add_content(response_text)
+        if coalescer and (response_text := coalescer.add(response_text)) is None:
+            continue
+        yield format_stream_without_data_chunk(response_chunk, response_text, history_metadata)
+
+    # Release whatever the coalescer still holds
+    if coalescer and (response_text := coalescer.flush()):
+        yield format_stream_without_data_chunk(response_chunk, response_text, history_metadata)
+
+async def conversation_without_data(request_body, model, api_version):
+    if AZURE_OPENAI_PARALLEL_TOOL_CALLS:
+        api_version = TOOLS_API_VERSION
+    history_metadata = request_body.get("history_metadata", {})
+
+    cache_key = response_cache_key(request_body, without_data_cache_scope(model, api_version), request.headers)
+    if cache_key:
+        cached, embedding = await lookup_response_cache(cache_key, api_version)
+        if cached:
+            return cached_response(cached, history_metadata)
+
+    messages = await fit_context_window(prepare_messages_without_data(request_body), history_metadata)
+
+    def create(deployment):
+        return get_openai_client(api_version, deployment).chat.completions.create(
+            model=deployment.deployment,
+            messages = messages,
+            temperature=app_settings.chat.temperature,
+            max_tokens=app_settings.chat.max_tokens,
+            top_p=app_settings.chat.top_p,
+            stop=list(app_settings.chat.stop) if app_settings.chat.stop else None,
+            stream=SHOULD_STREAM,
+            timeout=60,
+            **tool_parameters()
+        )
+
+    tokens = request_tokens(messages)
+    if SHOULD_STREAM and hedger:
+        # the response is then the stream of chunks, its first one read while racing the hedge
+        _, lease, response = await hedger.astart(
+            lambda picked: upstream_retry.acall("openai:chat", lambda: chat_deployments.astart(create, tokens, picked=picked)),
+            lambda exclude: chat_deployments.astart(create, tokens, exclude=exclude), aiter)
+    else:
+        response, lease = await upstream_retry.acall("openai:chat", lambda: chat_deployments.astart(create, tokens))
+
+    if not SHOULD_STREAM:
+        lease.release()
+        response_obj = {
+            "id": response.id,
+            "model": response.model,
+            "created": response.created,
+            "object": response.object,
+            "choices": [{
+                "messages": [{
+                    "role": "assistant",
+                    "content": response.choices[0].message.content
+                }]
+            }],
+            "history_metadata": history_metadata
+        }
+
+        if cache_key:
+            await asyncio.to_thread(store_response_cache, cache_key, embedding, [dumps(response_obj)])
+        return jsonify(response_obj), 200
+    else:
+        coalescer = new_stream_coalescer(request.headers)
+        transcript = new_stream_transcript(history_metadata)
+        stream = lease.awrap(stream_without_data(response, messages, api_version, lease.deployment, history_metadata, coalescer, transcript))
+        if cache_key:
+            stream = record_response_cache(stream, cache_key, embedding)
+        if transcript:
+            stream = persist_stream(stream, transcript, request.headers.get('x-auth-request-email'), history_metadata['conversation_id'])
+        return Response(stream, mimetype='text/event-stream')
+
+
+@app.route("/conversation", methods=["GET", "POST"])
+@jwt_required
+async def conversation(jwt_claims):
+    request_body = await request.get_json()
+    return await conversation_internal(request_body)
+
+async def conversation_internal(request_body):
+    # Retrieve the user identity from the request headers
+    user_identity = '000000-000000'
+
+    # Retrieve the IP address from the request headers
+    ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
+
+    # Retrieve the content from the last message from the request body
+    message = request_body["messages"][-1]["content"]
+
+    model = chat_deployments.model
+    api_version = AZURE_OPENAI_CHAT_API_VERSION
+
+    # Log the user identity, device information, and message
+    logging.info(f'model: {model}, api version: {api_version}, user identity: {user_identity}, IP address: {ip_address}, message: {message}')
+
+    try:
+        if admission:
+            await admission.aadmit(request.headers.get('x-auth-request-email') or ip_address, "chat", request_tokens(request_body["messages"]))
+        use_data = should_use_data()
+        # Retries of the upstream calls made for the request share one deadline
+        with upstream_retry.deadline_scope():
+            if use_data:
+                return await conversation_with_data(request_body, model, api_version)
+            else:
+                return await conversation_without_data(request_body, model, api_version)
+    except (AdmissionRejected, CircuitOpenError, openai.RateLimitError, UpstreamStatusError) as e:
+        logging.warning(f"Upstream unavailable: {e}")
+        return upstream_error(e)
+    except (TimeoutError, openai.APITimeoutError) as e:
+        logging.error("OpenAI timed out!")
+        return jsonify({"error": _parse_openai_error(e)}), 408
+    except openai.BadRequestError as e:
+        logging.error(e)
+        return jsonify({"error": _parse_openai_error(e)}), 400
+    except Exception as e:
+        logging.exception("Exception in /conversation")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/dalle", methods=["GET", "POST"])
+@jwt_required
+async def dalle(jwt_claims):
+    request_body = await request.get_json()
+
+    # Retrieve the user identity from the request headers
+    user_identity = request.headers.get('x-auth-request-email')
+
+    # Retrieve the IP address from the request headers
+    ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
+
+    # Retrieve the content from the last message from the request body
+    message = request_body["messages"][-1]["content"]
+
+    model = image_deployments.model
+    api_version = AZURE_OPENAI_DALLE_API_VERSION
+
+    # Log the user identity, device information, and message
+    logging.info(f'model: {model}, api version: {api_version}, user identity: {user_identity}, IP address: {ip_address}, message: {message}')
+
+    def generate(deployment):
+        return get_openai_client(api_version, deployment).images.generate(
+            model=deployment.deployment, # the name of your DALL-E 3 deployment
+            prompt=message,
+            timeout=60
+        )
+
+    try:
+        if admission:
+            await admission.aadmit(user_identity or ip_address, "image")
+        # Rate limited generations are retried (after the Retry-After of the service) within the request's deadline
+        with upstream_retry.deadline_scope():
+            generation_response = await upstream_retry.acall("openai:image", lambda: image_deployments.acall(generate))
+
+        logging.info(f"prompt: {message}, revised_prompt: {generation_response.data[0].revised_prompt}")
+
+        image_url = generation_response.data[0].url
+        response_data = {"image_url": image_url}
+        return Response(dumps(response_data), status=200)
+    except AdmissionRejected as e:
+        logging.warning(str(e))
+        return upstream_error(e)
+    except (openai.RateLimitError, CircuitOpenError) as e:
+        logging.error(f"OpenAI rate limit exceeded: {_parse_openai_error(e)}")
+        return jsonify({"error": HIGH_DEMAND_MESSAGE}), 429
+    except (TimeoutError, openai.APITimeoutError) as e:
+        logging.error("OpenAI timed out!")
+        return jsonify({"error": _parse_openai_error(e)}), 408
+    except openai.BadRequestError as e:
+        logging.error(e)
+        return jsonify({"error": _parse_openai_error(e)}), 400
+    except Exception as e:
+        logging.exception(f"Exception in /dalle: {_parse_openai_error(e)}")
+        return jsonify({"error": _parse_openai_error(e)}), 500
+
+## Conversation History API ##
+@app.route("/history/generate", methods=["POST"])
+@jwt_required
+async def add_conversation(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
+    request_body = await request.get_json()
+
+    ## check request for conversation_id
+    conversation_id = request_body.get("conversation_id", None)
+
+    try:
+        # make sure cosmos is configured
+        if not conversation_store:
+            raise Exception("CosmosDB is not configured")
+
+        # check for the conversation_id, if the conversation is not set, we will create a new one
+        history_metadata = {}
+        if not conversation_id:
+            ## start with the user's message as the title, the generated one is set in the background
+            title = provisional_title(request_body["messages"])
+            conversation_dict = await conversation_store.create_conversation(user_id=user_id, title=title)
+            conversation_id = conversation_dict['id']
+            title_worker.aschedule(generate_title, conversation_store, user_id, conversation_id, request_body["messages"], title)
+            history_metadata['title'] = title
+            history_metadata['date'] = conversation_dict['createdAt']
+
+        ## Format the incoming message object in the "chat/completions" messages format
+        ## then write it to the conversation history in cosmos
+        messages = request_body["messages"]
+        if len(messages) > 0 and messages[-1]['role'] == "user":
+            await conversation_store.create_message(
+                conversation_id=conversation_id,
+                user_id=user_id,
+                input_message=messages[-1]
+            )
+        else:
+            raise Exception("No user message found")
+
+        # Submit request to Chat Completions for response
+        history_metadata['conversation_id'] = conversation_id
+        request_body['history_metadata'] = history_metadata
+        return await conversation_internal(request_body)
+
+    except Exception as e:
+        logging.exception("Exception in /history/generate")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/history/update", methods=["POST"])
+@jwt_required
+async def update_conversation(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
+    request_body = await request.get_json()
+
+    ## check request for conversation_id
+    conversation_id = request_body.get("conversation_id", None)
+
+    try:
+        # make sure cosmos is configured
+        if not conversation_store:
+            raise Exception("CosmosDB is not configured")
+
+        # check for the conversation_id, if the conversation is not set, we will create a new one
+        if not conversation_id:
+            raise Exception("No conversation_id found")
+
+        ## Format the incoming message object in the "chat/completions" messages format
+        ## then write it to the conversation history in cosmos
+        messages = request_body["messages"]
+        if len(messages) > 0 and messages[-1]['role'] == "assistant":
+            # write the tool message first (if any), then the assistant message, in one write
+            new_messages = messages[-2:] if len(messages) > 1 and messages[-2].get('role', None) == "tool" else messages[-1:]
+            if stream_tee and already_stored(await conversation_store.get_messages(user_id, conversation_id), new_messages):
+                # the answer was written when its stream ended
+                stream_tee.count("duplicates_skipped")
+            else:
+                await conversation_store.create_messages(
+                    conversation_id=conversation_id,
+                    user_id=user_id,
+                    input_messages=new_messages
+                )
+        else:
+            raise Exception("No bot messages found")
+
+        # Submit request to Chat Completions for response
+        response = {'success': True}
+        return jsonify(response), 200
+
+    except Exception as e:
+        logging.exception("Exception in /history/update")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/history/delete", methods=["DELETE"])
+@jwt_required
+async def delete_conversation(jwt_claims):
+    ## get the user id from the request headers
+    user_id = request.headers.get('x-auth-request-email')
+    request_body = await request.get_json()
+
+    ## check request for conversation_id
+    conversation_id = request_body.get("conversation_id", None)
+    try:
+        if not conversation_id:
+            return jsonify({"error": "conversation_id is required"}), 400
+
+        ## delete the conversation messages from cosmos first
+        await conversation_store.delete_messages(conversation_id, user_id)
+
+        ## Now delete the conversation
+        await conversation_store.delete_conversation(user_id, conversation_id)
+
+        return jsonify({"message": "Successfully deleted conversation and messages", "conversation_id": conversation_id}), 200
+    except Exception as e:
+        logging.exception("Exception in /history/delete")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/history/list", methods=["GET"])
+@jwt_required
+async def list_conversations(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
+
+    ## with a cursor (empty for the first page) page by keyset, the next page's cursor is sent in the
+    ## X-Next-Cursor header and left out on the last page. Without one, page by offset as before
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        try:
+            conversations, next_cursor = await conversation_store.get_conversations_page(user_id, limit=25, cursor=cursor)
+        except ValueError:
+            return jsonify({"error": "cursor is invalid"}), 400
+        response = jsonify(conversations)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return response, 200
+
+    try:
+        offset = int(request.args.get("offset", 0))
+    except ValueError:
+        return jsonify({"error": "offset must be an integer"}), 400
+
+    ## get the conversations from cosmos
+    conversations = await conversation_store.get_conversations(user_id, offset=offset, limit=25)
+    if not isinstance(conversations, list):
+        return jsonify({"error": f"No conversations for {user_id} were found"}), 404
+
+    ## return the conversation ids
+
+    return jsonify(conversations), 200
+
+@app.route("/history/read", methods=["POST"])
+@jwt_required
+async def get_conversation(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
+    request_body = await request.get_json()
+
+    ## check request for conversation_id
+    conversation_id = request_body.get("conversation_id", None)
+
+    if not conversation_id:
+        return jsonify({"error": "conversation_id is required"}), 400
+
+    ## get the conversation object and the related messages from cosmos
+    conversation = await conversation_store.get_conversation(user_id, conversation_id)
+    ## return the conversation id and the messages in the bot frontend format
+    if not conversation:
+        return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
+
+    # get the messages for the conversation from cosmos
+    conversation_messages = await conversation_store.get_messages(user_id, conversation_id)
+
+    ## format the messages in the bot frontend format
+    messages = [{'id': msg['id'], 'role': msg['role'], 'content': msg['content'], 'createdAt': msg['createdAt']} for msg in conversation_messages]
+
+    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
+
+@app.route("/history/rename", methods=["POST"])
+@jwt_required
+async def rename_conversation(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
+    request_body = await request.get_json()
+
+    ## check request for conversation_id
+    conversation_id = request_body.get("conversation_id", None)
+
+    if not conversation_id:
+        return jsonify({"error": "conversation_id is required"}), 400
+
+    ## get the conversation from cosmos
+    conversation = await conversation_store.get_conversation(user_id, conversation_id)
+    if not conversation:
+        return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
+
+    ## update the title
+    title = request_body.get("title", None)
+    if not title:
+        return jsonify({"error": "title is required"}), 400
+    conversation['title'] = title
+    updated_conversation = await conversation_store.upsert_conversation(conversation)
+
+    return jsonify(updated_conversation), 200
+
+@app.route("/history/delete_all", methods=["DELETE"])
+@jwt_required
+async def delete_all_conversations(jwt_claims):
+    ## get the user id from the request headers
+    user_id = request.headers.get('x-auth-request-email')
+
+    # get the ids of the user's conversations and messages
+    try:
+        message_ids, conversation_ids = await conversation_store.get_history_item_ids(user_id)
+        if not conversation_ids:
+            return jsonify({"error": f"No conversations for {user_id} were found"}), 404
+
+        async def delete_history(progress=None):
+            return await conversation_store.delete_history(user_id, message_ids, conversation_ids,
+                                                                   batch_size=bulk_delete_settings.batch_size,
+                                                                   concurrency=bulk_delete_settings.concurrency,
+                                                                   progress=progress)
+
+        # too much to delete within the request: continue in the background and report progress
+        total = len(message_ids) + len(conversation_ids)
+        if total > bulk_delete_settings.background_threshold:
+            job = deletion_jobs.astart(user_id, total, lambda job: delete_history(job.advance))
+            return jsonify({
+                "message": f"Deleting {total} conversations and messages for user {user_id}",
+                "job_id": job.id,
+                "status_url": f"/history/delete_all/status?job_id={job.id}",
+            }), 202
+
+        await delete_history()
+        return jsonify({"message": f"Successfully deleted conversation and messages for user {user_id}"}), 200
+
+    except Exception as e:
+        logging.exception("Exception in /history/delete_all")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/history/delete_all/status", methods=["GET"])
+@jwt_required
+async def delete_all_status(jwt_claims):
+    user_id = request.headers.get('x-auth-request-email')
+    job = deletion_jobs.get(user_id, request.args.get("job_id", ""))
+    if not job:
+        return jsonify({"error": "Deletion job was not found"}), 404
+    return jsonify(job.progress()), 200
+
+@app.route("/history/clear", methods=["POST"])
+@jwt_required
+async def clear_messages(jwt_claims):
+    ## get the user id from the request headers
+    user_id = request.headers.get('x-auth-request-email')
+    request_body = await request.get_json()
+
+    ## check request for conversation_id
+    conversation_id = request_body.get("conversation_id", None)
+    try:
+        if not conversation_id:
+            return jsonify({"error": "conversation_id is required"}), 400
+
+        ## delete the conversation messages from cosmos
+        await conversation_store.delete_messages(conversation_id, user_id)
+
+        return jsonify({"message": "Successfully deleted messages in conversation", "conversation_id": conversation_id}), 200
+    except Exception as e:
+        logging.exception("Exception in /history/clear_messages")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/history/ensure", methods=["GET"])
+async def ensure_cosmos():
+    if not CHAT_HISTORY_CONFIGURED:
+        return jsonify({"error": "CosmosDB is not configured"}), 404
+
+    if not conversation_store or not await conversation_store.ensure():
+        return jsonify({"error": "CosmosDB is not working"}), 500
+
+    return jsonify({"message": "CosmosDB is configured and working"}), 200
+
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    if not ENABLE_METRICS_ENDPOINT:
+        return jsonify({"error": "Metrics are not enabled"}), 404
+    return jsonify(metrics.collect()), 200
+
+
+async def generate_title(conversation_messages):
+    """The generated title, None when the completion fails (the conversation keeps its provisional title)."""
+    messages = prepare_title_messages(conversation_messages)
+
+    try:
+        ## Submit prompt to Chat Completions for response
+        completion = await upstream_retry.acall("openai:chat", lambda: chat_deployments.acall(
+            lambda deployment: get_openai_client(AZURE_OPENAI_PREVIEW_API_VERSION, deployment).chat.completions.create(
+                model=deployment.deployment,
+                messages=messages,
+                temperature=1,
+                max_tokens=64
+            ), token_counter.prompt_tokens(messages) + 64))
+        return json.loads(completion.choices[0].message.content)['title']
+    except Exception as e:
+        logging.warning(f"Title generation failed: {e}")
+        return None
@@ -1,10 +1,16 @@
 from functools import wraps
+import asyncio
+import collections
+import inspect
 import logging
 import os
+import threading
+import time
 
-from flask import request, jsonify
-from okta_jwt_verifier import AccessTokenVerifier
-from okta_jwt_verifier.jwt_utils import JWTUtils
+import jwt
+import requests
+
+from backend import metrics
 
 try:
     from dotenv import load_dotenv
@@ -18,60 +24,271 @@ logging.basicConfig(level=logging.INFO)
 OKTA_JWT_ISSUER = os.environ.get("OKTA_JWT_ISSUER")
 OKTA_JWT_AUDIENCE = os.environ.get("OKTA_JWT_AUDIENCE")
 
-"""
-Private method to verify JWT access token.
-"""
-async def _verify_jwt_access_token(token: str) -> dict:
-    # verifier = AccessTokenVerifier(issuer=f'{OKTA_JWT_ISSUER}', audience=f'{OKTA_JWT_AUDIENCE}')
+
+class AuthSettings():
+    def __init__(self, issuer: str = None, audience: str = None, jwks_uri: str = None, jwks_cache_seconds: float = 3600.0,
+                 token_cache_size: int = 1024, leeway_seconds: float = 120.0):
+        self.issuer = issuer
+        self.audience = audience
+        self.jwks_uri = jwks_uri
+        self.jwks_cache_seconds = jwks_cache_seconds
+        self.token_cache_size = token_cache_size
+        self.leeway_seconds = leeway_seconds
+
+    @classmethod
+    def from_env(cls):
+        issuer = OKTA_JWT_ISSUER.rstrip("/") if OKTA_JWT_ISSUER else None
+        return cls(
+            issuer=issuer,
+            audience=OKTA_JWT_AUDIENCE,
+            # the keys of an Okta authorization server
+            jwks_uri=os.environ.get("OKTA_JWKS_URI") or (f"{issuer}/v1/keys" if issuer else None),
+            jwks_cache_seconds=float(os.environ.get("JWT_JWKS_CACHE_SECONDS", 3600)),
+            token_cache_size=int(os.environ.get("JWT_TOKEN_CACHE_SIZE", 1024)),
+            leeway_seconds=float(os.environ.get("JWT_LEEWAY_SECONDS", 120)),
+        )
+
+
+class JWKSCache():
+    """
+    The signing keys of the issuer, fetched once and kept for ttl_seconds. A token signed with a key
+    that is not known yet (a rotation) refetches them, at most every min_refresh_seconds so forged
+    kids cannot make every request call the issuer. When a refetch fails the known keys are kept.
+    """
+
+    def __init__(self, jwks_uri: str, ttl_seconds: float = 3600.0, min_refresh_seconds: float = 30.0, clock=time.monotonic):
+        self.jwks_uri = jwks_uri
+        self.ttl_seconds = ttl_seconds
+        self.min_refresh_seconds = min_refresh_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._keys = {}
+        self._fetched_at = None
+        self._counters = {"refreshes": 0, "refresh_errors": 0}
+
+    def _fetch(self) -> dict:
+        response = requests.get(self.jwks_uri, timeout=10)
+        response.raise_for_status()
+        keys = {}
+        for entry in response.json().get("keys", []):
+            if entry.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[entry.get("kid")] = jwt.PyJWK(entry)
+            except jwt.PyJWTError as e:
+                logging.warning(f"Skipping JWKS key {entry.get('kid')}: {e}")
+        return keys
+
+    def _lookup(self, kid):
+        """The key of kid, or None when the keys are to be fetched first."""
+        with self._lock:
+            now = self.clock()
+            if self._fetched_at is None or now - self._fetched_at >= self.ttl_seconds:
+                return None
+            if kid in self._keys:
+                return self._keys[kid]
+            if now - self._fetched_at < self.min_refresh_seconds:
+                raise jwt.InvalidKeyError(f"Unknown signing key {kid}")
+            return None
+
+    def _refresh(self, kid):
+        # one fetch at a time, outside of _lock so lookups (on the event loop too) never wait for it
+        with self._refresh_lock:
+            with self._lock:
+                # another request may have refreshed the keys meanwhile
+                now = self.clock()
+                fresh = self._fetched_at is not None and now - self._fetched_at < self.min_refresh_seconds
+                failed_before = self._fetched_at is None
+            if not fresh:
+                try:
+                    keys = self._fetch()
+                except Exception:
+                    if failed_before:
+                        raise
+                    logging.exception("Refreshing the JWKS failed, keeping the known keys")
+                    keys = None
+                with self._lock:
+                    if keys is None:
+                        self._counters["refresh_errors"] += 1
+                    else:
+                        self._keys = keys
+                        self._counters["refreshes"] += 1
+                    self._fetched_at = now
+            with self._lock:
+                if kid not in self._keys:
+                    raise jwt.InvalidKeyError(f"Unknown signing key {kid}")
+                return self._keys[kid]
+
+    def key(self, kid) -> jwt.PyJWK:
+        return self._lookup(kid) or self._refresh(kid)
+
+    async def akey(self, kid) -> jwt.PyJWK:
+        """key, fetching the keys off the event loop."""
+        return self._lookup(kid) or await asyncio.to_thread(self._refresh, kid)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters, keys=len(self._keys))
+
+
+class TokenVerifier():
+    """
+    Verifies the signature and the exp, nbf, iss and aud claims of access tokens against the cached
+    JWKS, without a call to the issuer per request. Verified tokens are kept in an LRU of
+    cache_size entries until they expire, so a token seen again is only looked up.
+    """
+
+    def __init__(self, jwks: JWKSCache, issuer: str, audience: str = None, cache_size: int = 1024,
+                 leeway_seconds: float = 120.0, clock=time.time):
+        self.jwks = jwks
+        self.issuer = issuer
+        self.audience = audience
+        self.cache_size = cache_size
+        self.leeway_seconds = leeway_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._verified = collections.OrderedDict()
+        self._counters = {"cache_hits": 0, "verified": 0, "rejected": 0}
+
+    @classmethod
+    def from_settings(cls, settings: AuthSettings):
+        if not settings.issuer:
+            return None
+        return cls(JWKSCache(settings.jwks_uri, settings.jwks_cache_seconds), settings.issuer, settings.audience,
+                   settings.token_cache_size, settings.leeway_seconds)
+
+    def _cached(self, token):
+        with self._lock:
+            entry = self._verified.get(token)
+            if entry is None:
+                return None
+            claims, expires_at = entry
+            if expires_at + self.leeway_seconds <= self.clock():
+                del self._verified[token]
+                return None
+            self._verified.move_to_end(token)
+            self._counters["cache_hits"] += 1
+            return claims
+
+    def _decode(self, token, key: jwt.PyJWK) -> dict:
+        try:
+            claims = jwt.decode(token, key.key, algorithms=[key.algorithm_name], audience=self.audience, issuer=self.issuer,
+                                leeway=self.leeway_seconds, options={"require": ["exp"], "verify_aud": self.audience is not None})
+        except jwt.PyJWTError:
+            with self._lock:
+                self._counters["rejected"] += 1
+            raise
+        with self._lock:
+            self._counters["verified"] += 1
+            if self.cache_size:
+                self._verified[token] = (claims, claims["exp"])
+                while len(self._verified) > self.cache_size:
+                    self._verified.popitem(last=False)
+        return claims
+
+    def _kid(self, token):
+        try:
+            return jwt.get_unverified_header(token).get("kid")
+        except jwt.PyJWTError:
+            with self._lock:
+                self._counters["rejected"] += 1
+            raise
+
+    def verify(self, token: str) -> dict:
+        """The claims of token, raises jwt.PyJWTError when it is not valid."""
+        claims = self._cached(token)
+        if claims is None:
+            claims = self._decode(token, self.jwks.key(self._kid(token)))
+        return claims
+
+    async def averify(self, token: str) -> dict:
+        claims = self._cached(token)
+        if claims is None:
+            claims = self._decode(token, await self.jwks.akey(self._kid(token)))
+        return claims
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._counters, cached=len(self._verified))
+        stats["jwks"] = self.jwks.snapshot()
+        return stats
+
+
+token_verifier = TokenVerifier.from_settings(AuthSettings.from_env())
+if token_verifier:
+    metrics.register("auth", token_verifier.snapshot)
+
+
+def _error(message, status_code, error=None):
+    # a body and status, answered as is by both Flask and Quart
+    return {"message": message, "data": None, "error": error or message}, status_code
+
+
+def _auth_disabled() -> bool:
+    if os.getenv("JWT_AUTH_DISABLED", "false").lower() == "true":
+        logging.info('Running locally, skipping auth')
+        return True
+    return False
+
+
+def _token(request):
     try:
-        # await verifier.verify(token)
-        return JWTUtils.parse_token(token)[1] # Returns the JWT claims only
+        return request.headers["Authorization"].split(" ")[1]
     except Exception:
         return None
 
 
+def _verifier() -> TokenVerifier:
+    if token_verifier is None:
+        raise RuntimeError("OKTA_JWT_ISSUER is not set, access tokens cannot be verified")
+    return token_verifier
+
+
 """
 Decorator to verify JWT access token.
-Add to any route that requires authentication.
+Add to any route that requires authentication, sync (Flask) or async (Quart).
 If authentication succeeds, passes the JWT claims to the route.
 :returns: 401 if no token is provided.
 :returns: 403 if token is invalid.
+:returns: 500 if it cannot be verified, e.g. without OKTA_JWT_ISSUER or when the JWKS cannot be fetched.
 """
 def jwt_required(f):
-    @wraps(f)
-    async def decorated(*args, **kwargs):
-        jwt_claims = None
-        token: str = None
-        is_auth_disabled: bool = os.getenv("JWT_AUTH_DISABLED", "false").lower() == "true"
-
-        if is_auth_disabled:
-            logging.info('Running locally, skipping auth')
-        else:
-            try:
-                token = request.headers["Authorization"].split(" ")[1]
-            except Exception:
-                pass
+    if inspect.iscoroutinefunction(f):
+        from quart import request
 
+        @wraps(f)
+        async def decorated_async(*args, **kwargs):
+            if _auth_disabled():
+                return await f(None, *args, **kwargs)
+            token = _token(request)
             if not token:
-                return jsonify({
-                    "message": "Unauthorized",
-                    "data": None,
-                    "error": "Unauthorized"
-                }), 401
+                return _error("Unauthorized", 401)
             try:
-                jwt_claims = await _verify_jwt_access_token(token)
-                if jwt_claims is None:
-                    return jsonify({
-                        "message": "Unauthorized",
-                        "data": None,
-                        "error": "Unauthorized"
-                    }), 403
+                jwt_claims = await _verifier().averify(token)
+            except jwt.PyJWTError as e:
+                logging.info(f"Rejected access token: {e}")
+                return _error("Unauthorized", 403)
             except Exception as e:
-                return jsonify({
-                    "message": "Something went wrong",
-                    "data": None,
-                    "error": str(e)
-                }), 500
+                return _error("Something went wrong", 500, str(e))
+            return await f(jwt_claims, *args, **kwargs)
+        return decorated_async
 
+    from flask import request
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if _auth_disabled():
+            return f(None, *args, **kwargs)
+        token = _token(request)
+        if not token:
+            return _error("Unauthorized", 401)
+        try:
+            jwt_claims = _verifier().verify(token)
+        except jwt.PyJWTError as e:
+            logging.info(f"Rejected access token: {e}")
+            return _error("Unauthorized", 403)
+        except Exception as e:
+            return _error("Something went wrong", 500, str(e))
         return f(jwt_claims, *args, **kwargs)
-    return decorated
\ No newline at end of file
+    return decorated
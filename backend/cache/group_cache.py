@@ -0,0 +1,129 @@
+"""
+Per-user cache of Microsoft Graph group memberships used for search security trimming.
+
+Entries are keyed by the subject of the user's access token (tenant + object id), so a user keeps
+one entry across chats. Each entry also remembers a digest of the token it was fetched with and is
+only served for that same token: the claims are read without verifying the signature, and a
+different token claiming the same subject is looked up in Graph again, which validates it.
+
+Concurrent lookups for the same token share one Graph call (single flight), and the security
+filter built from the groups is cached with the entry.
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def token_subject(token: str) -> str:
+    """tenant/object id of a JWT access token, a digest of the token when it cannot be decoded."""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        subject = claims.get("oid") or claims.get("sub")
+        if subject:
+            return f"{claims.get('tid', '')}/{subject}"
+    except (IndexError, ValueError, AttributeError):
+        pass
+    return _digest(token)
+
+
+def _digest(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class _Entry():
+    __slots__ = ("expires_at", "token_digest", "groups", "filter")
+
+    def __init__(self, expires_at, token_digest, groups):
+        self.expires_at = expires_at
+        self.token_digest = token_digest
+        self.groups = groups
+        self.filter = None
+
+
+class _Flight():
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+        self.error = None
+
+
+class GroupMembershipCache():
+    def __init__(self, fetch_groups, ttl_seconds: float = 300, max_entries: int = 10000, clock=time.monotonic):
+        # fetch_groups(token) returns the group objects of the token's user and raises on failure
+        self.fetch_groups = fetch_groups
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._counters = {"hits": 0, "misses": 0, "shared_lookups": 0, "errors": 0}
+
+    @classmethod
+    def from_env(cls, fetch_groups):
+        return cls(
+            fetch_groups,
+            ttl_seconds=float(os.environ.get("GRAPH_GROUPS_CACHE_TTL_SECONDS", 300)),
+            max_entries=int(os.environ.get("GRAPH_GROUPS_CACHE_MAX_ENTRIES", 10000)),
+        )
+
+    def _entry(self, token: str) -> _Entry:
+        subject = token_subject(token)
+        token_digest = _digest(token)
+        with self._lock:
+            entry = self._entries.get(subject)
+            if entry is not None and entry.token_digest == token_digest and entry.expires_at > self.clock():
+                self._entries.move_to_end(subject)
+                self._counters["hits"] += 1
+                return entry
+            flight = self._inflight.get((subject, token_digest))
+            leader = flight is None
+            if leader:
+                flight = self._inflight[(subject, token_digest)] = _Flight()
+                self._counters["misses"] += 1
+            else:
+                self._counters["shared_lookups"] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.entry
+
+        try:
+            entry = _Entry(self.clock() + self.ttl_seconds, token_digest, list(self.fetch_groups(token)))
+            flight.entry = entry
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self._counters["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[(subject, token_digest)]
+                if flight.entry is not None and self.ttl_seconds > 0:
+                    self._entries[subject] = flight.entry
+                    self._entries.move_to_end(subject)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            flight.done.set()
+        return entry
+
+    def groups(self, token: str):
+        return self._entry(token).groups
+
+    def filter_string(self, token: str, build_filter):
+        """build_filter(groups) for the token's user, built once per cached entry."""
+        entry = self._entry(token)
+        if entry.filter is None:
+            entry.filter = build_filter(entry.groups)
+        return entry.filter
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries))
@@ -0,0 +1,303 @@
+"""
+Read-through cache of chat history reads: the conversation list pages of a user and the
+conversation documents and transcripts behind /history/read.
+
+Entries are not deleted on writes. Each entry key includes the current generation token of the
+scopes it depends on: the user, the user's conversation list and the conversation. A write replaces
+the tokens of the scopes it changes, so every entry that depended on them stops matching and
+ages out. With the Redis backend the tokens live next to the entries, and all instances see a write
+on their next read. A read that raced with a write stores its result under the old token, where
+nothing will look it up. A token that is evicted or expires is recreated as a new random one, which
+can only cause misses, never stale hits.
+
+Values are stored serialized, so callers can modify what they get back (rename does).
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from backend.history.bulk_delete import MAX_BATCH_OPERATIONS
+from backend.history.store import ConversationStore
+from backend.serialization import dumps, loads
+
+
+class HistoryCacheSettings():
+    def __init__(self, enabled: bool = False, backend: str = "memory", redis_url: str = None, ttl_seconds: int = 300,
+                 max_entries: int = 10000):
+        self.enabled = enabled
+        self.backend = backend
+        self.redis_url = redis_url
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get("HISTORY_CACHE_ENABLED", "false").lower() == "true",
+            backend=os.environ.get("HISTORY_CACHE_BACKEND", "memory").lower(),
+            redis_url=os.environ.get("HISTORY_CACHE_REDIS_URL") or os.environ.get("RESPONSE_CACHE_REDIS_URL"),
+            ttl_seconds=int(os.environ.get("HISTORY_CACHE_TTL_SECONDS", 300)),
+            max_entries=int(os.environ.get("HISTORY_CACHE_MAX_ENTRIES", 10000)),
+        )
+
+
+class MemoryHistoryCacheBackend():
+    """Process-local LRUs of entries and of generation tokens, both bounded by max_entries."""
+
+    def __init__(self, max_entries: int = 10000, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tokens = OrderedDict()
+
+    def _remember(self, items, key, value):
+        items[key] = value
+        items.move_to_end(key)
+        while len(items) > self.max_entries:
+            items.popitem(last=False)
+
+    def tokens(self, scopes, ttl_seconds):
+        with self._lock:
+            tokens = []
+            for scope in scopes:
+                token = self._tokens.get(scope)
+                if token is None:
+                    token = uuid.uuid4().hex
+                self._remember(self._tokens, scope, token)
+                tokens.append(token)
+            return tokens
+
+    def bump(self, scopes, ttl_seconds):
+        with self._lock:
+            for scope in scopes:
+                self._remember(self._tokens, scope, uuid.uuid4().hex)
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value, ttl_seconds):
+        with self._lock:
+            self._remember(self._entries, key, (self.clock() + ttl_seconds, value))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisHistoryCacheBackend():
+    """Shared backend for any Redis-compatible server, entries and tokens expire, eviction is left to the server."""
+
+    def __init__(self, url: str, prefix: str = "aoai-chat:history-cache", client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def _token_key(self, scope):
+        return f"{self.prefix}:token:{scope}"
+
+    def tokens(self, scopes, ttl_seconds):
+        keys = [self._token_key(scope) for scope in scopes]
+        tokens = self.client.mget(keys)
+        missing = [i for i, token in enumerate(tokens) if token is None]
+        if missing:
+            # tokens outlive the entries made with them; concurrent creators agree on the first one set
+            pipeline = self.client.pipeline()
+            for i in missing:
+                pipeline.set(keys[i], uuid.uuid4().hex, nx=True, ex=ttl_seconds * 2)
+                pipeline.get(keys[i])
+            results = pipeline.execute()
+            for n, i in enumerate(missing):
+                tokens[i] = results[2 * n + 1]
+        return [token.decode("utf-8") if isinstance(token, bytes) else token for token in tokens]
+
+    def bump(self, scopes, ttl_seconds):
+        pipeline = self.client.pipeline()
+        for scope in scopes:
+            pipeline.set(self._token_key(scope), uuid.uuid4().hex, ex=ttl_seconds * 2)
+        pipeline.execute()
+
+    def get(self, key):
+        return self.client.get(f"{self.prefix}:entry:{key}")
+
+    def put(self, key, value, ttl_seconds):
+        self.client.set(f"{self.prefix}:entry:{key}", value, ex=ttl_seconds)
+
+
+def user_scope(user_id):
+    return f"user:{user_id}"
+
+
+def list_scope(user_id):
+    return f"list:{user_id}"
+
+
+def conversation_scope(user_id, conversation_id):
+    return f"conversation:{user_id}:{conversation_id}"
+
+
+class HistoryCache():
+    def __init__(self, backend, ttl_seconds: int = 300):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "invalidations": 0, "errors": 0}
+
+    @classmethod
+    def from_settings(cls, settings: HistoryCacheSettings):
+        if settings.backend == "redis":
+            backend = RedisHistoryCacheBackend(settings.redis_url)
+        elif settings.backend == "memory":
+            backend = MemoryHistoryCacheBackend(settings.max_entries)
+        else:
+            raise ValueError(f"Unknown HISTORY_CACHE_BACKEND: {settings.backend}")
+        return cls(backend, settings.ttl_seconds)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def read_through(self, scopes, name, load):
+        """The cached value of name under the current tokens of scopes, load() on a miss."""
+        try:
+            tokens = self.backend.tokens(scopes, self.ttl_seconds)
+            key = hashlib.sha256("\n".join([name] + tokens).encode("utf-8")).hexdigest()
+            raw = self.backend.get(key)
+        except Exception:
+            logging.exception("History cache lookup failed")
+            self._count("errors")
+            return load()
+        if raw is not None:
+            self._count("hits")
+            return loads(raw)["value"]
+
+        self._count("misses")
+        value = load()
+        try:
+            self.backend.put(key, dumps({"value": value}), self.ttl_seconds)
+        except Exception:
+            logging.exception("History cache store failed")
+            self._count("errors")
+        return value
+
+    def invalidate(self, *scopes):
+        try:
+            self.backend.bump(scopes, self.ttl_seconds)
+        except Exception:
+            # the entries of these scopes can be stale until they expire
+            logging.exception("History cache invalidation failed")
+            self._count("errors")
+            return
+        self._count("invalidations")
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        if isinstance(self.backend, MemoryHistoryCacheBackend):
+            stats["entries"] = len(self.backend)
+        return stats
+
+
+class CachingConversationStore(ConversationStore):
+    """A ConversationStore whose list and read operations go through a HistoryCache."""
+
+    def __init__(self, store: ConversationStore, cache: HistoryCache):
+        self.store = store
+        self.cache = cache
+
+    ## reads
+
+    def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        return self.cache.read_through([user_scope(user_id), list_scope(user_id)], f"list\n{user_id}\n{limit}\n{sort_order}\n{offset}",
+                                       lambda: self.store.get_conversations(user_id, limit, sort_order, offset))
+
+    def get_conversations_page(self, user_id, limit, cursor = None):
+        page, next_cursor = self.cache.read_through([user_scope(user_id), list_scope(user_id)], f"page\n{user_id}\n{limit}\n{cursor}",
+                                                    lambda: list(self.store.get_conversations_page(user_id, limit, cursor)))
+        return page, next_cursor
+
+    def get_conversation(self, user_id, conversation_id):
+        return self.cache.read_through([user_scope(user_id), conversation_scope(user_id, conversation_id)], f"conversation\n{user_id}\n{conversation_id}",
+                                       lambda: self.store.get_conversation(user_id, conversation_id))
+
+    def get_messages(self, user_id, conversation_id):
+        return self.cache.read_through([user_scope(user_id), conversation_scope(user_id, conversation_id)], f"messages\n{user_id}\n{conversation_id}",
+                                       lambda: self.store.get_messages(user_id, conversation_id))
+
+    def get_history_item_ids(self, user_id):
+        return self.store.get_history_item_ids(user_id)
+
+    def ensure(self):
+        return self.store.ensure()
+
+    ## writes invalidate what they change
+
+    def create_conversation(self, user_id, title = ''):
+        conversation = self.store.create_conversation(user_id, title)
+        self.cache.invalidate(list_scope(user_id))
+        return conversation
+
+    def upsert_conversation(self, conversation):
+        resp = self.store.upsert_conversation(conversation)
+        self.cache.invalidate(list_scope(conversation['userId']), conversation_scope(conversation['userId'], conversation['id']))
+        return resp
+
+    def set_title(self, user_id, conversation_id, title):
+        try:
+            return self.store.set_title(user_id, conversation_id, title)
+        finally:
+            self.cache.invalidate(list_scope(user_id), conversation_scope(user_id, conversation_id))
+
+    def set_summary(self, user_id, conversation_id, summary):
+        try:
+            return self.store.set_summary(user_id, conversation_id, summary)
+        finally:
+            # the summary is not part of the list projection
+            self.cache.invalidate(conversation_scope(user_id, conversation_id))
+
+    def save_messages(self, conversation_id, user_id, messages: list):
+        try:
+            return self.store.save_messages(conversation_id, user_id, messages)
+        finally:
+            # the transcript and the conversation's updatedAt, and with it the list order, changed
+            self.cache.invalidate(list_scope(user_id), conversation_scope(user_id, conversation_id))
+
+    def delete_conversation(self, user_id, conversation_id):
+        try:
+            return self.store.delete_conversation(user_id, conversation_id)
+        finally:
+            self.cache.invalidate(list_scope(user_id), conversation_scope(user_id, conversation_id))
+
+    def delete_messages(self, conversation_id, user_id):
+        try:
+            return self.store.delete_messages(conversation_id, user_id)
+        finally:
+            self.cache.invalidate(list_scope(user_id), conversation_scope(user_id, conversation_id))
+
+    def delete_history(self, user_id, message_ids, conversation_ids, batch_size = MAX_BATCH_OPERATIONS, concurrency = 4, progress = None):
+        # reads during a long deletion see (and cache) partial states, so invalidate again at the end
+        self.cache.invalidate(user_scope(user_id))
+        try:
+            return self.store.delete_history(user_id, message_ids, conversation_ids, batch_size, concurrency, progress)
+        finally:
+            self.cache.invalidate(user_scope(user_id))
+
+    def close(self):
+        close = getattr(self.store, 'close', None)
+        if close:
+            close()
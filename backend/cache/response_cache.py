@@ -0,0 +1,364 @@
+"""
+Response cache for /conversation.
+
+Answers are keyed on the normalized tail of the conversation (the last few user/assistant messages)
+and a scope: the earlier messages of the conversation, and everything else that shapes the answer,
+such as the model, the data source configuration and the per-user security filter. A follow-up such
+as "and the second one?" is only answered from the cache after the same conversation, while the
+first question of a conversation is shared by all of them. A lookup is first an exact match on that
+key and, when a similarity threshold is configured, then a cosine-similarity match between the
+embedding of the tail and the embeddings of the answers cached in the same scope.
+
+Cached answers are the response messages (citations and assistant text) recorded from a completed
+response. They are replayed with the history_metadata of the current request, either as NDJSON
+stream lines or as a single JSON response.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from array import array
+from collections import OrderedDict
+from operator import mul
+
+from backend.serialization import dumps, loads
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = " .?!"
+
+
+def normalize_text(text) -> str:
+    return _WHITESPACE.sub(" ", str(text or "")).strip().strip(_TRAILING_PUNCTUATION).lower()
+
+
+def conversation_turns(messages):
+    """The user/assistant messages as (role, normalized content) pairs, tool messages are skipped."""
+    return [(message["role"], normalize_text(message["content"]))
+            for message in messages if message.get("role") in ("user", "assistant") and message.get("content")]
+
+
+def _unit_vector(vector):
+    norm = sum(map(mul, vector, vector)) ** 0.5
+    return array("f", (v / norm for v in vector)) if norm else None
+
+
+def _ranked(vector, candidates, threshold):
+    """The digests of the (digest, vector) candidates at least threshold similar to vector, most similar first."""
+    scored = [(sum(map(mul, vector, candidate)), digest) for digest, candidate in candidates]
+    return [digest for score, digest in sorted(scored, key=lambda item: item[0], reverse=True) if score >= threshold]
+
+
+class ResponseCacheSettings():
+    def __init__(self, enabled: bool = False, backend: str = "memory", redis_url: str = None, ttl_seconds: int = 3600,
+                 max_entries: int = 1000, similarity_threshold: float = 0.0, embedding_deployment: str = None,
+                 tail_messages: int = 1, max_candidates: int = 500):
+        self.enabled = enabled
+        self.backend = backend
+        self.redis_url = redis_url
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.embedding_deployment = embedding_deployment
+        self.tail_messages = tail_messages
+        self.max_candidates = max_candidates
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() == "true",
+            backend=os.environ.get("RESPONSE_CACHE_BACKEND", "memory").lower(),
+            redis_url=os.environ.get("RESPONSE_CACHE_REDIS_URL"),
+            ttl_seconds=int(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 3600)),
+            max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1000)),
+            similarity_threshold=float(os.environ.get("RESPONSE_CACHE_SIMILARITY_THRESHOLD", 0)),
+            embedding_deployment=os.environ.get("RESPONSE_CACHE_EMBEDDING_DEPLOYMENT") or os.environ.get("AZURE_OPENAI_EMBEDDING_NAME"),
+            tail_messages=int(os.environ.get("RESPONSE_CACHE_TAIL_MESSAGES", 1)),
+            max_candidates=int(os.environ.get("RESPONSE_CACHE_MAX_CANDIDATES", 500)),
+        )
+
+
+class CacheKey():
+    def __init__(self, scope: str, text: str):
+        self.scope = scope
+        self.text = text
+        self.digest = hashlib.sha256(f"{scope}\n{text}".encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend():
+    """
+    Process-local LRU with per-entry expiry. The embeddings are indexed by scope, a similarity
+    lookup compares the newest max_candidates of its scope, outside of the lock.
+    """
+
+    def __init__(self, max_entries: int = 1000, clock=time.monotonic, max_candidates: int = 500):
+        self.max_entries = max_entries
+        self.max_candidates = max_candidates
+        self.clock = clock
+        self._lock = threading.Lock()
+        # digest -> (expires_at, scope, vector, entry)
+        self._entries = OrderedDict()
+        # scope -> digest -> vector, oldest first
+        self._vectors = {}
+
+    def _remove(self, digest):
+        _, scope, vector, _ = self._entries.pop(digest)
+        if vector is not None:
+            vectors = self._vectors[scope]
+            del vectors[digest]
+            if not vectors:
+                del self._vectors[scope]
+
+    def get(self, digest):
+        with self._lock:
+            item = self._entries.get(digest)
+            if item is None:
+                return None
+            if item[0] <= self.clock():
+                self._remove(digest)
+                return None
+            self._entries.move_to_end(digest)
+            return item[3]
+
+    def nearest(self, scope, vector, threshold):
+        with self._lock:
+            vectors = self._vectors.get(scope)
+            candidates = list(vectors.items())[-self.max_candidates:] if vectors else []
+        # expired entries are skipped by get
+        for digest in _ranked(vector, candidates, threshold):
+            entry = self.get(digest)
+            if entry is not None:
+                return entry
+        return None
+
+    def put(self, digest, entry, ttl_seconds, scope, vector=None):
+        with self._lock:
+            if digest in self._entries:
+                self._remove(digest)
+            self._entries[digest] = (self.clock() + ttl_seconds, scope, vector, entry)
+            if vector is not None:
+                self._vectors.setdefault(scope, OrderedDict())[digest] = vector
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCacheBackend():
+    """
+    Shared backend for any Redis-compatible server. Entries expire with the TTL, size eviction is
+    left to the server (maxmemory-policy allkeys-lru). The embedding of an entry has a key of its own
+    with the same TTL, and each scope a sorted set of its digests scored by their expiry time: expired
+    digests are removed on every lookup and store, and only the newest max_candidates are kept.
+    """
+
+    def __init__(self, url: str, prefix: str = "aoai-chat:response-cache", client=None, max_candidates: int = 500, clock=time.time):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.max_candidates = max_candidates
+        self.clock = clock
+
+    def _entry_key(self, digest):
+        return f"{self.prefix}:entry:{digest}"
+
+    def _vector_key(self, digest):
+        return f"{self.prefix}:vector:{digest}"
+
+    def _scope_key(self, scope):
+        return f"{self.prefix}:scope:{scope}"
+
+    def get(self, digest):
+        value = self.client.get(self._entry_key(digest))
+        return loads(value) if value is not None else None
+
+    def nearest(self, scope, vector, threshold):
+        pipeline = self.client.pipeline()
+        pipeline.zremrangebyscore(self._scope_key(scope), "-inf", self.clock())
+        pipeline.zrevrange(self._scope_key(scope), 0, self.max_candidates - 1)
+        _, digests = pipeline.execute()
+        if not digests:
+            return None
+        digests = [digest.decode("utf-8") for digest in digests]
+        raw_vectors = self.client.mget([self._vector_key(digest) for digest in digests])
+        candidates = [(digest, array("f", raw)) for digest, raw in zip(digests, raw_vectors) if raw is not None]
+        # entries evicted by the server before their expiry are skipped for the next best
+        for digest in _ranked(vector, candidates, threshold):
+            entry = self.get(digest)
+            if entry is not None:
+                return entry
+            self.client.zrem(self._scope_key(scope), digest)
+        return None
+
+    def put(self, digest, entry, ttl_seconds, scope, vector=None):
+        pipeline = self.client.pipeline()
+        pipeline.set(self._entry_key(digest), dumps(entry), ex=ttl_seconds)
+        if vector is not None:
+            now = self.clock()
+            pipeline.set(self._vector_key(digest), vector.tobytes(), ex=ttl_seconds)
+            pipeline.zadd(self._scope_key(scope), {digest: now + ttl_seconds})
+            pipeline.zremrangebyscore(self._scope_key(scope), "-inf", now)
+            pipeline.zremrangebyrank(self._scope_key(scope), 0, -self.max_candidates - 1)
+            # every member left expires within the TTL, so does the set
+            pipeline.expire(self._scope_key(scope), ttl_seconds)
+        pipeline.execute()
+
+
+class ResponseCache():
+    def __init__(self, backend, ttl_seconds: int = 3600, similarity_threshold: float = 0.0, tail_messages: int = 1):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.tail_messages = tail_messages
+        self._lock = threading.Lock()
+        self._counters = {"lookups": 0, "exact_hits": 0, "similar_hits": 0, "stores": 0, "errors": 0}
+
+    @classmethod
+    def from_settings(cls, settings: ResponseCacheSettings):
+        """The configured cache, None when caching is disabled."""
+        if not settings.enabled:
+            return None
+        if settings.backend == "redis":
+            backend = RedisCacheBackend(settings.redis_url, max_candidates=settings.max_candidates)
+        elif settings.backend == "memory":
+            backend = MemoryCacheBackend(settings.max_entries, max_candidates=settings.max_candidates)
+        else:
+            raise ValueError(f"Unknown RESPONSE_CACHE_BACKEND: {settings.backend}")
+        return cls(backend, settings.ttl_seconds, settings.similarity_threshold, settings.tail_messages)
+
+    @property
+    def similarity_enabled(self):
+        return self.similarity_threshold > 0
+
+    def key(self, scope, messages):
+        """Cache key of a request, None when the conversation has nothing to key on."""
+        turns = conversation_turns(messages)
+        if not turns or turns[-1][0] != "user":
+            return None
+        tail = turns[-self.tail_messages:] if self.tail_messages > 0 else turns
+        earlier = turns[:len(turns) - len(tail)]
+        scope = hashlib.sha256((scope if isinstance(scope, bytes) else dumps(scope)) + dumps(earlier)).hexdigest()
+        return CacheKey(scope, "\n".join(f"{role}: {content}" for role, content in tail))
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def get(self, key: CacheKey):
+        self._count("lookups")
+        try:
+            entry = self.backend.get(key.digest)
+        except Exception:
+            logging.exception("Response cache lookup failed")
+            self._count("errors")
+            return None
+        if entry is not None:
+            self._count("exact_hits")
+        return entry
+
+    def get_similar(self, key: CacheKey, embedding):
+        """Closest cached answer in the scope of key whose similarity reaches the threshold."""
+        vector = _unit_vector(embedding)
+        if vector is None:
+            return None
+        try:
+            entry = self.backend.nearest(key.scope, vector, self.similarity_threshold)
+        except Exception:
+            logging.exception("Response cache similarity lookup failed")
+            self._count("errors")
+            return None
+        if entry is not None:
+            self._count("similar_hits")
+        return entry
+
+    def put(self, key: CacheKey, entry, embedding=None):
+        vector = _unit_vector(embedding) if embedding else None
+        try:
+            self.backend.put(key.digest, entry, self.ttl_seconds, key.scope, vector)
+        except Exception:
+            logging.exception("Response cache store failed")
+            self._count("errors")
+            return
+        self._count("stores")
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._counters)
+        hits = stats["exact_hits"] + stats["similar_hits"]
+        stats["hit_rate"] = hits / stats["lookups"] if stats["lookups"] else 0.0
+        if isinstance(self.backend, MemoryCacheBackend):
+            stats["entries"] = len(self.backend)
+        return stats
+
+
+class AnswerRecorder():
+    """
+    Collects the response bytes sent to the client and turns them into a cache entry once the
+    response is complete. Parsing happens once at the end, not per streamed line.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def feed(self, chunk):
+        self._chunks.append(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+
+    def answer(self):
+        """The cache entry, None when the response failed or had no assistant content."""
+        envelope = None
+        tool_messages = []
+        content = []
+        for line in b"".join(self._chunks).splitlines():
+            if not line.strip():
+                continue
+            try:
+                obj = loads(line)
+            except ValueError:
+                return None
+            if not isinstance(obj, dict) or "error" in obj or not obj.get("choices"):
+                return None
+            envelope = obj
+            for message in obj["choices"][0].get("messages", []):
+                if message.get("role") == "tool":
+                    tool_messages.append(message)
+                elif message.get("role") == "assistant":
+                    content.append(message.get("content") or "")
+        text = "".join(content)
+        if envelope is None or not text:
+            return None
+        return {
+            "model": envelope.get("model"),
+            "object": envelope.get("object"),
+            "messages": tool_messages + [{"role": "assistant", "content": text}],
+        }
+
+
+def _envelope(entry, messages, history_metadata):
+    return {
+        "id": f"cached-{uuid.uuid4()}",
+        "model": entry.get("model"),
+        "created": int(time.time()),
+        "object": entry.get("object"),
+        "choices": [{"messages": messages}],
+        "history_metadata": history_metadata,
+    }
+
+
+def replay_stream(entry, history_metadata):
+    """A cached answer as the NDJSON lines of a streamed response."""
+    lines = []
+    for message in entry["messages"]:
+        if message["role"] == "assistant":
+            lines.append(dumps(_envelope(entry, [{"role": "assistant", "content": ""}], history_metadata)) + b"\n")
+        lines.append(dumps(_envelope(entry, [message], history_metadata)) + b"\n")
+    return b"".join(lines)
+
+
+def replay_response(entry, history_metadata):
+    """A cached answer as the body of a non-streamed response."""
+    return _envelope(entry, entry["messages"], history_metadata)
@@ -0,0 +1,267 @@
+"""
+Admission control of /conversation and /dalle in front of the Azure OpenAI quota.
+
+Every request takes tokens from token buckets before it is sent: the estimated prompt and
+completion tokens and one request from the buckets of its user (ADMISSION_USER_TPM/_RPM) and of the
+deployment pool it goes to, whose limits are the summed "tpm"/"rpm" of the deployments in
+AZURE_OPENAI_DEPLOYMENTS. A bucket holds one minute of its limit and refills continuously, so short
+bursts pass and sustained use is held to the limit. The buckets of a request are taken all or
+nothing.
+
+A request that does not fit waits until its buckets have refilled enough, for at most
+max_wait_seconds, with at most max_queue requests of the process waiting. When the queue is full,
+or the wait would be longer, the request is rejected at once with AdmissionRejected, answered as a
+429 with the Retry-After the buckets need.
+
+The memory backend limits each process on its own. With the Redis backend the buckets are shared by
+all instances, and a script takes them atomically. When the backend fails, requests are admitted.
+"""
+import asyncio
+import collections
+import logging
+import os
+import threading
+import time
+
+# KEYS are the buckets, ARGV the time followed by amount, capacity and refill rate per bucket.
+# Returns the seconds to wait (0 when the amounts were taken) and the index of the bucket waited for.
+TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local wait, limiting = 0, 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local amount, capacity, rate = tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1])
+    local state = redis.call('HMGET', key, 'level', 'updated')
+    local level = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    level = math.min(capacity, level + math.max(0, now - updated) * rate)
+    levels[i] = level
+    if level < amount and (amount - level) / rate > wait then
+        wait, limiting = (amount - level) / rate, i
+    end
+end
+if wait == 0 then
+    for i, key in ipairs(KEYS) do
+        local amount, capacity, rate = tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i]), tonumber(ARGV[3 * i + 1])
+        redis.call('HSET', key, 'level', tostring(levels[i] - amount), 'updated', tostring(now))
+        redis.call('EXPIRE', key, math.ceil(capacity / rate) + 60)
+    end
+end
+return {tostring(wait), limiting}
+"""
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, scope, retry_after):
+        super().__init__(f"Too many requests for the {scope} quota, retry in {retry_after:.0f}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class AdmissionSettings():
+    def __init__(self, enabled: bool = False, user_tpm: int = 0, user_rpm: int = 0, max_wait_seconds: float = 10.0,
+                 max_queue: int = 100, backend: str = "memory", redis_url: str = None, max_buckets: int = 100000):
+        self.enabled = enabled
+        self.user_tpm = user_tpm
+        self.user_rpm = user_rpm
+        self.max_wait_seconds = max_wait_seconds
+        self.max_queue = max_queue
+        self.backend = backend
+        self.redis_url = redis_url
+        self.max_buckets = max_buckets
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get("ADMISSION_ENABLED", "false").lower() == "true",
+            user_tpm=int(os.environ.get("ADMISSION_USER_TPM", 0)),
+            user_rpm=int(os.environ.get("ADMISSION_USER_RPM", 0)),
+            max_wait_seconds=float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", 10)),
+            max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", 100)),
+            backend=os.environ.get("ADMISSION_BACKEND", "memory").lower(),
+            redis_url=os.environ.get("ADMISSION_REDIS_URL") or os.environ.get("RESPONSE_CACHE_REDIS_URL"),
+            max_buckets=int(os.environ.get("ADMISSION_MAX_BUCKETS", 100000)),
+        )
+
+
+class MemoryBucketBackend():
+    """
+    Buckets of this process, least recently used first. Buckets that have refilled to capacity are
+    the same as absent ones and are dropped; beyond max_buckets the least recently used are dropped
+    anyway, so client-chosen keys (X-Forwarded-For) cannot grow the table without bound.
+    """
+    remote = False
+
+    def __init__(self, clock=time.monotonic, max_buckets: int = 100000):
+        self.clock = clock
+        self.max_buckets = max_buckets
+        self._lock = threading.Lock()
+        # key -> (level, updated, capacity, rate)
+        self._buckets = collections.OrderedDict()
+
+    def take(self, buckets):
+        """Take amount from each (key, amount, capacity, rate) bucket, or nothing; (wait seconds, index of the limiting bucket)."""
+        with self._lock:
+            now = self.clock()
+            wait, limiting, levels = 0.0, 0, []
+            for i, (key, amount, capacity, rate) in enumerate(buckets):
+                level, updated, _, _ = self._buckets.get(key, (capacity, now, capacity, rate))
+                level = min(capacity, level + max(0.0, now - updated) * rate)
+                levels.append(level)
+                if level < amount and (amount - level) / rate > wait:
+                    wait, limiting = (amount - level) / rate, i
+            if wait == 0:
+                for (key, amount, capacity, rate), level in zip(buckets, levels):
+                    self._buckets[key] = (level - amount, now, capacity, rate)
+                    self._buckets.move_to_end(key)
+                self._prune(now)
+            return wait, limiting
+
+    def _prune(self, now):
+        while self._buckets:
+            key, (level, updated, capacity, rate) = next(iter(self._buckets.items()))
+            if level + (now - updated) * rate < capacity and len(self._buckets) <= self.max_buckets:
+                break
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisBucketBackend():
+    """Buckets shared by every instance on a Redis-compatible server, the clocks of the instances must agree."""
+    remote = True
+
+    def __init__(self, url: str, prefix: str = "aoai-chat:admission", client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.script = client.register_script(TAKE_SCRIPT)
+
+    def take(self, buckets):
+        args = [time.time()]
+        for _, amount, capacity, rate in buckets:
+            args += [amount, capacity, rate]
+        wait, limiting = self.script(keys=[f"{self.prefix}:{key}" for key, _, _, _ in buckets], args=args)
+        return float(wait), max(0, int(limiting) - 1)
+
+
+class AdmissionController():
+    def __init__(self, backend, quotas: dict = None, user_tpm: int = 0, user_rpm: int = 0, max_wait_seconds: float = 10.0,
+                 max_queue: int = 100, clock=time.monotonic, sleep=time.sleep, asleep=asyncio.sleep):
+        self.backend = backend
+        # pool name -> (tokens per minute, requests per minute), 0 for no limit
+        self.quotas = quotas or {}
+        self.user_tpm = user_tpm
+        self.user_rpm = user_rpm
+        self.max_wait_seconds = max_wait_seconds
+        self.max_queue = max_queue
+        self.clock = clock
+        self.sleep = sleep
+        self.asleep = asleep
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._counters = {"admitted": 0, "queued": 0, "rejected_user": 0, "rejected_deployment": 0, "queue_full": 0,
+                          "errors": 0, "wait_seconds": 0.0}
+
+    @classmethod
+    def from_settings(cls, settings: AdmissionSettings, quotas: dict):
+        if settings.backend == "redis":
+            backend = RedisBucketBackend(settings.redis_url)
+        elif settings.backend == "memory":
+            backend = MemoryBucketBackend(max_buckets=settings.max_buckets)
+        else:
+            raise ValueError(f"Unknown ADMISSION_BACKEND: {settings.backend}")
+        return cls(backend, quotas, settings.user_tpm, settings.user_rpm, settings.max_wait_seconds, settings.max_queue)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _buckets(self, user_id, pool, tokens):
+        """(key, amount, capacity, refill rate per second, scope) of the buckets a request takes from."""
+        tpm, rpm = self.quotas.get(pool, (0, 0))
+        limits = [(f"user:{user_id}:tokens", tokens, self.user_tpm, "user"), (f"user:{user_id}:requests", 1, self.user_rpm, "user"),
+                  (f"deployment:{pool}:tokens", tokens, tpm, "deployment"), (f"deployment:{pool}:requests", 1, rpm, "deployment")]
+        # a request larger than a bucket waits for a full bucket instead of forever
+        return [(key, min(amount, limit), limit, limit / 60, scope) for key, amount, limit, scope in limits if limit and amount]
+
+    def _take(self, buckets):
+        try:
+            wait, limiting = self.backend.take([bucket[:4] for bucket in buckets])
+        except Exception:
+            logging.exception("Admission control failed, admitting the request")
+            self._count("errors")
+            return 0.0, None
+        return wait, buckets[limiting][4]
+
+    def _enqueue(self) -> bool:
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                self._counters["queue_full"] += 1
+                return False
+            self._waiting += 1
+            self._counters["queued"] += 1
+            return True
+
+    def _dequeue(self):
+        with self._lock:
+            self._waiting -= 1
+
+    def _next_wait(self, wait, scope, started, queued):
+        """How long to sleep before trying again, raises AdmissionRejected when the request cannot wait that long."""
+        remaining = started + self.max_wait_seconds - self.clock()
+        if wait > remaining or (not queued and not self._enqueue()):
+            self._count(f"rejected_{scope}")
+            raise AdmissionRejected(scope, wait)
+        return wait
+
+    def admit(self, user_id: str, pool: str, tokens: int = 0) -> float:
+        """Take the request's tokens, waiting for them if need be; the seconds waited."""
+        buckets = self._buckets(user_id, pool, tokens)
+        started, queued = self.clock(), False
+        try:
+            while buckets:
+                wait, scope = self._take(buckets)
+                if not wait:
+                    break
+                wait = self._next_wait(wait, scope, started, queued)
+                queued = True
+                self.sleep(wait)
+        finally:
+            if queued:
+                self._dequeue()
+        return self._admitted(started)
+
+    async def aadmit(self, user_id: str, pool: str, tokens: int = 0) -> float:
+        """admit without blocking the event loop."""
+        buckets = self._buckets(user_id, pool, tokens)
+        started, queued = self.clock(), False
+        try:
+            while buckets:
+                if self.backend.remote:
+                    wait, scope = await asyncio.to_thread(self._take, buckets)
+                else:
+                    wait, scope = self._take(buckets)
+                if not wait:
+                    break
+                wait = self._next_wait(wait, scope, started, queued)
+                queued = True
+                await self.asleep(wait)
+        finally:
+            if queued:
+                self._dequeue()
+        return self._admitted(started)
+
+    def _admitted(self, started):
+        waited = self.clock() - started
+        with self._lock:
+            self._counters["admitted"] += 1
+            self._counters["wait_seconds"] += waited
+        return waited
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters, waiting=self._waiting, quotas={pool: {"tpm": tpm, "rpm": rpm} for pool, (tpm, rpm) in self.quotas.items()})
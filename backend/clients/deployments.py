@@ -0,0 +1,307 @@
+"""
+Routing of Azure OpenAI requests over several deployments.
+
+AZURE_OPENAI_DEPLOYMENTS lists the chat deployments as a JSON array, e.g.
+    [{"name": "east", "resource": "contoso-east", "key": "...", "deployment": "gpt-4-32k", "weight": 2, "tpm": 80000, "rpm": 480},
+     {"name": "west", "endpoint": "https://contoso-west.openai.azure.com/", "deployment": "gpt-4-32k"}]
+An entry without "key" uses AZURE_OPENAI_KEY and one without "deployment" the default deployment.
+AZURE_OPENAI_IMAGE_DEPLOYMENTS does the same for /dalle. Without them each pool holds the single
+deployment of AZURE_OPENAI_RESOURCE (or AZURE_OPENAI_ENDPOINT).
+
+AZURE_OPENAI_ROUTING picks the deployment of each request:
+- least_outstanding (default): fewest requests in flight per unit of weight
+- weighted: at random, in proportion to the weights
+- token_aware: the lowest share of the deployment's tokens per minute ("tpm") taken by the
+  estimated prompt and completion tokens of the requests it got in the last minute
+
+A deployment that answers 429 or 5xx, or cannot be reached, is taken out of rotation for the
+Retry-After it sent, or for a cooldown that doubles with each consecutive failure, and the request
+is tried on the next deployment. When every deployment is out of rotation, the one due back first
+is used anyway rather than failing the request without trying.
+"""
+import collections
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from backend.clients.retry import is_transient as should_fail_over, retry_after_seconds, status_code_of
+
+ROUTING_POLICIES = ("least_outstanding", "weighted", "token_aware")
+TOKEN_WINDOW_SECONDS = 60
+
+
+class Deployment():
+    def __init__(self, name: str, endpoint: str, api_key: str, deployment: str, weight: float = 1, tpm: int = 0, rpm: int = 0):
+        self.name = name
+        self.endpoint = endpoint.rstrip("/")
+        self.api_key = api_key
+        self.deployment = deployment
+        self.weight = weight
+        self.tpm = tpm
+        self.rpm = rpm
+        # runtime state, guarded by the pool's lock
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.unavailable_until = 0.0
+        self.tokens = collections.deque()
+        self.counters = {"picks": 0, "successes": 0, "failures": 0, "throttled": 0, "errors": 0}
+
+    @classmethod
+    def from_dict(cls, entry: dict, api_key: str = None, deployment: str = None):
+        endpoint = entry.get("endpoint") or f"https://{entry['resource']}.openai.azure.com"
+        deployment = entry.get("deployment") or deployment
+        return cls(
+            name=entry.get("name") or f"{endpoint.rstrip('/').split('//')[-1]}/{deployment}",
+            endpoint=endpoint,
+            api_key=entry.get("key", api_key),
+            deployment=deployment,
+            weight=float(entry.get("weight", 1)),
+            tpm=int(entry.get("tpm", 0)),
+            rpm=int(entry.get("rpm", 0)),
+        )
+
+    def recent_tokens(self, now) -> int:
+        while self.tokens and self.tokens[0][0] <= now - TOKEN_WINDOW_SECONDS:
+            self.tokens.popleft()
+        return sum(tokens for _, tokens in self.tokens)
+
+
+class DeploymentPoolSettings():
+    def __init__(self, deployments: list, routing: str = "least_outstanding", cooldown_seconds: float = 5.0,
+                 max_cooldown_seconds: float = 60.0):
+        self.deployments = deployments
+        self.routing = routing
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+
+    @classmethod
+    def from_env(cls, variable: str, endpoint: str, api_key: str, deployment: str):
+        """The deployments listed in the JSON of variable, or the one at endpoint."""
+        entries = json.loads(os.environ.get(variable) or "[]") or [{"name": "default", "endpoint": endpoint}]
+        return cls(
+            deployments=[Deployment.from_dict(entry, api_key, deployment) for entry in entries],
+            routing=os.environ.get("AZURE_OPENAI_ROUTING", "least_outstanding").lower(),
+            cooldown_seconds=float(os.environ.get("AZURE_OPENAI_FAILOVER_COOLDOWN_SECONDS", 5)),
+            max_cooldown_seconds=float(os.environ.get("AZURE_OPENAI_FAILOVER_MAX_COOLDOWN_SECONDS", 60)),
+        )
+
+
+class Lease():
+    """A request in flight on a deployment, released once when it is over."""
+
+    def __init__(self, pool, deployment: Deployment):
+        self.pool = pool
+        self.deployment = deployment
+        self.released = False
+
+    def release(self, error=None):
+        if not self.released:
+            self.released = True
+            self.pool._release(self.deployment, error)
+
+    def wrap(self, stream):
+        """Yield from stream and release when it ends, fails or is closed."""
+        try:
+            for chunk in stream:
+                yield chunk
+        except Exception as e:
+            self.release(e)
+            raise
+        finally:
+            self.release()
+
+    async def awrap(self, stream):
+        try:
+            async for chunk in stream:
+                yield chunk
+        except Exception as e:
+            self.release(e)
+            raise
+        finally:
+            self.release()
+
+
+class DeploymentPool():
+    def __init__(self, deployments, routing: str = "least_outstanding", cooldown_seconds: float = 5.0,
+                 max_cooldown_seconds: float = 60.0, clock=time.monotonic, rng=None):
+        if not deployments:
+            raise ValueError("A deployment pool needs at least one deployment")
+        if routing not in ROUTING_POLICIES:
+            raise ValueError(f"Unknown AZURE_OPENAI_ROUTING: {routing}")
+        self.deployments = list(deployments)
+        self.routing = routing
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._counters = {"requests": 0, "failovers": 0, "exhausted": 0}
+
+    @classmethod
+    def from_settings(cls, settings: DeploymentPoolSettings):
+        return cls(settings.deployments, settings.routing, settings.cooldown_seconds, settings.max_cooldown_seconds)
+
+    @property
+    def model(self) -> str:
+        """The deployment names of the pool, to log and to scope cached answers by."""
+        return ",".join(sorted({deployment.deployment for deployment in self.deployments}))
+
+    def quota(self):
+        """Tokens and requests per minute of all deployments together, 0 when one has no such limit."""
+        tpm = sum(deployment.tpm for deployment in self.deployments) if all(deployment.tpm for deployment in self.deployments) else 0
+        rpm = sum(deployment.rpm for deployment in self.deployments) if all(deployment.rpm for deployment in self.deployments) else 0
+        return tpm, rpm
+
+    ## routing
+
+    def acquire(self, tokens: int = 0, exclude=()) -> Lease:
+        with self._lock:
+            now = self.clock()
+            candidates = [deployment for deployment in self.deployments if deployment not in exclude]
+            available = [deployment for deployment in candidates if deployment.unavailable_until <= now]
+            if available:
+                deployment = self._choose(available, tokens, now)
+            else:
+                # all out of rotation: try the one due back first instead of failing untried
+                deployment = min(candidates, key=lambda candidate: candidate.unavailable_until)
+                self._counters["exhausted"] += 1
+            deployment.outstanding += 1
+            deployment.counters["picks"] += 1
+            if tokens:
+                deployment.tokens.append((now, tokens))
+            self._counters["requests"] += 1
+        return Lease(self, deployment)
+
+    def _choose(self, available, tokens, now):
+        if len(available) == 1:
+            return available[0]
+        if self.routing == "weighted":
+            return self.rng.choices(available, weights=[deployment.weight for deployment in available])[0]
+        if self.routing == "token_aware":
+            # deployments without a tpm are compared by tokens per unit of weight
+            return min(available, key=lambda deployment: ((deployment.recent_tokens(now) + tokens) / (deployment.tpm or deployment.weight),
+                                                          deployment.outstanding / deployment.weight))
+        return min(available, key=lambda deployment: (deployment.outstanding / deployment.weight,
+                                                      deployment.counters["picks"] / deployment.weight))
+
+    def _release(self, deployment: Deployment, error=None):
+        with self._lock:
+            deployment.outstanding -= 1
+            if error is None:
+                deployment.counters["successes"] += 1
+                deployment.consecutive_failures = 0
+            elif should_fail_over(error):
+                deployment.counters["failures"] += 1
+                if status_code_of(error) == 429:
+                    deployment.counters["throttled"] += 1
+                deployment.consecutive_failures += 1
+                cooldown = retry_after_seconds(error)
+                if cooldown is None:
+                    cooldown = self.cooldown_seconds * 2 ** (deployment.consecutive_failures - 1)
+                deployment.unavailable_until = self.clock() + min(cooldown, self.max_cooldown_seconds)
+            else:
+                # the request was at fault, not the deployment
+                deployment.counters["errors"] += 1
+
+    def _fail_over(self, error, tried, deployment) -> bool:
+        tried.append(deployment)
+        if not should_fail_over(error) or len(tried) >= len(self.deployments):
+            return False
+        logging.warning(f"Deployment {deployment.name} failed ({status_code_of(error) or type(error).__name__}), failing over")
+        with self._lock:
+            self._counters["failovers"] += 1
+        return True
+
+    ## calls
+
+    def start(self, attempt, tokens: int = 0, failed=None, exclude=(), picked=None):
+        """
+        attempt(deployment) on the routed deployment, then on the next one while it fails with a
+        failover error. failed(result) can turn a result into such an error, e.g. a raw 429 response;
+        the last deployment's result is returned regardless. Returns the result and its Lease, which
+        the caller releases when done with the result (Lease.wrap for streams).
+
+        Deployments in exclude are not tried, and each deployment tried is appended to picked as it
+        is picked, for hedging.py to send a duplicate of a slow request elsewhere.
+        """
+        tried = list(exclude)
+        while True:
+            lease = self.acquire(tokens, exclude=tried)
+            if picked is not None:
+                picked.append(lease.deployment)
+            try:
+                result = attempt(lease.deployment)
+            except Exception as e:
+                lease.release(e)
+                if not self._fail_over(e, tried, lease.deployment):
+                    raise
+                continue
+            error = failed(result) if failed else None
+            if error is None:
+                return result, lease
+            lease.release(error)
+            if not self._fail_over(error, tried, lease.deployment):
+                return result, lease
+            close = getattr(result, "close", None)
+            if close:
+                close()
+
+    def call(self, attempt, tokens: int = 0, failed=None):
+        """start for a result that is complete when attempt returns."""
+        result, lease = self.start(attempt, tokens, failed)
+        lease.release()
+        return result
+
+    async def astart(self, attempt, tokens: int = 0, failed=None, exclude=(), picked=None):
+        """start with a coroutine function attempt."""
+        tried = list(exclude)
+        while True:
+            lease = self.acquire(tokens, exclude=tried)
+            if picked is not None:
+                picked.append(lease.deployment)
+            try:
+                result = await attempt(lease.deployment)
+            except Exception as e:
+                lease.release(e)
+                if not self._fail_over(e, tried, lease.deployment):
+                    raise
+                continue
+            except BaseException:
+                # cancelled, e.g. a hedged request that lost
+                lease.release()
+                raise
+            error = failed(result) if failed else None
+            if error is None:
+                return result, lease
+            lease.release(error)
+            if not self._fail_over(error, tried, lease.deployment):
+                return result, lease
+            aclose = getattr(result, "aclose", None)
+            if aclose:
+                await aclose()
+
+    async def acall(self, attempt, tokens: int = 0, failed=None):
+        result, lease = await self.astart(attempt, tokens, failed)
+        lease.release()
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            now = self.clock()
+            deployments = {}
+            for deployment in self.deployments:
+                recent_tokens = deployment.recent_tokens(now)
+                deployments[deployment.name] = dict(
+                    deployment.counters,
+                    deployment=deployment.deployment,
+                    weight=deployment.weight,
+                    outstanding=deployment.outstanding,
+                    tokens_last_minute=recent_tokens,
+                    utilization=recent_tokens / deployment.tpm if deployment.tpm else None,
+                    available=deployment.unavailable_until <= now,
+                    unavailable_for_seconds=max(0.0, deployment.unavailable_until - now),
+                )
+            return dict(self._counters, routing=self.routing, deployments=deployments)
@@ -0,0 +1,262 @@
+"""
+Hedged streaming requests, against the slow starts that make up the tail of time to first token.
+
+A streamed chat request is started on its deployment as usual. When its first chunk has not come
+after a delay, the percentile HEDGE_PERCENTILE of the recent times to first token (at least
+HEDGE_MIN_DELAY_SECONDS, HEDGE_DEFAULT_DELAY_SECONDS until HEDGE_MIN_SAMPLES were seen), the same
+request is sent to another deployment of the pool. The stream whose first chunk comes first is
+answered, the other one is closed and its deployment released.
+
+A hedge is a second request and costs its tokens, so at most HEDGE_BUDGET_PERCENT of the requests
+are hedged; past the budget, slow requests are waited for as before. Hedging needs a pool of at
+least two deployments (see deployments.py).
+"""
+import asyncio
+import collections
+import contextvars
+import itertools
+import logging
+import os
+import threading
+import time
+
+_END = object()
+
+
+class HedgeSettings():
+    def __init__(self, enabled: bool = False, percentile: float = 95.0, min_delay_seconds: float = 0.25,
+                 default_delay_seconds: float = 2.0, budget_percent: float = 5.0, min_samples: int = 20):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay_seconds = min_delay_seconds
+        self.default_delay_seconds = default_delay_seconds
+        self.budget_percent = budget_percent
+        self.min_samples = min_samples
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get("HEDGE_ENABLED", "false").lower() == "true",
+            percentile=float(os.environ.get("HEDGE_PERCENTILE", 95)),
+            min_delay_seconds=float(os.environ.get("HEDGE_MIN_DELAY_SECONDS", 0.25)),
+            default_delay_seconds=float(os.environ.get("HEDGE_DEFAULT_DELAY_SECONDS", 2)),
+            budget_percent=float(os.environ.get("HEDGE_BUDGET_PERCENT", 5)),
+            min_samples=int(os.environ.get("HEDGE_MIN_SAMPLES", 20)),
+        )
+
+
+def _close(result):
+    # requests/httpx responses close themselves, SDK streams through their response
+    close = getattr(result, "close", None) or getattr(getattr(result, "response", None), "close", None)
+    if close:
+        close()
+
+
+async def _aclose(result):
+    aclose = getattr(result, "aclose", None) or getattr(getattr(result, "response", None), "aclose", None)
+    if aclose:
+        await aclose()
+
+
+def _replay(first, chunks):
+    return chunks if first is _END else itertools.chain([first], chunks)
+
+
+async def _areplay(first, chunks):
+    if first is not _END:
+        yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+class _Race():
+    """The streams of one request racing to their first chunk, in threads."""
+
+    def __init__(self, hedger, read):
+        self.hedger = hedger
+        self.read = read
+        self.lock = threading.Lock()
+        self.decided = threading.Event()
+        self.started = 0
+        self.winner = None
+        self.errors = []
+
+    def launch(self, name, start):
+        with self.lock:
+            if self.decided.is_set():
+                return
+            self.started += 1
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._run, name, start), daemon=True).start()
+
+    def _run(self, name, start):
+        started = self.hedger.clock()
+        try:
+            result, lease = start()
+        except Exception as e:
+            return self._fail(name, e)
+        chunks = iter(self.read(result))
+        try:
+            first = next(chunks, _END)
+        except Exception as e:
+            _close(result)
+            lease.release(e)
+            return self._fail(name, e)
+        self.hedger._first_token(self.hedger.clock() - started)
+        with self.lock:
+            won = not self.decided.is_set()
+            if won:
+                self.winner = (name, result, lease, _replay(first, chunks))
+                self.decided.set()
+        if not won:
+            _close(result)
+            lease.release()
+
+    def _fail(self, name, error):
+        if name == "hedge":
+            logging.warning(f"Hedged request failed: {error}")
+        with self.lock:
+            self.errors.append((name, error))
+            if len(self.errors) == self.started:
+                self.decided.set()
+
+    def error(self):
+        # the primary's error is the one the request would have had without hedging
+        return next((error for name, error in self.errors if name == "primary"), self.errors[0][1])
+
+
+class Hedger():
+    def __init__(self, percentile: float = 95.0, min_delay_seconds: float = 0.25, default_delay_seconds: float = 2.0,
+                 budget_percent: float = 5.0, min_samples: int = 20, window: int = 500, clock=time.monotonic):
+        self.percentile = percentile
+        self.min_delay_seconds = min_delay_seconds
+        self.default_delay_seconds = default_delay_seconds
+        self.budget_percent = budget_percent
+        self.min_samples = min_samples
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=window)
+        self._counters = {"requests": 0, "hedged": 0, "hedge_wins": 0, "primary_wins": 0, "budget_denied": 0}
+
+    @classmethod
+    def from_settings(cls, settings: HedgeSettings):
+        return cls(settings.percentile, settings.min_delay_seconds, settings.default_delay_seconds,
+                   settings.budget_percent, settings.min_samples)
+
+    def _quantile(self, samples, percentile):
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def delay(self) -> float:
+        """Seconds to wait for the first chunk before hedging."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return self.default_delay_seconds
+            return max(self.min_delay_seconds, self._quantile(self._samples, self.percentile))
+
+    def _first_token(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def _request(self):
+        with self._lock:
+            self._counters["requests"] += 1
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if (self._counters["hedged"] + 1) * 100 > self._counters["requests"] * self.budget_percent:
+                self._counters["budget_denied"] += 1
+                return False
+            self._counters["hedged"] += 1
+            return True
+
+    def _won(self, name):
+        with self._lock:
+            self._counters["hedge_wins" if name == "hedge" else "primary_wins"] += 1
+
+    def start(self, primary, hedge, read):
+        """
+        primary(picked) starts the request, appending the deployments it picks to picked, and returns
+        the result and its Lease; hedge(exclude) starts the same request on a deployment not in
+        exclude. read(result) iterates the chunks of a result. Returns the result, Lease and chunks of
+        the stream whose first chunk came first, that chunk put back in front.
+        """
+        self._request()
+        picked = []
+        race = _Race(self, read)
+        race.launch("primary", lambda: primary(picked))
+        if not race.decided.wait(self.delay()) and picked and self._take_budget():
+            race.launch("hedge", lambda: hedge(picked[-1:]))
+        race.decided.wait()
+        if race.winner is None:
+            raise race.error()
+        name, result, lease, chunks = race.winner
+        self._won(name)
+        return result, lease, chunks
+
+    async def _arun(self, start, read):
+        started = self.clock()
+        result, lease = await start()
+        chunks = read(result)
+        try:
+            first = await anext(chunks, _END)
+        except BaseException as e:
+            await _aclose(result)
+            lease.release(e if isinstance(e, Exception) else None)
+            raise
+        self._first_token(self.clock() - started)
+        return result, lease, _areplay(first, chunks)
+
+    async def astart(self, primary, hedge, read):
+        """start with coroutine functions primary and hedge and async iterators of chunks."""
+        self._request()
+        picked = []
+        primary_task = asyncio.create_task(self._arun(lambda: primary(picked), read))
+        tasks = {primary_task: "primary"}
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=self.delay())
+            if not done and picked and self._take_budget():
+                tasks[asyncio.create_task(self._arun(lambda: hedge(picked[-1:]), read))] = "hedge"
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is None:
+                    for task in done:
+                        if tasks[task] == "hedge":
+                            logging.warning(f"Hedged request failed: {task.exception()}")
+                    continue
+                for task in pending:
+                    task.cancel()
+                # cancelled losers close their response and release their deployment before the answer starts
+                await asyncio.gather(*pending, return_exceptions=True)
+                # a loser that got its first chunk at the same time is closed here
+                for task in done - {winner}:
+                    if task.exception() is None:
+                        await self._adiscard(task)
+                self._won(tasks[winner])
+                return winner.result()
+        except BaseException:
+            # the request was cancelled (the client went away): no stream is answered, none may keep its deployment
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for task in tasks:
+                if not task.cancelled() and task.exception() is None:
+                    await self._adiscard(task)
+            raise
+        raise primary_task.exception()
+
+    async def _adiscard(self, task):
+        result, lease, _ = task.result()
+        await _aclose(result)
+        lease.release()
+
+    def snapshot(self):
+        with self._lock:
+            samples = list(self._samples)
+            stats = dict(self._counters, samples=len(samples))
+        stats["delay_seconds"] = self.delay()
+        stats["first_token_p50_seconds"] = self._quantile(samples, 50) if samples else None
+        stats[f"first_token_p{self.percentile:g}_seconds"] = self._quantile(samples, self.percentile) if samples else None
+        return stats
@@ -0,0 +1,292 @@
+import http.cookiejar
+import importlib.util
+import os
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def _parse_pool_sizes(value):
+    # "graph.microsoft.com=8,api.bing.microsoft.com=4" -> {"graph.microsoft.com": 8, ...}
+    pool_sizes = {}
+    for entry in (value or "").split(","):
+        host, _, size = entry.partition("=")
+        if host.strip() and size.strip():
+            pool_sizes[host.strip().lower()] = int(size)
+    return pool_sizes
+
+
+def _no_cookies():
+    # Pooled sessions are shared by every user of the process, never replay cookies across requests
+    return http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+
+
+class PoolSettings():
+    def __init__(self, default_pool_size: int = 32, pool_sizes: dict = None, connect_timeout: float = 10.0,
+                 read_timeout: float = 60.0, keepalive_expiry: float = 60.0, http2: bool = True):
+        self.default_pool_size = default_pool_size
+        self.pool_sizes = pool_sizes or {}
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2 and HTTP2_AVAILABLE
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            default_pool_size=int(os.environ.get("UPSTREAM_POOL_SIZE", 32)),
+            pool_sizes=_parse_pool_sizes(os.environ.get("UPSTREAM_POOL_SIZES")),
+            connect_timeout=float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 10)),
+            read_timeout=float(os.environ.get("UPSTREAM_READ_TIMEOUT", 60)),
+            keepalive_expiry=float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", 60)),
+            http2=os.environ.get("UPSTREAM_HTTP2", "true").lower() == "true",
+        )
+
+    def pool_size(self, host):
+        return self.pool_sizes.get(host, self.default_pool_size)
+
+    @property
+    def timeout(self):
+        # (connect, read) tuple understood by requests
+        return (self.connect_timeout, self.read_timeout)
+
+    def httpx_timeout(self):
+        return httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+
+    def httpx_limits(self, host):
+        size = self.pool_size(host)
+        return httpx.Limits(max_connections=size, max_keepalive_connections=size, keepalive_expiry=self.keepalive_expiry)
+
+
+class PoolStats():
+    """
+    Connection reuse counters per upstream host. A request that was served on an
+    already open connection is a hit, one that had to open a new connection is a miss.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._misses = {}
+
+    def record_request(self, host):
+        with self._lock:
+            self._requests[host] = self._requests.get(host, 0) + 1
+
+    def record_miss(self, host):
+        with self._lock:
+            self._misses[host] = self._misses.get(host, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                host: {"requests": count, "hits": count - self._misses.get(host, 0), "misses": self._misses.get(host, 0)}
+                for host, count in self._requests.items()
+            }
+
+
+def _host(url):
+    return (urlsplit(str(url)).hostname or "").lower()
+
+
+def _is_new_connection(event_name):
+    return event_name == "connection.connect_tcp.complete"
+
+
+class ConnectionPool():
+    """
+    Process-wide, thread-safe upstream connections for the WSGI serving path.
+
+    All plain HTTP calls (extensions endpoint, Graph, Bing) share a requests.Session with a
+    keep-alive adapter per host, and Azure OpenAI SDK clients are built once per endpoint and
+    API version on top of a pooled (HTTP/2 when available) httpx.Client per host.
+    """
+
+    def __init__(self, settings: PoolSettings = None):
+        self.settings = settings or PoolSettings.from_env()
+        self.stats = PoolStats()
+        self._lock = threading.RLock()
+        self._session = self._new_session({})
+        self._adapters = {}
+        self._httpx_clients = {}
+        self._openai_clients = {}
+
+    @staticmethod
+    def _new_session(adapters):
+        session = requests.Session()
+        session.cookies.set_policy(_no_cookies())
+        for host, adapter in adapters.items():
+            for scheme in ("https", "http"):
+                session.mount(f"{scheme}://{host}", adapter)
+        return session
+
+    def _mount(self, url):
+        host = _host(url)
+        if host not in self._adapters:
+            with self._lock:
+                if host not in self._adapters:
+                    size = self.settings.pool_size(host)
+                    adapters = dict(self._adapters, **{host: HTTPAdapter(pool_connections=1, pool_maxsize=size)})
+                    # copy on write: a published session's adapters are never changed while other threads
+                    # look them up, a new host gets a new session sharing the adapters (and connections) so far
+                    self._session = self._new_session(adapters)
+                    self._adapters = adapters
+        return host
+
+    def session(self, url) -> requests.Session:
+        self._mount(url)
+        return self._session
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.settings.timeout)
+        return self.session(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def httpx_client(self, url) -> httpx.Client:
+        host = _host(url)
+        client = self._httpx_clients.get(host)
+        if client is None:
+            with self._lock:
+                client = self._httpx_clients.get(host)
+                if client is None:
+                    client = self._build_httpx_client(host)
+                    self._httpx_clients[host] = client
+        return client
+
+    def _build_httpx_client(self, host):
+        stats = self.stats
+
+        def trace(event_name, info):
+            if _is_new_connection(event_name):
+                stats.record_miss(host)
+
+        def on_request(request):
+            stats.record_request(host)
+            request.extensions["trace"] = trace
+
+        return httpx.Client(
+            http2=self.settings.http2,
+            limits=self.settings.httpx_limits(host),
+            timeout=self.settings.httpx_timeout(),
+            cookies=httpx.Cookies(http.cookiejar.CookieJar(_no_cookies())),
+            event_hooks={"request": [on_request]},
+        )
+
+    def openai_client(self, azure_endpoint, api_key, api_version) -> openai.AzureOpenAI:
+        key = (azure_endpoint, api_key, api_version)
+        client = self._openai_clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._openai_clients.get(key)
+                if client is None:
+                    client = openai.AzureOpenAI(
+                        api_key=api_key,
+                        azure_endpoint=azure_endpoint,
+                        api_version=api_version,
+                        # retries are made by backend/clients/retry.py
+                        max_retries=0,
+                        http_client=self.httpx_client(azure_endpoint))
+                    self._openai_clients[key] = client
+        return client
+
+    def snapshot(self):
+        hosts = self.stats.snapshot()
+        # requests/urllib3 keeps its own counters, one connection pool per mounted host
+        for host, adapter in list(self._adapters.items()):
+            num_requests = 0
+            num_connections = 0
+            for pool_key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[pool_key]
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+            entry = hosts.setdefault(host, {"requests": 0, "hits": 0, "misses": 0})
+            entry["requests"] += num_requests
+            entry["hits"] += num_requests - num_connections
+            entry["misses"] += num_connections
+        for host, entry in hosts.items():
+            entry["pool_size"] = self.settings.pool_size(host)
+        return {"http2": self.settings.http2, "openai_clients": len(self._openai_clients), "hosts": hosts}
+
+    def close(self):
+        with self._lock:
+            self._session.close()
+            for client in self._httpx_clients.values():
+                client.close()
+            self._httpx_clients.clear()
+            self._openai_clients.clear()
+
+
+class AsyncConnectionPool():
+    """
+    asyncio counterpart of ConnectionPool for the ASGI serving path. Clients are created lazily on
+    first use (inside the running event loop) and closed with aclose() on shutdown.
+    """
+
+    def __init__(self, settings: PoolSettings = None):
+        self.settings = settings or PoolSettings.from_env()
+        self.stats = PoolStats()
+        self._httpx_clients = {}
+        self._openai_clients = {}
+
+    def httpx_client(self, url) -> httpx.AsyncClient:
+        host = _host(url)
+        client = self._httpx_clients.get(host)
+        if client is None:
+            client = self._build_httpx_client(host)
+            self._httpx_clients[host] = client
+        return client
+
+    def _build_httpx_client(self, host):
+        stats = self.stats
+
+        async def trace(event_name, info):
+            if _is_new_connection(event_name):
+                stats.record_miss(host)
+
+        async def on_request(request):
+            stats.record_request(host)
+            request.extensions["trace"] = trace
+
+        return httpx.AsyncClient(
+            http2=self.settings.http2,
+            limits=self.settings.httpx_limits(host),
+            timeout=self.settings.httpx_timeout(),
+            cookies=httpx.Cookies(http.cookiejar.CookieJar(_no_cookies())),
+            event_hooks={"request": [on_request]},
+        )
+
+    def openai_client(self, azure_endpoint, api_key, api_version) -> openai.AsyncAzureOpenAI:
+        key = (azure_endpoint, api_key, api_version)
+        client = self._openai_clients.get(key)
+        if client is None:
+            client = openai.AsyncAzureOpenAI(
+                api_key=api_key,
+                azure_endpoint=azure_endpoint,
+                api_version=api_version,
+                max_retries=0,
+                http_client=self.httpx_client(azure_endpoint))
+            self._openai_clients[key] = client
+        return client
+
+    def snapshot(self):
+        hosts = self.stats.snapshot()
+        for host, entry in hosts.items():
+            entry["pool_size"] = self.settings.pool_size(host)
+        return {"http2": self.settings.http2, "openai_clients": len(self._openai_clients), "hosts": hosts}
+
+    async def aclose(self):
+        for client in self._httpx_clients.values():
+            await client.aclose()
+        self._httpx_clients.clear()
+        self._openai_clients.clear()
@@ -0,0 +1,356 @@
+"""
+Retries of upstream calls (Azure OpenAI, Microsoft Graph, Bing) with a circuit breaker per backend.
+
+RetryPolicy.call(backend, fn) calls fn again when it fails with a transient error: 408, 429 or 5xx,
+a timeout or a connection failure. Requests that were at fault (other 4xx) are not retried. The
+delay before each retry is the one the upstream asked for (Retry-After, retry-after-ms or, on a 429,
+x-ratelimit-reset-requests/-tokens), otherwise an exponential backoff with full jitter. Retries stop
+after max_attempts, or as soon as the next delay would run past the request's deadline:
+deadline_scope sets one for the upstream calls made by a request, calls outside one get
+deadline_seconds of their own.
+
+Every transient failure counts against the backend's CircuitBreaker, every answer (even a 4xx)
+resets it. After failure_threshold failures in a row the breaker opens and calls fail at once with
+CircuitOpenError for reset_seconds. Then a single call is let through, which closes the breaker
+again or reopens it.
+
+Azure OpenAI calls through a deployment pool ("openai:chat", "openai:image") only fail here once
+every deployment of the pool failed; the health of each deployment is left to the pool's cooldowns
+(deployments.py). Calls to one deployment, such as tool rounds, have a breaker per deployment.
+
+The OpenAI SDK clients of backend/clients/pool.py do not retry on their own, retries are made here.
+"""
+import asyncio
+import collections
+import contextlib
+import contextvars
+import email.utils
+import os
+import random
+import re
+import threading
+import time
+
+import httpx
+import openai
+import requests
+
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+RATE_LIMIT_RESET_HEADERS = ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+_deadline = contextvars.ContextVar("upstream_deadline", default=None)
+
+
+class UpstreamStatusError(Exception):
+    """A failed status of a raw (not SDK) upstream response, e.g. of the extensions endpoint."""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"Upstream responded with status {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class CircuitOpenError(Exception):
+    """The backend failed too often recently, the call was not made."""
+
+    def __init__(self, backend, retry_after):
+        super().__init__(f"{backend} is unavailable, retry in {retry_after:.0f}s")
+        self.backend = backend
+        self.retry_after = retry_after
+
+
+def status_code_of(error):
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code
+
+
+def headers_of(error):
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    return headers or {}
+
+
+def is_transient(error) -> bool:
+    """Whether error says the upstream (rather than the request) is the problem, so it may pass."""
+    status_code = status_code_of(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (openai.APIConnectionError, httpx.TransportError, requests.ConnectionError, requests.Timeout,
+                              ConnectionError, TimeoutError))
+
+
+def status_error(response):
+    """An UpstreamStatusError for a raw response with a retryable status, None otherwise."""
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        return UpstreamStatusError(response.status_code, response.headers)
+    return None
+
+
+def parse_duration(value):
+    """Seconds of "30", "1.5", "250ms" or "1m30s", None when value is none of these."""
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts or "".join(number + unit for number, unit in parts) != value:
+        return None
+    return sum(float(number) * _DURATION_SECONDS[unit] for number, unit in parts)
+
+
+def retry_after_seconds(error):
+    """The delay the upstream asked for, None when it did not say."""
+    headers = headers_of(error)
+    if headers.get("retry-after-ms"):
+        delay = parse_duration(headers["retry-after-ms"])
+        if delay is not None:
+            return delay / 1000
+    if headers.get("retry-after"):
+        delay = parse_duration(headers["retry-after"])
+        if delay is None:
+            # an HTTP date
+            try:
+                delay = email.utils.parsedate_to_datetime(headers["retry-after"]).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return max(0.0, delay)
+    if status_code_of(error) == 429:
+        resets = [parse_duration(headers[name]) for name in RATE_LIMIT_RESET_HEADERS if headers.get(name)]
+        resets = [reset for reset in resets if reset is not None]
+        if resets:
+            return max(resets)
+    return None
+
+
+class Deadline():
+    def __init__(self, seconds: float, clock=time.monotonic):
+        self.clock = clock
+        self.expires_at = clock() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - self.clock())
+
+
+def current_deadline():
+    """The deadline of the request being served, None outside a deadline_scope."""
+    return _deadline.get()
+
+
+class CircuitBreaker():
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_until = None
+        self.probing = False
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_until is None:
+                return "closed"
+            return "half_open" if self.clock() >= self.opened_until else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_until is None:
+                return True
+            now = self.clock()
+            if now < self.opened_until:
+                return False
+            # half open: one call finds out whether the backend is back, another one after
+            # reset_seconds if it never reports (e.g. it was cancelled)
+            self.probing = True
+            self.opened_until = now + self.reset_seconds
+            return True
+
+    def retry_after(self) -> float:
+        with self._lock:
+            return max(0.0, (self.opened_until or 0.0) - self.clock()) or self.reset_seconds
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_until = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                if self.opened_until is None or self.probing:
+                    self.opened += 1
+                self.opened_until = self.clock() + self.reset_seconds
+                self.probing = False
+
+
+class RetrySettings():
+    def __init__(self, max_attempts: int = 3, base_delay_seconds: float = 0.5, max_delay_seconds: float = 8.0,
+                 deadline_seconds: float = 90.0, breaker_failures: int = 5, breaker_reset_seconds: float = 30.0):
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.deadline_seconds = deadline_seconds
+        self.breaker_failures = breaker_failures
+        self.breaker_reset_seconds = breaker_reset_seconds
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_attempts=int(os.environ.get("UPSTREAM_RETRY_MAX_ATTEMPTS", 3)),
+            base_delay_seconds=float(os.environ.get("UPSTREAM_RETRY_BASE_DELAY_SECONDS", 0.5)),
+            max_delay_seconds=float(os.environ.get("UPSTREAM_RETRY_MAX_DELAY_SECONDS", 8)),
+            deadline_seconds=float(os.environ.get("UPSTREAM_REQUEST_DEADLINE_SECONDS", 90)),
+            breaker_failures=int(os.environ.get("UPSTREAM_BREAKER_FAILURES", 5)),
+            breaker_reset_seconds=float(os.environ.get("UPSTREAM_BREAKER_RESET_SECONDS", 30)),
+        )
+
+
+class RetryPolicy():
+    def __init__(self, max_attempts: int = 3, base_delay_seconds: float = 0.5, max_delay_seconds: float = 8.0,
+                 deadline_seconds: float = 90.0, breaker_failures: int = 5, breaker_reset_seconds: float = 30.0,
+                 clock=time.monotonic, sleep=time.sleep, asleep=asyncio.sleep, rng=None):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.deadline_seconds = deadline_seconds
+        self.breaker_failures = breaker_failures
+        self.breaker_reset_seconds = breaker_reset_seconds
+        self.clock = clock
+        self.sleep = sleep
+        self.asleep = asleep
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._counters = collections.defaultdict(lambda: {"calls": 0, "retries": 0, "failed": 0, "gave_up": 0, "short_circuited": 0,
+                                                          "retry_delay_seconds": 0.0})
+
+    @classmethod
+    def from_settings(cls, settings: RetrySettings):
+        return cls(settings.max_attempts, settings.base_delay_seconds, settings.max_delay_seconds, settings.deadline_seconds,
+                   settings.breaker_failures, settings.breaker_reset_seconds)
+
+    def breaker(self, backend) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(backend)
+            if breaker is None:
+                breaker = self._breakers[backend] = CircuitBreaker(self.breaker_failures, self.breaker_reset_seconds, self.clock)
+            return breaker
+
+    @contextlib.contextmanager
+    def deadline_scope(self, seconds: float = None):
+        """Give the upstream calls made inside (by this thread or task) one shared deadline."""
+        token = _deadline.set(Deadline(self.deadline_seconds if seconds is None else seconds, self.clock))
+        try:
+            yield
+        finally:
+            _deadline.reset(token)
+
+    def _count(self, backend, name, value=1):
+        with self._lock:
+            self._counters[backend][name] += value
+
+    def _admit(self, backend, breaker):
+        if not breaker.allow():
+            self._count(backend, "short_circuited")
+            raise CircuitOpenError(backend, breaker.retry_after())
+        self._count(backend, "calls")
+
+    def _delay(self, backend, breaker, error, attempt, deadline):
+        """The delay before the next attempt, None when error is final."""
+        if not is_transient(error):
+            # the backend answered, the request was at fault
+            breaker.record_success()
+            return None
+        breaker.record_failure()
+        self._count(backend, "failed")
+        if attempt >= self.max_attempts or breaker.state == "open":
+            self._count(backend, "gave_up")
+            return None
+        delay = retry_after_seconds(error)
+        if delay is None:
+            delay = self.rng.uniform(0, min(self.max_delay_seconds, self.base_delay_seconds * 2 ** (attempt - 1)))
+        else:
+            # spread the clients that were told the same time
+            delay += self.rng.uniform(0, self.base_delay_seconds)
+        if delay >= deadline.remaining():
+            self._count(backend, "gave_up")
+            return None
+        self._count(backend, "retries")
+        self._count(backend, "retry_delay_seconds", delay)
+        return delay
+
+    def call(self, backend: str, fn, failed=None, deadline: Deadline = None):
+        """
+        fn() with retries. failed(result) can turn a result into a retryable error, e.g. a raw 503
+        response; a discarded result is closed, the last one is returned regardless.
+        """
+        breaker = self.breaker(backend)
+        deadline = deadline or current_deadline() or Deadline(self.deadline_seconds, self.clock)
+        attempt = 1
+        while True:
+            self._admit(backend, breaker)
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._delay(backend, breaker, e, attempt, deadline)
+                if delay is None:
+                    raise
+            else:
+                error = failed(result) if failed else None
+                if error is None:
+                    breaker.record_success()
+                    return result
+                delay = self._delay(backend, breaker, error, attempt, deadline)
+                if delay is None:
+                    return result
+                close = getattr(result, "close", None)
+                if close:
+                    close()
+            self.sleep(delay)
+            attempt += 1
+
+    async def acall(self, backend: str, fn, failed=None, deadline: Deadline = None):
+        """call with a coroutine function fn."""
+        breaker = self.breaker(backend)
+        deadline = deadline or current_deadline() or Deadline(self.deadline_seconds, self.clock)
+        attempt = 1
+        while True:
+            self._admit(backend, breaker)
+            try:
+                result = await fn()
+            except Exception as e:
+                delay = self._delay(backend, breaker, e, attempt, deadline)
+                if delay is None:
+                    raise
+            else:
+                error = failed(result) if failed else None
+                if error is None:
+                    breaker.record_success()
+                    return result
+                delay = self._delay(backend, breaker, error, attempt, deadline)
+                if delay is None:
+                    return result
+                aclose = getattr(result, "aclose", None)
+                if aclose:
+                    await aclose()
+            await self.asleep(delay)
+            attempt += 1
+
+    def snapshot(self):
+        with self._lock:
+            backends = {backend: dict(counters) for backend, counters in self._counters.items()}
+            breakers = dict(self._breakers)
+        for backend, breaker in breakers.items():
+            backends.setdefault(backend, {}).update(breaker_state=breaker.state, breaker_opened=breaker.opened)
+        return backends
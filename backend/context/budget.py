@@ -0,0 +1,239 @@
+"""
+Context-window budgeting for the chat completion requests.
+
+The frontend sends the whole transcript on every turn. Before it is forwarded, ContextBudget.plan
+drops the oldest turns that do not fit the prompt budget: CONTEXT_MAX_PROMPT_TOKENS, by default
+the context window of AZURE_OPENAI_MODEL_NAME minus AZURE_OPENAI_MAX_TOKENS. System messages at the
+start are always kept, and the kept turns start at a user message.
+
+With data, part of the budget is left to the retrieved documents: CONTEXT_DATA_SOURCE_RESERVED_TOKENS,
+by default CONTEXT_DATA_SOURCE_RESERVED_SHARE of the budget, so small context windows keep room for
+the transcript too.
+
+With CONTEXT_SUMMARIZE, the apps replace the dropped turns by a summary from a completion. The
+summary is kept on the conversation document (ConversationStore.set_summary) together with the
+number of messages it covers and a digest of them. Later turns reuse it while the turns after it
+still fit. Once they do not, the summary is rolled forward: the old summary and the newly dropped
+turns are summarized together. When a cut is needed, it is made deep enough (trim_target of the
+budget) that a summary lasts for several turns, instead of costing a completion every turn.
+"""
+import hashlib
+import logging
+import os
+import threading
+
+from backend.context.tokens import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+from backend.serialization import dumps
+
+# Context windows by model name prefix, longest prefix wins
+CONTEXT_WINDOWS = {
+    "gpt-35-turbo": 4096,
+    "gpt-35-turbo-16k": 16384,
+    "gpt-35-turbo-1106": 16384,
+    "gpt-35-turbo-0125": 16384,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106": 128000,
+    "gpt-4-0125": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# fewer prompt tokens than this for the transcript make most turns trimmed
+MIN_TRANSCRIPT_TOKENS = 1000
+
+SUMMARY_PROMPT = "Summarize the conversation below in a few sentences, keeping names, numbers, decisions and open questions the assistant needs to continue it. Respond with the summary only."
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def context_window(model_name: str) -> int:
+    name = (model_name or "").lower()
+    matches = [prefix for prefix in CONTEXT_WINDOWS if name.startswith(prefix)]
+    return CONTEXT_WINDOWS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_WINDOW
+
+
+def transcript_digest(messages) -> str:
+    return hashlib.blake2b(dumps([[message.get("role"), message.get("content")] for message in messages]), digest_size=16).hexdigest()
+
+
+class ContextBudgetSettings():
+    def __init__(self, enabled: bool = None, max_prompt_tokens: int = 0, summarize: bool = False, summary_max_tokens: int = 400,
+                 trim_target: float = 0.75, data_source_reserved_tokens: int = None, data_source_reserved_share: float = 0.5):
+        # None: only when the token counts are exact (see active)
+        self.enabled = enabled
+        self.max_prompt_tokens = max_prompt_tokens
+        # None: data_source_reserved_share of the prompt budget
+        self.data_source_reserved_tokens = data_source_reserved_tokens
+        self.data_source_reserved_share = data_source_reserved_share
+        self.summarize = summarize
+        self.summary_max_tokens = summary_max_tokens
+        self.trim_target = trim_target
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ["CONTEXT_BUDGET_ENABLED"].lower() == "true" if os.environ.get("CONTEXT_BUDGET_ENABLED") else None,
+            max_prompt_tokens=int(os.environ.get("CONTEXT_MAX_PROMPT_TOKENS", 0)),
+            summarize=os.environ.get("CONTEXT_SUMMARIZE", "false").lower() == "true",
+            summary_max_tokens=int(os.environ.get("CONTEXT_SUMMARY_MAX_TOKENS", 400)),
+            trim_target=float(os.environ.get("CONTEXT_TRIM_TARGET", 0.75)),
+            data_source_reserved_tokens=int(os.environ["CONTEXT_DATA_SOURCE_RESERVED_TOKENS"]) if os.environ.get("CONTEXT_DATA_SOURCE_RESERVED_TOKENS") else None,
+            data_source_reserved_share=float(os.environ.get("CONTEXT_DATA_SOURCE_RESERVED_SHARE", 0.5)),
+        )
+
+    def active(self, counter) -> bool:
+        # the character estimate undercounts code and non-English text, trimming on it is opt-in
+        if self.enabled is None:
+            if not counter.exact:
+                logging.warning("tiktoken or its encoding is not available, token counts are estimated: "
+                                "set CONTEXT_BUDGET_ENABLED=true to trim conversations on the estimate")
+            return counter.exact
+        return self.enabled
+
+
+class ContextPlan():
+    """What to send: the leading system messages, an optional summary and messages[cut:]."""
+
+    def __init__(self, messages, head: int, cut: int, summary: dict = None, summarize_from: int = None):
+        self.all_messages = messages
+        self.head = head
+        self.cut = cut
+        # the stored summary covering messages[head:cut], when it can be used as is
+        self.summary = summary
+        # with summarize_from set, a new summary of messages[summarize_from:cut] (after self.summary, if any) is needed
+        self.summarize_from = summarize_from
+
+    @property
+    def trimmed(self) -> bool:
+        return self.cut > self.head
+
+    @property
+    def summary_needed(self) -> bool:
+        return self.summarize_from is not None
+
+    def summary_prompt(self):
+        """The messages of the completion that rolls the summary forward."""
+        lines = []
+        if self.summary:
+            lines.append(f"{SUMMARY_PREFIX}{self.summary['content']}")
+        for message in self.all_messages[self.summarize_from:self.cut]:
+            content = message.get("content")
+            lines.append(f"{message.get('role')}: {content if isinstance(content, str) else dumps(content).decode('utf-8')}")
+        return [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": "\n\n".join(lines)}]
+
+    def summary_record(self, content: str) -> dict:
+        """The summary to store on the conversation."""
+        return {"content": content, "messages": self.cut, "digest": transcript_digest(self.all_messages[:self.cut])}
+
+    def messages(self, summary: dict = None):
+        """The messages to send, with the summary (the stored one, or a new record) in front of the kept turns."""
+        summary = summary or self.summary
+        messages = list(self.all_messages[:self.head])
+        if self.trimmed and summary:
+            messages.append({"role": "system", "content": f"{SUMMARY_PREFIX}{summary['content']}"})
+        return messages + list(self.all_messages[self.cut:])
+
+
+class ContextBudget():
+    def __init__(self, counter, max_prompt_tokens: int, summarize: bool = False, summary_max_tokens: int = 400, trim_target: float = 0.75,
+                 data_source_reserved_tokens: int = 0):
+        self.counter = counter
+        self.max_prompt_tokens = max_prompt_tokens
+        self.data_source_reserved_tokens = data_source_reserved_tokens
+        self.summarize = summarize
+        self.summary_max_tokens = summary_max_tokens
+        self.trim_target = trim_target
+        self._lock = threading.Lock()
+        self._counters = {"turns": 0, "trimmed": 0, "messages_dropped": 0, "tokens_dropped": 0,
+                          "summaries_reused": 0, "summaries_needed": 0}
+
+    @classmethod
+    def from_settings(cls, counter, settings: ContextBudgetSettings, max_completion_tokens: int = 0):
+        max_prompt_tokens = settings.max_prompt_tokens or context_window(counter.model_name) - max_completion_tokens
+        reserved_tokens = settings.data_source_reserved_tokens
+        if reserved_tokens is None:
+            reserved_tokens = int(max(0, max_prompt_tokens) * settings.data_source_reserved_share)
+        for name, tokens in (("the transcript", max_prompt_tokens), ("the transcript with data", max_prompt_tokens - reserved_tokens)):
+            if tokens < MIN_TRANSCRIPT_TOKENS:
+                logging.warning(f"The prompt budget leaves {tokens} tokens for {name} ({counter.model_name}, {max_completion_tokens} "
+                                f"completion tokens, {reserved_tokens} reserved for the data source), most turns will be trimmed")
+        return cls(counter, max_prompt_tokens, settings.summarize, settings.summary_max_tokens, settings.trim_target, reserved_tokens)
+
+    def _count(self, **values):
+        with self._lock:
+            for name, value in values.items():
+                self._counters[name] += value
+
+    def fits(self, messages, reserved_tokens: int = 0) -> bool:
+        return self.counter.prompt_tokens(messages) <= self.max_prompt_tokens - reserved_tokens
+
+    def plan(self, messages, reserved_tokens: int = 0, stored_summary: dict = None, summarize: bool = None) -> ContextPlan:
+        """
+        Fit messages into the budget minus reserved_tokens (e.g. for the documents of a data source).
+        stored_summary is the summary record of the conversation, if any; with summarize False the
+        dropped turns are just left out.
+        """
+        summarize = self.summarize if summarize is None else summarize
+        head = 0
+        while head < len(messages) - 1 and messages[head].get("role") == "system":
+            head += 1
+        sizes = [self.counter.message_tokens(message) for message in messages]
+        available = self.max_prompt_tokens - reserved_tokens - sum(sizes[:head]) - TOKENS_PER_REPLY
+        self._count(turns=1)
+        if sum(sizes[head:]) <= available:
+            return ContextPlan(messages, head, head)
+
+        summary = stored_summary if summarize and self._covers(stored_summary, messages, head) else None
+        if summary:
+            cut = summary["messages"]
+            if sum(sizes[cut:]) + self._summary_tokens(summary["content"]) <= available:
+                self._dropped(sizes[head:cut], summaries_reused=1)
+                return ContextPlan(messages, head, cut, summary)
+
+        # cut deep enough that the next turns still fit, so a new summary lasts a while
+        target = int((available - self._summary_tokens("") - self.summary_max_tokens) * self.trim_target) if summarize else available
+        cut, kept = len(messages), 0
+        while cut > head + 1 and kept + sizes[cut - 1] <= target:
+            cut -= 1
+            kept += sizes[cut]
+        # the kept turns start with a question, never with an answer to a dropped one
+        while cut < len(messages) - 1 and messages[cut].get("role") != "user":
+            cut += 1
+        # the last question is always sent, even alone over the budget: the upstream then answers
+        # with its context length error instead of the question being dropped
+        last_question = next((i for i in range(len(messages) - 1, head - 1, -1) if messages[i].get("role") == "user"), len(messages) - 1)
+        cut = max(head, min(cut, last_question))
+        if not summarize:
+            self._dropped(sizes[head:cut])
+            return ContextPlan(messages, head, cut)
+
+        # roll the stored summary forward, or summarize as many of the dropped turns as one completion takes
+        if summary:
+            cut = max(cut, min(summary["messages"], last_question))
+            summarize_from = min(summary["messages"], cut)
+        else:
+            summarize_from, size = cut, 0
+            while summarize_from > head and size + sizes[summarize_from - 1] <= available - self.summary_max_tokens:
+                summarize_from -= 1
+                size += sizes[summarize_from]
+        self._dropped(sizes[head:cut], summaries_needed=1)
+        return ContextPlan(messages, head, cut, summary, summarize_from)
+
+    def _summary_tokens(self, content):
+        return TOKENS_PER_MESSAGE + self.counter.count("system") + self.counter.count(SUMMARY_PREFIX + content)
+
+    def _covers(self, summary, messages, head) -> bool:
+        if not summary or not isinstance(summary, dict) or not summary.get("content"):
+            return False
+        covered = summary.get("messages", 0)
+        return head < covered < len(messages) and summary.get("digest") == transcript_digest(messages[:covered])
+
+    def _dropped(self, sizes, **counters):
+        self._count(trimmed=1, messages_dropped=len(sizes), tokens_dropped=sum(sizes), **counters)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters, max_prompt_tokens=self.max_prompt_tokens, data_source_reserved_tokens=self.data_source_reserved_tokens,
+                        exact_token_counts=self.counter.exact)
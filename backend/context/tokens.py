@@ -0,0 +1,80 @@
+"""
+Prompt token counting.
+
+Counts use the tiktoken encoding of the model (AZURE_OPENAI_MODEL_NAME) when tiktoken is installed
+and its encoding can be loaded (tiktoken downloads it on first use, unless TIKTOKEN_CACHE_DIR holds
+it), and a character estimate otherwise. The encoding is loaded once per process. Encoding a long transcript on every turn is not free, so the
+counts of recently seen message contents are kept in an LRU keyed by their digest.
+"""
+import functools
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from backend.serialization import dumps
+
+# The chat format adds a few tokens per message and primes the reply with a few more
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+DEFAULT_ENCODING = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name: str):
+    """The tiktoken encoding of the model, None without tiktoken (or when its data cannot be loaded)."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            # Azure model names such as gpt-35-turbo-16k are not all known to tiktoken
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception:
+        logging.exception(f"Loading the tiktoken encoding of {model_name} failed, estimating token counts")
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    # About 4 characters per token in English
+    return (len(text) + 3) // 4
+
+
+class TokenCounter():
+    def __init__(self, model_name: str, cache_size: int = 4096):
+        self.model_name = model_name
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._counts = OrderedDict()
+
+    @property
+    def exact(self) -> bool:
+        return get_encoding(self.model_name) is not None
+
+    def count(self, text) -> int:
+        if not text:
+            return 0
+        if not isinstance(text, str):
+            text = dumps(text).decode("utf-8")
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                return count
+        encoding = get_encoding(self.model_name)
+        count = len(encoding.encode(text, disallowed_special=())) if encoding else estimate_tokens(text)
+        with self._lock:
+            self._counts[key] = count
+            while len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        return count
+
+    def message_tokens(self, message: dict) -> int:
+        return TOKENS_PER_MESSAGE + sum(self.count(value) for value in message.values())
+
+    def prompt_tokens(self, messages) -> int:
+        return sum(self.message_tokens(message) for message in messages) + TOKENS_PER_REPLY
@@ -0,0 +1,241 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from azure.cosmos import exceptions
+from azure.cosmos.aio import CosmosClient
+
+from backend.history.bulk_delete import BATCH_ERRORS, MAX_BATCH_OPERATIONS, batches
+from backend.history.pagination import CONVERSATION_LIST_PROJECTION, decode_cursor, next_page
+
+class AsyncCosmosConversationClient():
+    """
+    asyncio counterpart of CosmosConversationClient, used by the ASGI app (asgi.py).
+    Same documents and queries; every call is awaited instead of blocking a worker.
+    """
+
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str):
+        self.cosmosdb_endpoint = cosmosdb_endpoint
+        self.credential = credential
+        self.database_name = database_name
+        self.container_name = container_name
+        self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
+        self.database_client = self.cosmosdb_client.get_database_client(database_name)
+        self.container_client = self.database_client.get_container_client(container_name)
+
+    async def close(self):
+        await self.cosmosdb_client.close()
+
+    async def ensure(self):
+        try:
+            if not self.cosmosdb_client or not self.database_client or not self.container_client:
+                return False
+
+            container_info = await self.container_client.read()
+            if not container_info:
+                return False
+
+            return True
+        except:
+            return False
+
+    async def create_conversation(self, user_id, title = ''):
+        conversation = {
+            'id': str(uuid.uuid4()),
+            'type': 'conversation',
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'userId': user_id,
+            'title': title
+        }
+        resp = await self.container_client.upsert_item(conversation)
+        if resp:
+            return resp
+        else:
+            return False
+
+    async def upsert_conversation(self, conversation):
+        resp = await self.container_client.upsert_item(conversation)
+        if resp:
+            return resp
+        else:
+            return False
+
+    async def set_title(self, user_id, conversation_id, title):
+        ## partial-document patch: does not overwrite an updatedAt that create_messages moved in the meantime
+        try:
+            return await self.container_client.patch_item(item=conversation_id, partition_key=user_id,
+                                                         patch_operations=[{'op': 'set', 'path': '/title', 'value': title}])
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    async def set_summary(self, user_id, conversation_id, summary):
+        try:
+            return await self.container_client.patch_item(item=conversation_id, partition_key=user_id,
+                                                         patch_operations=[{'op': 'set', 'path': '/summary', 'value': summary}])
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    async def delete_conversation(self, user_id, conversation_id):
+        try:
+            return await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return True
+
+    async def delete_messages(self, conversation_id, user_id):
+        ## delete the messages of the conversation in batches, returns the ids of the deleted messages
+        message_ids = await self.get_message_ids(user_id, conversation_id)
+        if message_ids:
+            await self.delete_items(user_id, message_ids)
+            return message_ids
+
+    async def get_message_ids(self, user_id, conversation_id):
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            }
+        ]
+        query = "SELECT VALUE c.id FROM c WHERE c.conversationId = @conversationId AND c.type='message'"
+        return [item_id async for item_id in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id)]
+
+    async def get_history_item_ids(self, user_id):
+        ## ids of all the user's messages and conversations, one projection over the user's partition
+        query = "SELECT c.id, c.type FROM c WHERE c.type IN ('message', 'conversation')"
+        items = [item async for item in self.container_client.query_items(query=query, partition_key=user_id)]
+        message_ids = [item['id'] for item in items if item['type'] == 'message']
+        conversation_ids = [item['id'] for item in items if item['type'] == 'conversation']
+        return message_ids, conversation_ids
+
+    async def _delete_item(self, user_id, item_id):
+        try:
+            await self.container_client.delete_item(item=item_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+    async def _delete_batch(self, user_id, ids):
+        if hasattr(self.container_client, 'execute_item_batch'):
+            try:
+                await self.container_client.execute_item_batch(batch_operations=[('delete', (item_id,)) for item_id in ids], partition_key=user_id)
+                return len(ids)
+            except BATCH_ERRORS:
+                ## the batch was rolled back, most likely because one of the documents is already gone
+                pass
+        for item_id in ids:
+            await self._delete_item(user_id, item_id)
+        return len(ids)
+
+    async def delete_items(self, user_id, ids, batch_size = MAX_BATCH_OPERATIONS, concurrency = 4, progress = None):
+        ## delete documents of the user's partition: transactional batches of up to batch_size deletes,
+        ## at most concurrency batches in flight. progress(count) is called after every batch
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def run(batch):
+            async with semaphore:
+                deleted = await self._delete_batch(user_id, batch)
+            if progress:
+                progress(deleted)
+            return deleted
+
+        return sum(await asyncio.gather(*(run(batch) for batch in batches(list(ids), batch_size))))
+
+    async def delete_history(self, user_id, message_ids, conversation_ids, batch_size = MAX_BATCH_OPERATIONS, concurrency = 4, progress = None):
+        ## messages first, so that an interrupted deletion does not leave messages without their conversation
+        deleted = await self.delete_items(user_id, message_ids, batch_size, concurrency, progress)
+        return deleted + await self.delete_items(user_id, conversation_ids, batch_size, concurrency, progress)
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        ## every document of the user lives in the user's partition, no cross-partition fan out.
+        ## Only the fields the history list shows are returned
+        sort_order = 'ASC' if str(sort_order).upper() == 'ASC' else 'DESC'
+        query = f"SELECT {CONVERSATION_LIST_PROJECTION} FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        if limit is not None:
+            query += " offset @offset limit @limit"
+            parameters += [{'name': '@offset', 'value': int(offset)}, {'name': '@limit', 'value': int(limit)}]
+
+        conversations = [conversation async for conversation in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id)]
+        return conversations
+
+    async def get_conversations_page(self, user_id, limit, cursor = None):
+        ## newest first, starting after the conversation the cursor points to (see pagination.py).
+        ## Returns the conversations and the cursor of the next page, None on the last page
+        parameters = [{'name': '@limit', 'value': int(limit) + 1}]
+        query = f"SELECT TOP @limit {CONVERSATION_LIST_PROJECTION} FROM c WHERE c.type='conversation'"
+        if cursor:
+            updated_at, conversation_id = decode_cursor(cursor)
+            query += " AND (c.updatedAt < @updatedAt OR (c.updatedAt = @updatedAt AND c.id < @id))"
+            parameters += [{'name': '@updatedAt', 'value': updated_at}, {'name': '@id', 'value': conversation_id}]
+        query += " ORDER BY c.updatedAt DESC, c.id DESC"
+
+        conversations = [conversation async for conversation in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id)]
+        return next_page(conversations, int(limit))
+
+    async def get_conversation(self, user_id, conversation_id):
+        ## point read by id within the user's partition, None when there is no such conversation
+        try:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        if conversation.get('type') != 'conversation':
+            return None
+        return conversation
+
+    def _new_message(self, conversation_id, user_id, input_message: dict, created_at: str):
+        return {
+            'id': str(uuid.uuid4()),
+            'type': 'message',
+            'userId' : user_id,
+            'createdAt': created_at,
+            'updatedAt': created_at,
+            'conversationId' : conversation_id,
+            'role': input_message['role'],
+            'content': input_message['content']
+        }
+
+    async def create_message(self, conversation_id, user_id, input_message: dict):
+        resp = await self.create_messages(conversation_id, user_id, [input_message])
+        if resp:
+            return resp[0]
+        else:
+            return False
+
+    async def create_messages(self, conversation_id, user_id, input_messages: list):
+        ## write the messages and move the parent conversation's updatedAt to the last message's createdAt.
+        ## Both live in the user's partition: one transactional batch when the SDK supports it (azure-cosmos>=4.6),
+        ## otherwise one upsert per message and a partial-document patch instead of reading and rewriting the conversation
+        now = datetime.utcnow()
+        messages = [
+            self._new_message(conversation_id, user_id, input_message, (now + timedelta(microseconds=i)).isoformat())
+            for i, input_message in enumerate(input_messages)
+        ]
+        return await self.save_messages(conversation_id, user_id, messages)
+
+    async def save_messages(self, conversation_id, user_id, messages: list):
+        ## persist message documents built by create_messages (or queued by write_behind.py), in createdAt order
+        touch = [{'op': 'set', 'path': '/updatedAt', 'value': messages[-1]['createdAt']}]
+
+        if hasattr(self.container_client, 'execute_item_batch'):
+            operations = [('upsert', (message,)) for message in messages] + [('patch', (conversation_id, touch))]
+            results = await self.container_client.execute_item_batch(batch_operations=operations, partition_key=user_id)
+            return [result['resourceBody'] for result in results[:len(messages)]]
+
+        resp = [await self.container_client.upsert_item(message) for message in messages]
+        await self.container_client.patch_item(item=conversation_id, partition_key=user_id, patch_operations=touch)
+        return resp
+
+    async def get_messages(self, user_id, conversation_id):
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            }
+        ]
+        ## scoped to the user's partition, served by the (conversationId, type, createdAt) composite index
+        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' ORDER BY c.createdAt ASC"
+        messages = [message async for message in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id)]
+        return messages
@@ -0,0 +1,170 @@
+"""
+Bulk deletion of chat history.
+
+All documents of a user (conversations and their messages) live in the user's partition, so they
+are deleted in transactional batches of up to MAX_BATCH_OPERATIONS deletes (execute_item_batch,
+azure-cosmos>=4.6), several batches at a time. Without batch support, or when a batch is rolled
+back because one of its documents is already gone, the batch falls back to point deletes.
+
+Deleting everything of a heavy user can take longer than an HTTP request should, so above a
+threshold /history/delete_all starts a DeletionJob and answers right away; the job's progress is
+polled from /history/delete_all/status. Jobs live in the process that started them.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from azure.cosmos import exceptions
+
+# Cosmos DB limit on the operations of one transactional batch
+MAX_BATCH_OPERATIONS = 100
+
+# Raised when an operation of a transactional batch fails (CosmosBatchOperationError from azure-cosmos 4.6)
+BATCH_ERRORS = (getattr(exceptions, "CosmosBatchOperationError", exceptions.CosmosHttpResponseError), exceptions.CosmosHttpResponseError)
+
+
+def batches(ids, size: int):
+    size = max(1, min(size, MAX_BATCH_OPERATIONS))
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+class BulkDeleteSettings():
+    def __init__(self, batch_size: int = MAX_BATCH_OPERATIONS, concurrency: int = 4, background_threshold: int = 500):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        # delete_all runs as a background job when the user has more documents than this
+        self.background_threshold = background_threshold
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            batch_size=int(os.environ.get("HISTORY_DELETE_BATCH_SIZE", MAX_BATCH_OPERATIONS)),
+            concurrency=int(os.environ.get("HISTORY_DELETE_CONCURRENCY", 4)),
+            background_threshold=int(os.environ.get("HISTORY_DELETE_BACKGROUND_THRESHOLD", 500)),
+        )
+
+
+class DeletionJob():
+    def __init__(self, user_id: str, total: int, clock=time.monotonic):
+        self.id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.total = total
+        self.deleted = 0
+        self.status = "running"
+        self.error = None
+        self.clock = clock
+        self.started_at = clock()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def advance(self, deleted: int):
+        with self._lock:
+            self.deleted += deleted
+
+    def finish(self, error: Exception = None):
+        self.status = "failed" if error is not None else "succeeded"
+        self.error = str(error) if error is not None else None
+        self.finished_at = self.clock()
+
+    def progress(self):
+        with self._lock:
+            deleted = self.deleted
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "deleted": deleted,
+            "error": self.error,
+            "seconds": (self.finished_at or self.clock()) - self.started_at,
+        }
+
+
+class DeletionJobs():
+    """Background deletions of this process. Finished jobs can be polled for retention_seconds."""
+
+    def __init__(self, max_workers: int = 2, retention_seconds: float = 3600, clock=time.monotonic):
+        self.max_workers = max_workers
+        self.retention_seconds = retention_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._tasks = set()
+        self._pool = None
+        self._counters = {"started": 0, "succeeded": 0, "failed": 0, "documents_deleted": 0}
+
+    def _add(self, user_id, total):
+        job = DeletionJob(user_id, total, self.clock)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+            self._counters["started"] += 1
+        return job
+
+    def _prune(self):
+        now = self.clock()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > self.retention_seconds:
+                del self._jobs[job_id]
+
+    def _finished(self, job, error=None):
+        if error is not None:
+            logging.error(f"History deletion job {job.id} failed: {error}")
+        job.finish(error)
+        with self._lock:
+            self._counters["failed" if error is not None else "succeeded"] += 1
+            self._counters["documents_deleted"] += job.deleted
+
+    def start(self, user_id: str, total: int, run) -> DeletionJob:
+        """Run run(job) on a worker thread, run reports its progress with job.advance."""
+        job = self._add(user_id, total)
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="history-delete")
+
+        def target():
+            try:
+                run(job)
+            except Exception as e:
+                self._finished(job, e)
+            else:
+                self._finished(job)
+
+        self._pool.submit(target)
+        return job
+
+    def astart(self, user_id: str, total: int, run) -> DeletionJob:
+        """Run the coroutine function run(job) as a task of the running event loop."""
+        job = self._add(user_id, total)
+
+        async def target():
+            try:
+                await run(job)
+            except Exception as e:
+                self._finished(job, e)
+            else:
+                self._finished(job)
+
+        # keep a reference, the loop only holds weak ones to its tasks
+        task = asyncio.get_running_loop().create_task(target())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def get(self, user_id: str, job_id: str):
+        """The job, None when it does not exist, has expired or belongs to another user."""
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(job_id)
+        if job is None or job.user_id != user_id:
+            return None
+        return job
+
+    def snapshot(self):
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if job.finished_at is None)
+            return dict(self._counters, running=running)
@@ -1,11 +1,22 @@
+import json
 import os
 import uuid
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from flask import Flask, request
 from azure.identity import DefaultAzureCredential  
-from azure.cosmos import CosmosClient, PartitionKey  
-  
-class CosmosConversationClient():
+from azure.cosmos import CosmosClient, PartitionKey, exceptions
+
+from backend.history.bulk_delete import BATCH_ERRORS, MAX_BATCH_OPERATIONS, batches
+from backend.history.pagination import CONVERSATION_LIST_PROJECTION, decode_cursor, next_page
+from backend.history.store import ConversationStore
+
+# Indexing policy for the conversations container (also deployed by infra/db.bicep): only the
+# properties the history queries filter and sort on are indexed, with composite indexes for them
+with open(os.path.join(os.path.dirname(__file__), "indexing_policy.json")) as f:
+    INDEXING_POLICY = json.load(f)
+
+class CosmosConversationClient(ConversationStore):
     
     def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str):
         self.cosmosdb_endpoint = cosmosdb_endpoint
@@ -29,6 +40,11 @@ class CosmosConversationClient():
         except:
             return False
 
+    def apply_indexing_policy(self):
+        ## replace the policy of an existing container, Cosmos re-indexes in the background
+        return self.database_client.replace_container(self.container_client, partition_key=PartitionKey(path='/userId'),
+                                                      indexing_policy=INDEXING_POLICY)
+
     def create_conversation(self, user_id, title = ''):
         conversation = {
             'id': str(uuid.uuid4()),  
@@ -52,106 +68,183 @@ class CosmosConversationClient():
         else:
             return False
 
+    def set_title(self, user_id, conversation_id, title):
+        ## partial-document patch: does not overwrite an updatedAt that create_messages moved in the meantime
+        try:
+            return self.container_client.patch_item(item=conversation_id, partition_key=user_id,
+                                                   patch_operations=[{'op': 'set', 'path': '/title', 'value': title}])
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    def set_summary(self, user_id, conversation_id, summary):
+        try:
+            return self.container_client.patch_item(item=conversation_id, partition_key=user_id,
+                                                   patch_operations=[{'op': 'set', 'path': '/summary', 'value': summary}])
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
     def delete_conversation(self, user_id, conversation_id):
-        conversation = self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
-            resp = self.container_client.delete_item(item=conversation_id, partition_key=user_id)
-            return resp
-        else:
+        try:
+            return self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
             return True
 
-        
     def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
-
+        ## delete the messages of the conversation in batches, returns the ids of the deleted messages
+        message_ids = self.get_message_ids(user_id, conversation_id)
+        if message_ids:
+            self.delete_items(user_id, message_ids)
+            return message_ids
 
-    def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+    def get_message_ids(self, user_id, conversation_id):
         parameters = [
             {
-                'name': '@userId',
-                'value': user_id
+                'name': '@conversationId',
+                'value': conversation_id
             }
         ]
-        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
-        if limit is not None:
-            query += f" offset {offset} limit {limit}" 
-            
-        conversations = list(self.container_client.query_items(query=query, parameters=parameters,
-                                                                               enable_cross_partition_query =True))
-        ## if no conversations are found, return None
-        if len(conversations) == 0:
-            return []
-        else:
-            return conversations
+        query = "SELECT VALUE c.id FROM c WHERE c.conversationId = @conversationId AND c.type='message'"
+        return list(self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id))
 
-    def get_conversation(self, user_id, conversation_id):
+    def get_history_item_ids(self, user_id):
+        ## ids of all the user's messages and conversations, one projection over the user's partition
+        query = "SELECT c.id, c.type FROM c WHERE c.type IN ('message', 'conversation')"
+        items = list(self.container_client.query_items(query=query, partition_key=user_id))
+        message_ids = [item['id'] for item in items if item['type'] == 'message']
+        conversation_ids = [item['id'] for item in items if item['type'] == 'conversation']
+        return message_ids, conversation_ids
+
+    def _delete_item(self, user_id, item_id):
+        try:
+            self.container_client.delete_item(item=item_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+    def _delete_batch(self, user_id, ids):
+        if hasattr(self.container_client, 'execute_item_batch'):
+            try:
+                self.container_client.execute_item_batch(batch_operations=[('delete', (item_id,)) for item_id in ids], partition_key=user_id)
+                return len(ids)
+            except BATCH_ERRORS:
+                ## the batch was rolled back, most likely because one of the documents is already gone
+                pass
+        for item_id in ids:
+            self._delete_item(user_id, item_id)
+        return len(ids)
+
+    def delete_items(self, user_id, ids, batch_size = MAX_BATCH_OPERATIONS, concurrency = 4, progress = None):
+        ## delete documents of the user's partition: transactional batches of up to batch_size deletes,
+        ## concurrency batches at a time. progress(count) is called after every batch
+        def run(batch):
+            deleted = self._delete_batch(user_id, batch)
+            if progress:
+                progress(deleted)
+            return deleted
+
+        work = batches(list(ids), batch_size)
+        if len(work) <= 1 or concurrency <= 1:
+            return sum(run(batch) for batch in work)
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(work)), thread_name_prefix='history-delete') as pool:
+            return sum(pool.map(run, work))
+
+    def delete_history(self, user_id, message_ids, conversation_ids, batch_size = MAX_BATCH_OPERATIONS, concurrency = 4, progress = None):
+        ## messages first, so that an interrupted deletion does not leave messages without their conversation
+        deleted = self.delete_items(user_id, message_ids, batch_size, concurrency, progress)
+        return deleted + self.delete_items(user_id, conversation_ids, batch_size, concurrency, progress)
+
+    def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
         parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
             {
                 'name': '@userId',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
-        conversation = list(self.container_client.query_items(query=query, parameters=parameters,
-                                                                               enable_cross_partition_query =True))
-        ## if no conversations are found, return None
-        if len(conversation) == 0:
+        ## every document of the user lives in the user's partition, no cross-partition fan out.
+        ## Only the fields the history list shows are returned
+        sort_order = 'ASC' if str(sort_order).upper() == 'ASC' else 'DESC'
+        query = f"SELECT {CONVERSATION_LIST_PROJECTION} FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        if limit is not None:
+            query += " offset @offset limit @limit"
+            parameters += [{'name': '@offset', 'value': int(offset)}, {'name': '@limit', 'value': int(limit)}]
+
+        conversations = list(self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id))
+        return conversations
+
+    def get_conversations_page(self, user_id, limit, cursor = None):
+        ## newest first, starting after the conversation the cursor points to (see pagination.py).
+        ## Returns the conversations and the cursor of the next page, None on the last page
+        parameters = [{'name': '@limit', 'value': int(limit) + 1}]
+        query = f"SELECT TOP @limit {CONVERSATION_LIST_PROJECTION} FROM c WHERE c.type='conversation'"
+        if cursor:
+            updated_at, conversation_id = decode_cursor(cursor)
+            query += " AND (c.updatedAt < @updatedAt OR (c.updatedAt = @updatedAt AND c.id < @id))"
+            parameters += [{'name': '@updatedAt', 'value': updated_at}, {'name': '@id', 'value': conversation_id}]
+        query += " ORDER BY c.updatedAt DESC, c.id DESC"
+
+        conversations = list(self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id))
+        return next_page(conversations, int(limit))
+
+    def get_conversation(self, user_id, conversation_id):
+        ## point read by id within the user's partition, None when there is no such conversation
+        try:
+            conversation = self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
             return None
-        else:
-            return conversation[0]
- 
-    def create_message(self, conversation_id, user_id, input_message: dict):
-        message = {
+        if conversation.get('type') != 'conversation':
+            return None
+        return conversation
+
+    def _new_message(self, conversation_id, user_id, input_message: dict, created_at: str):
+        return {
             'id': str(uuid.uuid4()),
             'type': 'message',
             'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
+            'createdAt': created_at,
+            'updatedAt': created_at,
             'conversationId' : conversation_id,
             'role': input_message['role'],
             'content': input_message['content']
         }
-        
-        resp = self.container_client.upsert_item(message)  
+
+    def create_message(self, conversation_id, user_id, input_message: dict):
+        resp = self.create_messages(conversation_id, user_id, [input_message])
         if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = self.get_conversation(user_id, conversation_id)
-            conversation['updatedAt'] = message['createdAt']
-            self.upsert_conversation(conversation)
-            return resp
+            return resp[0]
         else:
             return False
-    
 
+    def create_messages(self, conversation_id, user_id, input_messages: list):
+        ## write the messages and move the parent conversation's updatedAt to the last message's createdAt.
+        ## Both live in the user's partition: one transactional batch when the SDK supports it (azure-cosmos>=4.6),
+        ## otherwise one upsert per message and a partial-document patch instead of reading and rewriting the conversation
+        now = datetime.utcnow()
+        messages = [
+            self._new_message(conversation_id, user_id, input_message, (now + timedelta(microseconds=i)).isoformat())
+            for i, input_message in enumerate(input_messages)
+        ]
+        return self.save_messages(conversation_id, user_id, messages)
+
+    def save_messages(self, conversation_id, user_id, messages: list):
+        ## persist message documents built by create_messages (or queued by write_behind.py), in createdAt order
+        touch = [{'op': 'set', 'path': '/updatedAt', 'value': messages[-1]['createdAt']}]
+
+        if hasattr(self.container_client, 'execute_item_batch'):
+            operations = [('upsert', (message,)) for message in messages] + [('patch', (conversation_id, touch))]
+            results = self.container_client.execute_item_batch(batch_operations=operations, partition_key=user_id)
+            return [result['resourceBody'] for result in results[:len(messages)]]
+
+        resp = [self.container_client.upsert_item(message) for message in messages]
+        self.container_client.patch_item(item=conversation_id, partition_key=user_id, patch_operations=touch)
+        return resp
 
     def get_messages(self, user_id, conversation_id):
         parameters = [
             {
                 'name': '@conversationId',
                 'value': conversation_id
-            },
-            {
-                'name': '@userId',
-                'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
-        messages = list(self.container_client.query_items(query=query, parameters=parameters,
-                                                                     enable_cross_partition_query =True))
-        ## if no messages are found, return false
-        if len(messages) == 0:
-            return []
-        else:
-            return messages
-
+        ## scoped to the user's partition, served by the (conversationId, type, createdAt) composite index
+        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' ORDER BY c.createdAt ASC"
+        messages = list(self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id))
+        return messages
@@ -0,0 +1,130 @@
+"""
+Chat history kept in process memory, lost on restart. For tests, single-node demos and as the
+zero-latency baseline of benchmarks/bench_history_backends.py.
+"""
+import copy
+import threading
+
+from backend.history.bulk_delete import MAX_BATCH_OPERATIONS, batches
+from backend.history.pagination import CONVERSATION_LIST_FIELDS, decode_cursor, next_page
+from backend.history.store import ConversationStore, new_conversation
+
+
+def _project(conversation):
+    return {field: conversation.get(field) for field in CONVERSATION_LIST_FIELDS}
+
+
+class InMemoryConversationStore(ConversationStore):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # user id -> {"conversations": {id: document}, "messages": {conversation id: [documents]}}
+        self._users = {}
+
+    def _partition(self, user_id):
+        return self._users.setdefault(user_id, {"conversations": {}, "messages": {}})
+
+    def create_conversation(self, user_id, title = ''):
+        conversation = new_conversation(user_id, title)
+        with self._lock:
+            self._partition(user_id)["conversations"][conversation['id']] = conversation
+        return copy.deepcopy(conversation)
+
+    def upsert_conversation(self, conversation):
+        conversation = copy.deepcopy(conversation)
+        with self._lock:
+            self._partition(conversation['userId'])["conversations"][conversation['id']] = conversation
+        return copy.deepcopy(conversation)
+
+    def _set(self, user_id, conversation_id, field, value):
+        with self._lock:
+            conversation = self._partition(user_id)["conversations"].get(conversation_id)
+            if not conversation:
+                return None
+            conversation[field] = copy.deepcopy(value)
+            return copy.deepcopy(conversation)
+
+    def set_title(self, user_id, conversation_id, title):
+        return self._set(user_id, conversation_id, 'title', title)
+
+    def set_summary(self, user_id, conversation_id, summary):
+        return self._set(user_id, conversation_id, 'summary', summary)
+
+    def delete_conversation(self, user_id, conversation_id):
+        with self._lock:
+            self._partition(user_id)["conversations"].pop(conversation_id, None)
+        return True
+
+    def delete_messages(self, conversation_id, user_id):
+        with self._lock:
+            messages = self._partition(user_id)["messages"].pop(conversation_id, [])
+        if messages:
+            return [message['id'] for message in messages]
+
+    def _sorted_conversations(self, user_id, descending = True):
+        with self._lock:
+            conversations = list(self._partition(user_id)["conversations"].values())
+        return sorted(conversations, key=lambda conversation: (conversation['updatedAt'], conversation['id']), reverse=descending)
+
+    def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        conversations = self._sorted_conversations(user_id, str(sort_order).upper() != 'ASC')
+        end = None if limit is None else int(offset) + int(limit)
+        return [_project(conversation) for conversation in conversations[int(offset):end]]
+
+    def get_conversations_page(self, user_id, limit, cursor = None):
+        conversations = self._sorted_conversations(user_id)
+        if cursor:
+            key = decode_cursor(cursor)
+            conversations = [conversation for conversation in conversations if (conversation['updatedAt'], conversation['id']) < key]
+        return next_page([_project(conversation) for conversation in conversations[:int(limit) + 1]], int(limit))
+
+    def get_conversation(self, user_id, conversation_id):
+        with self._lock:
+            conversation = self._partition(user_id)["conversations"].get(conversation_id)
+            return copy.deepcopy(conversation) if conversation else None
+
+    def save_messages(self, conversation_id, user_id, messages: list):
+        messages = copy.deepcopy(messages)
+        with self._lock:
+            partition = self._partition(user_id)
+            # writes are idempotent like upserts: a retried write replaces the messages it already wrote
+            saved = {message['id'] for message in messages}
+            existing = [message for message in partition["messages"].get(conversation_id, []) if message['id'] not in saved]
+            partition["messages"][conversation_id] = existing + messages
+            conversation = partition["conversations"].get(conversation_id)
+            if conversation:
+                conversation['updatedAt'] = messages[-1]['createdAt']
+        return copy.deepcopy(messages)
+
+    def get_messages(self, user_id, conversation_id):
+        with self._lock:
+            return copy.deepcopy(self._partition(user_id)["messages"].get(conversation_id, []))
+
+    def get_history_item_ids(self, user_id):
+        with self._lock:
+            partition = self._partition(user_id)
+            message_ids = [message['id'] for messages in partition["messages"].values() for message in messages]
+            return message_ids, list(partition["conversations"])
+
+    def delete_history(self, user_id, message_ids, conversation_ids, batch_size = MAX_BATCH_OPERATIONS, concurrency = 4, progress = None):
+        deleted = 0
+        for batch in batches(list(message_ids), batch_size):
+            remove = set(batch)
+            with self._lock:
+                partition = self._partition(user_id)
+                for conversation_id, messages in list(partition["messages"].items()):
+                    partition["messages"][conversation_id] = [message for message in messages if message['id'] not in remove]
+            deleted += self._deleted(len(batch), progress)
+        for batch in batches(list(conversation_ids), batch_size):
+            with self._lock:
+                partition = self._partition(user_id)
+                for conversation_id in batch:
+                    partition["conversations"].pop(conversation_id, None)
+                    if not partition["messages"].get(conversation_id, True):
+                        del partition["messages"][conversation_id]
+            deleted += self._deleted(len(batch), progress)
+        return deleted
+
+    def _deleted(self, count, progress):
+        if progress:
+            progress(count)
+        return count
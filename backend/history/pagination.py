@@ -0,0 +1,39 @@
+"""
+Keyset pagination of the conversation list.
+
+/history/list pages with OFFSET n LIMIT m make Cosmos DB read and skip every earlier conversation,
+so a page costs more the further the user scrolls. A cursor instead carries the sort key of the
+last conversation of the previous page, (updatedAt, id), and the next page starts right after it,
+at the same cost as the first one. Cursors are opaque to clients: url-safe base64 of that key.
+"""
+import base64
+
+from backend.serialization import dumps, loads
+
+# Fields of a conversation the history sidebar needs
+CONVERSATION_LIST_FIELDS = ("id", "title", "createdAt", "updatedAt")
+CONVERSATION_LIST_PROJECTION = ", ".join(f"c.{field}" for field in CONVERSATION_LIST_FIELDS)
+
+
+def encode_cursor(conversation) -> str:
+    key = dumps([conversation["updatedAt"], conversation["id"]])
+    return base64.urlsafe_b64encode(key).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """The (updatedAt, id) the cursor points after, ValueError when it is not a cursor of encode_cursor."""
+    try:
+        key = loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not (isinstance(key, list) and len(key) == 2 and all(isinstance(part, str) for part in key)):
+        raise ValueError("Invalid cursor")
+    return key[0], key[1]
+
+
+def next_page(rows, limit: int):
+    """(page, next cursor) from up to limit + 1 rows, the cursor is None on the last page."""
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    return page, encode_cursor(page[-1])
@@ -0,0 +1,186 @@
+"""
+Chat history in a SQLite database file, for single-node deployments and local development.
+
+Every query the endpoints make is served by an index: conversations by (user_id, updated_at, id)
+for the list and its keyset pages, messages by (user_id, conversation_id, created_at) for a
+transcript. Each thread uses its own connection; the database runs in WAL mode so reads do not
+wait for a write in progress.
+"""
+import json
+import sqlite3
+import threading
+import uuid
+
+from backend.history.bulk_delete import MAX_BATCH_OPERATIONS, batches
+from backend.history.pagination import CONVERSATION_LIST_FIELDS, decode_cursor, next_page
+from backend.history.store import ConversationStore, new_conversation
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    title TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    summary TEXT,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS conversations_by_update ON conversations (user_id, updated_at, id);
+CREATE TABLE IF NOT EXISTS messages (
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (user_id, conversation_id, created_at);
+"""
+
+_CONVERSATION_COLUMNS = "id, user_id, title, created_at, updated_at"
+_MESSAGE_COLUMNS = "id, user_id, conversation_id, role, content, created_at, updated_at"
+
+
+def _conversation(row):
+    conversation = {'id': row[0], 'type': 'conversation', 'userId': row[1], 'title': row[2], 'createdAt': row[3], 'updatedAt': row[4]}
+    if row[5] is not None:
+        conversation['summary'] = json.loads(row[5])
+    return conversation
+
+
+def _listed(row):
+    return {field: value for field, value in zip(CONVERSATION_LIST_FIELDS, (row[0], row[2], row[3], row[4]))}
+
+
+def _message(row):
+    return {'id': row[0], 'type': 'message', 'userId': row[1], 'conversationId': row[2], 'role': row[3], 'content': row[4],
+            'createdAt': row[5], 'updatedAt': row[6]}
+
+
+class SqliteConversationStore(ConversationStore):
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._anchor = None
+        if path == ":memory:":
+            # one in-memory database shared by the connections of all threads, alive as long as the anchor
+            self.path = f"file:chat-history-{uuid.uuid4()}?mode=memory&cache=shared"
+            self._anchor = self._connect()
+        with self._connection() as connection:
+            connection.executescript(SCHEMA)
+            # databases created before conversations had a summary
+            if "summary" not in [row[1] for row in connection.execute("PRAGMA table_info(conversations)")]:
+                connection.execute("ALTER TABLE conversations ADD COLUMN summary TEXT")
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, uri=self.path.startswith("file:"), check_same_thread=False, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def ensure(self):
+        try:
+            self._connection().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def create_conversation(self, user_id, title = ''):
+        return self.upsert_conversation(new_conversation(user_id, title))
+
+    def upsert_conversation(self, conversation):
+        with self._connection() as connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO conversations ({_CONVERSATION_COLUMNS}, summary) VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation['id'], conversation['userId'], conversation.get('title', ''), conversation['createdAt'], conversation['updatedAt'],
+                 json.dumps(conversation['summary']) if conversation.get('summary') else None))
+        return conversation
+
+    def set_title(self, user_id, conversation_id, title):
+        with self._connection() as connection:
+            connection.execute("UPDATE conversations SET title = ? WHERE user_id = ? AND id = ?", (title, user_id, conversation_id))
+        return self.get_conversation(user_id, conversation_id)
+
+    def set_summary(self, user_id, conversation_id, summary):
+        with self._connection() as connection:
+            connection.execute("UPDATE conversations SET summary = ? WHERE user_id = ? AND id = ?", (json.dumps(summary), user_id, conversation_id))
+        return self.get_conversation(user_id, conversation_id)
+
+    def delete_conversation(self, user_id, conversation_id):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM conversations WHERE user_id = ? AND id = ?", (user_id, conversation_id))
+        return True
+
+    def delete_messages(self, conversation_id, user_id):
+        with self._connection() as connection:
+            message_ids = [row[0] for row in connection.execute("SELECT id FROM messages WHERE user_id = ? AND conversation_id = ?",
+                                                                (user_id, conversation_id))]
+            connection.execute("DELETE FROM messages WHERE user_id = ? AND conversation_id = ?", (user_id, conversation_id))
+        if message_ids:
+            return message_ids
+
+    def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        sort_order = 'ASC' if str(sort_order).upper() == 'ASC' else 'DESC'
+        query = f"SELECT {_CONVERSATION_COLUMNS} FROM conversations WHERE user_id = ? ORDER BY updated_at {sort_order}, id {sort_order}"
+        parameters = [user_id]
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            parameters += [int(limit), int(offset)]
+        return [_listed(row) for row in self._connection().execute(query, parameters)]
+
+    def get_conversations_page(self, user_id, limit, cursor = None):
+        query = f"SELECT {_CONVERSATION_COLUMNS} FROM conversations WHERE user_id = ?"
+        parameters = [user_id]
+        if cursor:
+            updated_at, conversation_id = decode_cursor(cursor)
+            query += " AND (updated_at < ? OR (updated_at = ? AND id < ?))"
+            parameters += [updated_at, updated_at, conversation_id]
+        query += " ORDER BY updated_at DESC, id DESC LIMIT ?"
+        parameters.append(int(limit) + 1)
+        return next_page([_listed(row) for row in self._connection().execute(query, parameters)], int(limit))
+
+    def get_conversation(self, user_id, conversation_id):
+        row = self._connection().execute(f"SELECT {_CONVERSATION_COLUMNS}, summary FROM conversations WHERE user_id = ? AND id = ?",
+                                         (user_id, conversation_id)).fetchone()
+        return _conversation(row) if row else None
+
+    def save_messages(self, conversation_id, user_id, messages: list):
+        with self._connection() as connection:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO messages ({_MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(m['id'], m['userId'], m['conversationId'], m['role'], m['content'], m['createdAt'], m['updatedAt']) for m in messages])
+            connection.execute("UPDATE conversations SET updated_at = ? WHERE user_id = ? AND id = ?",
+                               (messages[-1]['createdAt'], user_id, conversation_id))
+        return messages
+
+    def get_messages(self, user_id, conversation_id):
+        rows = self._connection().execute(
+            f"SELECT {_MESSAGE_COLUMNS} FROM messages WHERE user_id = ? AND conversation_id = ? ORDER BY created_at",
+            (user_id, conversation_id))
+        return [_message(row) for row in rows]
+
+    def get_history_item_ids(self, user_id):
+        connection = self._connection()
+        message_ids = [row[0] for row in connection.execute("SELECT id FROM messages WHERE user_id = ?", (user_id,))]
+        conversation_ids = [row[0] for row in connection.execute("SELECT id FROM conversations WHERE user_id = ?", (user_id,))]
+        return message_ids, conversation_ids
+
+    def delete_history(self, user_id, message_ids, conversation_ids, batch_size = MAX_BATCH_OPERATIONS, concurrency = 4, progress = None):
+        ## one transaction per batch, messages first like the Cosmos DB client
+        deleted = 0
+        for table, ids in (("messages", message_ids), ("conversations", conversation_ids)):
+            for batch in batches(list(ids), batch_size):
+                with self._connection() as connection:
+                    connection.executemany(f"DELETE FROM {table} WHERE user_id = ? AND id = ?", [(user_id, item_id) for item_id in batch])
+                deleted += len(batch)
+                if progress:
+                    progress(len(batch))
+        return deleted
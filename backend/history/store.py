@@ -0,0 +1,204 @@
+"""
+Chat history storage interface.
+
+ConversationStore lists the operations the /history endpoints use. CosmosConversationClient is the
+production implementation; InMemoryConversationStore (memory_store.py) and SqliteConversationStore
+(sqlite_store.py) store the same documents locally, for tests, single-node deployments and as
+baselines for the benchmarks. CHAT_HISTORY_BACKEND selects the backend (cosmos, sqlite or memory).
+
+Documents have the shape of the Cosmos DB items: conversations are
+{id, type: "conversation", userId, title, createdAt, updatedAt, summary (optional, see
+backend/context/budget.py)} and messages are
+{id, type: "message", userId, conversationId, role, content, createdAt, updatedAt}.
+"""
+import asyncio
+import os
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+
+from backend.history.bulk_delete import MAX_BATCH_OPERATIONS
+
+
+class ConversationStore(ABC):
+    def ensure(self):
+        return True
+
+    @abstractmethod
+    def create_conversation(self, user_id, title = ''):
+        """The new conversation document."""
+
+    @abstractmethod
+    def upsert_conversation(self, conversation):
+        """Write a conversation document (e.g. with a new title), returns it."""
+
+    def set_title(self, user_id, conversation_id, title):
+        """Change the title of a conversation, None when it no longer exists."""
+        conversation = self.get_conversation(user_id, conversation_id)
+        if not conversation:
+            return None
+        conversation['title'] = title
+        return self.upsert_conversation(conversation)
+
+    def set_summary(self, user_id, conversation_id, summary):
+        """Store the rolling summary of older turns on the conversation, None when it no longer exists."""
+        conversation = self.get_conversation(user_id, conversation_id)
+        if not conversation:
+            return None
+        conversation['summary'] = summary
+        return self.upsert_conversation(conversation)
+
+    @abstractmethod
+    def delete_conversation(self, user_id, conversation_id):
+        """Delete the conversation document, its messages are deleted with delete_messages."""
+
+    @abstractmethod
+    def delete_messages(self, conversation_id, user_id):
+        """Delete the messages of the conversation, returns their ids (None when there were none)."""
+
+    @abstractmethod
+    def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        """The user's conversations by updatedAt, projected to the fields of pagination.CONVERSATION_LIST_FIELDS."""
+
+    @abstractmethod
+    def get_conversations_page(self, user_id, limit, cursor = None):
+        """(conversations, next cursor) newest first, see pagination.py."""
+
+    @abstractmethod
+    def get_conversation(self, user_id, conversation_id):
+        """The conversation document, None when the user has no such conversation."""
+
+    def create_message(self, conversation_id, user_id, input_message: dict):
+        resp = self.create_messages(conversation_id, user_id, [input_message])
+        if resp:
+            return resp[0]
+        else:
+            return False
+
+    def create_messages(self, conversation_id, user_id, input_messages: list):
+        """Add the messages in order and move the conversation's updatedAt to the last one, returns the message documents."""
+        return self.save_messages(conversation_id, user_id, new_messages(conversation_id, user_id, input_messages))
+
+    @abstractmethod
+    def save_messages(self, conversation_id, user_id, messages: list):
+        """Write message documents (see new_messages) and move the conversation's updatedAt to the last one's createdAt."""
+
+    @abstractmethod
+    def get_messages(self, user_id, conversation_id):
+        """The messages of the conversation, oldest first."""
+
+    @abstractmethod
+    def get_history_item_ids(self, user_id):
+        """(message ids, conversation ids) of all the user's documents."""
+
+    @abstractmethod
+    def delete_history(self, user_id, message_ids, conversation_ids, batch_size = MAX_BATCH_OPERATIONS, concurrency = 4, progress = None):
+        """Delete the documents, progress(count) after each batch. Returns the number deleted."""
+
+
+def new_conversation(user_id, title = ''):
+    now = datetime.utcnow().isoformat()
+    return {
+        'id': str(uuid.uuid4()),
+        'type': 'conversation',
+        'createdAt': now,
+        'updatedAt': now,
+        'userId': user_id,
+        'title': title
+    }
+
+
+def new_messages(conversation_id, user_id, input_messages: list):
+    ## createdAt strictly increases within the call so the messages keep their order
+    now = datetime.utcnow()
+    messages = []
+    for i, input_message in enumerate(input_messages):
+        created_at = (now + timedelta(microseconds=i)).isoformat()
+        messages.append({
+            'id': str(uuid.uuid4()),
+            'type': 'message',
+            'userId': user_id,
+            'createdAt': created_at,
+            'updatedAt': created_at,
+            'conversationId': conversation_id,
+            'role': input_message['role'],
+            'content': input_message['content']
+        })
+    return messages
+
+
+class AsyncConversationStore():
+    """
+    A ConversationStore for the ASGI app, same methods as AsyncCosmosConversationClient. Calls run
+    on the default executor so a local store never blocks the event loop.
+    """
+
+    def __init__(self, store: ConversationStore):
+        self.store = store
+
+    async def _call(self, method, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: method(*args, **kwargs))
+
+    async def close(self):
+        close = getattr(self.store, 'close', None)
+        if close:
+            await self._call(close)
+
+    async def ensure(self):
+        return await self._call(self.store.ensure)
+
+    async def create_conversation(self, user_id, title = ''):
+        return await self._call(self.store.create_conversation, user_id, title)
+
+    async def upsert_conversation(self, conversation):
+        return await self._call(self.store.upsert_conversation, conversation)
+
+    async def set_title(self, user_id, conversation_id, title):
+        return await self._call(self.store.set_title, user_id, conversation_id, title)
+
+    async def set_summary(self, user_id, conversation_id, summary):
+        return await self._call(self.store.set_summary, user_id, conversation_id, summary)
+
+    async def delete_conversation(self, user_id, conversation_id):
+        return await self._call(self.store.delete_conversation, user_id, conversation_id)
+
+    async def delete_messages(self, conversation_id, user_id):
+        return await self._call(self.store.delete_messages, conversation_id, user_id)
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        return await self._call(self.store.get_conversations, user_id, limit, sort_order, offset)
+
+    async def get_conversations_page(self, user_id, limit, cursor = None):
+        return await self._call(self.store.get_conversations_page, user_id, limit, cursor)
+
+    async def get_conversation(self, user_id, conversation_id):
+        return await self._call(self.store.get_conversation, user_id, conversation_id)
+
+    async def create_message(self, conversation_id, user_id, input_message: dict):
+        return await self._call(self.store.create_message, conversation_id, user_id, input_message)
+
+    async def create_messages(self, conversation_id, user_id, input_messages: list):
+        return await self._call(self.store.create_messages, conversation_id, user_id, input_messages)
+
+    async def save_messages(self, conversation_id, user_id, messages: list):
+        return await self._call(self.store.save_messages, conversation_id, user_id, messages)
+
+    async def get_messages(self, user_id, conversation_id):
+        return await self._call(self.store.get_messages, user_id, conversation_id)
+
+    async def get_history_item_ids(self, user_id):
+        return await self._call(self.store.get_history_item_ids, user_id)
+
+    async def delete_history(self, user_id, message_ids, conversation_ids, batch_size = MAX_BATCH_OPERATIONS, concurrency = 4, progress = None):
+        return await self._call(self.store.delete_history, user_id, message_ids, conversation_ids, batch_size, concurrency, progress)
+
+
+def create_local_store(backend: str, sqlite_path: str = None) -> ConversationStore:
+    """The store of a CHAT_HISTORY_BACKEND other than cosmos."""
+    if backend == "memory":
+        from backend.history.memory_store import InMemoryConversationStore
+        return InMemoryConversationStore()
+    if backend == "sqlite":
+        from backend.history.sqlite_store import SqliteConversationStore
+        return SqliteConversationStore(sqlite_path or os.environ.get("CHAT_HISTORY_SQLITE_PATH", "chat_history.db"))
+    raise ValueError(f"Unknown CHAT_HISTORY_BACKEND: {backend}")
@@ -0,0 +1,148 @@
+"""
+Server-side persistence of streamed answers.
+
+Without it, the frontend reassembles the streamed answer and posts it back to /history/update, so
+the answer crosses the network twice and is lost when the tab closes before the post. With
+HISTORY_STREAM_TEE enabled, the /history/generate stream collects the tool message and the
+assistant text while they are relayed (StreamTranscript) and writes them to the conversation once
+the stream ends. When the client goes away first, the apps keep reading the upstream answer
+(without sending it) and write it all the same.
+
+The frontend still posts /history/update. already_stored makes that post a no-op when the
+conversation already ends with the messages it carries, so enabling the tee never duplicates them.
+
+Text is collected as a list of parts compacted every COMPACT_PARTS deltas, which is linear in the
+answer length. An answer longer than max_chars is dropped rather than held in memory, and is left
+to /history/update.
+"""
+import logging
+import os
+import threading
+
+COMPACT_PARTS = 256
+
+
+class StreamTeeSettings():
+    def __init__(self, enabled: bool = False, max_chars: int = 1000000):
+        self.enabled = enabled
+        self.max_chars = max_chars
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get("HISTORY_STREAM_TEE", "false").lower() == "true",
+            max_chars=int(os.environ.get("HISTORY_STREAM_TEE_MAX_CHARS", 1000000)),
+        )
+
+
+class StreamTranscript():
+    """The tool message and the assistant text of one streamed answer."""
+
+    def __init__(self, max_chars: int = 1000000):
+        self.max_chars = max_chars
+        self.tool_content = None
+        self.failed = False
+        self.truncated = False
+        self._chunks = []
+        self._parts = []
+        self._chars = 0
+
+    def add_tool(self, content):
+        self.tool_content = content
+
+    def add_content(self, text):
+        if self.truncated or not text:
+            return
+        self._chars += len(text)
+        if self._chars > self.max_chars:
+            self.truncated = True
+            self._chunks, self._parts = [], []
+            return
+        self._parts.append(text)
+        if len(self._parts) >= COMPACT_PARTS:
+            self._chunks.append("".join(self._parts))
+            self._parts = []
+
+    def add_messages(self, messages):
+        """Collect the messages of a complete answer, e.g. a response cache hit."""
+        for message in messages:
+            if message.get("role") == "tool":
+                self.add_tool(message.get("content"))
+            elif message.get("role") == "assistant":
+                self.add_content(message.get("content"))
+
+    def fail(self):
+        self.failed = True
+
+    def messages(self):
+        """The messages to write, as /history/update would get them, None when there is nothing to write."""
+        if self.failed or self.truncated or not self._chars:
+            return None
+        messages = [{"role": "assistant", "content": "".join(self._chunks) + "".join(self._parts)}]
+        if self.tool_content is not None:
+            messages.insert(0, {"role": "tool", "content": self.tool_content})
+        return messages
+
+
+def already_stored(stored_messages, new_messages) -> bool:
+    """Whether the conversation already ends with new_messages (same roles and contents)."""
+    if len(stored_messages) < len(new_messages):
+        return False
+    tail = stored_messages[len(stored_messages) - len(new_messages):]
+    return all(stored['role'] == new['role'] and stored['content'] == new['content'] for stored, new in zip(tail, new_messages))
+
+
+class StreamTee():
+    def __init__(self, max_chars: int = 1000000):
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        self._counters = {"persisted": 0, "incomplete": 0, "oversized": 0, "failed": 0, "duplicates_skipped": 0}
+
+    @classmethod
+    def from_settings(cls, settings: StreamTeeSettings):
+        return cls(settings.max_chars)
+
+    def transcript(self) -> StreamTranscript:
+        return StreamTranscript(self.max_chars)
+
+    def count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _messages(self, transcript: StreamTranscript):
+        messages = transcript.messages()
+        if messages is None:
+            self.count("oversized" if transcript.truncated else "incomplete")
+        return messages
+
+    def _failed(self, conversation_id):
+        logging.exception(f"Writing the streamed answer of conversation {conversation_id} failed")
+        self.count("failed")
+
+    def persist(self, transcript: StreamTranscript, write, conversation_id):
+        """write(messages) the answer of a finished stream."""
+        messages = self._messages(transcript)
+        if messages is None:
+            return
+        try:
+            write(messages)
+        except Exception:
+            self._failed(conversation_id)
+        else:
+            self.count("persisted")
+
+    async def apersist(self, transcript: StreamTranscript, write, conversation_id):
+        """persist with a coroutine function write."""
+        messages = self._messages(transcript)
+        if messages is None:
+            return
+        try:
+            await write(messages)
+        except Exception:
+            self._failed(conversation_id)
+        else:
+            self.count("persisted")
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
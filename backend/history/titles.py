@@ -0,0 +1,131 @@
+"""
+Conversation titles generated off the request path.
+
+/history/generate used to wait for a title completion before it created the conversation and
+started the answer. Now it creates the conversation with a provisional title, the user's message
+shortened to PROVISIONAL_TITLE_LENGTH, and hands the title completion to TitleWorker. The worker
+writes the generated title into the conversation with ConversationStore.set_title, and the
+frontend picks it up on its next /history/list.
+
+At most max_workers titles are generated at a time. When max_pending are waiting, new
+conversations keep their provisional title instead of queueing more work behind a slow model.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+
+PROVISIONAL_TITLE_LENGTH = 64
+
+
+def provisional_title(conversation_messages) -> str:
+    """The last user message on one line, cut at a word boundary to PROVISIONAL_TITLE_LENGTH."""
+    content = next((message['content'] for message in reversed(conversation_messages) if message['role'] == 'user'), '')
+    if not isinstance(content, str):
+        return ''
+    title = " ".join(content.split())
+    if len(title) <= PROVISIONAL_TITLE_LENGTH:
+        return title
+    title = title[:PROVISIONAL_TITLE_LENGTH - 3]
+    return (title.rsplit(" ", 1)[0] or title) + "..."
+
+
+class TitleSettings():
+    def __init__(self, max_workers: int = 2, max_pending: int = 100):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_workers=int(os.environ.get("HISTORY_TITLE_WORKERS", 2)),
+            max_pending=int(os.environ.get("HISTORY_TITLE_MAX_PENDING", 100)),
+        )
+
+
+class TitleWorker():
+    def __init__(self, max_workers: int = 2, max_pending: int = 100):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._pool = None
+        self._semaphore = None
+        self._tasks = set()
+        self._counters = {"scheduled": 0, "generated": 0, "kept": 0, "failed": 0, "rejected": 0}
+
+    @classmethod
+    def from_settings(cls, settings: TitleSettings):
+        return cls(settings.max_workers, settings.max_pending)
+
+    def _admit(self) -> bool:
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._counters["rejected"] += 1
+                return False
+            self._pending += 1
+            self._counters["scheduled"] += 1
+            return True
+
+    def _finished(self, outcome):
+        with self._lock:
+            self._pending -= 1
+            self._counters[outcome] += 1
+
+    def schedule(self, generate, store, user_id, conversation_id, conversation_messages, current_title) -> bool:
+        """Run generate(messages) on a worker thread and set the title it returns, False when the queue is full."""
+        if not self._admit():
+            return False
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="history-title")
+        conversation_messages = [dict(message) for message in conversation_messages]
+
+        def target():
+            try:
+                title = generate(conversation_messages)
+                if not title or title == current_title:
+                    self._finished("kept")
+                    return
+                store.set_title(user_id, conversation_id, title)
+            except Exception:
+                logging.exception(f"Generating the title of conversation {conversation_id} failed")
+                self._finished("failed")
+            else:
+                self._finished("generated")
+
+        self._pool.submit(target)
+        return True
+
+    def aschedule(self, generate, store, user_id, conversation_id, conversation_messages, current_title) -> bool:
+        """Like schedule, with a coroutine function generate and an async store, as a task of the running event loop."""
+        if not self._admit():
+            return False
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        conversation_messages = [dict(message) for message in conversation_messages]
+
+        async def target():
+            try:
+                async with self._semaphore:
+                    title = await generate(conversation_messages)
+                if not title or title == current_title:
+                    self._finished("kept")
+                    return
+                await store.set_title(user_id, conversation_id, title)
+            except Exception:
+                logging.exception(f"Generating the title of conversation {conversation_id} failed")
+                self._finished("failed")
+            else:
+                self._finished("generated")
+
+        # keep a reference, the event loop only holds tasks weakly
+        task = asyncio.get_running_loop().create_task(target())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters, pending=self._pending)
@@ -0,0 +1,270 @@
+"""
+Write-behind persistence of chat messages.
+
+With HISTORY_WRITE_BEHIND enabled, /history/generate and /history/update do not wait for the store:
+create_messages builds the message documents, queues them and returns. A flusher thread writes the
+queue every flush interval. Everything queued for one conversation since the last flush goes out as
+a single save_messages call (one transactional batch including the updatedAt patch on Cosmos DB),
+and the conversations of one user partition are written by the same worker. Throttling (429) and
+other transient failures are retried with exponential backoff, or after the retry-after the store
+asks for.
+
+The queue is bounded: when it is full, the caller writes its conversation (with whatever is queued
+for it) synchronously, which slows producers down to what the store accepts. close() stops taking
+new writes and drains the queue; the apps call it on shutdown.
+
+Reads from this process see the queued messages (read-your-writes): get_messages merges the queued
+and in-flight messages of the conversation and get_conversation reports the pending updatedAt.
+Other instances see them once flushed. Deleting a conversation drops what is queued for it.
+"""
+import concurrent.futures
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from backend.history.bulk_delete import MAX_BATCH_OPERATIONS
+from backend.history.store import ConversationStore
+
+TRANSIENT_STATUS_CODES = {408, 429, 449, 500, 503}
+
+
+def is_transient(error) -> bool:
+    """Throttling, timeouts and errors without a status code (connection failures) are worth retrying."""
+    status_code = getattr(error, "status_code", None)
+    return not status_code or status_code in TRANSIENT_STATUS_CODES
+
+
+def retry_delay(error, attempt: int, base_seconds: float) -> float:
+    headers = getattr(error, "headers", None) or {}
+    retry_after_ms = headers.get("x-ms-retry-after-ms")
+    if retry_after_ms:
+        return float(retry_after_ms) / 1000
+    return base_seconds * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class WriteBehindSettings():
+    def __init__(self, enabled: bool = False, max_pending: int = 1000, flush_interval_seconds: float = 0.2,
+                 max_retries: int = 5, retry_base_seconds: float = 0.5, workers: int = 4):
+        self.enabled = enabled
+        self.max_pending = max_pending
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.workers = workers
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get("HISTORY_WRITE_BEHIND", "false").lower() == "true",
+            max_pending=int(os.environ.get("HISTORY_WRITE_BEHIND_MAX_PENDING", 1000)),
+            flush_interval_seconds=int(os.environ.get("HISTORY_WRITE_BEHIND_FLUSH_MS", 200)) / 1000,
+            max_retries=int(os.environ.get("HISTORY_WRITE_BEHIND_MAX_RETRIES", 5)),
+            workers=int(os.environ.get("HISTORY_WRITE_BEHIND_WORKERS", 4)),
+        )
+
+
+class WriteBehindStore(ConversationStore):
+    def __init__(self, store: ConversationStore, max_pending: int = 1000, flush_interval_seconds: float = 0.2,
+                 max_retries: int = 5, retry_base_seconds: float = 0.5, workers: int = 4, sleep=time.sleep):
+        self.store = store
+        self.max_pending = max_pending
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.sleep = sleep
+        self._condition = threading.Condition()
+        # (user id, conversation id) -> messages waiting for the next flush, in createdAt order
+        self._pending = OrderedDict()
+        self._pending_count = 0
+        # (user id, conversation id) -> messages being written right now
+        self._inflight = {}
+        self._closed = False
+        self._closing = threading.Event()
+        self._counters = {"queued": 0, "writes": 0, "messages_written": 0, "synchronous_writes": 0,
+                          "retries": 0, "dropped": 0, "discarded": 0}
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="history-write")
+        self._thread = threading.Thread(target=self._run, name="history-write-behind", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_settings(cls, store: ConversationStore, settings: WriteBehindSettings):
+        return cls(store, settings.max_pending, settings.flush_interval_seconds, settings.max_retries,
+                   settings.retry_base_seconds, settings.workers)
+
+    def _count(self, name, value=1):
+        with self._condition:
+            self._counters[name] += value
+
+    ## writes
+
+    def save_messages(self, conversation_id, user_id, messages: list):
+        key = (user_id, conversation_id)
+        with self._condition:
+            if not self._closed and self._pending_count + len(messages) <= self.max_pending:
+                self._pending.setdefault(key, []).extend(messages)
+                self._pending_count += len(messages)
+                self._counters["queued"] += len(messages)
+                self._condition.notify_all()
+                return messages
+
+            # queue full or shutting down: write this conversation now, together with what is queued for it
+            while key in self._inflight:
+                self._condition.wait()
+            queued = self._pending.pop(key, [])
+            self._pending_count -= len(queued)
+            self._inflight[key] = queued + messages
+            self._counters["synchronous_writes"] += 1
+        try:
+            self._write(key, queued + messages)
+        finally:
+            self._done(key)
+        return messages
+
+    def _write(self, key, messages):
+        user_id, conversation_id = key
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.store.save_messages(conversation_id, user_id, messages)
+                self._count("writes")
+                self._count("messages_written", len(messages))
+                return
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient(e):
+                    raise
+                self._count("retries")
+                self.sleep(retry_delay(e, attempt, self.retry_base_seconds))
+
+    def _done(self, key):
+        with self._condition:
+            del self._inflight[key]
+            self._condition.notify_all()
+
+    def _write_partition(self, writes):
+        for key, messages in writes:
+            try:
+                self._write(key, messages)
+            except Exception:
+                logging.exception(f"Dropping {len(messages)} chat history messages of conversation {key[1]}")
+                self._count("dropped", len(messages))
+            finally:
+                self._done(key)
+
+    def flush(self):
+        """Write everything queued, one save_messages per conversation, one worker per user partition."""
+        partitions = {}
+        with self._condition:
+            for key in [key for key in self._pending if key not in self._inflight]:
+                messages = self._pending.pop(key)
+                self._pending_count -= len(messages)
+                self._inflight[key] = messages
+                partitions.setdefault(key[0], []).append((key, messages))
+        futures = [self._pool.submit(self._write_partition, writes) for writes in partitions.values()]
+        concurrent.futures.wait(futures)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed and not self._pending:
+                    return
+            # give the next writes to the same conversations a moment to coalesce
+            self._closing.wait(self.flush_interval_seconds)
+            self.flush()
+            with self._condition:
+                # a conversation that is still being written synchronously stays queued, wait for it
+                while self._pending and all(key in self._inflight for key in self._pending):
+                    self._condition.wait()
+
+    def close(self, timeout: float = 30):
+        """Stop queueing, write what is queued and stop the flusher."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._closing.set()
+        self._thread.join(timeout)
+        self._pool.shutdown(wait=True)
+
+    ## reads see the queued messages
+
+    def _queued(self, user_id, conversation_id):
+        key = (user_id, conversation_id)
+        with self._condition:
+            return list(self._inflight.get(key, [])) + list(self._pending.get(key, []))
+
+    def get_messages(self, user_id, conversation_id):
+        # take the queued messages before reading the store: a message flushed in between is then in the
+        # store's answer, the other order could miss it in both
+        queued = self._queued(user_id, conversation_id)
+        messages = self.store.get_messages(user_id, conversation_id)
+        if queued:
+            stored = {message['id'] for message in messages}
+            messages = sorted(messages + [dict(message) for message in queued if message['id'] not in stored],
+                              key=lambda message: message['createdAt'])
+        return messages
+
+    def get_conversation(self, user_id, conversation_id):
+        queued = self._queued(user_id, conversation_id)
+        conversation = self.store.get_conversation(user_id, conversation_id)
+        if conversation and queued and queued[-1]['createdAt'] > conversation.get('updatedAt', ''):
+            conversation['updatedAt'] = queued[-1]['createdAt']
+        return conversation
+
+    def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        return self.store.get_conversations(user_id, limit, sort_order, offset)
+
+    def get_conversations_page(self, user_id, limit, cursor = None):
+        return self.store.get_conversations_page(user_id, limit, cursor)
+
+    def get_history_item_ids(self, user_id):
+        return self.store.get_history_item_ids(user_id)
+
+    ## conversations are written through
+
+    def ensure(self):
+        return self.store.ensure()
+
+    def create_conversation(self, user_id, title = ''):
+        return self.store.create_conversation(user_id, title)
+
+    def upsert_conversation(self, conversation):
+        return self.store.upsert_conversation(conversation)
+
+    def set_title(self, user_id, conversation_id, title):
+        return self.store.set_title(user_id, conversation_id, title)
+
+    def set_summary(self, user_id, conversation_id, summary):
+        return self.store.set_summary(user_id, conversation_id, summary)
+
+    ## deletes drop what is queued first, and wait for what is being written
+
+    def _discard(self, user_id, conversation_id=None):
+        def matches(key):
+            return key[0] == user_id and (conversation_id is None or key[1] == conversation_id)
+
+        with self._condition:
+            for key in [key for key in self._pending if matches(key)]:
+                messages = self._pending.pop(key)
+                self._pending_count -= len(messages)
+                self._counters["discarded"] += len(messages)
+            while any(matches(key) for key in self._inflight):
+                self._condition.wait()
+
+    def delete_conversation(self, user_id, conversation_id):
+        self._discard(user_id, conversation_id)
+        return self.store.delete_conversation(user_id, conversation_id)
+
+    def delete_messages(self, conversation_id, user_id):
+        self._discard(user_id, conversation_id)
+        return self.store.delete_messages(conversation_id, user_id)
+
+    def delete_history(self, user_id, message_ids, conversation_ids, batch_size = MAX_BATCH_OPERATIONS, concurrency = 4, progress = None):
+        self._discard(user_id)
+        return self.store.delete_history(user_id, message_ids, conversation_ids, batch_size, concurrency, progress)
+
+    def snapshot(self):
+        with self._condition:
+            return dict(self._counters, pending=self._pending_count, in_flight=sum(len(messages) for messages in self._inflight.values()))
@@ -0,0 +1,24 @@
+"""
+Process-wide registry of runtime statistics.
+Components register a snapshot callable under a name; /metrics returns every snapshot as JSON.
+"""
+import threading
+
+_lock = threading.Lock()
+_sources = {}
+
+
+def register(name, snapshot):
+    with _lock:
+        _sources[name] = snapshot
+
+
+def unregister(name):
+    with _lock:
+        _sources.pop(name, None)
+
+
+def collect():
+    with _lock:
+        sources = dict(_sources)
+    return {name: snapshot() for name, snapshot in sources.items()}
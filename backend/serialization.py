@@ -0,0 +1,88 @@
+"""
+JSON encoding for everything the app sends: NDJSON stream lines, jsonify responses and upstream
+request bodies.
+
+dumps() returns compact UTF-8 bytes (non-ASCII characters are not escaped) using the fastest
+encoder installed: orjson, then msgspec, then the standard library. JSON_SERIALIZER can pin one
+of "orjson", "msgspec" or "json". All of them produce the same bytes for the plain dict/list/str
+payloads the app builds, and none of them emits a raw newline, so every dumps() result is a
+valid NDJSON line.
+"""
+import json
+import os
+
+from flask.json.provider import DefaultJSONProvider
+
+
+def _stdlib_dumps(obj, default=None) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default).encode("utf-8")
+
+
+def _orjson_backend():
+    import orjson
+
+    def dumps(obj, default=None) -> bytes:
+        return orjson.dumps(obj, default=default)
+    return dumps, orjson.loads
+
+
+def _msgspec_backend():
+    import msgspec
+
+    encoder = msgspec.json.Encoder()
+    decoder = msgspec.json.Decoder()
+
+    def dumps(obj, default=None) -> bytes:
+        if default is None:
+            return encoder.encode(obj)
+        return msgspec.json.encode(obj, enc_hook=default)
+
+    def loads(s):
+        try:
+            return decoder.decode(s)
+        except msgspec.DecodeError as e:
+            # callers expect json.JSONDecodeError/ValueError like the other backends
+            raise ValueError(str(e)) from e
+    return dumps, loads
+
+
+_BACKENDS = {
+    "orjson": _orjson_backend,
+    "msgspec": _msgspec_backend,
+    "json": lambda: (_stdlib_dumps, json.loads),
+}
+
+
+def load_backend(name: str = "auto"):
+    """(name, dumps, loads) for the named encoder, "auto" picks the first one installed."""
+    if name != "auto" and name not in _BACKENDS:
+        raise ValueError(f"Unknown JSON_SERIALIZER: {name}, expected auto, {', '.join(_BACKENDS)}")
+    names = list(_BACKENDS) if name == "auto" else [name]
+    for candidate in names:
+        try:
+            dumps, loads = _BACKENDS[candidate]()
+        except ImportError:
+            continue
+        return candidate, dumps, loads
+    raise ValueError(f"JSON serializer {name} is not available")
+
+
+SERIALIZER, dumps, loads = load_backend(os.environ.get("JSON_SERIALIZER", "auto").lower())
+
+
+def ndjson(obj) -> bytes:
+    return dumps(obj) + b"\n"
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask/Quart JSON provider that renders jsonify() responses with dumps()."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return dumps(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj, default=self.default) + b"\n", mimetype=self.mimetype)
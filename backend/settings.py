@@ -0,0 +1,226 @@
+"""
+Typed settings for the chat completion requests, parsed once at startup.
+
+Everything in the extensions/chat/completions request body except the conversation itself (and the
+optional per-user security filter) only depends on configuration, so it is serialized once into a
+RequestBodyTemplate and per request only the messages are spliced in at the byte level.
+"""
+import copy
+import os
+import uuid
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
+
+from backend.serialization import dumps
+
+# Parameters that must never end up in logs
+SECRET_PARAMETERS = ("key", "connectionString", "embeddingKey")
+
+USER_AGENT = "GitHubSampleWebApp/PublicAPI/3.0.0"
+
+
+def _split_columns(value):
+    return value.split("|") if value else []
+
+
+def _is_true(value):
+    return str(value).lower() == "true"
+
+
+@dataclass(frozen=True)
+class ChatCompletionSettings:
+    temperature: float
+    max_tokens: int
+    top_p: float
+    stop: Optional[Tuple[str, ...]]
+    stream: bool
+    system_message: str
+
+    @classmethod
+    def from_env(cls, env: Mapping = os.environ, system_message: str = ""):
+        stop_sequence = env.get("AZURE_OPENAI_STOP_SEQUENCE")
+        return cls(
+            temperature=float(env.get("AZURE_OPENAI_TEMPERATURE", 0)),
+            max_tokens=int(env.get("AZURE_OPENAI_MAX_TOKENS", 1000)),
+            top_p=float(env.get("AZURE_OPENAI_TOP_P", 1.0)),
+            stop=tuple(stop_sequence.split("|")) if stop_sequence else None,
+            stream=_is_true(env.get("AZURE_OPENAI_STREAM", "true")),
+            system_message=env.get("AZURE_OPENAI_SYSTEM_MESSAGE", system_message),
+        )
+
+
+@dataclass(frozen=True)
+class DataSourceSettings:
+    type: str
+    parameters: Mapping
+    # Index field holding the AAD groups allowed to see a document, enables per-user filters
+    permitted_groups_column: Optional[str] = None
+
+    @classmethod
+    def from_env(cls, datasource_type: str, system_message: str, env: Mapping = os.environ):
+        if datasource_type == "AzureCognitiveSearch":
+            if not (env.get("AZURE_SEARCH_SERVICE") and env.get("AZURE_SEARCH_INDEX") and env.get("AZURE_SEARCH_KEY")):
+                return None
+            parameters = _azure_cognitive_search_parameters(env, system_message)
+            permitted_groups_column = env.get("AZURE_SEARCH_PERMITTED_GROUPS_COLUMN") or None
+        elif datasource_type == "AzureCosmosDB":
+            if not (env.get("AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING") and env.get("AZURE_COSMOSDB_MONGO_VCORE_DATABASE")
+                    and env.get("AZURE_COSMOSDB_MONGO_VCORE_CONTAINER") and env.get("AZURE_COSMOSDB_MONGO_VCORE_INDEX")):
+                return None
+            parameters = _azure_cosmosdb_parameters(env, system_message)
+            permitted_groups_column = None
+        else:
+            raise ValueError(f"DATASOURCE_TYPE is not configured or unknown: {datasource_type}")
+
+        if "vector" in parameters["queryType"].lower():
+            if env.get("AZURE_OPENAI_EMBEDDING_NAME"):
+                parameters["embeddingDeploymentName"] = env.get("AZURE_OPENAI_EMBEDDING_NAME")
+            else:
+                parameters["embeddingEndpoint"] = env.get("AZURE_OPENAI_EMBEDDING_ENDPOINT")
+                parameters["embeddingKey"] = env.get("AZURE_OPENAI_EMBEDDING_KEY")
+
+        return cls(type=datasource_type, parameters=MappingProxyType(parameters), permitted_groups_column=permitted_groups_column)
+
+
+def _azure_cognitive_search_parameters(env, system_message):
+    query_type = env.get("AZURE_SEARCH_QUERY_TYPE")
+    if not query_type:
+        query_type = "semantic" if _is_true(env.get("AZURE_SEARCH_USE_SEMANTIC_SEARCH", "false")) else "simple"
+
+    return {
+        "endpoint": f"https://{env.get('AZURE_SEARCH_SERVICE')}.search.windows.net",
+        "key": env.get("AZURE_SEARCH_KEY"),
+        "indexName": env.get("AZURE_SEARCH_INDEX"),
+        "fieldsMapping": {
+            "contentFields": _split_columns(env.get("AZURE_SEARCH_CONTENT_COLUMNS")),
+            "titleField": env.get("AZURE_SEARCH_TITLE_COLUMN") or None,
+            "urlField": env.get("AZURE_SEARCH_URL_COLUMN") or None,
+            "filepathField": env.get("AZURE_SEARCH_FILENAME_COLUMN") or None,
+            "vectorFields": _split_columns(env.get("AZURE_SEARCH_VECTOR_COLUMNS")),
+        },
+        "inScope": _is_true(env.get("AZURE_SEARCH_ENABLE_IN_DOMAIN", "true")),
+        "topNDocuments": int(env.get("AZURE_SEARCH_TOP_K", 5)),
+        "queryType": query_type,
+        "semanticConfiguration": env.get("AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG") or "",
+        "roleInformation": system_message,
+        "filter": None,
+        "strictness": int(env.get("AZURE_SEARCH_STRICTNESS", 3)),
+    }
+
+
+def _azure_cosmosdb_parameters(env, system_message):
+    return {
+        "connectionString": env.get("AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING"),
+        "indexName": env.get("AZURE_COSMOSDB_MONGO_VCORE_INDEX"),
+        "databaseName": env.get("AZURE_COSMOSDB_MONGO_VCORE_DATABASE"),
+        "containerName": env.get("AZURE_COSMOSDB_MONGO_VCORE_CONTAINER"),
+        "fieldsMapping": {
+            "contentFields": _split_columns(env.get("AZURE_COSMOSDB_MONGO_VCORE_CONTENT_COLUMNS")),
+            "titleField": env.get("AZURE_COSMOSDB_MONGO_VCORE_TITLE_COLUMN") or None,
+            "urlField": env.get("AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN") or None,
+            "filepathField": env.get("AZURE_COSMOSDB_MONGO_VCORE_FILENAME_COLUMN") or None,
+            "vectorFields": _split_columns(env.get("AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS")),
+        },
+        "inScope": _is_true(env.get("AZURE_COSMOSDB_MONGO_VCORE_ENABLE_IN_DOMAIN", "true")),
+        "topNDocuments": int(env.get("AZURE_COSMOSDB_MONGO_VCORE_TOP_K", 5)),
+        "strictness": int(env.get("AZURE_COSMOSDB_MONGO_VCORE_STRICTNESS", 3)),
+        "queryType": "vector",
+        "roleInformation": system_message,
+    }
+
+
+@dataclass(frozen=True)
+class RequestBodyTemplate:
+    """
+    Pre-serialized request body split around its per-request slots:
+
+        prefix + <messages> + middle + <filter> + suffix
+
+    When the data source has no per-user filter, middle holds the whole remainder and suffix is empty.
+    """
+    prefix: bytes
+    middle: bytes
+    suffix: bytes
+    has_filter: bool
+
+    @classmethod
+    def compile(cls, body: dict):
+        messages_slot = f"__messages_{uuid.uuid4().hex}__"
+        filter_slot = f"__filter_{uuid.uuid4().hex}__"
+        body = dict(body, messages=messages_slot)
+        has_filter = False
+        if body.get("dataSources") and "filter" in body["dataSources"][0]["parameters"]:
+            data_source = dict(body["dataSources"][0])
+            data_source["parameters"] = dict(data_source["parameters"], filter=filter_slot)
+            body["dataSources"] = [data_source] + body["dataSources"][1:]
+            has_filter = True
+
+        prefix, rest = dumps(body).split(dumps(messages_slot), 1)
+        if has_filter:
+            middle, suffix = rest.split(dumps(filter_slot), 1)
+        else:
+            middle, suffix = rest, b""
+        return cls(prefix=prefix, middle=middle, suffix=suffix, has_filter=has_filter)
+
+    def render(self, messages, filter: Optional[str] = None) -> bytes:
+        if self.has_filter:
+            return b"".join((self.prefix, dumps(messages), self.middle, dumps(filter), self.suffix))
+        return b"".join((self.prefix, dumps(messages), self.middle))
+
+
+@dataclass(frozen=True)
+class AppSettings:
+    chat: ChatCompletionSettings
+    datasource_type: str
+    datasource: Optional[DataSourceSettings]
+    openai_key: Optional[str]
+    body_template: Optional[RequestBodyTemplate]
+    # Same body with secrets masked, only used for debug logging
+    redacted_body_template: Optional[RequestBodyTemplate]
+    headers: Mapping
+
+    @classmethod
+    def from_env(cls, env: Mapping = os.environ, system_message: str = ""):
+        chat = ChatCompletionSettings.from_env(env, system_message)
+        datasource_type = env.get("DATASOURCE_TYPE", "AzureCognitiveSearch")
+        datasource = DataSourceSettings.from_env(datasource_type, chat.system_message, env)
+
+        body_template = None
+        redacted_body_template = None
+        if datasource:
+            body = cls.static_body(chat, datasource)
+            body_template = RequestBodyTemplate.compile(body)
+            redacted_parameters = {name: ("*****" if name in SECRET_PARAMETERS and value else value)
+                                   for name, value in datasource.parameters.items()}
+            body["dataSources"] = [{"type": datasource.type, "parameters": redacted_parameters}]
+            redacted_body_template = RequestBodyTemplate.compile(body)
+
+        return cls(
+            chat=chat,
+            datasource_type=datasource_type,
+            datasource=datasource,
+            openai_key=env.get("AZURE_OPENAI_KEY"),
+            body_template=body_template,
+            redacted_body_template=redacted_body_template,
+            headers=MappingProxyType({
+                "Content-Type": "application/json",
+                "api-key": env.get("AZURE_OPENAI_KEY"),
+                "x-ms-useragent": USER_AGENT,
+            }),
+        )
+
+    @staticmethod
+    def static_body(chat: ChatCompletionSettings, datasource: DataSourceSettings) -> dict:
+        return {
+            "messages": [],
+            "temperature": chat.temperature,
+            "max_tokens": chat.max_tokens,
+            "top_p": chat.top_p,
+            "stop": list(chat.stop) if chat.stop else None,
+            "stream": chat.stream,
+            "dataSources": [{
+                "type": datasource.type,
+                "parameters": copy.deepcopy(dict(datasource.parameters)),
+            }],
+        }
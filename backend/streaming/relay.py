@@ -0,0 +1,182 @@
+"""
+Relay for the Azure OpenAI on your data (extensions/chat/completions) SSE stream.
+
+Upstream bytes are read in large chunks and split into SSE lines incrementally. Each event is
+re-emitted as the NDJSON line the frontend expects, but only the message that changes per event is
+encoded: the envelope (id, model, created, object, apim-request-id, history_metadata) is
+pre-encoded once per stream and reused for every token.
+"""
+import logging
+
+from backend.serialization import dumps, loads
+
+# Bytes requested per socket read, chunked responses are still relayed as soon as a chunk arrives
+READ_SIZE = 64 * 1024
+
+_DATA_PREFIX = b"data:"
+_ASSISTANT_START = b'{"role":"assistant","content":""}'
+_ASSISTANT_CONTENT = b'{"role":"assistant","content":'
+
+
+def iter_raw_chunks(response, read_size=READ_SIZE):
+    """
+    Read a streaming requests.Response in chunks of up to read_size bytes without waiting for a
+    full buffer, so tokens are relayed as soon as they arrive.
+    """
+    raw = response.raw
+    if raw.chunked and raw.supports_chunked_reads():
+        yield from raw.read_chunked(read_size, decode_content=True)
+    else:
+        while chunk := raw.read1(read_size, decode_content=True):
+            yield chunk
+
+
+class SSELineSplitter():
+    """Split a byte stream into lines, independently of where the reads were cut."""
+
+    def __init__(self):
+        self._pending = b""
+
+    def feed(self, chunk: bytes):
+        if self._pending:
+            chunk = self._pending + chunk
+        lines = chunk.split(b"\n")
+        self._pending = lines.pop()
+        return lines
+
+    def flush(self):
+        pending, self._pending = self._pending, b""
+        return [pending] if pending else []
+
+
+class WithDataStreamRelay():
+    """
+    Translates extensions/chat/completions SSE events into NDJSON response lines.
+
+    feed() takes raw upstream bytes and returns the encoded lines completed by them, close()
+    returns whatever was left in the buffer when the upstream stream ended. With a coalescer,
+    assistant content deltas are combined and flush_pending() releases them once they are due.
+    With a transcript (backend/history/stream_tee.py), the tool message and the assistant text are
+    also collected for the chat history.
+    """
+
+    def __init__(self, history_metadata: dict = None, apim_request_id: str = None, legacy_format: bool = False,
+                 debug_logging: bool = False, coalescer=None, transcript=None):
+        self.legacy_format = legacy_format
+        self.debug_logging = debug_logging
+        self.apim_request_id = apim_request_id
+        self.coalescer = coalescer
+        self.transcript = transcript
+        self._splitter = SSELineSplitter()
+        self._envelope_key = None
+        self._head = b""
+        self._tail = b''.join((
+            b']}],"apim-request-id":', dumps(apim_request_id),
+            b',"history_metadata":', dumps(history_metadata or {}),
+            b'}\n'
+        ))
+
+    def feed(self, chunk: bytes):
+        events = []
+        for line in self._splitter.feed(chunk):
+            self._relay_line(line, events)
+        return events
+
+    def close(self):
+        events = []
+        for line in self._splitter.flush():
+            self._relay_line(line, events)
+        self._flush_into(events)
+        return events
+
+    def flush_timeout(self):
+        return self.coalescer.flush_timeout() if self.coalescer else None
+
+    def flush_pending(self):
+        events = []
+        self._flush_into(events)
+        return events
+
+    def _flush_into(self, events):
+        if self.coalescer:
+            text = self.coalescer.flush()
+            if text:
+                events.append(self._head + _ASSISTANT_CONTENT + dumps(text) + b"}" + self._tail)
+
+    def _relay_line(self, line: bytes, events):
+        line = line.strip()
+        if not line.startswith(_DATA_PREFIX):
+            # blank separators, comments and non-data fields
+            return
+        try:
+            event = loads(line[len(_DATA_PREFIX):])
+        except ValueError:
+            # "data: [DONE]" and keep-alives
+            return
+
+        if 'error' in event:
+            if self.transcript:
+                self.transcript.fail()
+            self._flush_into(events)
+            events.append(dumps({"error": event["error"]}) + b"\n")
+            return
+
+        message = self._message(event["choices"][0])
+        if message is None:
+            return
+
+        if isinstance(message, str):
+            # assistant content delta
+            if self.transcript:
+                self.transcript.add_content(message)
+            if self.coalescer:
+                message = self.coalescer.add(message)
+                if message is None:
+                    return
+            message = _ASSISTANT_CONTENT + dumps(message) + b"}"
+        else:
+            # anything else must not overtake the buffered content
+            self._flush_into(events)
+
+        envelope_key = (event["id"], event["model"], event["created"], event["object"])
+        if envelope_key != self._envelope_key:
+            self._flush_into(events)
+            self._envelope_key = envelope_key
+            self._head = b''.join((
+                b'{"id":', dumps(event["id"]),
+                b',"model":', dumps(event["model"]),
+                b',"created":', dumps(event["created"]),
+                b',"object":', dumps(event["object"]),
+                b',"choices":[{"messages":['
+            ))
+        events.append(self._head + message + self._tail)
+
+    def _message(self, choice):
+        """Encoded tool/assistant-start message, the text of a content delta, or None to skip the event."""
+        if self.legacy_format:
+            delta = choice["messages"][0]["delta"]
+            role = delta.get("role")
+            if role == "tool":
+                if self.transcript:
+                    self.transcript.add_tool(delta.get("content"))
+                return dumps(delta)
+        else:
+            delta = choice["delta"]
+            if delta.get("context"):
+                content = delta["context"]["messages"][0]["content"]
+                if self.transcript:
+                    self.transcript.add_tool(content)
+                return dumps({"role": "tool", "content": content})
+            role = "assistant" if delta.get("role") else None
+            if role is None and choice.get("end_turn"):
+                return None
+
+        if role == "assistant":
+            if self.apim_request_id and self.debug_logging:
+                logging.debug(f"RESPONSE apim-request-id: {self.apim_request_id}")
+            return _ASSISTANT_START
+
+        content = delta.get("content")
+        if content is None or content == "[DONE]":
+            return None
+        return content
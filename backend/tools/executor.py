@@ -0,0 +1,282 @@
+"""
+Execution of the functions/tools the model asks for.
+
+Streamed function_call and tool_calls deltas are assembled by ToolCallAccumulator, which hands out
+each call as soon as its arguments are complete (when the model moves on to the next call), so a
+tool can already run while the model is still streaming the rest of its request.
+
+ToolExecutor runs the calls concurrently on a thread pool (or as asyncio tasks), enforces a
+timeout per tool and caches successful results by tool name and normalized arguments. A call never
+raises: failures and timeouts become an error result the model can answer from.
+"""
+import asyncio
+import concurrent.futures
+import inspect
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from backend.serialization import dumps
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_arguments(arguments: str) -> str:
+    """Canonical form of the JSON arguments of a call: sorted keys, case and whitespace folded strings."""
+    def fold(value):
+        if isinstance(value, str):
+            return _WHITESPACE.sub(" ", value).strip().lower()
+        if isinstance(value, dict):
+            return {key: fold(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [fold(item) for item in value]
+        return value
+    try:
+        return json.dumps(fold(json.loads(arguments or "{}")), sort_keys=True, separators=(",", ":"))
+    except ValueError:
+        return _WHITESPACE.sub(" ", arguments).strip()
+
+
+class ToolCall():
+    def __init__(self, id: str = None, name: str = "", arguments: str = ""):
+        # id is None for legacy function_call requests
+        self.id = id
+        self.name = name
+        self.arguments = arguments
+
+    def __repr__(self):
+        return f"ToolCall({self.id!r}, {self.name!r}, {self.arguments!r})"
+
+
+class ToolResult():
+    def __init__(self, call: ToolCall, content: str, error: str = None, cached: bool = False, seconds: float = 0.0):
+        self.call = call
+        self.content = content
+        self.error = error
+        self.cached = cached
+        self.seconds = seconds
+
+    @classmethod
+    def failed(cls, call, error, seconds=0.0):
+        return cls(call, dumps({"error": error}).decode("utf-8"), error=error, seconds=seconds)
+
+
+class ToolCallAccumulator():
+    """Assembles ToolCalls from streamed deltas, in the order the model requested them."""
+
+    def __init__(self):
+        self.calls = []
+        self._released = 0
+
+    def __bool__(self):
+        return bool(self.calls)
+
+    @property
+    def legacy(self):
+        return bool(self.calls) and self.calls[0].id is None
+
+    def feed(self, delta):
+        """Add a delta, returns the calls whose arguments became complete with it."""
+        function_call = getattr(delta, "function_call", None)
+        if function_call is not None:
+            if not self.calls:
+                self.calls.append(ToolCall())
+            self.calls[0].name = function_call.name or self.calls[0].name
+            self.calls[0].arguments += function_call.arguments or ""
+
+        for tool_call in getattr(delta, "tool_calls", None) or []:
+            while len(self.calls) <= tool_call.index:
+                self.calls.append(ToolCall(id=""))
+            call = self.calls[tool_call.index]
+            call.id = tool_call.id or call.id
+            if tool_call.function is not None:
+                call.name = tool_call.function.name or call.name
+                call.arguments += tool_call.function.arguments or ""
+
+        # every call but the last one is complete once a later one started
+        return self._release(len(self.calls) - 1)
+
+    def finish(self):
+        """The calls not handed out yet, once the model finished requesting calls."""
+        return self._release(len(self.calls))
+
+    def _release(self, end):
+        ready = self.calls[self._released:end]
+        self._released = max(self._released, end)
+        return ready
+
+
+def tool_messages(calls, results):
+    """The assistant request and the tool answers to append to the conversation."""
+    if calls and calls[0].id is None:
+        call, result = calls[0], results[0]
+        return [
+            {"role": "assistant", "content": None, "function_call": {"name": call.name, "arguments": call.arguments}},
+            {"role": "function", "name": call.name, "content": result.content},
+        ]
+    messages = [{
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [{"id": call.id, "type": "function", "function": {"name": call.name, "arguments": call.arguments}} for call in calls],
+    }]
+    messages += [{"role": "tool", "tool_call_id": result.call.id, "content": result.content} for result in results]
+    return messages
+
+
+class Tool():
+    def __init__(self, func, timeout_seconds: float = 10.0, cache_ttl_seconds: float = 0.0):
+        self.func = func
+        self.timeout_seconds = timeout_seconds
+        self.cache_ttl_seconds = cache_ttl_seconds
+
+
+class ToolResultCache():
+    """LRU of tool results with a TTL per entry."""
+
+    def __init__(self, max_entries: int = 1000, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def put(self, key, content, ttl_seconds):
+        with self._lock:
+            self._entries[key] = (self.clock() + ttl_seconds, content)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ToolExecutor():
+    def __init__(self, tools: dict, cache: ToolResultCache = None, max_workers: int = 8):
+        self.tools = tools
+        self.cache = cache
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "cache_hits": 0, "timeouts": 0, "errors": 0}
+
+    @classmethod
+    def from_env(cls, functions: dict):
+        timeout = float(os.environ.get("TOOL_TIMEOUT_SECONDS", 10))
+        ttl = float(os.environ.get("TOOL_CACHE_TTL_SECONDS", 300))
+        tools = {name: Tool(func, timeout_seconds=timeout, cache_ttl_seconds=ttl) for name, func in functions.items()}
+        return cls(tools, ToolResultCache(int(os.environ.get("TOOL_CACHE_MAX_ENTRIES", 1000))),
+                   max_workers=int(os.environ.get("TOOL_MAX_WORKERS", 8)))
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _prepare(self, call):
+        """(tool, kwargs, cache key, immediate result) for a call, the result is set when there is nothing to run."""
+        self._count("calls")
+        tool = self.tools.get(call.name)
+        if tool is None:
+            logging.error(f"Function {call.name} does not exist")
+            return None, None, None, ToolResult.failed(call, f"Function {call.name} does not exist")
+        try:
+            kwargs = json.loads(call.arguments or "{}")
+        except ValueError:
+            return None, None, None, ToolResult.failed(call, f"Invalid arguments for {call.name}")
+        key = (call.name, normalize_arguments(call.arguments))
+        if self.cache is not None and tool.cache_ttl_seconds > 0:
+            content = self.cache.get(key)
+            if content is not None:
+                self._count("cache_hits")
+                return None, None, None, ToolResult(call, content, cached=True)
+        return tool, kwargs, key, None
+
+    def _finish(self, call, tool, key, content, started):
+        if not isinstance(content, str):
+            content = dumps(content).decode("utf-8")
+        if self.cache is not None and tool.cache_ttl_seconds > 0:
+            self.cache.put(key, content, tool.cache_ttl_seconds)
+        return ToolResult(call, content, seconds=time.monotonic() - started)
+
+    def _failure(self, call, error, started, counter):
+        self._count(counter)
+        return ToolResult.failed(call, error, seconds=time.monotonic() - started)
+
+    def submit(self, call: ToolCall) -> concurrent.futures.Future:
+        """Start a call on the thread pool, the future resolves to its ToolResult by the tool's timeout at the latest."""
+        outcome = concurrent.futures.Future()
+        tool, kwargs, key, result = self._prepare(call)
+        if result is not None:
+            outcome.set_result(result)
+            return outcome
+        started = time.monotonic()
+
+        def resolve(result):
+            try:
+                outcome.set_result(result)
+            except concurrent.futures.InvalidStateError:
+                # the other one of completion and timeout came first
+                pass
+
+        def run():
+            try:
+                result = self._finish(call, tool, key, tool.func(**kwargs), started)
+            except Exception as e:
+                logging.exception(f"Function {call.name} failed")
+                result = self._failure(call, f"{call.name} failed: {e}", started, "errors")
+            resolve(result)
+
+        def timed_out():
+            if not outcome.done():
+                resolve(self._failure(call, f"{call.name} timed out after {tool.timeout_seconds}s", started, "timeouts"))
+
+        timer = threading.Timer(tool.timeout_seconds, timed_out)
+        timer.daemon = True
+        timer.start()
+        self._pool.submit(run).add_done_callback(lambda _: timer.cancel())
+        return outcome
+
+    def run_all(self, calls):
+        futures = [self.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+    async def arun(self, call: ToolCall) -> ToolResult:
+        tool, kwargs, key, result = self._prepare(call)
+        if result is not None:
+            return result
+        started = time.monotonic()
+        try:
+            if inspect.iscoroutinefunction(tool.func):
+                content = await asyncio.wait_for(tool.func(**kwargs), tool.timeout_seconds)
+            else:
+                loop = asyncio.get_running_loop()
+                content = await asyncio.wait_for(loop.run_in_executor(self._pool, lambda: tool.func(**kwargs)), tool.timeout_seconds)
+        except asyncio.TimeoutError:
+            return self._failure(call, f"{call.name} timed out after {tool.timeout_seconds}s", started, "timeouts")
+        except Exception as e:
+            logging.exception(f"Function {call.name} failed")
+            return self._failure(call, f"{call.name} failed: {e}", started, "errors")
+        return self._finish(call, tool, key, content, started)
+
+    async def arun_all(self, calls):
+        return list(await asyncio.gather(*(self.arun(call) for call in calls)))
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._counters)
+        if self.cache is not None:
+            stats["cache_entries"] = len(self.cache)
+        return stats
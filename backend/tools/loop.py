@@ -0,0 +1,200 @@
+"""
+Multi-round tool loop for chat completions without data.
+
+Each round streams one completion. Answer text is passed on as it arrives; when the model requests
+function/tool calls, the calls run (see executor.py) while heartbeats keep the response streaming,
+their trimmed results are appended to the conversation and the next round starts with the same
+pooled client and the same tools offered, until the model answers. After max_rounds rounds with
+tools the next round is made without them, so the model has to answer.
+
+The loops yield (chunk, text) pairs: the completion chunk the text came from, to build the
+response envelope, and the answer text, None for heartbeats.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+from backend.serialization import dumps, loads
+from backend.tools.executor import ToolCallAccumulator, ToolResult, tool_messages
+
+_TRIMMED_MARKER = " [truncated]"
+
+
+def trim_tool_output(content: str, max_chars: int) -> str:
+    """
+    Shorten a tool result to about max_chars before it is sent back to the model. JSON lists (like
+    the search results) keep as many whole items as fit, anything else is cut off.
+    """
+    if max_chars <= 0 or len(content) <= max_chars:
+        return content
+    try:
+        items = loads(content)
+    except ValueError:
+        items = None
+    if isinstance(items, list):
+        kept = []
+        size = 2
+        for item in items:
+            encoded = dumps(item).decode("utf-8")
+            if size + len(encoded) + 1 > max_chars:
+                break
+            kept.append(item)
+            size += len(encoded) + 1
+        if kept:
+            return dumps(kept).decode("utf-8")
+    return content[:max(0, max_chars - len(_TRIMMED_MARKER))] + _TRIMMED_MARKER
+
+
+def estimate_prompt_tokens(messages) -> int:
+    # About 4 characters per token plus the per-message overhead of the chat format
+    return sum(4 + len(dumps(message)) // 4 for message in messages) + 3
+
+
+class RoundStats():
+    def __init__(self, round: int, prompt_tokens: int):
+        self.round = round
+        self.prompt_tokens = prompt_tokens
+        self.started = time.monotonic()
+        self.first_chunk_seconds = None
+        self.seconds = None
+        self.tool_calls = 0
+        self.tool_seconds = 0.0
+
+    def chunk_received(self):
+        if self.first_chunk_seconds is None:
+            self.first_chunk_seconds = time.monotonic() - self.started
+
+    def finish(self):
+        self.seconds = time.monotonic() - self.started
+        logging.info(f"tool loop round {self.round}: {self.seconds * 1000:.0f}ms (first chunk {(self.first_chunk_seconds or 0) * 1000:.0f}ms), "
+                     f"~{self.prompt_tokens} prompt tokens, {self.tool_calls} tool calls ({self.tool_seconds * 1000:.0f}ms)")
+
+
+class ToolLoopStats():
+    """Per-round totals over all conversations, exposed as a metric."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rounds = {}
+        self._turns = 0
+
+    def record_turn(self, rounds):
+        with self._lock:
+            self._turns += 1
+            for stats in rounds:
+                totals = self._rounds.setdefault(stats.round, {"count": 0, "seconds": 0.0, "first_chunk_seconds": 0.0,
+                                                              "prompt_tokens": 0, "tool_calls": 0, "tool_seconds": 0.0})
+                totals["count"] += 1
+                totals["seconds"] += stats.seconds or 0.0
+                totals["first_chunk_seconds"] += stats.first_chunk_seconds or 0.0
+                totals["prompt_tokens"] += stats.prompt_tokens
+                totals["tool_calls"] += stats.tool_calls
+                totals["tool_seconds"] += stats.tool_seconds
+
+    def snapshot(self):
+        with self._lock:
+            rounds = {}
+            for round, totals in sorted(self._rounds.items()):
+                count = totals["count"]
+                rounds[str(round)] = {
+                    "count": count,
+                    "avg_ms": totals["seconds"] / count * 1000,
+                    "avg_first_chunk_ms": totals["first_chunk_seconds"] / count * 1000,
+                    "avg_prompt_tokens": totals["prompt_tokens"] / count,
+                    "tool_calls": totals["tool_calls"],
+                    "avg_tool_ms": totals["tool_seconds"] / count * 1000,
+                }
+            return {"turns": self._turns, "rounds": rounds}
+
+
+class ToolLoop():
+    """
+    Settings and statistics shared by the loops. create_completion(messages, with_tools) starts the
+    streaming completion of a round, synchronously for run() and as a coroutine for arun().
+    """
+
+    def __init__(self, executor, max_rounds: int = 3, max_output_chars: int = 8000, heartbeat_seconds: float = 2.0,
+                 count_tokens=estimate_prompt_tokens):
+        self.executor = executor
+        self.max_rounds = max_rounds
+        self.max_output_chars = max_output_chars
+        self.heartbeat_seconds = heartbeat_seconds
+        # prompt token count for the round statistics, e.g. TokenCounter.prompt_tokens (backend/context/tokens.py)
+        self.count_tokens = count_tokens
+        self.stats = ToolLoopStats()
+
+    def _tool_round_messages(self, tool_calls, results, round_stats):
+        round_stats.tool_calls = len(results)
+        round_stats.tool_seconds = max((result.seconds for result in results), default=0.0)
+        trimmed = [ToolResult(result.call, trim_tool_output(result.content, self.max_output_chars)) for result in results]
+        return tool_messages(tool_calls.calls, trimmed)
+
+    def run(self, response, messages, create_completion):
+        rounds = [RoundStats(1, self.count_tokens(messages))]
+        try:
+            while True:
+                round_stats = rounds[-1]
+                tool_calls = ToolCallAccumulator()
+                running = []
+                chunk = None
+                for chunk in response:
+                    round_stats.chunk_received()
+                    if not (choices := getattr(chunk, "choices")):
+                        continue
+                    delta = choices[0].delta or None
+
+                    # Start every call whose arguments are complete, the model may still be streaming the next one
+                    running += [self.executor.submit(call) for call in tool_calls.feed(delta)]
+                    if not tool_calls and hasattr(delta, "content"):
+                        yield chunk, delta.content or ""
+
+                if not tool_calls:
+                    return
+                running += [self.executor.submit(call) for call in tool_calls.finish()]
+                while concurrent.futures.wait(running, timeout=self.heartbeat_seconds).not_done:
+                    yield chunk, None
+                messages.extend(self._tool_round_messages(tool_calls, [future.result() for future in running], round_stats))
+                round_stats.finish()
+
+                rounds.append(RoundStats(len(rounds) + 1, self.count_tokens(messages)))
+                response = create_completion(messages, len(rounds) <= self.max_rounds)
+        finally:
+            if rounds[-1].seconds is None:
+                rounds[-1].finish()
+            self.stats.record_turn(rounds)
+
+    async def arun(self, response, messages, create_completion):
+        rounds = [RoundStats(1, self.count_tokens(messages))]
+        try:
+            while True:
+                round_stats = rounds[-1]
+                tool_calls = ToolCallAccumulator()
+                running = []
+                chunk = None
+                async for chunk in response:
+                    round_stats.chunk_received()
+                    if not (choices := getattr(chunk, "choices")):
+                        continue
+                    delta = choices[0].delta or None
+
+                    # Start every call whose arguments are complete, the model may still be streaming the next one
+                    running += [asyncio.create_task(self.executor.arun(call)) for call in tool_calls.feed(delta)]
+                    if not tool_calls and hasattr(delta, "content"):
+                        yield chunk, delta.content or ""
+
+                if not tool_calls:
+                    return
+                running += [asyncio.create_task(self.executor.arun(call)) for call in tool_calls.finish()]
+                while (await asyncio.wait(running, timeout=self.heartbeat_seconds))[1]:
+                    yield chunk, None
+                messages.extend(self._tool_round_messages(tool_calls, [task.result() for task in running], round_stats))
+                round_stats.finish()
+
+                rounds.append(RoundStats(len(rounds) + 1, self.count_tokens(messages)))
+                response = await create_completion(messages, len(rounds) <= self.max_rounds)
+        finally:
+            if rounds[-1].seconds is None:
+                rounds[-1].finish()
+            self.stats.record_turn(rounds)
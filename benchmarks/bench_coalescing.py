@@ -0,0 +1,62 @@
+"""
+Lines, bytes and CPU per answer with and without coalescing of the streamed deltas.
+
+The same extensions/chat/completions event stream is relayed once per token (as upstream sends it)
+and through a DeltaCoalescer. A fake clock advances TOKEN_INTERVAL per token so the time window
+behaves as it would with a real model. CPU includes parsing every NDJSON line the way the browser
+does, since that cost scales with the number of lines too.
+
+    python -m benchmarks.bench_coalescing
+"""
+import json
+import time
+
+from backend.streaming.coalesce import DeltaCoalescer
+from backend.streaming.relay import WithDataStreamRelay
+from benchmarks.stubs import with_data_events
+
+TOKENS = [f" token{i}" for i in range(2000)]
+TOKEN_INTERVAL = 0.02
+STREAMS = 20
+HISTORY_METADATA = {"conversation_id": "8f2d3c8e-6f1a-4a53-9b3e-1c0f3a4e5d6b", "title": "Vacation policy", "date": "2023-11-20T10:00:00"}
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def relay_answer(events, coalescer, clock):
+    relay = WithDataStreamRelay(history_metadata=HISTORY_METADATA, apim_request_id="stub-request", coalescer=coalescer)
+    for event in events:
+        clock.now += TOKEN_INTERVAL
+        yield from relay.feed(event)
+    yield from relay.close()
+
+
+def measure(name, events, make_coalescer):
+    lines = size = 0
+    cpu = time.thread_time()
+    for _ in range(STREAMS):
+        clock = FakeClock()
+        for line in relay_answer(events, make_coalescer(clock), clock):
+            json.loads(line)
+            lines += 1
+            size += len(line)
+    cpu = time.thread_time() - cpu
+    print(f"{name:<16}{lines / STREAMS:>12,.0f}{size / STREAMS / 1024:>12.1f}{cpu / STREAMS * 1000:>16.2f}")
+
+
+def main():
+    events = with_data_events(TOKENS)
+    print(f"{'case':<16}{'lines':>12}{'KB':>12}{'cpu ms/stream':>16}")
+    measure("per token", events, lambda clock: None)
+    for window_ms in (30, 100):
+        measure(f"coalesce {window_ms}ms", events, lambda clock: DeltaCoalescer(window_seconds=window_ms / 1000, clock=clock))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+RU charge, round trips and latency of the chat history operations, against the Cosmos DB emulator
+(or any account you point it at; a database and container are created for the run).
+
+    python -m benchmarks.bench_history
+    COSMOS_BENCH_ENDPOINT=https://<account>.documents.azure.com:443/ COSMOS_BENCH_KEY=<key> python -m benchmarks.bench_history
+
+Every request goes through a transport that sums the x-ms-request-charge response headers, so a
+row is the cost of one history operation as the app issues it. The container gets the indexing
+policy of backend/history/indexing_policy.json; COSMOS_BENCH_DEFAULT_INDEXING=true keeps the
+default index-everything policy to compare write charges against.
+"""
+import os
+import statistics
+import time
+import uuid
+from datetime import datetime
+
+import urllib3
+from azure.core.pipeline.transport import RequestsTransport
+from azure.cosmos import CosmosClient, PartitionKey
+
+from backend.history.cosmosdbservice import INDEXING_POLICY, CosmosConversationClient
+
+# Well-known key of the local emulator
+EMULATOR_KEY = "C2y6yDjf5/R+ob0N8A7Cgv30VRDJIWEHLM+4QDU5DE2nQ9nDuVTqobD4b8mGGyPMbIZnqyMsEcaGQy67XIw/Jw=="
+ENDPOINT = os.environ.get("COSMOS_BENCH_ENDPOINT", "https://localhost:8081")
+KEY = os.environ.get("COSMOS_BENCH_KEY", EMULATOR_KEY)
+DATABASE = os.environ.get("COSMOS_BENCH_DATABASE", "history-bench")
+ITERATIONS = int(os.environ.get("COSMOS_BENCH_ITERATIONS", 50))
+DEFAULT_INDEXING = os.environ.get("COSMOS_BENCH_DEFAULT_INDEXING", "false").lower() == "true"
+SEED_CONVERSATIONS = 20
+SEED_MESSAGES = 10
+
+
+class ChargeRecordingTransport(RequestsTransport):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.charge = 0.0
+        self.round_trips = 0
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        self.charge += float(response.headers.get("x-ms-request-charge", 0))
+        self.round_trips += 1
+        return response
+
+
+def legacy_create_message(client, conversation_id, user_id, input_message):
+    # create_message before the partial-document patch: upsert, cross-partition query, full upsert
+    message = client._new_message(conversation_id, user_id, input_message, datetime.utcnow().isoformat())
+    client.container_client.upsert_item(message)
+    conversation = list(client.container_client.query_items(
+        query="SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId",
+        parameters=[{"name": "@conversationId", "value": conversation_id}, {"name": "@userId", "value": user_id}],
+        enable_cross_partition_query=True))[0]
+    conversation["updatedAt"] = message["createdAt"]
+    client.container_client.upsert_item(conversation)
+
+
+def legacy_get_conversation(client, user_id, conversation_id):
+    # get_conversation before the point read: a cross-partition query
+    conversations = list(client.container_client.query_items(
+        query="SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId",
+        parameters=[{"name": "@conversationId", "value": conversation_id}, {"name": "@userId", "value": user_id}],
+        enable_cross_partition_query=True))
+    return conversations[0] if conversations else None
+
+
+def legacy_get_messages(client, user_id, conversation_id):
+    # get_messages before the partition-scoped query
+    return list(client.container_client.query_items(
+        query="SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC",
+        parameters=[{"name": "@conversationId", "value": conversation_id}, {"name": "@userId", "value": user_id}],
+        enable_cross_partition_query=True))
+
+
+def legacy_get_conversations(client, user_id):
+    return list(client.container_client.query_items(
+        query="SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt DESC offset 0 limit 25",
+        parameters=[{"name": "@userId", "value": user_id}],
+        enable_cross_partition_query=True))
+
+
+def measure(name, operation, transport, iterations=ITERATIONS):
+    latencies = []
+    charge, round_trips = transport.charge, transport.round_trips
+    for i in range(iterations):
+        started = time.perf_counter()
+        operation(i)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name:<34}{(transport.charge - charge) / iterations:>10.2f}{(transport.round_trips - round_trips) / iterations:>8.1f}"
+          f"{statistics.median(latencies):>10.1f}{p99:>10.1f}")
+
+
+def connect():
+    urllib3.disable_warnings()
+    transport = ChargeRecordingTransport(connection_verify=False)
+    cosmos = CosmosClient(ENDPOINT, credential=KEY, transport=transport, connection_verify=False)
+    database = cosmos.create_database_if_not_exists(DATABASE)
+    container_name = f"conversations-{uuid.uuid4().hex[:8]}"
+    if DEFAULT_INDEXING:
+        database.create_container(container_name, partition_key=PartitionKey(path="/userId"))
+    else:
+        database.create_container(container_name, partition_key=PartitionKey(path="/userId"), indexing_policy=INDEXING_POLICY)
+
+    client = CosmosConversationClient.__new__(CosmosConversationClient)
+    client.cosmosdb_client = cosmos
+    client.database_client = database
+    client.container_client = database.get_container_client(container_name)
+    return client, transport, container_name
+
+
+def scenarios(client, user_id):
+    conversation_id = client.create_conversation(user_id, "Benchmark")["id"]
+    user_message = {"role": "user", "content": "How many vacation days do new employees get?"}
+    tool_message = {"role": "tool", "content": "{\"citations\": [], \"intent\": \"vacation days\"}"}
+    assistant_message = {"role": "assistant", "content": "New employees get 15 days of paid time off per year."}
+
+    def update_legacy(i):
+        legacy_create_message(client, conversation_id, user_id, tool_message)
+        legacy_create_message(client, conversation_id, user_id, assistant_message)
+
+    return {
+        "create_message (before)": lambda i: legacy_create_message(client, conversation_id, user_id, user_message),
+        "create_message": lambda i: client.create_message(conversation_id, user_id, user_message),
+        "/history/update tool+answer (before)": update_legacy,
+        "/history/update tool+answer": lambda i: client.create_messages(conversation_id, user_id, [tool_message, assistant_message]),
+    }
+
+
+def read_scenarios(client, user_id):
+    conversation_ids = []
+    for i in range(SEED_CONVERSATIONS):
+        conversation_id = client.create_conversation(user_id, f"Benchmark {i}")["id"]
+        client.create_messages(conversation_id, user_id, [
+            {"role": "user" if j % 2 == 0 else "assistant", "content": f"Message {j} of conversation {i}"}
+            for j in range(SEED_MESSAGES)
+        ])
+        conversation_ids.append(conversation_id)
+
+    # cursor of the page before the last one, to compare against its offset equivalent
+    cursor = None
+    for _ in range(SEED_CONVERSATIONS // 5 - 1):
+        _, cursor = client.get_conversations_page(user_id, 5, cursor=cursor)
+    last_page_cursor = cursor
+
+    def pick(i):
+        return conversation_ids[i % len(conversation_ids)]
+
+    def delete(i):
+        conversation_id = client.create_conversation(user_id, "Deleted")["id"]
+        client.delete_conversation(user_id, conversation_id)
+
+    return {
+        "get_conversation (before)": lambda i: legacy_get_conversation(client, user_id, pick(i)),
+        "get_conversation": lambda i: client.get_conversation(user_id, pick(i)),
+        "get_messages (before)": lambda i: legacy_get_messages(client, user_id, pick(i)),
+        "get_messages": lambda i: client.get_messages(user_id, pick(i)),
+        "get_conversations (before)": lambda i: legacy_get_conversations(client, user_id),
+        "get_conversations": lambda i: client.get_conversations(user_id, 25),
+        "last page by offset": lambda i: client.get_conversations(user_id, 5, offset=SEED_CONVERSATIONS - 5),
+        "last page by cursor": lambda i: client.get_conversations_page(user_id, 5, cursor=last_page_cursor),
+        "create+delete_conversation": delete,
+    }
+
+
+def main():
+    client, transport, container_name = connect()
+    try:
+        print(f"{'operation':<34}{'RU':>10}{'trips':>8}{'p50 ms':>10}{'p99 ms':>10}")
+        for name, operation in scenarios(client, f"bench-{uuid.uuid4()}@contoso.com").items():
+            measure(name, operation, transport)
+        for name, operation in read_scenarios(client, f"bench-{uuid.uuid4()}@contoso.com").items():
+            measure(name, operation, transport)
+    finally:
+        client.database_client.delete_container(container_name)
+
+
+if __name__ == "__main__":
+    main()
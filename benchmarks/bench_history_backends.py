@@ -0,0 +1,94 @@
+"""
+Latency of the chat history operations per storage backend (CHAT_HISTORY_BACKEND).
+
+Every backend gets the same user with SEED_CONVERSATIONS conversations of SEED_MESSAGES messages,
+then each operation runs ITERATIONS times the way the /history endpoints call it. memory and
+sqlite always run; cosmos runs too when COSMOS_BENCH_ENDPOINT is set (see bench_history.py, a
+temporary container is created and deleted).
+
+    python -m benchmarks.bench_history_backends
+    COSMOS_BENCH_ENDPOINT=https://localhost:8081 python -m benchmarks.bench_history_backends
+"""
+import os
+import statistics
+import tempfile
+import time
+import uuid
+
+from backend.history.memory_store import InMemoryConversationStore
+from backend.history.sqlite_store import SqliteConversationStore
+
+ITERATIONS = int(os.environ.get("HISTORY_BENCH_ITERATIONS", 200))
+SEED_CONVERSATIONS = 100
+SEED_MESSAGES = 10
+
+
+def seed(store, user_id):
+    conversation_ids = []
+    for i in range(SEED_CONVERSATIONS):
+        conversation_id = store.create_conversation(user_id, f"Conversation {i}")["id"]
+        store.create_messages(conversation_id, user_id, [
+            {"role": "user" if j % 2 == 0 else "assistant", "content": f"Message {j} of conversation {i}. " * 10}
+            for j in range(SEED_MESSAGES)
+        ])
+        conversation_ids.append(conversation_id)
+    return conversation_ids
+
+
+def operations(store, user_id, conversation_ids):
+    _, cursor = store.get_conversations_page(user_id, 25)
+
+    def pick(i):
+        return conversation_ids[i % len(conversation_ids)]
+
+    def create_and_delete(i):
+        conversation_id = store.create_conversation(user_id, "Deleted")["id"]
+        store.delete_messages(conversation_id, user_id)
+        store.delete_conversation(user_id, conversation_id)
+
+    return {
+        "/history/list (first page)": lambda i: store.get_conversations(user_id, 25),
+        "/history/list (cursor page)": lambda i: store.get_conversations_page(user_id, 25, cursor),
+        "/history/read": lambda i: (store.get_conversation(user_id, pick(i)), store.get_messages(user_id, pick(i))),
+        "/history/update": lambda i: store.create_messages(pick(i), user_id, [{"role": "tool", "content": "{}"}, {"role": "assistant", "content": "Answer"}]),
+        "/history/generate (new)": lambda i: store.create_message(store.create_conversation(user_id, "New")["id"], user_id, {"role": "user", "content": "Hi"}),
+        "/history/delete": create_and_delete,
+    }
+
+
+def measure(operation, iterations=ITERATIONS):
+    latencies = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        operation(i)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+
+def backends(directory):
+    yield "memory", InMemoryConversationStore(), None
+    yield "sqlite", SqliteConversationStore(os.path.join(directory, "history.db")), None
+    if os.environ.get("COSMOS_BENCH_ENDPOINT"):
+        from benchmarks.bench_history import connect
+        client, _, container_name = connect()
+        yield "cosmos", client, lambda: client.database_client.delete_container(container_name)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'backend':<8}{'operation':<30}{'p50 ms':>10}{'p99 ms':>10}")
+        for name, store, cleanup in backends(directory):
+            try:
+                user_id = f"bench-{uuid.uuid4()}@contoso.com"
+                conversation_ids = seed(store, user_id)
+                for operation_name, operation in operations(store, user_id, conversation_ids).items():
+                    p50, p99 = measure(operation)
+                    print(f"{name:<8}{operation_name:<30}{p50:>10.3f}{p99:>10.3f}")
+            finally:
+                if cleanup:
+                    cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Per-request cost of building the extensions/chat/completions request body.
+
+Compares the previous implementation (assemble the dataSources dict from settings on every request,
+then json-encode it) with the RequestBodyTemplate compiled once at startup.
+
+    python -m benchmarks.bench_request_body
+"""
+import copy
+import json
+import timeit
+
+from backend.settings import AppSettings
+
+ENV = {
+    "DATASOURCE_TYPE": "AzureCognitiveSearch",
+    "AZURE_SEARCH_SERVICE": "contoso-search",
+    "AZURE_SEARCH_INDEX": "employee-handbook",
+    "AZURE_SEARCH_KEY": "search-key",
+    "AZURE_SEARCH_CONTENT_COLUMNS": "content|chunk",
+    "AZURE_SEARCH_TITLE_COLUMN": "title",
+    "AZURE_SEARCH_FILENAME_COLUMN": "filepath",
+    "AZURE_SEARCH_URL_COLUMN": "url",
+    "AZURE_SEARCH_VECTOR_COLUMNS": "contentVector",
+    "AZURE_SEARCH_QUERY_TYPE": "vectorSemanticHybrid",
+    "AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG": "default",
+    "AZURE_OPENAI_EMBEDDING_NAME": "text-embedding-ada-002",
+    "AZURE_OPENAI_KEY": "aoai-key",
+    "AZURE_OPENAI_STOP_SEQUENCE": "stop1|stop2",
+    "AZURE_OPENAI_SYSTEM_MESSAGE": "You are an AI assistant that helps people find information.",
+}
+
+MESSAGES = [
+    {"role": "user", "content": "How many vacation days do new employees get?"},
+    {"role": "tool", "content": json.dumps({"citations": [{"content": "x" * 2000, "title": "Benefits"}]})},
+    {"role": "assistant", "content": "New employees get 15 days of paid time off per year [doc1]."},
+    {"role": "user", "content": "And after five years?"},
+]
+
+
+def legacy_body(env, request_messages, debug=False):
+    body = {
+        "messages": request_messages,
+        "temperature": float(env.get("AZURE_OPENAI_TEMPERATURE", 0)),
+        "max_tokens": int(env.get("AZURE_OPENAI_MAX_TOKENS", 1000)),
+        "top_p": float(env.get("AZURE_OPENAI_TOP_P", 1.0)),
+        "stop": env.get("AZURE_OPENAI_STOP_SEQUENCE").split("|") if env.get("AZURE_OPENAI_STOP_SEQUENCE") else None,
+        "stream": True,
+        "dataSources": [{
+            "type": "AzureCognitiveSearch",
+            "parameters": {
+                "endpoint": f"https://{env['AZURE_SEARCH_SERVICE']}.search.windows.net",
+                "key": env["AZURE_SEARCH_KEY"],
+                "indexName": env["AZURE_SEARCH_INDEX"],
+                "fieldsMapping": {
+                    "contentFields": env["AZURE_SEARCH_CONTENT_COLUMNS"].split("|") if env.get("AZURE_SEARCH_CONTENT_COLUMNS") else [],
+                    "titleField": env.get("AZURE_SEARCH_TITLE_COLUMN") or None,
+                    "urlField": env.get("AZURE_SEARCH_URL_COLUMN") or None,
+                    "filepathField": env.get("AZURE_SEARCH_FILENAME_COLUMN") or None,
+                    "vectorFields": env["AZURE_SEARCH_VECTOR_COLUMNS"].split("|") if env.get("AZURE_SEARCH_VECTOR_COLUMNS") else [],
+                },
+                "inScope": True,
+                "topNDocuments": int(env.get("AZURE_SEARCH_TOP_K", 5)),
+                "queryType": env["AZURE_SEARCH_QUERY_TYPE"],
+                "semanticConfiguration": env.get("AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG") or "",
+                "roleInformation": env["AZURE_OPENAI_SYSTEM_MESSAGE"],
+                "filter": None,
+                "strictness": int(env.get("AZURE_SEARCH_STRICTNESS", 3)),
+                "embeddingDeploymentName": env["AZURE_OPENAI_EMBEDDING_NAME"],
+            }
+        }]
+    }
+    if debug:
+        body_clean = copy.deepcopy(body)
+        body_clean["dataSources"][0]["parameters"]["key"] = "*****"
+        json.dumps(body_clean, indent=4)
+    # requests encodes json= bodies with json.dumps
+    return json.dumps(body).encode("utf-8")
+
+
+def main(number=20000):
+    settings = AppSettings.from_env(ENV)
+    template = settings.body_template
+
+    cases = {
+        "legacy": lambda: legacy_body(ENV, MESSAGES),
+        "legacy (DEBUG)": lambda: legacy_body(ENV, MESSAGES, debug=True),
+        "template": lambda: template.render(MESSAGES),
+        "template (DEBUG)": lambda: (template.render(MESSAGES), settings.redacted_body_template.render(MESSAGES)),
+    }
+    print(f"{'case':<20}{'us/request':>12}")
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=number, repeat=5))
+        print(f"{name:<20}{seconds / number * 1e6:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Encoded NDJSON events per second on realistic chat payloads, per JSON serializer.
+
+"previous" is what stream_without_data did before (json.dumps + .replace("\n", "\\n") + "\n", then
+encoded to UTF-8 by the server); the other rows are backend.serialization.ndjson with each backend
+that is installed. Payloads are a streamed token line, a citations (tool) line and a history list.
+
+    python -m benchmarks.bench_serialization
+"""
+import json
+import timeit
+
+from backend.serialization import load_backend
+
+CITATIONS = {"citations": [{"content": "Employees accrue paid time off monthly. " * 40, "title": f"Benefits {i}",
+                            "url": f"https://contoso.sharepoint.com/benefits/{i}.pdf", "filepath": f"benefits_{i}.pdf",
+                            "chunk_id": str(i)} for i in range(5)], "intent": "[\"vacation days\"]"}
+HISTORY_METADATA = {"conversation_id": "8f2d3c8e-6f1a-4a53-9b3e-1c0f3a4e5d6b", "title": "Vacation policy", "date": "2023-11-20T10:00:00"}
+ENVELOPE = {"id": "chatcmpl-8NnVb", "model": "gpt-4-32k", "created": 1700000000, "object": "chat.completion.chunk"}
+
+PAYLOADS = {
+    "token": dict(ENVELOPE, choices=[{"messages": [{"role": "assistant", "content": " vacation"}]}], history_metadata=HISTORY_METADATA),
+    "citations": dict(ENVELOPE, choices=[{"messages": [{"role": "tool", "content": json.dumps(CITATIONS)}]}], history_metadata=HISTORY_METADATA),
+    "history list": [{"id": f"conv-{i}", "type": "conversation", "title": f"Conversation {i} über Urlaub", "userId": "00000000-0000-0000-0000-000000000000",
+                      "createdAt": "2023-11-20T10:00:00.000000", "updatedAt": "2023-11-20T10:05:00.000000"} for i in range(25)],
+}
+
+
+def previous(obj):
+    return (json.dumps(obj).replace("\n", "\\n") + "\n").encode("utf-8")
+
+
+def main(number=20000):
+    encoders = {"previous": previous}
+    for name in ("json", "msgspec", "orjson"):
+        try:
+            _, dumps, _ = load_backend(name)
+        except ValueError:
+            continue
+        encoders[name] = lambda obj, dumps=dumps: dumps(obj) + b"\n"
+
+    print(f"{'payload':<14}" + "".join(f"{name:>14}" for name in encoders) + "   (events/s)")
+    for payload_name, payload in PAYLOADS.items():
+        row = f"{payload_name:<14}"
+        for encode in encoders.values():
+            seconds = min(timeit.repeat(lambda: encode(payload), number=number, repeat=5))
+            row += f"{number / seconds:>14,.0f}"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
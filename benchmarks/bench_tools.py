@@ -0,0 +1,45 @@
+"""
+Wall time of a tool turn with several search_bing calls against a local stub Bing with latency.
+
+"serial" runs the calls one after the other like run_function did, "parallel" runs them through
+ToolExecutor, "cached" repeats the same (differently cased/spaced) queries within the cache TTL.
+
+    python -m benchmarks.bench_tools
+"""
+import json
+import time
+from unittest import mock
+
+import app
+from backend.tools.executor import Tool, ToolCall, ToolExecutor, ToolResultCache
+from benchmarks.stubs import StubServer, bing_search
+
+LATENCY_SECONDS = 0.25
+QUERIES = ["contoso vacation policy", "contoso parental leave", "contoso 401k match"]
+ROUNDS = 5
+
+
+def measure(name, run):
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        run()
+    print(f"{name:<10}{(time.perf_counter() - started) / ROUNDS * 1000:>12.0f}")
+
+
+def main():
+    routes = {("GET", "/v7.0/search"): lambda handler: bing_search(handler, delay_seconds=LATENCY_SECONDS)}
+    with StubServer(routes) as stub, mock.patch.object(app, "BING_SEARCH_ENDPOINT", f"{stub.url}/v7.0/search"):
+        calls = [ToolCall(str(i), "search_bing", json.dumps({"query": query})) for i, query in enumerate(QUERIES)]
+        uncached = ToolExecutor({"search_bing": Tool(app.search)})
+        cached = ToolExecutor({"search_bing": Tool(app.search, cache_ttl_seconds=300)}, ToolResultCache())
+        cached.run_all(calls)
+        variants = [ToolCall(call.id, call.name, json.dumps({"query": f"  {json.loads(call.arguments)['query'].title()} "})) for call in calls]
+
+        print(f"{'case':<10}{'ms/turn':>12}")
+        measure("serial", lambda: [app.search(json.loads(call.arguments)["query"]) for call in calls])
+        measure("parallel", lambda: uncached.run_all(calls))
+        measure("cached", lambda: cached.run_all(variants))
+
+
+if __name__ == "__main__":
+    main()
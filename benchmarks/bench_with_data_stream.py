@@ -0,0 +1,110 @@
+"""
+Tokens per second and client CPU per stream for the on-your-data streaming path.
+
+A local stub serves an extensions/chat/completions SSE stream; the previous implementation
+(iter_lines(chunk_size=10), json.loads + formatApiResponseStreaming + json.dumps per token) is compared
+with WithDataStreamRelay fed by 64KB buffered reads. CPU is measured on the consuming thread only.
+
+    python -m benchmarks.bench_with_data_stream
+"""
+import json
+import time
+
+import requests
+
+from backend.streaming.relay import WithDataStreamRelay, iter_raw_chunks
+from benchmarks.stubs import StubServer, send_chunked, with_data_events
+
+TOKENS = [f" token{i}" for i in range(2000)]
+STREAMS = 20
+HISTORY_METADATA = {"conversation_id": "8f2d3c8e-6f1a-4a53-9b3e-1c0f3a4e5d6b", "title": "Vacation policy", "date": "2023-11-20T10:00:00"}
+
+
+def legacy_format_streaming(rawResponse):
+    if 'error' in rawResponse:
+        return {"error": rawResponse["error"]}
+    response = {
+        "id": rawResponse["id"],
+        "model": rawResponse["model"],
+        "created": rawResponse["created"],
+        "object": rawResponse["object"],
+        "choices": [{"messages": []}],
+    }
+    delta = rawResponse["choices"][0]["delta"]
+    if delta.get("context"):
+        response["choices"][0]["messages"].append({"delta": {"role": "tool", "content": delta["context"]["messages"][0]["content"]}})
+    elif delta.get("role"):
+        response["choices"][0]["messages"].append({"delta": {"role": "assistant"}})
+    elif rawResponse["choices"][0]["end_turn"]:
+        response["choices"][0]["messages"].append({"delta": {"content": "[DONE]"}})
+    else:
+        response["choices"][0]["messages"].append({"delta": {"content": delta["content"]}})
+    return response
+
+
+def legacy_stream(session, url):
+    with session.post(url, data=b"{}", stream=True) as r:
+        for line in r.iter_lines(chunk_size=10):
+            if not line:
+                continue
+            response = {"id": "", "model": "", "created": 0, "object": "", "choices": [{"messages": []}],
+                        "apim-request-id": "", "history_metadata": HISTORY_METADATA}
+            try:
+                lineJson = legacy_format_streaming(json.loads(line.lstrip(b'data:').decode('utf-8')))
+            except json.decoder.JSONDecodeError:
+                continue
+            response["id"] = lineJson["id"]
+            response["model"] = lineJson["model"]
+            response["created"] = lineJson["created"]
+            response["object"] = lineJson["object"]
+            response["apim-request-id"] = r.headers.get('apim-request-id')
+            delta = lineJson["choices"][0]["messages"][0]["delta"]
+            role = delta.get("role")
+            if role == "tool":
+                response["choices"][0]["messages"].append(delta)
+            elif role == "assistant":
+                response["choices"][0]["messages"].append({"role": "assistant", "content": ""})
+            elif delta["content"] != "[DONE]":
+                response["choices"][0]["messages"].append({"role": "assistant", "content": delta["content"]})
+            else:
+                continue
+            yield json.dumps(response, ensure_ascii=False) + "\n"
+
+
+def relay_stream(session, url):
+    with session.post(url, data=b"{}", stream=True) as r:
+        relay = WithDataStreamRelay(history_metadata=HISTORY_METADATA, apim_request_id=r.headers.get('apim-request-id'))
+        for chunk in iter_raw_chunks(r):
+            events = relay.feed(chunk)
+            if events:
+                yield b"".join(events)
+        events = relay.close()
+        if events:
+            yield b"".join(events)
+
+
+def measure(name, stream, session, url):
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    output = 0
+    for _ in range(STREAMS):
+        for chunk in stream(session, url):
+            output += len(chunk)
+    cpu = time.thread_time() - cpu
+    wall = time.perf_counter() - wall
+    tokens = len(TOKENS) * STREAMS
+    print(f"{name:<8}{tokens / wall:>14,.0f}{cpu / STREAMS * 1000:>16.2f}{output / STREAMS / 1024:>14.1f}")
+
+
+def main():
+    events = with_data_events(TOKENS)
+    routes = {("POST", "/stream"): lambda handler: send_chunked(handler, events, headers={"apim-request-id": "stub-request"})}
+    with StubServer(routes) as stub, requests.Session() as session:
+        url = f"{stub.url}/stream"
+        print(f"{'impl':<8}{'tokens/s':>14}{'cpu ms/stream':>16}{'KB/stream':>14}")
+        measure("legacy", legacy_stream, session, url)
+        measure("relay", relay_stream, session, url)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Local stand-ins for the upstream services, used by the tests and benchmarks.
+
+StubServer runs a ThreadingHTTPServer on 127.0.0.1 and dispatches to handler functions keyed by
+(method, path). A handler receives the BaseHTTPRequestHandler and writes the whole response.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class StubServer():
+    def __init__(self, routes: dict):
+        self.routes = routes
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _dispatch(self, method):
+                path = urlsplit(self.path).path
+                length = int(self.headers.get("Content-Length") or 0)
+                self.body = self.rfile.read(length) if length else b""
+                stub.requests.append((method, self.path, self.body))
+                handler = stub.routes.get((method, path))
+                if handler is None:
+                    send_json(self, 404, {"error": {"code": "NotFound", "message": path}})
+                else:
+                    handler(self)
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def send_json(handler, status, obj, headers=None):
+    body = json.dumps(obj).encode("utf-8")
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def send_chunked(handler, chunks, content_type="text/event-stream", headers=None):
+    handler.send_response(200)
+    handler.send_header("Content-Type", content_type)
+    handler.send_header("Transfer-Encoding", "chunked")
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.end_headers()
+    for chunk in chunks:
+        handler.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+    handler.wfile.write(b"0\r\n\r\n")
+    handler.wfile.flush()
+
+
+def with_data_events(tokens, citations="{\"citations\": [], \"intent\": \"[]\"}"):
+    """SSE events of an extensions/chat/completions stream (2023-08-01-preview format) answering with tokens."""
+    envelope = {"id": "chatcmpl-stub", "model": "gpt-4-32k", "created": 1700000000, "object": "extensions.chat.completion.chunk"}
+    events = [
+        dict(envelope, choices=[{"index": 0, "delta": {"role": "assistant", "context": {"messages": [{"role": "tool", "content": citations, "end_turn": False}]}}, "end_turn": False}]),
+        dict(envelope, choices=[{"index": 0, "delta": {"role": "assistant"}, "end_turn": False}]),
+    ]
+    events += [dict(envelope, choices=[{"index": 0, "delta": {"content": token}, "end_turn": False}]) for token in tokens]
+    events.append(dict(envelope, choices=[{"index": 0, "delta": {}, "end_turn": True}]))
+    return [b"data: " + json.dumps(event).encode("utf-8") + b"\n\n" for event in events] + [b"data: [DONE]\n\n"]
+
+
+def chat_completion_events(tokens, model="gpt-4-32k"):
+    """SSE events of a chat/completions stream answering with tokens."""
+    envelope = {"id": "chatcmpl-stub", "model": model, "created": 1700000000, "object": "chat.completion.chunk"}
+    events = [dict(envelope, choices=[{"index": 0, "finish_reason": None, "delta": {"role": "assistant", "content": ""}}])]
+    events += [dict(envelope, choices=[{"index": 0, "finish_reason": None, "delta": {"content": token}}]) for token in tokens]
+    events.append(dict(envelope, choices=[{"index": 0, "finish_reason": "stop", "delta": {}}]))
+    return [b"data: " + json.dumps(event).encode("utf-8") + b"\n\n" for event in events] + [b"data: [DONE]\n\n"]
+
+
+def tool_call_events(calls, model="gpt-4-32k", legacy=False):
+    """
+    SSE events of a chat/completions stream requesting calls, a list of (name, arguments) pairs.
+    Arguments are streamed in small pieces like the service does. legacy streams a function_call.
+    """
+    envelope = {"id": "chatcmpl-stub", "model": model, "created": 1700000000, "object": "chat.completion.chunk"}
+    events = [dict(envelope, choices=[{"index": 0, "finish_reason": None, "delta": {"role": "assistant", "content": None}}])]
+    for index, (name, arguments) in enumerate(calls):
+        pieces = [arguments[i:i + 8] for i in range(0, len(arguments), 8)]
+        for position, piece in enumerate(pieces):
+            function = {"arguments": piece}
+            if position == 0:
+                function["name"] = name
+            if legacy:
+                delta = {"function_call": function}
+            else:
+                tool_call = {"index": index, "function": function}
+                if position == 0:
+                    tool_call.update(id=f"call_{index}", type="function")
+                delta = {"tool_calls": [tool_call]}
+            events.append(dict(envelope, choices=[{"index": 0, "finish_reason": None, "delta": delta}]))
+    finish_reason = "function_call" if legacy else "tool_calls"
+    events.append(dict(envelope, choices=[{"index": 0, "finish_reason": finish_reason, "delta": {}}]))
+    return [b"data: " + json.dumps(event).encode("utf-8") + b"\n\n" for event in events] + [b"data: [DONE]\n\n"]
+
+
+def bing_search(handler, results=3, delay_seconds=0.0):
+    """Bing Web Search v7 response for the q parameter of the request."""
+    query = parse_qs(urlsplit(handler.path).query).get("q", [""])[0]
+    time.sleep(delay_seconds)
+    send_json(handler, 200, {
+        "_type": "SearchResponse",
+        "queryContext": {"originalQuery": query},
+        "webPages": {"value": [
+            {"name": f"{query} result {i}", "url": f"https://example.com/{i}", "snippet": f"Snippet {i} about {query}. " * 8}
+            for i in range(results)
+        ]},
+    })
+
+
+def faulty(handler, faults):
+    """
+    A handler that answers with the faults, in order, before it passes requests on to handler. A
+    fault is a status code, a (status code, headers) pair, or "drop" to close the connection
+    without a response.
+    """
+    faults = list(faults)
+    lock = threading.Lock()
+
+    def respond(request):
+        with lock:
+            fault = faults.pop(0) if faults else None
+        if fault is None:
+            handler(request)
+        elif fault == "drop":
+            request.close_connection = True
+            request.connection.close()
+        else:
+            status, headers = fault if isinstance(fault, tuple) else (fault, None)
+            send_json(request, status, {"error": {"code": str(status), "message": "Injected fault"}}, headers=headers)
+
+    return respond
@@ -0,0 +1,74 @@
+import pytest
+
+import app
+from backend.clients.admission import AdmissionController, AdmissionRejected, MemoryBucketBackend
+
+
+class FakeTime():
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def controller(fake, **limits):
+    return AdmissionController(MemoryBucketBackend(fake.clock), clock=fake.clock, sleep=fake.sleep, **limits)
+
+
+def test_waits_for_the_quota_within_the_bound_then_rejects():
+    fake = FakeTime()
+    admission = controller(fake, quotas={"chat": (3000, 0)}, user_tpm=1200, max_wait_seconds=6)
+
+    # a minute of quota passes at once, then the bucket refills at 20 tokens a second
+    assert admission.admit("alice", "chat", 1200) == 0
+    assert admission.admit("alice", "chat", 100) == pytest.approx(5)
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit("alice", "chat", 1000)
+    assert rejected.value.scope == "user" and rejected.value.retry_after == pytest.approx(50)
+
+    # other users have their own buckets, until the deployment's is empty
+    admission.admit("bob", "chat", 1200)
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.admit("carol", "chat", 1200)
+    assert rejected.value.scope == "deployment"
+
+    stats = admission.snapshot()
+    assert stats["admitted"] == 3 and stats["queued"] == 1 and stats["rejected_user"] == 1 and stats["rejected_deployment"] == 1
+
+
+def test_full_queue_rejects_at_once_with_retry_after(monkeypatch):
+    fake = FakeTime()
+    admission = controller(fake, quotas={"image": (0, 12)}, max_queue=0)
+    monkeypatch.setattr(app, "admission", admission)
+    monkeypatch.setattr(app, "upstream_retry", None)
+
+    for user in range(12):
+        admission.admit(f"user-{user}", "image")
+    request_body = {"messages": [{"role": "user", "content": "A lighthouse at dusk"}]}
+    with app.app.test_request_context("/dalle", method="POST", json=request_body, headers={"x-auth-request-email": "carol"}):
+        body, status_code, headers = app.dalle.__wrapped__({})
+
+    assert status_code == 429 and headers == {"Retry-After": "5"}
+    assert fake.sleeps == [] and admission.snapshot()["queue_full"] == 1
+
+
+def test_memory_buckets_are_dropped_once_refilled_and_bounded():
+    fake = FakeTime()
+    backend = MemoryBucketBackend(fake.clock, max_buckets=3)
+
+    # client-chosen keys cannot grow the table past max_buckets
+    for address in range(10):
+        assert backend.take([(f"user:{address}:requests", 1, 2, 1.0)]) == (0.0, 0)
+    assert len(backend) == 3
+
+    # a bucket that has refilled is dropped, it answers as a new one would
+    fake.now += 5
+    backend.take([("user:alice:requests", 2, 2, 1.0)])
+    assert len(backend) == 1
+    assert backend.take([("user:alice:requests", 1, 2, 1.0)]) == (pytest.approx(1.0), 0)
@@ -3,4 +3,4 @@ from app import format_as_ndjson
 
 def test_format_as_ndjson():
     obj = {"message": "I ❤️ 🐍 \n and escaped newlines"}
-    assert format_as_ndjson(obj) == '{"message": "I ❤️ 🐍 \\n and escaped newlines"}\n'
+    assert format_as_ndjson(obj) == '{"message":"I ❤️ 🐍 \\n and escaped newlines"}\n'.encode("utf-8")
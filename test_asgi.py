@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+import httpx
+import openai
+
+import asgi
+
+
+def _sse(chunks):
+    return "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks) + "data: [DONE]\n\n"
+
+
+def _completion_chunk(content):
+    return {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "gpt-4-32k",
+        "choices": [{"index": 0, "finish_reason": None, "delta": {"content": content}}],
+    }
+
+
+def test_conversation_without_data_streams_ndjson(monkeypatch):
+    monkeypatch.setenv("JWT_AUTH_DISABLED", "true")
+    monkeypatch.setattr(asgi, "should_use_data", lambda: False)
+
+    def handler(request):
+        return httpx.Response(200, text=_sse([_completion_chunk("Hello"), _completion_chunk(" world")]),
+                              headers={"content-type": "text/event-stream"})
+
+    async def run():
+        client = openai.AsyncAzureOpenAI(api_key="key", azure_endpoint="https://example.openai.azure.com",
+                                         api_version="2023-08-01-preview",
+                                         http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        monkeypatch.setattr(asgi, "get_openai_client", lambda api_version, deployment=None: client)
+
+        test_client = asgi.app.test_client()
+        response = await test_client.post("/conversation", json={"messages": [{"role": "user", "content": "Hi"}]})
+        return response.status_code, await response.get_data(as_text=True)
+
+    status_code, body = asyncio.run(run())
+    lines = [json.loads(line) for line in body.splitlines()]
+
+    assert status_code == 200
+    assert [line["choices"][0]["messages"][0]["content"] for line in lines] == ["Hello", " world"]
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from flask import Flask
+from quart import Quart
+
+import auth
+from benchmarks.stubs import StubServer, send_json
+
+ISSUER = "https://contoso.okta.com/oauth2/default"
+
+
+def signing_key(kid):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key, dict(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key(), as_dict=True), kid=kid, use="sig", alg="RS256")
+
+
+def access_token(key, kid, **claims):
+    claims = dict({"iss": ISSUER, "aud": "api://default", "sub": "alice@contoso.com", "exp": int(time.time()) + 3600}, **claims)
+    return jwt.encode(claims, key, algorithm="RS256", headers={"kid": kid})
+
+
+def test_flask_views_verify_tokens_offline_and_refresh_rotated_keys(monkeypatch):
+    monkeypatch.delenv("JWT_AUTH_DISABLED", raising=False)
+    first, first_jwk = signing_key("first")
+    second, second_jwk = signing_key("second")
+    jwks = {"keys": [first_jwk]}
+
+    flask_app = Flask(__name__)
+
+    @flask_app.route("/me")
+    @auth.jwt_required
+    def me(jwt_claims):
+        return {"sub": jwt_claims["sub"]}
+
+    with StubServer({("GET", "/oauth2/default/v1/keys"): lambda handler: send_json(handler, 200, jwks)}) as stub:
+        verifier = auth.TokenVerifier(auth.JWKSCache(f"{stub.url}/oauth2/default/v1/keys", min_refresh_seconds=0), ISSUER, "api://default")
+        monkeypatch.setattr(auth, "token_verifier", verifier)
+        client = flask_app.test_client()
+
+        token = access_token(first, "first")
+        for _ in range(3):
+            response = client.get("/me", headers={"Authorization": f"Bearer {token}"})
+            assert response.status_code == 200 and response.json == {"sub": "alice@contoso.com"}
+        # the keys are fetched once, the token verified once
+        assert len(stub.requests) == 1 and verifier.snapshot()["cache_hits"] == 2
+
+        # a token signed with a rotated key refetches the keys
+        jwks["keys"].append(second_jwk)
+        assert client.get("/me", headers={"Authorization": f"Bearer {access_token(second, 'second')}"}).status_code == 200
+        assert len(stub.requests) == 2
+
+        assert client.get("/me").status_code == 401
+        forged = access_token(second, "first")
+        assert client.get("/me", headers={"Authorization": f"Bearer {forged}"}).status_code == 403
+        expired = access_token(first, "first", exp=int(time.time()) - 600)
+        assert client.get("/me", headers={"Authorization": f"Bearer {expired}"}).status_code == 403
+        other_audience = access_token(first, "first", aud="api://other")
+        assert client.get("/me", headers={"Authorization": f"Bearer {other_audience}"}).status_code == 403
+
+    assert verifier.snapshot()["rejected"] == 3
+
+
+def test_quart_views_are_verified_on_the_event_loop(monkeypatch):
+    monkeypatch.delenv("JWT_AUTH_DISABLED", raising=False)
+    key, jwk = signing_key("only")
+    quart_app = Quart(__name__)
+
+    @quart_app.route("/me")
+    @auth.jwt_required
+    async def me(jwt_claims):
+        return {"sub": jwt_claims["sub"]}
+
+    async def requests(token):
+        client = quart_app.test_client()
+        return [(await client.get("/me", headers={"Authorization": f"Bearer {token}"})).status_code for _ in range(2)]
+
+    with StubServer({("GET", "/keys"): lambda handler: send_json(handler, 200, {"keys": [jwk]})}) as stub:
+        verifier = auth.TokenVerifier(auth.JWKSCache(f"{stub.url}/keys"), ISSUER, cache_size=0)
+        monkeypatch.setattr(auth, "token_verifier", verifier)
+        assert asyncio.run(requests(access_token(key, "only"))) == [200, 200]
+        # without the token cache each request verifies the signature, against the keys fetched once
+        assert len(stub.requests) == 1 and verifier.snapshot()["verified"] == 2
+
+    monkeypatch.setattr(auth, "token_verifier", None)
+    assert asyncio.run(requests(access_token(key, "only"))) == [500, 500]
+
+
+def test_lookups_do_not_wait_for_a_refresh():
+    _, jwk = signing_key("only")
+    fetching, release = threading.Event(), threading.Event()
+    jwks = auth.JWKSCache("https://contoso.okta.com/keys")
+
+    def slow_fetch():
+        fetching.set()
+        release.wait(5)
+        return {"only": jwt.PyJWK(jwk)}
+    jwks._fetch = slow_fetch
+
+    refresh = threading.Thread(target=jwks.key, args=("only",))
+    refresh.start()
+    assert fetching.wait(5)
+    # the keys are being fetched: a lookup answers at once that it needs them, without blocking on the fetch
+    started = time.monotonic()
+    assert jwks._lookup("only") is None and time.monotonic() - started < 1
+    release.set()
+    refresh.join(5)
+    assert jwks._lookup("only").key_id == "only" and jwks.snapshot()["refreshes"] == 1
@@ -0,0 +1,55 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from backend.clients.pool import ConnectionPool, PoolSettings
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b'{"value": []}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "affinity=user-a")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_connections_are_reused_across_calls():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    pool = ConnectionPool(PoolSettings(default_pool_size=2, http2=False))
+    try:
+        for _ in range(3):
+            assert pool.get(url).status_code == 200
+            assert pool.httpx_client(url).get(url).status_code == 200
+
+        hosts = pool.snapshot()["hosts"]
+        assert hosts["127.0.0.1"] == {"requests": 6, "hits": 4, "misses": 2, "pool_size": 2}
+        # cookies set by one upstream response must not leak into the next caller's request
+        assert len(pool.session(url).cookies) == 0
+    finally:
+        pool.close()
+        server.shutdown()
+
+
+def test_new_hosts_do_not_change_a_session_in_use():
+    pool = ConnectionPool(PoolSettings(http2=False))
+    try:
+        session = pool.session("https://graph.microsoft.com/v1.0/me")
+        adapters = dict(session.adapters)
+        newer = pool.session("https://api.bing.microsoft.com/v7.0/search")
+
+        # other threads may be looking up adapters in the session they got
+        assert newer is not session and dict(session.adapters) == adapters
+        # the sessions share the adapter, and so the connections, of a host mounted before
+        assert newer.get_adapter("https://graph.microsoft.com/") is session.get_adapter("https://graph.microsoft.com/")
+        assert pool.session("https://graph.microsoft.com/v1.0/users") is newer
+    finally:
+        pool.close()
@@ -0,0 +1,98 @@
+import logging
+
+from backend.context.budget import SUMMARY_PREFIX, ContextBudget, ContextBudgetSettings, context_window
+from backend.context.tokens import TokenCounter
+
+
+def turns(count, size=40):
+    messages = [{"role": "system", "content": "You are helpful."}]
+    for i in range(count):
+        messages.append({"role": "user", "content": f"question {i} " + "x" * size})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "y" * size})
+    return messages
+
+
+def test_older_turns_are_dropped_to_fit_the_budget():
+    counter = TokenCounter("gpt-35-turbo-16k")
+    messages = turns(20)
+    budget = ContextBudget(counter, max_prompt_tokens=counter.prompt_tokens(messages[:1] + messages[-6:]))
+
+    assert budget.fits(messages[:7]) and not budget.fits(messages)
+    plan = budget.plan(messages)
+    kept = plan.messages()
+    assert kept[0]["role"] == "system" and kept[1]["role"] == "user"
+    assert kept[1:] == messages[-len(kept) + 1:] and len(kept) == 7
+    assert counter.prompt_tokens(kept) <= budget.max_prompt_tokens
+    assert not plan.summary_needed and budget.snapshot()["messages_dropped"] == 34
+    assert context_window("gpt-4-32k-0613") == 32768 and context_window("gpt-4") == 8192
+
+
+def test_summaries_are_reused_until_the_kept_turns_outgrow_the_budget():
+    counter = TokenCounter("gpt-4")
+    budget = ContextBudget(counter, max_prompt_tokens=400, summarize=True, summary_max_tokens=50)
+
+    messages = turns(12)
+    plan = budget.plan(messages)
+    assert plan.summary_needed and plan.summary is None
+    prompt = plan.summary_prompt()
+    assert prompt[1]["content"].startswith("user: question 0")
+    summary = plan.summary_record("The user asked questions.")
+    sent = plan.messages(summary)
+    assert sent[1] == {"role": "system", "content": SUMMARY_PREFIX + "The user asked questions."}
+    assert counter.prompt_tokens(sent) <= 400
+
+    # the next turn still fits after the stored summary
+    messages = messages + [{"role": "user", "content": "one more"}]
+    plan = budget.plan(messages, stored_summary=summary)
+    assert not plan.summary_needed and plan.cut == summary["messages"]
+
+    # much later the summary is rolled forward from where it stopped
+    messages = turns(20)
+    plan = budget.plan(messages, stored_summary=summary)
+    assert plan.summary_needed and plan.summarize_from == summary["messages"] and plan.cut > summary["messages"]
+    assert plan.summary_prompt()[1]["content"].startswith(SUMMARY_PREFIX + "The user asked questions.")
+
+    # a transcript that does not start like the summarized one gets a new summary
+    edited = [messages[0], {"role": "user", "content": "edited"}] + messages[2:]
+    assert budget.plan(edited, stored_summary=summary).summary is None
+    assert budget.snapshot()["summaries_reused"] == 1
+
+
+def test_the_question_is_sent_even_when_it_alone_is_over_the_budget():
+    counter = TokenCounter("gpt-4")
+    budget = ContextBudget(counter, max_prompt_tokens=100)
+    system, question = {"role": "system", "content": "You are helpful."}, {"role": "user", "content": "x " * 4000}
+
+    assert budget.plan([system, question]).messages() == [system, question]
+    answered = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}, question]
+    assert budget.plan(answered).messages() == [question]
+    plan = ContextBudget(counter, max_prompt_tokens=100, summarize=True).plan(answered)
+    assert plan.messages({"content": "Greetings."})[-1] == question
+
+
+def test_the_data_source_reservation_leaves_room_on_small_windows(caplog):
+    counter = TokenCounter("gpt-35-turbo")
+    budget = ContextBudget.from_settings(counter, ContextBudgetSettings(), max_completion_tokens=1000)
+    assert budget.max_prompt_tokens == 3096 and budget.data_source_reserved_tokens == 1548
+
+    with caplog.at_level(logging.WARNING):
+        ContextBudget.from_settings(counter, ContextBudgetSettings(data_source_reserved_tokens=3000), max_completion_tokens=1000)
+    assert "leaves 96 tokens for the transcript with data" in caplog.text
+
+
+def test_the_budget_is_off_by_default_on_estimated_counts(monkeypatch, caplog):
+    class Counter():
+        exact = False
+
+    monkeypatch.delenv("CONTEXT_BUDGET_ENABLED", raising=False)
+    with caplog.at_level(logging.WARNING):
+        assert not ContextBudgetSettings.from_env().active(Counter())
+    assert "CONTEXT_BUDGET_ENABLED=true" in caplog.text
+
+    Counter.exact = True
+    assert ContextBudgetSettings.from_env().active(Counter())
+    monkeypatch.setenv("CONTEXT_BUDGET_ENABLED", "false")
+    assert not ContextBudgetSettings.from_env().active(Counter())
+    Counter.exact = False
+    monkeypatch.setenv("CONTEXT_BUDGET_ENABLED", "true")
+    assert ContextBudgetSettings.from_env().active(Counter())
@@ -0,0 +1,126 @@
+import pytest
+from azure.cosmos import exceptions
+
+from backend.history.bulk_delete import DeletionJobs
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.pagination import decode_cursor, encode_cursor
+
+
+class FakeContainer():
+    def __init__(self):
+        self.calls = []
+
+    def upsert_item(self, body):
+        self.calls.append(("upsert_item", body["type"]))
+        return body
+
+    def patch_item(self, item, partition_key, patch_operations):
+        self.calls.append(("patch_item", item, partition_key, patch_operations[0]["path"]))
+        return {"id": item}
+
+    def read_item(self, item, partition_key):
+        self.calls.append(("read_item", item, partition_key))
+        if item == "missing":
+            raise exceptions.CosmosResourceNotFoundError(message="Not found")
+        return {"id": item, "type": "message" if item.startswith("msg") else "conversation"}
+
+    def query_items(self, query, parameters=None, partition_key=None):
+        self.calls.append(("query_items", query, {parameter["name"]: parameter["value"] for parameter in parameters or []}, partition_key))
+        return list(getattr(self, "rows", []))
+
+    def delete_item(self, item, partition_key):
+        self.calls.append(("delete_item", item, partition_key))
+
+
+class FakeBatchContainer(FakeContainer):
+    def execute_item_batch(self, batch_operations, partition_key):
+        self.calls.append(("execute_item_batch", [operation for operation, _ in batch_operations], partition_key))
+        if any(args[0] == "missing" for operation, args in batch_operations):
+            raise exceptions.CosmosHttpResponseError(status_code=404, message="Batch rolled back")
+        return [{"statusCode": 200, "resourceBody": args[0]} for operation, args in batch_operations]
+
+
+def _client(container):
+    client = CosmosConversationClient.__new__(CosmosConversationClient)
+    client.container_client = container
+    return client
+
+
+def test_create_messages_patches_the_conversation_instead_of_rewriting_it():
+    container = FakeContainer()
+    messages = _client(container).create_messages("conv-1", "user-1", [{"role": "tool", "content": "{}"}, {"role": "assistant", "content": "Hi"}])
+
+    assert container.calls == [("upsert_item", "message"), ("upsert_item", "message"), ("patch_item", "conv-1", "user-1", "/updatedAt")]
+    assert [message["role"] for message in messages] == ["tool", "assistant"]
+    assert messages[0]["createdAt"] < messages[1]["createdAt"]
+
+
+def test_create_message_is_one_transactional_batch_when_supported():
+    container = FakeBatchContainer()
+    message = _client(container).create_message("conv-1", "user-1", {"role": "user", "content": "Hello"})
+
+    assert container.calls == [("execute_item_batch", ["upsert", "patch"], "user-1")]
+    assert message["content"] == "Hello" and message["conversationId"] == "conv-1"
+
+
+def test_get_conversation_is_a_point_read_in_the_users_partition():
+    container = FakeContainer()
+    client = _client(container)
+
+    assert client.get_conversation("user-1", "conv-1") == {"id": "conv-1", "type": "conversation"}
+    assert client.get_conversation("user-1", "missing") is None
+    assert client.get_conversation("user-1", "msg-1") is None
+    assert container.calls == [("read_item", "conv-1", "user-1"), ("read_item", "missing", "user-1"), ("read_item", "msg-1", "user-1")]
+
+
+def test_delete_items_runs_transactional_batches_and_reports_progress():
+    container = FakeBatchContainer()
+    progress = []
+    deleted = _client(container).delete_items("user-1", [f"msg-{i}" for i in range(250)], concurrency=2, progress=progress.append)
+
+    assert deleted == 250
+    assert sorted(progress) == [50, 100, 100]
+    assert sorted(len(call[1]) for call in container.calls) == [50, 100, 100]
+    assert all(call[0] == "execute_item_batch" and set(call[1]) == {"delete"} and call[2] == "user-1" for call in container.calls)
+
+
+def test_rolled_back_batch_falls_back_to_point_deletes():
+    container = FakeBatchContainer()
+    _client(container).delete_items("user-1", ["msg-1", "missing"])
+
+    assert container.calls[1:] == [("delete_item", "msg-1", "user-1"), ("delete_item", "missing", "user-1")]
+
+
+def test_deletion_job_reports_progress_until_done():
+    jobs = DeletionJobs()
+    job = jobs.start("user-1", 3, lambda job: [job.advance(1) for _ in range(3)])
+    jobs._pool.shutdown(wait=True)
+
+    assert jobs.get("user-1", job.id).progress()["status"] == "succeeded"
+    assert jobs.get("user-1", job.id).progress()["deleted"] == 3
+    assert jobs.get("user-2", job.id) is None
+    assert jobs.snapshot()["documents_deleted"] == 3
+
+
+def test_conversation_pages_continue_after_the_cursor():
+    container = FakeContainer()
+    container.rows = [{"id": f"conv-{i}", "title": "", "createdAt": "", "updatedAt": f"2024-01-0{9 - i}"} for i in range(3)]
+    client = _client(container)
+
+    page, cursor = client.get_conversations_page("user-1", limit=2)
+    assert [conversation["id"] for conversation in page] == ["conv-0", "conv-1"]
+    assert decode_cursor(cursor) == ("2024-01-08", "conv-1")
+
+    container.rows = container.rows[2:]
+    page, next_cursor = client.get_conversations_page("user-1", limit=2, cursor=cursor)
+    _, query, parameters, partition_key = container.calls[-1]
+    assert [conversation["id"] for conversation in page] == ["conv-2"] and next_cursor is None
+    assert "c.updatedAt < @updatedAt" in query and "SELECT TOP @limit c.id, c.title" in query
+    assert parameters == {"@limit": 3, "@updatedAt": "2024-01-08", "@id": "conv-1"} and partition_key == "user-1"
+
+
+def test_malformed_cursors_are_rejected():
+    assert decode_cursor(encode_cursor({"updatedAt": "2024-01-01", "id": "conv-1"})) == ("2024-01-01", "conv-1")
+    for cursor in ["not a cursor", encode_cursor({"updatedAt": 1, "id": "conv-1"})]:
+        with pytest.raises(ValueError):
+            decode_cursor(cursor)
@@ -0,0 +1,60 @@
+import json
+
+import app
+from backend.clients.deployments import Deployment, DeploymentPool
+from backend.settings import AppSettings
+from benchmarks.stubs import StubServer, send_chunked, send_json, with_data_events
+
+
+def test_conversation_fails_over_from_a_throttled_deployment(monkeypatch):
+    monkeypatch.setattr(app, "should_use_data", lambda: True)
+    monkeypatch.setattr(app, "app_settings", AppSettings.from_env({
+        "AZURE_SEARCH_SERVICE": "contoso-search", "AZURE_SEARCH_INDEX": "handbook", "AZURE_SEARCH_KEY": "search-key"}))
+
+    def throttled(handler):
+        send_json(handler, 429, {"error": {"code": "429", "message": "Rate limit is exceeded."}}, headers={"Retry-After": "30"})
+
+    routes = {
+        ("POST", "/openai/deployments/busy/extensions/chat/completions"): throttled,
+        ("POST", "/openai/deployments/free/extensions/chat/completions"): lambda handler: send_chunked(handler, with_data_events(["Hi", "!"])),
+    }
+    with StubServer(routes) as stub:
+        pool = DeploymentPool([Deployment("busy", stub.url, "key-1", "busy"), Deployment("free", stub.url, "key-2", "free")])
+        monkeypatch.setattr(app, "chat_deployments", pool)
+        bodies = []
+        for _ in range(2):
+            request_body = {"messages": [{"role": "user", "content": "Hi"}]}
+            with app.app.test_request_context("/conversation", method="POST", json=request_body):
+                bodies.append(app.conversation_internal(request_body).get_data(as_text=True))
+
+    for body in bodies:
+        lines = [json.loads(line) for line in body.splitlines()]
+        messages = [message for line in lines for message in line["choices"][0]["messages"]]
+        assert "".join(message["content"] for message in messages if message["role"] == "assistant") == "Hi!"
+    # the throttled deployment sits out its Retry-After, the second request goes straight to the other one
+    assert [path.split("/")[3] for _, path, _ in stub.requests] == ["busy", "free", "free"]
+    snapshot = pool.snapshot()
+    assert snapshot["failovers"] == 1
+    assert snapshot["deployments"]["busy"]["throttled"] == 1 and not snapshot["deployments"]["busy"]["available"]
+    assert snapshot["deployments"]["free"]["successes"] == 2 and snapshot["deployments"]["free"]["outstanding"] == 0
+
+
+def test_token_aware_routing_and_cooldown():
+    now = [0.0]
+    small, large = Deployment("small", "https://small", "k", "gpt", tpm=10000), Deployment("large", "https://large", "k", "gpt", tpm=40000)
+    pool = DeploymentPool([small, large], routing="token_aware", cooldown_seconds=5, clock=lambda: now[0])
+
+    picks = []
+    for _ in range(5):
+        lease = pool.acquire(tokens=2000)
+        picks.append(lease.deployment.name)
+        lease.release()
+    # 4x the capacity takes 4x the tokens
+    assert picks.count("large") == 4 and picks.count("small") == 1
+
+    lease = pool.acquire(tokens=2000)
+    assert lease.deployment is large
+    lease.release(TimeoutError())
+    assert pool.acquire().deployment is small
+    now[0] = 61.0
+    assert pool.acquire().deployment is large
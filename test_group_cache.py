@@ -0,0 +1,70 @@
+import base64
+import json
+import threading
+
+import app
+from backend.cache.group_cache import GroupMembershipCache, token_subject
+from benchmarks.stubs import StubServer, send_json
+
+
+def _token(oid, nonce="1"):
+    payload = base64.urlsafe_b64encode(json.dumps({"tid": "t1", "oid": oid, "nonce": nonce}).encode()).rstrip(b"=")
+    return f"header.{payload.decode()}.signature"
+
+
+def test_concurrent_lookups_share_one_fetch_and_filter_is_cached():
+    release = threading.Event()
+    calls = []
+
+    def fetch(token):
+        calls.append(token)
+        release.wait(5)
+        return [{"id": "g1"}, {"id": "g2"}]
+
+    cache = GroupMembershipCache(fetch)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.groups(_token("alice")))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    built = []
+    def build(groups):
+        built.append(groups)
+        return ",".join(group["id"] for group in groups)
+
+    assert cache.filter_string(_token("alice"), build) == cache.filter_string(_token("alice"), build) == "g1,g2"
+    assert len(calls) == 1 and len(built) == 1
+    assert results == [[{"id": "g1"}, {"id": "g2"}]] * 5
+    assert token_subject(_token("alice")) == "t1/alice"
+
+
+def test_new_token_or_expired_entry_is_fetched_again():
+    now = [0.0]
+    calls = []
+    cache = GroupMembershipCache(lambda token: calls.append(token) or [], ttl_seconds=60, clock=lambda: now[0])
+
+    cache.groups(_token("alice"))
+    cache.groups(_token("alice", nonce="forged"))
+    now[0] = 61
+    cache.groups(_token("alice", nonce="forged"))
+    assert len(calls) == 3
+    assert cache.snapshot()["entries"] == 1
+
+
+def test_group_pages_are_followed_iteratively(monkeypatch):
+    def page(handler, groups, next_path=None):
+        body = {"value": [{"id": group} for group in groups]}
+        if next_path:
+            body["@odata.nextLink"] = f"{stub.url}{next_path}"
+        send_json(handler, 200, body)
+
+    routes = {
+        ("GET", "/me/transitiveMemberOf"): lambda handler: page(handler, ["g1", "g2"], "/page2"),
+        ("GET", "/page2"): lambda handler: page(handler, ["g3"]),
+    }
+    with StubServer(routes) as stub:
+        monkeypatch.setattr(app, "GRAPH_MEMBER_OF_ENDPOINT", f"{stub.url}/me/transitiveMemberOf")
+        assert [group["id"] for group in app.fetchUserGroupPages("token")] == ["g1", "g2", "g3"]
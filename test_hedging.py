@@ -0,0 +1,132 @@
+import asyncio
+import json
+import time
+
+import app
+from backend.clients.deployments import Deployment, DeploymentPool
+from backend.clients.hedging import Hedger
+from benchmarks.stubs import StubServer, chat_completion_events, send_chunked
+
+
+def test_slow_stream_is_hedged_to_another_deployment(monkeypatch):
+    monkeypatch.setattr(app, "should_use_data", lambda: False)
+    hedger = Hedger(default_delay_seconds=0.05, budget_percent=100)
+    monkeypatch.setattr(app, "hedger", hedger)
+
+    def slow(handler):
+        time.sleep(1)
+        send_chunked(handler, chat_completion_events(["Late"]))
+
+    routes = {
+        ("POST", "/openai/deployments/slow/chat/completions"): slow,
+        ("POST", "/openai/deployments/fast/chat/completions"): lambda handler: send_chunked(handler, chat_completion_events(["Hello", "!"])),
+    }
+    with StubServer(routes) as stub:
+        pool = DeploymentPool([Deployment("slow", stub.url, "key", "slow"), Deployment("fast", stub.url, "key", "fast")])
+        monkeypatch.setattr(app, "chat_deployments", pool)
+        request_body = {"messages": [{"role": "user", "content": "Hi"}]}
+        with app.app.test_request_context("/conversation", method="POST", json=request_body):
+            body = app.conversation_internal(request_body).get_data(as_text=True)
+
+        assert "".join(json.loads(line)["choices"][0]["messages"][0]["content"] for line in body.splitlines()) == "Hello!"
+        assert sorted(path.split("/")[3] for _, path, _ in stub.requests) == ["fast", "slow"]
+        # the losing stream is closed and released once its first chunk comes
+        time.sleep(1.5)
+
+    stats = hedger.snapshot()
+    assert stats["hedged"] == 1 and stats["hedge_wins"] == 1 and stats["primary_wins"] == 0
+    assert all(deployment["outstanding"] == 0 for deployment in pool.snapshot()["deployments"].values())
+
+
+def test_hedges_stay_within_the_budget():
+    hedger = Hedger(default_delay_seconds=0.01, budget_percent=50)
+    pool = DeploymentPool([Deployment("a", "https://a", "k", "gpt"), Deployment("b", "https://b", "k", "gpt")])
+
+    async def slow(deployment):
+        await asyncio.sleep(0.05)
+        return ["primary"]
+
+    async def fast(deployment):
+        return ["hedge"]
+
+    async def chunks(result):
+        for chunk in result:
+            yield chunk
+
+    async def request():
+        _, lease, stream = await hedger.astart(lambda picked: pool.astart(slow, picked=picked),
+                                               lambda exclude: pool.astart(fast, exclude=exclude), chunks)
+        lease.release()
+        return [chunk async for chunk in stream]
+
+    async def requests():
+        return [await request() for _ in range(4)]
+
+    answers = asyncio.run(requests())
+
+    # every other request may be hedged: the first is not, the second is and wins
+    assert answers == [["primary"], ["hedge"], ["primary"], ["hedge"]]
+    stats = hedger.snapshot()
+    assert stats["hedged"] == 2 and stats["hedge_wins"] == 2 and stats["budget_denied"] == 2
+    assert all(deployment["outstanding"] == 0 for deployment in pool.snapshot()["deployments"].values())
+
+
+def test_cancelled_requests_release_their_deployments():
+    hedger = Hedger(default_delay_seconds=0.01, budget_percent=100)
+    pool = DeploymentPool([Deployment("a", "https://a", "k", "gpt"), Deployment("b", "https://b", "k", "gpt")])
+
+    async def slow(deployment):
+        await asyncio.sleep(0.05)
+        return ["Hello"]
+
+    async def chunks(result):
+        yield "Hello"
+
+    async def request():
+        task = asyncio.create_task(hedger.astart(lambda picked: pool.astart(slow, picked=picked),
+                                                 lambda exclude: pool.astart(slow, exclude=exclude), chunks))
+        # the client goes away while both streams are on their way to their first chunk
+        await asyncio.sleep(0.03)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        await asyncio.sleep(0.1)
+
+    asyncio.run(request())
+
+    assert hedger.snapshot()["hedged"] == 1
+    assert all(deployment["outstanding"] == 0 for deployment in pool.snapshot()["deployments"].values())
+
+
+def test_streams_that_came_before_the_cancellation_are_closed():
+    hedger = Hedger(default_delay_seconds=1)
+    pool = DeploymentPool([Deployment("a", "https://a", "k", "gpt")])
+    closed = []
+
+    class Response():
+        async def aclose(self):
+            closed.append(self)
+
+    async def start(deployment):
+        return Response()
+
+    async def chunks(result):
+        yield "Hello"
+
+    async def request():
+        task = asyncio.create_task(hedger.astart(lambda picked: pool.astart(start, picked=picked), None, chunks))
+        # the first chunk is in, but the handler is cancelled before it is woken up
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(request())
+
+    assert len(closed) == 1
+    assert pool.snapshot()["deployments"]["a"]["outstanding"] == 0
@@ -0,0 +1,132 @@
+from backend.cache.history_cache import (
+    CachingConversationStore,
+    HistoryCache,
+    MemoryHistoryCacheBackend,
+    RedisHistoryCacheBackend,
+)
+from backend.history.memory_store import InMemoryConversationStore
+from backend.history.write_behind import WriteBehindStore
+
+
+class CountingStore(InMemoryConversationStore):
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def get_conversations(self, *args, **kwargs):
+        self.reads += 1
+        return super().get_conversations(*args, **kwargs)
+
+    def get_messages(self, *args, **kwargs):
+        self.reads += 1
+        return super().get_messages(*args, **kwargs)
+
+
+class FakeRedis():
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value.encode("utf-8") if isinstance(value, str) else value
+        return True
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline():
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, *args, **kwargs):
+        self.commands.append(lambda: self.client.set(*args, **kwargs))
+
+    def get(self, key):
+        self.commands.append(lambda: self.client.get(key))
+
+    def execute(self):
+        return [command() for command in self.commands]
+
+
+def test_reads_are_cached_until_a_write_changes_them():
+    inner = CountingStore()
+    store = CachingConversationStore(inner, HistoryCache(MemoryHistoryCacheBackend()))
+    conversation = store.create_conversation("user-1", "Vacation")
+
+    assert len(store.get_conversations("user-1", 25)) == 1
+    assert store.get_messages("user-1", conversation["id"]) == []
+    store.get_conversations("user-1", 25)
+    store.get_messages("user-1", conversation["id"])
+    assert inner.reads == 2
+
+    store.create_message(conversation["id"], "user-1", {"role": "user", "content": "Hi"})
+    assert [message["content"] for message in store.get_messages("user-1", conversation["id"])] == ["Hi"]
+    assert store.get_conversations("user-1", 25)[0]["updatedAt"] > conversation["updatedAt"]
+    assert inner.reads == 4
+
+    renamed = store.get_conversation("user-1", conversation["id"])
+    renamed["title"] = "Time off"
+    assert store.get_conversation("user-1", conversation["id"])["title"] == "Vacation"
+    store.upsert_conversation(renamed)
+    assert store.get_conversation("user-1", conversation["id"])["title"] == "Time off"
+
+    message_ids, conversation_ids = store.get_history_item_ids("user-1")
+    store.delete_history("user-1", message_ids, conversation_ids)
+    assert store.get_conversations("user-1", 25) == [] and store.get_messages("user-1", conversation["id"]) == []
+    assert store.cache.snapshot()["hits"] == 3
+
+
+def test_write_behind_flushes_invalidate_the_cache_below_it():
+    # stacked as app.py does with HISTORY_CACHE_ENABLED and HISTORY_WRITE_BEHIND
+    inner = InMemoryConversationStore()
+    store = WriteBehindStore(CachingConversationStore(inner, HistoryCache(MemoryHistoryCacheBackend())), flush_interval_seconds=60)
+    a = store.create_conversation("user-1", "A")
+    b = store.create_conversation("user-1", "B")
+    store.create_message(b["id"], "user-1", {"role": "user", "content": "Hi"})
+    store.flush()
+    assert [conversation["id"] for conversation in store.get_conversations("user-1", 25)] == [b["id"], a["id"]]
+
+    # listed while the message is queued, the store's order is cached
+    store.create_message(a["id"], "user-1", {"role": "user", "content": "Hello"})
+    assert [conversation["id"] for conversation in store.get_conversations("user-1", 25)] == [b["id"], a["id"]]
+    assert [message["content"] for message in store.get_messages("user-1", a["id"])] == ["Hello"]
+
+    store.close()
+    assert [conversation["id"] for conversation in store.get_conversations("user-1", 25)] == [a["id"], b["id"]]
+    assert [message["content"] for message in store.get_messages("user-1", a["id"])] == ["Hello"]
+
+
+def test_instances_sharing_a_redis_backend_see_each_others_writes():
+    inner = CountingStore()
+    redis = FakeRedis()
+    first = CachingConversationStore(inner, HistoryCache(RedisHistoryCacheBackend(None, client=redis)))
+    second = CachingConversationStore(inner, HistoryCache(RedisHistoryCacheBackend(None, client=redis)))
+
+    conversation = first.create_conversation("user-1", "Vacation")
+    first.get_messages("user-1", conversation["id"])
+    assert second.get_messages("user-1", conversation["id"]) == [] and inner.reads == 1
+
+    second.create_message(conversation["id"], "user-1", {"role": "user", "content": "Hi"})
+    assert [message["content"] for message in first.get_messages("user-1", conversation["id"])] == ["Hi"]
+
+
+def test_lru_eviction_only_causes_misses():
+    backend = MemoryHistoryCacheBackend(max_entries=2)
+    cache = HistoryCache(backend)
+    values = iter(range(100))
+
+    assert cache.read_through(["user:a"], "x", lambda: next(values)) == 0
+    assert cache.read_through(["user:a"], "x", lambda: next(values)) == 0
+    for scope in ["user:b", "user:c"]:
+        cache.read_through([scope], "y", lambda: next(values))
+    assert len(backend) == 2
+    assert cache.read_through(["user:a"], "x", lambda: next(values)) == 3
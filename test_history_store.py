@@ -0,0 +1,213 @@
+import asyncio
+
+import pytest
+from azure.cosmos import exceptions
+
+import app
+import asgi
+from backend.history.memory_store import InMemoryConversationStore
+from backend.history.sqlite_store import SqliteConversationStore
+from backend.history.store import AsyncConversationStore
+from backend.history.stream_tee import StreamTee
+from backend.history.titles import TitleWorker, provisional_title
+from backend.history.write_behind import WriteBehindStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryConversationStore()
+    return SqliteConversationStore(str(tmp_path / "history.db"))
+
+
+def test_messages_are_kept_in_order_per_user(store):
+    conversation = store.create_conversation("user-1", "Vacation")
+    store.create_messages(conversation["id"], "user-1", [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}])
+    store.create_message(conversation["id"], "user-1", {"role": "user", "content": "Thanks"})
+
+    assert [message["content"] for message in store.get_messages("user-1", conversation["id"])] == ["Hi", "Hello", "Thanks"]
+    assert store.get_conversation("user-2", conversation["id"]) is None
+    assert store.get_messages("user-2", conversation["id"]) == []
+    assert store.get_conversation("user-1", conversation["id"])["updatedAt"] > conversation["updatedAt"]
+
+
+def test_conversations_are_listed_newest_first_by_offset_and_cursor(store):
+    ids = [store.create_conversation("user-1", f"Conversation {i}")["id"] for i in range(5)]
+    store.create_message(ids[0], "user-1", {"role": "user", "content": "Hi"})
+    newest_first = [ids[0]] + ids[:0:-1]
+
+    assert [conversation["id"] for conversation in store.get_conversations("user-1", limit=2, offset=2)] == newest_first[2:4]
+    assert set(store.get_conversations("user-1", limit=1)[0]) == {"id", "title", "createdAt", "updatedAt"}
+
+    pages, cursor = [], None
+    while True:
+        page, cursor = store.get_conversations_page("user-1", 2, cursor)
+        pages.append([conversation["id"] for conversation in page])
+        if not cursor:
+            break
+    assert pages == [newest_first[:2], newest_first[2:4], newest_first[4:]]
+
+
+def test_rename_and_delete_history(store):
+    conversation = store.create_conversation("user-1", "Old")
+    store.create_messages(conversation["id"], "user-1", [{"role": "user", "content": "Hi"}])
+    conversation["title"] = "New"
+    store.upsert_conversation(conversation)
+    assert store.get_conversation("user-1", conversation["id"])["title"] == "New"
+    store.set_title("user-1", conversation["id"], "Newer")
+    assert store.get_conversations("user-1", 10)[0]["title"] == "Newer"
+    assert store.set_title("user-2", conversation["id"], "Stolen") is None
+    store.set_summary("user-1", conversation["id"], {"content": "Said hi", "messages": 1, "digest": "d"})
+    assert store.get_conversation("user-1", conversation["id"])["summary"]["content"] == "Said hi"
+    assert "summary" not in store.get_conversations("user-1", 10)[0]
+
+    other = store.create_conversation("user-2", "Other")
+    message_ids, conversation_ids = store.get_history_item_ids("user-1")
+    progress = []
+    assert store.delete_history("user-1", message_ids, conversation_ids, progress=progress.append) == 2
+    assert sum(progress) == 2
+    assert store.get_history_item_ids("user-1") == ([], [])
+    assert store.get_conversation("user-2", other["id"]) is not None
+
+
+def test_history_endpoints_run_on_a_local_store(monkeypatch):
+    monkeypatch.setenv("JWT_AUTH_DISABLED", "true")
+    store = InMemoryConversationStore()
+    monkeypatch.setattr(asgi, "conversation_store", AsyncConversationStore(store))
+    conversation_ids = [store.create_conversation("user-1", f"Conversation {i}")["id"] for i in range(30)]
+    store.create_message(conversation_ids[0], "user-1", {"role": "user", "content": "Hi"})
+
+    async def run():
+        client = asgi.app.test_client()
+        headers = {"x-auth-request-email": "user-1"}
+        first = await client.get("/history/list?cursor=", headers=headers)
+        second = await client.get(f"/history/list?cursor={first.headers['X-Next-Cursor']}", headers=headers)
+        read = await client.post("/history/read", json={"conversation_id": conversation_ids[0]}, headers=headers)
+        return await first.get_json(), await second.get_json(), second.headers, await read.get_json()
+
+    first, second, second_headers, read = asyncio.run(run())
+    assert len(first) == 25 and first[0]["id"] == conversation_ids[0]
+    assert len(second) == 5 and "X-Next-Cursor" not in second_headers
+    assert [message["content"] for message in read["messages"]] == ["Hi"]
+
+
+def test_flask_history_endpoints_run_through_the_auth_decorator(monkeypatch):
+    monkeypatch.setenv("JWT_AUTH_DISABLED", "true")
+    store = InMemoryConversationStore()
+    monkeypatch.setattr(app, "conversation_store", store)
+    conversation = store.create_conversation("user-1", "Hello")
+    store.create_message(conversation["id"], "user-1", {"role": "user", "content": "Hi"})
+
+    client = app.app.test_client()
+    headers = {"x-auth-request-email": "user-1"}
+    listed = client.get("/history/list", headers=headers)
+    read = client.post("/history/read", json={"conversation_id": conversation["id"]}, headers=headers)
+
+    assert listed.status_code == 200 and [item["id"] for item in listed.json] == [conversation["id"]]
+    assert [message["content"] for message in read.json["messages"]] == ["Hi"]
+
+
+def test_titles_are_generated_after_the_conversation_is_created():
+    store = AsyncConversationStore(InMemoryConversationStore())
+    worker = TitleWorker(max_workers=1, max_pending=2)
+    messages = [{"role": "user", "content": "Where   should we go on vacation this summer with two kids and a dog, ideally by train?"}]
+    title = provisional_title(messages)
+    assert title == "Where should we go on vacation this summer with two kids and..."
+
+    async def generate(conversation_messages):
+        await asyncio.sleep(0.01)
+        return "Family train vacation" if "dog" in conversation_messages[0]["content"] else None
+
+    async def run():
+        generated = await store.create_conversation("user-1", title)
+        failed = await store.create_conversation("user-1", "Hi")
+        assert worker.aschedule(generate, store, "user-1", generated["id"], messages, title)
+        assert worker.aschedule(generate, store, "user-1", failed["id"], [{"role": "user", "content": "Hi"}], "Hi")
+        assert not worker.aschedule(generate, store, "user-1", failed["id"], messages, "Hi")
+        await asyncio.gather(*worker._tasks)
+        return [conversation["title"] for conversation in await store.get_conversations("user-1", 10, "ASC")]
+
+    assert asyncio.run(run()) == ["Family train vacation", "Hi"]
+    assert worker.snapshot() == {"scheduled": 2, "generated": 1, "kept": 1, "failed": 0, "rejected": 1, "pending": 0}
+
+
+def test_streamed_answers_are_written_even_when_the_client_goes_away(monkeypatch):
+    store = InMemoryConversationStore()
+    tee = StreamTee()
+    monkeypatch.setattr(asgi, "conversation_store", AsyncConversationStore(store))
+    monkeypatch.setattr(asgi, "stream_tee", tee)
+    conversation = store.create_conversation("user-1", "Vacation")
+
+    async def answer(transcript):
+        for text in ["Pack ", "light", "."]:
+            transcript.add_content(text)
+            yield text.encode("utf-8")
+            await asyncio.sleep(0)
+
+    async def run():
+        transcript = tee.transcript()
+        stream = asgi.persist_stream(answer(transcript), transcript, "user-1", conversation["id"])
+        first = await stream.__anext__()
+        await stream.aclose()
+        await asyncio.gather(*asgi.background_tasks)
+        return first
+
+    assert asyncio.run(run()) == b"Pack "
+    assert store.get_messages("user-1", conversation["id"])[-1]["content"] == "Pack light."
+
+    # the post of the frontend is then skipped
+    monkeypatch.setenv("JWT_AUTH_DISABLED", "true")
+    update = {"conversation_id": conversation["id"], "messages": [{"role": "user", "content": "Tips?"}, {"role": "assistant", "content": "Pack light."}]}
+
+    async def post():
+        response = await asgi.app.test_client().post("/history/update", json=update, headers={"x-auth-request-email": "user-1"})
+        return response.status_code
+
+    assert asyncio.run(post()) == 200
+    assert len(store.get_messages("user-1", conversation["id"])) == 1
+    assert tee.snapshot()["persisted"] == 1 and tee.snapshot()["duplicates_skipped"] == 1
+
+
+class FlakyStore(InMemoryConversationStore):
+    def __init__(self, failures=0):
+        super().__init__()
+        self.failures = failures
+        self.saves = []
+
+    def save_messages(self, conversation_id, user_id, messages):
+        if self.failures:
+            self.failures -= 1
+            raise exceptions.CosmosHttpResponseError(status_code=429, message="Request rate is large")
+        self.saves.append([message["content"] for message in messages])
+        return super().save_messages(conversation_id, user_id, messages)
+
+
+def test_write_behind_coalesces_per_conversation_and_reads_its_writes():
+    inner = FlakyStore(failures=1)
+    delays = []
+    store = WriteBehindStore(inner, flush_interval_seconds=60, sleep=delays.append)
+    conversation = store.create_conversation("user-1", "Vacation")
+    store.create_message(conversation["id"], "user-1", {"role": "user", "content": "Hi"})
+    store.create_messages(conversation["id"], "user-1", [{"role": "tool", "content": "{}"}, {"role": "assistant", "content": "Hello"}])
+
+    assert [message["content"] for message in store.get_messages("user-1", conversation["id"])] == ["Hi", "{}", "Hello"]
+    assert inner.get_messages("user-1", conversation["id"]) == []
+
+    store.close()
+    assert inner.saves == [["Hi", "{}", "Hello"]]
+    assert len(delays) == 1 and store.snapshot()["retries"] == 1 and store.snapshot()["pending"] == 0
+
+
+def test_write_behind_writes_synchronously_when_full_and_drops_deleted_conversations():
+    inner = FlakyStore()
+    store = WriteBehindStore(inner, max_pending=2, flush_interval_seconds=60)
+    conversation = store.create_conversation("user-1")
+    store.create_messages(conversation["id"], "user-1", [{"role": "user", "content": "1"}, {"role": "assistant", "content": "2"}])
+    store.create_message(conversation["id"], "user-1", {"role": "user", "content": "3"})
+    assert inner.saves == [["1", "2", "3"]]
+
+    deleted = store.create_conversation("user-1")
+    store.create_message(deleted["id"], "user-1", {"role": "user", "content": "gone"})
+    store.delete_messages(deleted["id"], "user-1")
+    store.close()
+    assert inner.saves == [["1", "2", "3"]] and store.snapshot()["discarded"] == 1
@@ -0,0 +1,147 @@
+import asyncio
+import json
+
+import httpx
+import openai
+import pytest
+
+import app
+import asgi
+from backend.cache.response_cache import AnswerRecorder, MemoryCacheBackend, RedisCacheBackend, ResponseCache, _unit_vector, replay_stream
+from benchmarks.stubs import chat_completion_events
+
+
+def _cache(clock, **kwargs):
+    return ResponseCache(MemoryCacheBackend(max_entries=2, clock=clock), ttl_seconds=60, **kwargs)
+
+
+def test_exact_hits_ignore_case_whitespace_and_punctuation():
+    now = [0.0]
+    cache = _cache(lambda: now[0])
+    key = cache.key("scope", [{"role": "user", "content": "How many vacation days do I get?"}])
+    cache.put(key, {"messages": [{"role": "assistant", "content": "15"}]})
+
+    same = cache.key("scope", [{"role": "user", "content": "  how many vacation   days do I get"}])
+    other_scope = cache.key("other scope", [{"role": "user", "content": "How many vacation days do I get?"}])
+    assert cache.get(same)["messages"][0]["content"] == "15"
+    assert cache.get(other_scope) is None
+
+    now[0] = 61
+    assert cache.get(same) is None
+    assert cache.snapshot()["exact_hits"] == 1
+
+
+def test_follow_ups_of_different_conversations_do_not_collide():
+    cache = _cache(lambda: 0.0, similarity_threshold=0.5)
+    follow_up = {"role": "user", "content": "And the second one?"}
+    holidays = [{"role": "user", "content": "Which holidays do we have?"}, {"role": "assistant", "content": "New Year and Easter."}, follow_up]
+    benefits = [{"role": "user", "content": "Which benefits do we have?"}, {"role": "assistant", "content": "Gym and lunch."}, follow_up]
+
+    cache.put(cache.key("scope", holidays), {"messages": [{"role": "assistant", "content": "Easter."}]}, embedding=[1.0, 0.0])
+    assert cache.get(cache.key("scope", benefits)) is None
+    assert cache.get_similar(cache.key("scope", benefits), [1.0, 0.0]) is None
+    assert cache.get(cache.key("scope", [dict(message) for message in holidays])) is not None
+
+
+def test_similarity_hits_within_scope_and_lru_eviction():
+    cache = _cache(lambda: 0.0, similarity_threshold=0.9)
+    first = cache.key("scope", [{"role": "user", "content": "vacation days"}])
+    cache.put(first, {"messages": []}, embedding=[1.0, 0.0, 0.0])
+
+    close = cache.key("scope", [{"role": "user", "content": "days of vacation"}])
+    assert cache.get_similar(close, [0.95, 0.1, 0.0]) is not None
+    assert cache.get_similar(close, [0.0, 1.0, 0.0]) is None
+
+    cache.put(cache.key("scope", [{"role": "user", "content": "b"}]), {"messages": []})
+    cache.put(cache.key("scope", [{"role": "user", "content": "c"}]), {"messages": []})
+    assert cache.get(first) is None
+
+
+def test_similarity_lookups_compare_the_newest_candidates_of_the_scope():
+    now = [0.0]
+    backend = MemoryCacheBackend(clock=lambda: now[0], max_candidates=2)
+    backend.put("old", {"answer": "old"}, 60, "scope", _unit_vector([1.0, 0.0]))
+    now[0] += 30
+    backend.put("newer", {"answer": "newer"}, 60, "scope", _unit_vector([0.8, 0.2]))
+    backend.put("newest", {"answer": "newest"}, 60, "scope", _unit_vector([0.0, 1.0]))
+    backend.put("elsewhere", {"answer": "elsewhere"}, 60, "other", _unit_vector([1.0, 0.0]))
+
+    # the exact match is older than the two newest of its scope and is not compared
+    assert backend.nearest("scope", _unit_vector([1.0, 0.0]), 0.5) == {"answer": "newer"}
+    now[0] += 60
+    assert backend.nearest("scope", _unit_vector([1.0, 0.0]), 0.5) is None
+
+
+def test_redis_similarity_skips_evicted_and_expired_answers():
+    fakeredis = pytest.importorskip("fakeredis")
+    now = [1000.0]
+    backend = RedisCacheBackend(None, client=fakeredis.FakeRedis(), max_candidates=2, clock=lambda: now[0])
+    backend.put("best", {"answer": "best"}, 60, "scope", _unit_vector([1.0, 0.0]))
+    backend.put("second", {"answer": "second"}, 60, "scope", _unit_vector([0.9, 0.1]))
+
+    # the most similar answer was evicted by the server, the next best is served
+    backend.client.delete(backend._entry_key("best"))
+    assert backend.nearest("scope", _unit_vector([1.0, 0.0]), 0.9) == {"answer": "second"}
+    # only the newest max_candidates are kept per scope, expired ones are dropped on lookup
+    backend.put("third", {"answer": "third"}, 60, "scope", _unit_vector([0.0, 1.0]))
+    assert backend.client.zcard(backend._scope_key("scope")) == 2
+    now[0] += 61
+    assert backend.nearest("scope", _unit_vector([0.0, 1.0]), 0.9) is None
+    assert backend.client.zcard(backend._scope_key("scope")) == 0
+
+
+def test_recorded_stream_replays_in_the_same_format():
+    recorder = AnswerRecorder()
+    for line in (b'{"model":"gpt-4","object":"chunk","choices":[{"messages":[{"role":"tool","content":"{}"}]}]}\n',
+                 b'{"model":"gpt-4","object":"chunk","choices":[{"messages":[{"role":"assistant","content":"Hel"}]}]}\n'
+                 b'{"model":"gpt-4","object":"chunk","choices":[{"messages":[{"role":"assistant","content":"lo"}]}]}\n'):
+        recorder.feed(line)
+    answer = recorder.answer()
+
+    lines = [json.loads(line) for line in replay_stream(answer, {"conversation_id": "c2"}).splitlines()]
+    assert [line["choices"][0]["messages"][0] for line in lines] == [
+        {"role": "tool", "content": "{}"},
+        {"role": "assistant", "content": ""},
+        {"role": "assistant", "content": "Hello"},
+    ]
+    assert lines[-1]["history_metadata"] == {"conversation_id": "c2"}
+
+    failed = AnswerRecorder()
+    failed.feed(b'{"error":"upstream failed"}\n')
+    assert failed.answer() is None
+
+
+def test_asgi_conversation_is_served_from_cache(monkeypatch):
+    monkeypatch.setenv("JWT_AUTH_DISABLED", "true")
+    monkeypatch.setattr(asgi, "should_use_data", lambda: False)
+    cache = ResponseCache(MemoryCacheBackend())
+    # the key/store helpers are shared with the WSGI app
+    monkeypatch.setattr(app, "response_cache", cache)
+    monkeypatch.setattr(asgi, "response_cache", cache)
+    upstream_calls = []
+
+    def handler(request):
+        upstream_calls.append(request)
+        return httpx.Response(200, content=b"".join(chat_completion_events(["Fifteen", " days"])),
+                              headers={"content-type": "text/event-stream"})
+
+    async def run():
+        client = openai.AsyncAzureOpenAI(api_key="key", azure_endpoint="https://example.openai.azure.com",
+                                         api_version="2023-08-01-preview",
+                                         http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        monkeypatch.setattr(asgi, "get_openai_client", lambda api_version, deployment=None: client)
+
+        test_client = asgi.app.test_client()
+        bodies = []
+        for question in ("Vacation days?", "vacation days"):
+            response = await test_client.post("/conversation", json={"messages": [{"role": "user", "content": question}]})
+            bodies.append(await response.get_data(as_text=True))
+        return bodies
+
+    first, second = asyncio.run(run())
+
+    def answer(body):
+        return "".join(json.loads(line)["choices"][0]["messages"][0]["content"] for line in body.splitlines())
+    assert len(upstream_calls) == 1
+    assert cache.snapshot()["exact_hits"] == 1
+    assert answer(first) == answer(second) == "Fifteen days"
@@ -0,0 +1,112 @@
+import json
+
+import pytest
+import requests
+
+import app
+from backend.clients.deployments import Deployment, DeploymentPool
+from backend.clients.retry import CircuitOpenError, Deadline, RetryPolicy, UpstreamStatusError, retry_after_seconds, status_error
+from benchmarks.stubs import StubServer, bing_search, chat_completion_events, faulty, send_chunked, send_json
+
+
+class FakeTime():
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_retries_transient_faults_honouring_retry_after():
+    fake = FakeTime()
+    policy = RetryPolicy(max_attempts=4, base_delay_seconds=0.5, clock=fake.clock, sleep=fake.sleep)
+    faults = [503, "drop", (429, {"Retry-After": "7"})]
+    with StubServer({("GET", "/v7.0/search"): faulty(bing_search, faults)}) as stub:
+        response = policy.call("bing", lambda: requests.get(f"{stub.url}/v7.0/search?q=contoso", timeout=5), failed=status_error)
+
+    assert response.status_code == 200 and len(stub.requests) == 4
+    # backoff with jitter below base * 2^(attempt - 1), then the Retry-After plus jitter
+    assert fake.sleeps[0] <= 0.5 and fake.sleeps[1] <= 1.0 and 7 <= fake.sleeps[2] <= 7.5
+    stats = policy.snapshot()["bing"]
+    assert stats["retries"] == 3 and stats["failed"] == 3 and stats["breaker_state"] == "closed"
+
+
+def test_gives_up_at_the_deadline_and_opens_the_breaker():
+    fake = FakeTime()
+    policy = RetryPolicy(max_attempts=3, breaker_failures=3, breaker_reset_seconds=30, clock=fake.clock, sleep=fake.sleep)
+    throttled = [(429, {"Retry-After": "20"})] * 4
+    with StubServer({("GET", "/v7.0/search"): faulty(bing_search, throttled)}) as stub:
+        url = f"{stub.url}/v7.0/search?q=contoso"
+        # a Retry-After past the deadline is not waited for, the 429 is returned as is
+        response = policy.call("bing", lambda: requests.get(url, timeout=5), failed=status_error, deadline=Deadline(10, fake.clock))
+        assert response.status_code == 429 and fake.sleeps == []
+
+        response = policy.call("bing", lambda: requests.get(url, timeout=5), failed=status_error)
+        assert response.status_code == 429 and len(stub.requests) == 3
+        with pytest.raises(CircuitOpenError):
+            policy.call("bing", lambda: requests.get(url, timeout=5), failed=status_error)
+        assert len(stub.requests) == 3
+
+        # after the reset time one call probes the backend, its success closes the breaker
+        fake.now += 30
+        assert policy.call("bing", lambda: requests.get(url, timeout=5), failed=status_error).status_code == 429
+        fake.now += 30
+        assert policy.call("bing", lambda: requests.get(url, timeout=5), failed=status_error).status_code == 200
+
+    stats = policy.snapshot()["bing"]
+    assert stats["short_circuited"] == 1 and stats["breaker_opened"] == 2 and stats["breaker_state"] == "closed"
+
+
+def test_conversation_retries_a_throttled_completion(monkeypatch):
+    monkeypatch.setattr(app, "should_use_data", lambda: False)
+    fake = FakeTime()
+    monkeypatch.setattr(app, "upstream_retry", RetryPolicy(clock=fake.clock, sleep=fake.sleep))
+    answer = faulty(lambda handler: send_chunked(handler, chat_completion_events(["Hello", "!"])), [(429, {"retry-after-ms": "250"})])
+    with StubServer({("POST", "/openai/deployments/gpt-4-32k/chat/completions"): answer}) as stub:
+        monkeypatch.setattr(app, "chat_deployments", DeploymentPool([Deployment("stub", stub.url, "key", "gpt-4-32k")]))
+        request_body = {"messages": [{"role": "user", "content": "Hi"}]}
+        with app.app.test_request_context("/conversation", method="POST", json=request_body):
+            body = app.conversation_internal(request_body).get_data(as_text=True)
+
+    assert "".join(json.loads(line)["choices"][0]["messages"][0]["content"] for line in body.splitlines()) == "Hello!"
+    assert len(stub.requests) == 2 and 0.25 <= fake.sleeps[0] <= 0.75
+
+
+def test_a_throttled_image_deployment_does_not_open_the_chat_breaker(monkeypatch):
+    monkeypatch.setattr(app, "should_use_data", lambda: False)
+    monkeypatch.setattr(app, "admission", None)
+    fake = FakeTime()
+    policy = RetryPolicy(max_attempts=1, breaker_failures=1, clock=fake.clock, sleep=fake.sleep)
+    monkeypatch.setattr(app, "upstream_retry", policy)
+
+    def throttled(handler):
+        send_json(handler, 429, {"error": {"code": "429", "message": "Rate limit is exceeded."}}, headers={"Retry-After": "30"})
+
+    routes = {
+        ("POST", "/openai/deployments/dall-e-3/images/generations"): throttled,
+        ("POST", "/openai/deployments/gpt-4-32k/chat/completions"): lambda handler: send_chunked(handler, chat_completion_events(["Hi"])),
+    }
+    with StubServer(routes) as stub:
+        monkeypatch.setattr(app, "image_deployments", DeploymentPool([Deployment("image", stub.url, "key", "dall-e-3")]))
+        monkeypatch.setattr(app, "chat_deployments", DeploymentPool([Deployment("chat", stub.url, "key", "gpt-4-32k")]))
+        request_body = {"messages": [{"role": "user", "content": "A lighthouse"}]}
+        with app.app.test_request_context("/dalle", method="POST", json=request_body):
+            assert app.dalle.__wrapped__({})[1] == 429
+        with app.app.test_request_context("/conversation", method="POST", json=request_body):
+            body = app.conversation_internal(request_body).get_data(as_text=True)
+
+    assert "".join(json.loads(line)["choices"][0]["messages"][0]["content"] for line in body.splitlines()) == "Hi"
+    stats = policy.snapshot()
+    assert stats["openai:image"]["breaker_state"] == "open" and stats["openai:chat"]["breaker_state"] == "closed"
+
+
+def test_retry_after_headers():
+    assert retry_after_seconds(UpstreamStatusError(429, {"retry-after-ms": "1500"})) == 1.5
+    assert retry_after_seconds(UpstreamStatusError(429, {"x-ratelimit-reset-tokens": "1m30s", "x-ratelimit-reset-requests": "250ms"})) == 90
+    assert retry_after_seconds(UpstreamStatusError(503, {"x-ratelimit-reset-tokens": "10s"})) is None
+    assert 0 <= retry_after_seconds(UpstreamStatusError(503, {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) < 1
@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+from backend.serialization import JSONProvider, load_backend
+from app import app
+
+
+CHAT_EVENT = {
+    "id": "chatcmpl-1", "model": "gpt-4", "created": 1700000000, "object": "chat.completion.chunk",
+    "choices": [{"messages": [{"role": "assistant", "content": "Grüße\n\"quoted\"   🐍"}]}],
+    "history_metadata": {"conversation_id": "c1", "stop": ("a", "b")},
+}
+
+
+@pytest.mark.parametrize("name", ["orjson", "msgspec"])
+def test_backends_match_stdlib(name):
+    try:
+        _, dumps, loads = load_backend(name)
+    except ValueError:
+        pytest.skip(f"{name} is not installed")
+    _, stdlib_dumps, _ = load_backend("json")
+
+    assert dumps(CHAT_EVENT) == stdlib_dumps(CHAT_EVENT)
+    assert b"\n" not in dumps(CHAT_EVENT)
+    assert loads(dumps(CHAT_EVENT)) == json.loads(stdlib_dumps(CHAT_EVENT))
+
+
+def test_unknown_backend_is_a_value_error():
+    with pytest.raises(ValueError, match="Unknown JSON_SERIALIZER: ojson"):
+        load_backend("ojson")
+
+
+def test_jsonify_uses_provider():
+    assert isinstance(app.json, JSONProvider)
+    with app.app_context():
+        response = app.json.response({"title": "Grüße"})
+    assert response.mimetype == "application/json"
+    assert response.get_data() == '{"title":"Grüße"}\n'.encode("utf-8")
@@ -0,0 +1,38 @@
+import json
+
+from backend.settings import AppSettings
+
+ENV = {
+    "AZURE_SEARCH_SERVICE": "contoso-search",
+    "AZURE_SEARCH_INDEX": "handbook",
+    "AZURE_SEARCH_KEY": "search-key",
+    "AZURE_SEARCH_CONTENT_COLUMNS": "content|chunk",
+    "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN": "groups",
+    "AZURE_OPENAI_STOP_SEQUENCE": "stop1|stop2",
+    "AZURE_OPENAI_KEY": "aoai-key",
+}
+
+
+def test_body_template_splices_messages_and_filter():
+    settings = AppSettings.from_env(ENV, system_message="Be helpful.")
+    messages = [{"role": "user", "content": "Wie viele Urlaubstage? ✈️"}]
+
+    body = json.loads(settings.body_template.render(messages, "groups/any(g:search.in(g, 'a, b'))"))
+
+    assert body["messages"] == messages
+    assert body["stop"] == ["stop1", "stop2"]
+    parameters = body["dataSources"][0]["parameters"]
+    assert parameters["filter"] == "groups/any(g:search.in(g, 'a, b'))"
+    assert parameters["fieldsMapping"]["contentFields"] == ["content", "chunk"]
+    assert parameters["roleInformation"] == "Be helpful."
+    assert parameters["key"] == "search-key"
+
+    redacted = json.loads(settings.redacted_body_template.render(messages, None))
+    assert redacted["dataSources"][0]["parameters"]["key"] == "*****"
+
+
+def test_no_datasource_without_search_settings():
+    settings = AppSettings.from_env({"AZURE_OPENAI_KEY": "aoai-key"})
+
+    assert settings.datasource is None
+    assert settings.body_template is None
@@ -0,0 +1,147 @@
+import asyncio
+import json
+
+from backend.history.stream_tee import StreamTranscript, already_stored
+from backend.streaming.coalesce import FLUSH, DeltaCoalescer, coalescing_requested, iterate_with_deadlines
+from backend.streaming.relay import WithDataStreamRelay
+from benchmarks.stubs import with_data_events
+
+
+def test_relay_reframes_events_split_across_reads():
+    stream = b"".join(with_data_events(["Hello", " wörld", "\n"]))
+    relay = WithDataStreamRelay(history_metadata={"conversation_id": "c1"}, apim_request_id="req-1")
+
+    output = b""
+    for i in range(0, len(stream), 7):
+        output += b"".join(relay.feed(stream[i:i + 7]))
+    output += b"".join(relay.close())
+
+    lines = [json.loads(line) for line in output.decode("utf-8").splitlines()]
+    messages = [line["choices"][0]["messages"] for line in lines]
+    assert messages == [
+        [{"role": "tool", "content": "{\"citations\": [], \"intent\": \"[]\"}"}],
+        [{"role": "assistant", "content": ""}],
+        [{"role": "assistant", "content": "Hello"}],
+        [{"role": "assistant", "content": " wörld"}],
+        [{"role": "assistant", "content": "\n"}],
+    ]
+    assert lines[-1]["id"] == "chatcmpl-stub"
+    assert lines[-1]["apim-request-id"] == "req-1"
+    assert lines[-1]["history_metadata"] == {"conversation_id": "c1"}
+
+
+def test_relay_forwards_upstream_errors():
+    relay = WithDataStreamRelay()
+
+    events = relay.feed(b'data: {"error": {"code": "429", "message": "Too many requests"}}\n\n')
+
+    assert [json.loads(event) for event in events] == [{"error": {"code": "429", "message": "Too many requests"}}]
+
+
+def test_coalescer_releases_first_delta_then_combines():
+    now = [0.0]
+    coalescer = DeltaCoalescer(max_bytes=10, window_seconds=0.05, clock=lambda: now[0])
+
+    assert coalescer.add("Hi") == "Hi"
+    assert coalescer.add(" th") is None
+    now[0] = 0.01
+    assert coalescer.add("ere") is None
+    assert coalescer.flush_timeout() == 0.04
+    now[0] = 0.06
+    assert coalescer.add("!") == " there!"
+    assert coalescer.add("0123456789") == "0123456789"
+    assert coalescer.add("tail") is None
+    assert coalescer.flush() == "tail"
+    assert coalescer.flush() is None
+
+
+def test_relay_flushes_coalesced_content_before_close():
+    stream = b"".join(with_data_events(["Hello", " wörld", "\n"]))
+    relay = WithDataStreamRelay(coalescer=DeltaCoalescer(window_seconds=60))
+
+    output = b"".join(relay.feed(stream)) + b"".join(relay.close())
+
+    messages = [json.loads(line)["choices"][0]["messages"] for line in output.decode("utf-8").splitlines()]
+    assert messages[2:] == [
+        [{"role": "assistant", "content": "Hello"}],
+        [{"role": "assistant", "content": " wörld\n"}],
+    ]
+    assert not coalescing_requested("off", True)
+    assert coalescing_requested(None, True)
+
+
+def test_relay_collects_the_answer_for_the_history():
+    transcript = StreamTranscript()
+    relay = WithDataStreamRelay(coalescer=DeltaCoalescer(window_seconds=60), transcript=transcript)
+    deltas = ["token "] * 1000
+
+    relay.feed(b"".join(with_data_events(deltas)))
+    relay.close()
+
+    messages = transcript.messages()
+    assert messages == [
+        {"role": "tool", "content": "{\"citations\": [], \"intent\": \"[]\"}"},
+        {"role": "assistant", "content": "".join(deltas)},
+    ]
+    assert already_stored([{"role": "user", "content": "Hi"}] + messages, messages)
+    assert not already_stored(messages[1:], messages)
+
+    failed = StreamTranscript()
+    WithDataStreamRelay(transcript=failed).feed(b'data: {"error": {"code": "500"}}\n\n')
+    oversized = StreamTranscript(max_chars=10)
+    oversized.add_content("0123456789")
+    oversized.add_content("!")
+    assert failed.messages() is None and oversized.messages() is None and oversized.truncated
+
+
+async def _deltas(*delays):
+    for i, delay in enumerate(delays):
+        await asyncio.sleep(delay)
+        yield i
+
+
+def test_deadlines_flush_between_slow_items_without_losing_the_read():
+    deadline = {"seconds": None}
+
+    async def consume():
+        items = []
+        async for item in iterate_with_deadlines(_deltas(0, 0.1, 0), lambda: deadline["seconds"]):
+            items.append(item)
+            # something is buffered once the first item is in, until the FLUSH
+            deadline["seconds"] = 0.02 if item is not FLUSH else None
+        return items
+
+    # the read of item 1 outlives the deadline and is not cancelled by it, and with nothing buffered
+    # after the FLUSH it is waited for without another one; item 2 comes before its deadline
+    assert asyncio.run(consume()) == [0, FLUSH, 1, 2]
+
+
+def test_deadlines_end_with_the_stream():
+    async def consume(aiterable, timeout):
+        return [item async for item in iterate_with_deadlines(aiterable, lambda: timeout)]
+
+    assert asyncio.run(consume(_deltas(), 1)) == []
+    assert asyncio.run(consume(_deltas(0, 0), None)) == [0, 1]
+    assert asyncio.run(consume(_deltas(0, 0), 1)) == [0, 1]
+
+
+def test_stopping_cancels_the_pending_read():
+    cancelled = asyncio.Event()
+
+    async def stalled():
+        yield "Hello"
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        yield "never"
+
+    async def consume():
+        items = iterate_with_deadlines(stalled(), lambda: 0.01)
+        assert [await anext(items), await anext(items)] == ["Hello", FLUSH]
+        # the consumer goes away while the next read waits upstream
+        await items.aclose()
+        await asyncio.wait_for(cancelled.wait(), 1)
+
+    asyncio.run(consume())
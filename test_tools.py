@@ -0,0 +1,103 @@
+import asyncio
+import json
+import time
+
+import httpx
+import openai
+
+import app
+import asgi
+from backend.tools.executor import Tool, ToolCall, ToolExecutor, ToolResultCache
+from backend.tools.loop import ToolLoop, trim_tool_output
+from benchmarks.stubs import StubServer, bing_search, chat_completion_events, tool_call_events
+
+
+def test_calls_run_concurrently_with_timeouts_and_cache():
+    executor = ToolExecutor({
+        "slow": Tool(lambda query: time.sleep(0.3) or f"answer to {query}", timeout_seconds=1, cache_ttl_seconds=60),
+        "stuck": Tool(lambda query: time.sleep(2), timeout_seconds=0.2),
+    }, ToolResultCache())
+
+    started = time.monotonic()
+    results = executor.run_all([ToolCall("1", "slow", '{"query": "a"}'), ToolCall("2", "slow", '{"query": "b"}'),
+                                ToolCall("3", "stuck", '{"query": "c"}'), ToolCall("4", "missing", "{}")])
+    assert time.monotonic() - started < 0.6
+    assert [result.error is None for result in results] == [True, True, False, False]
+    assert "timed out" in results[2].error
+
+    cached = executor.run_all([ToolCall("5", "slow", '{"query":  "A "}')])[0]
+    assert cached.cached and cached.content == "answer to a"
+    assert executor.snapshot()["cache_hits"] == 1
+
+
+def test_search_uses_stub_bing_and_is_cached(monkeypatch):
+    with StubServer({("GET", "/v7.0/search"): bing_search}) as stub:
+        monkeypatch.setattr(app, "BING_SEARCH_ENDPOINT", f"{stub.url}/v7.0/search")
+        executor = ToolExecutor({"search_bing": Tool(app.search, cache_ttl_seconds=60)}, ToolResultCache())
+        first, second = [executor.run_all([ToolCall(None, "search_bing", '{"query": "Contoso vacation policy"}')])[0] for _ in range(2)]
+
+    assert json.loads(first.content)[0]["title"] == "Contoso vacation policy result 0"
+    assert second.cached and len(stub.requests) == 1
+
+
+def test_asgi_streams_answer_after_parallel_tool_calls(monkeypatch):
+    monkeypatch.setenv("JWT_AUTH_DISABLED", "true")
+    monkeypatch.setattr(asgi, "should_use_data", lambda: False)
+    monkeypatch.setattr(asgi, "tool_loop", ToolLoop(ToolExecutor({"search_bing": Tool(lambda query: f"results for {query}")})))
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        if len(requests) == 1:
+            events = tool_call_events([("search_bing", '{"query": "weather Oslo"}'), ("search_bing", '{"query": "weather Bergen"}')])
+        else:
+            events = chat_completion_events(["Rainy", " in both"])
+        return httpx.Response(200, content=b"".join(events), headers={"content-type": "text/event-stream"})
+
+    async def run():
+        client = openai.AsyncAzureOpenAI(api_key="key", azure_endpoint="https://example.openai.azure.com",
+                                         api_version="2023-12-01-preview",
+                                         http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        monkeypatch.setattr(asgi, "get_openai_client", lambda api_version, deployment=None: client)
+        response = await asgi.app.test_client().post("/conversation", json={"messages": [{"role": "user", "content": "Weather?"}]})
+        return await response.get_data(as_text=True)
+
+    body = asyncio.run(run())
+
+    answer = "".join(json.loads(line)["choices"][0]["messages"][0]["content"] for line in body.splitlines())
+    assert answer == "Rainy in both"
+    followup = requests[1]["messages"]
+    assert [call["id"] for call in followup[-3]["tool_calls"]] == ["call_0", "call_1"]
+    assert [message["content"] for message in followup[-2:]] == ["results for weather Oslo", "results for weather Bergen"]
+
+
+def _chunks(events):
+    from openai.types.chat import ChatCompletionChunk
+    return [ChatCompletionChunk(**json.loads(event[len(b"data: "):])) for event in events if not event.startswith(b"data: [DONE]")]
+
+
+def test_tool_loop_runs_several_rounds_and_trims_outputs():
+    search_results = json.dumps([{"title": f"result {i}", "snippet": "x" * 100} for i in range(50)])
+    loop = ToolLoop(ToolExecutor({"search_bing": Tool(lambda query: search_results)}), max_rounds=2, max_output_chars=500)
+    rounds = []
+
+    def next_round(messages, with_tools):
+        rounds.append(with_tools)
+        if len(rounds) == 1:
+            return iter(_chunks(tool_call_events([("search_bing", '{"query": "more"}')], legacy=True)))
+        return iter(_chunks(chat_completion_events(["Done"])))
+
+    messages = [{"role": "user", "content": "Search twice"}]
+    first = iter(_chunks(tool_call_events([("search_bing", '{"query": "first"}')], legacy=True)))
+    answer = "".join(text or "" for _, text in loop.run(first, messages, next_round))
+
+    assert answer == "Done"
+    assert rounds == [True, False]
+    tool_outputs = [message["content"] for message in messages if message["role"] == "function"]
+    assert len(tool_outputs) == 2 and all(len(output) <= 500 for output in tool_outputs)
+    assert json.loads(tool_outputs[0])[0]["title"] == "result 0"
+    assert trim_tool_output("y" * 100, 20) == "y" * 8 + " [truncated]"
+
+    stats = loop.stats.snapshot()
+    assert stats["turns"] == 1 and sorted(stats["rounds"]) == ["1", "2", "3"]
+    assert stats["rounds"]["1"]["tool_calls"] == 1 and stats["rounds"]["1"]["avg_prompt_tokens"] > 0